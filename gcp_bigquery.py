@@ -33,6 +33,10 @@ BigQuery Datasets
         3. Recreate the views in the new dataset.
         4. Delete the old dataset to avoid additional storage costs.
     
+    bq_clone_dataset() runs these steps for a whole dataset: the copy jobs run concurrently, the views are recreated
+    (pointing at the new dataset) in dependency order, and a rerun with the same state_file resumes a partial clone.
+    Use delete_source=True to rename a dataset.
+    
     
 
 
@@ -93,18 +97,37 @@ To Do:
 ####################################################################################################
 
 
-import os
+# Only lightweight modules are imported here: importing this module does no I/O and does not load
+# google.cloud.bigquery, which each helper imports (once per process) on first use.
+# Credentials are found the usual way, e.g. export GOOGLE_APPLICATION_CREDENTIALS=/path/to/key.json
 
-from google.cloud import bigquery
 
-os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = '/home/dzaratsian/key.json'
+import os
+import re
+import time
+
+from gcp_bigquery_clients import get_client
+from gcp_bigquery_listing import iter_datasets, iter_project_tables, iter_tables
+from gcp_bigquery_metadata import bulk_table_metadata, get_metadata_cache, invalidate_metadata
+from gcp_bigquery_partitioning import apply_partitioning, check_partition_filter, enforce_partition_filter, partition_decorator
+from gcp_bigquery_quota import run_job
+from gcp_bigquery_telemetry import in_span_context, instrument, record_error
 
 
 ####################################################################################################
 
 
 
+# Dataset clones (https://cloud.google.com/bigquery/quotas#copy_jobs)
+CLONE_MAX_IN_FLIGHT     = 50                        # Copy jobs running at once, well under the per-project job rate limits
+CLONE_MAX_RETRIES       = 5                         # Times a copy job failing with a CLONE_RETRY_REASONS error is resubmitted
+CLONE_RETRY_REASONS     = ('rateLimitExceeded', 'quotaExceeded', 'backendError', 'internalError')
+
+
+
+
 # Create BigQuery Dataset
+@instrument
 def bq_create_dataset(dataset_id):
     '''
         Creates a BigQuery Dataset
@@ -153,65 +176,83 @@ def bq_create_dataset(dataset_id):
 
     '''
     try:
-        client               = bigquery.Client()
+        from google.cloud import bigquery
+        
+        client               = get_client()
         dataset_ref          = client.dataset(dataset_id)
         dataset_obj          = bigquery.Dataset(dataset_ref)
         dataset_obj.location = 'US'
         dataset              = client.create_dataset(dataset_obj)
+        invalidate_metadata(dataset_id)
         print('[ INFO ] Successfully created Dataset: {}'.format(dataset_id))
     except Exception as e:
+        record_error(e)
         print('[ ERROR ] {}'.format(e))
 
 
 
 
-def bq_list_datasets():
+@instrument
+def bq_list_datasets(prefix=None, labels=None):
     '''
         List Datasets within a Project
         
         Usage:
         bq_list_datasets()
+        bq_list_datasets(prefix='demo_', labels={'env': 'prod'})
         
         Required Permissions:
         Only datasets for which you have bigquery.datasets.get permissions are returned.
         This includes any dataset to which you have been granted dataset-level READER access.
+        
+        Datasets are printed as each page arrives (iter_datasets in gcp_bigquery_listing.py).
     
     '''
     try:
-        client   = bigquery.Client()
-        datasets = list(client.list_datasets())
+        client   = get_client()
         project  = client.project
+        count    = 0
         
-        if datasets:
-            print('Datasets in project {}:'.format(project))
-            for i,dataset in enumerate(datasets):  # API request(s)
-                print('\t{}\t{}'.format(i, dataset.dataset_id))
-        else:
-            print('{} project does not contain any datasets.'.format(project))
+        for i,dataset in enumerate(iter_datasets(prefix=prefix, labels=labels, client=client)):  # API request(s), one per page
+            if i == 0:
+                print('Datasets in project {}:'.format(project))
+            print('\t{}\t{}'.format(i, dataset.dataset_id))
+            count += 1
+        
+        if count == 0:
+            print('{} project does not contain any {}datasets.'.format(project, 'matching ' if prefix or labels else ''))
     
     except Exception as e:
+        record_error(e)
         print('[ ERROR ] {}'.format(e))
 
 
 
 
 
-def bq_dataset_metadata(dataset_id):
+@instrument
+def bq_dataset_metadata(dataset_id, bulk=False):
     '''
         List all metadata for a BigQuery Dataset
         
         USAGE:
         bq_dataset_metadata('ztest1')
+        bq_dataset_metadata('ztest1', bulk=True)   # Also rows, size, partitioning and clustering of every table
         
         Required Permissions:
         Must be assigned the dataset-level READER role,
         or you must be assigned a project-level IAM role that includes bigquery.datasets.get permissions.
+        
+        The dataset and its table list come from the metadata cache (gcp_bigquery_metadata.py).
+        With bulk=True the tables are described by one INFORMATION_SCHEMA query (bulk_table_metadata)
+        instead of one get_table() per table.
        
     '''
     try:
-        client = bigquery.Client()
+        client = get_client()
+        cache = get_metadata_cache()
         dataset_ref = client.dataset(dataset_id)
-        dataset = client.get_dataset(dataset_ref)
+        dataset = cache.get_dataset(client, dataset_ref)
         
         # View dataset properties
         print('Dataset ID:     {}'.format(dataset_id))
@@ -230,12 +271,15 @@ def bq_dataset_metadata(dataset_id):
         
         # View tables in dataset
         print('Tables:')
-        tables = list(client.list_tables(dataset_ref))
-        if tables:
-            for table in tables:
-                print('\t{}'.format(table.table_id))
+        if bulk:
+            _print_bulk_table_metadata(bulk_table_metadata(dataset_id, location=dataset.location), indent='\t')
         else:
-            print('\tThis dataset does not contain any tables.')
+            tables = cache.list_tables(client, dataset_ref)
+            if tables:
+                for table in tables:
+                    print('\t{}'.format(table.table_id))
+            else:
+                print('\tThis dataset does not contain any tables.')
         
         # Get Access Entries
         print('Access Entries:')
@@ -246,12 +290,14 @@ def bq_dataset_metadata(dataset_id):
             print('')
     
     except Exception as e:
+        record_error(e)
         print('[ ERROR ] {}'.format(e))
 
 
 
 
 
+@instrument
 def bq_update_access_to_dataset(dataset_id, role, entity_type, entity_id):
     '''
         Update access control for a BigQuery Dataset
@@ -265,7 +311,9 @@ def bq_update_access_to_dataset(dataset_id, role, entity_type, entity_id):
     
     '''
     try:
-        client = bigquery.Client()
+        from google.cloud import bigquery
+        
+        client = get_client()
         dataset = client.get_dataset(client.dataset(dataset_id))
         
         entry = bigquery.AccessEntry(
@@ -280,16 +328,19 @@ def bq_update_access_to_dataset(dataset_id, role, entity_type, entity_id):
         dataset.access_entries = entries
         
         dataset = client.update_dataset(dataset, ['access_entries'])  # API request
+        invalidate_metadata(dataset_id)
         
         assert entry in dataset.access_entries
     
     except Exception as e:
+        record_error(e)
         print('[ ERROR ] {}'.format(e))
 
 
 
 
 
+@instrument
 def bg_update_default_table_expiration(dataset_id, new_default_table_expiration_ms):
     '''
         Update the DEFAULT expiration (in ms) for all Tables in a Dataset (moving forward)
@@ -321,7 +372,7 @@ def bg_update_default_table_expiration(dataset_id, new_default_table_expiration_
     
     '''
     try:
-        client      = bigquery.Client()
+        client      = get_client()
         dataset_ref = client.dataset(dataset_id)
         dataset     = client.get_dataset(dataset_ref)
         
@@ -329,14 +380,17 @@ def bg_update_default_table_expiration(dataset_id, new_default_table_expiration_
         assert dataset.default_table_expiration_ms is None
         dataset.default_table_expiration_ms = new_default_table_expiration_ms
         dataset = client.update_dataset(dataset, ['default_table_expiration_ms'])
+        invalidate_metadata(dataset_id)
         assert dataset.default_table_expiration_ms == new_default_table_expiration_ms
     except Exception as e:
+        record_error(e)
         print('[ ERROR] {}'.format(e))
 
 
 
 
 
+@instrument
 def bg_update_dataset_desc(dataset_id, new_dataset_desc):
     '''
         Update the Dataset Description property
@@ -367,7 +421,7 @@ def bg_update_dataset_desc(dataset_id, new_dataset_desc):
     
     '''
     try:
-        client      = bigquery.Client()
+        client      = get_client()
         dataset_ref = client.dataset(dataset_id)
         dataset     = client.get_dataset(dataset_ref)
         
@@ -375,14 +429,17 @@ def bg_update_dataset_desc(dataset_id, new_dataset_desc):
         assert dataset.description == 'Original description.'
         dataset.description = new_dataset_desc
         dataset = client.update_dataset(dataset, ['description'])
+        invalidate_metadata(dataset_id)
         assert dataset.description == 'Updated description.'
     except Exception as e:
+        record_error(e)
         print('[ ERROR] {}'.format(e))
 
 
 
 
 
+@instrument
 def bq_delete_dataset(dataset_id):
     '''
         Deletes a Dataset (Deleting a dataset is permanent)
@@ -400,17 +457,20 @@ def bq_delete_dataset(dataset_id):
     
     '''
     try:
-        client = bigquery.Client()
+        client = get_client()
         dataset_ref = client.dataset(dataset_id)
         client.delete_dataset(dataset_ref, delete_contents=True)  # Set delete_contents=True to delete Dataset Tables
+        invalidate_metadata(dataset_id)
         print('Dataset {} deleted.'.format(dataset_id))
     except Exception as e:
+        record_error(e)
         print('[ ERROR] {}'.format(e))
 
 
 
 
 
+@instrument
 def bq_table_metadata(dataset_id, table_id):
     '''
         List all metadata for a BigQuery Table
@@ -421,13 +481,15 @@ def bq_table_metadata(dataset_id, table_id):
         Required Permissions:
         To get information about tables, you must be assigned the READER role on the dataset,
         or you must be assigned a project-level IAM role that includes bigquery.tables.get permissions.
+        
+        The table comes from the metadata cache (gcp_bigquery_metadata.py).
        
     '''
     try:
-        client      = bigquery.Client()
+        client      = get_client()
         dataset_ref = client.dataset(dataset_id)
         table_ref   = dataset_ref.table(table_id)
-        table       = client.get_table(table_ref)
+        table       = get_metadata_cache().get_table(client, table_ref)
         
         # View table properties
         print('Table:                {}'.format(table.table_id))
@@ -448,17 +510,36 @@ def bq_table_metadata(dataset_id, table_id):
             print('\t{}'.format(column))
     
     except Exception as e:
+        record_error(e)
         print('[ ERROR ] {}'.format(e))
 
 
 
 
-def bq_list_tables(dataset_id):
+def _print_bulk_table_metadata(columns, indent=''):
+    if len(columns['table_id']) == 0:
+        print('{}This dataset does not contain any tables.'.format(indent))
+    for i in range(len(columns['table_id'])):
+        print('{}{:<30} {:<18} rows: {:>14}  bytes: {:>16}  partitioning: {}  clustering: {}'.format(
+              indent, columns['table_id'][i], columns['table_type'][i], columns['num_rows'][i], columns['num_bytes'][i],
+              columns['partitioning'][i], columns['clustering'][i]))
+
+
+
+
+@instrument
+def bq_list_tables(dataset_id, bulk=False, prefix=None, labels=None):
     '''
         List tables within a BigQuery Dataset
     
         USAGE:
         bq_list_tables('zdataset')
+        bq_list_tables('zdataset', prefix='loans_', labels={'env': 'prod'})
+        bq_list_tables('zdataset', bulk=True)      # Also rows, size, partitioning and clustering of every table
+        
+        Tables are printed as each page arrives (iter_tables in gcp_bigquery_listing.py).
+        With bulk=True the tables are described by one INFORMATION_SCHEMA query (bulk_table_metadata)
+        instead of one get_table() per table.
         
         Required Permissions:
         To list tables in a dataset, you must be assigned the READER role on the dataset,
@@ -466,21 +547,67 @@ def bq_list_tables(dataset_id):
         
     '''
     try:
-        client      = bigquery.Client()
-        dataset_ref = client.dataset(dataset_id)
-        tables      = list(client.list_tables(dataset_ref))
+        if bulk:
+            columns = bulk_table_metadata(dataset_id)
+            if prefix or labels:
+                keep    = [i for i, table_id in enumerate(columns['table_id']) if not prefix or str(table_id).startswith(prefix)]
+                columns = dict((name, values[keep]) for name, values in columns.items())
+                if labels:
+                    print('[ WARN ] labels are not part of the bulk metadata and were not filtered on')
+            _print_bulk_table_metadata(columns)
+            print('Total Number of Table: {}'.format(len(columns['table_id'])))
+            return
         
-        for table in tables:
+        count = 0
+        for table in iter_tables(dataset_id, prefix=prefix, labels=labels):
             print('Table:               {}'.format(table.table_id))
             print('Dataset:             {}'.format(table.dataset_id))
             print('Project:             {}'.format(table.project))
             print('Table Type:          {}'.format(table.table_type))
             print('Time Partitioning:   {}'.format(table.time_partitioning))
             print('')
+            count += 1
         
-        print('Total Number of Table: {}'.format(len(tables)))
+        print('Total Number of Table: {}'.format(count))
     
     except Exception as e:
+        record_error(e)
+        print('[ ERROR ] {}'.format(e))
+
+
+
+
+
+@instrument
+def bq_list_project_tables(dataset_prefix=None, dataset_labels=None, table_prefix=None, table_labels=None, max_workers=16):
+    '''
+        List the tables of every (matching) dataset in the Project, one line per table
+
+        USAGE:
+        bq_list_project_tables()
+        bq_list_project_tables(dataset_labels={'env': 'prod'}, table_prefix='events_', max_workers=32)
+
+        The tables of max_workers datasets are listed at once (iter_project_tables in gcp_bigquery_listing.py)
+        and printed as they arrive, so tables of different datasets are interleaved.
+
+        Returns {'tables': <tables listed>, 'datasets': <datasets they are in>} (None on error).
+
+    '''
+    try:
+        start    = time.time()
+        datasets = set()
+        count    = 0
+        for table in iter_project_tables(dataset_prefix=dataset_prefix, dataset_labels=dataset_labels,
+                                         table_prefix=table_prefix, table_labels=table_labels, max_workers=max_workers):
+            print('{:<40} {:<50} {}'.format(table.dataset_id, table.table_id, table.table_type))
+            datasets.add(table.dataset_id)
+            count += 1
+
+        print('[ INFO ] Listed {} tables in {} datasets in {:.2f} seconds'.format(count, len(datasets), time.time() - start))
+        return {'tables': count, 'datasets': len(datasets)}
+
+    except Exception as e:
+        record_error(e)
         print('[ ERROR ] {}'.format(e))
 
 
@@ -488,6 +615,7 @@ def bq_list_tables(dataset_id):
 
 
 
+@instrument
 def bq_update_table_metadata(dataset_id, table_id, new_description=None, new_table_expiration=None):
     '''
         Update metadata / properties for a BigQuery Table
@@ -505,13 +633,14 @@ def bq_update_table_metadata(dataset_id, table_id, new_description=None, new_tab
         
     '''
     try:
-        client    = bigquery.Client()
+        client    = get_client()
         table_ref = client.dataset(dataset_id).table(table_id)
         table     = client.get_table(table_ref)
         
         if new_description != None:
             table.description = new_description
             table = client.update_table(table, ['description'])
+            invalidate_metadata(dataset_id, table_id)
         
         '''
         You can set a default table expiration time at the dataset level,
@@ -526,20 +655,32 @@ def bq_update_table_metadata(dataset_id, table_id, new_description=None, new_tab
         if new_table_expiration != None:
             table.expires = datetime.datetime.strptime(new_table_expiration, '%Y-%m-%d %H:%M:%S')
             table = client.update_table(table, ['expires'])
+            invalidate_metadata(dataset_id, table_id)
     
     except Exception as e:
+        record_error(e)
         print('[ ERROR ] {}'.format(e))
 
 
 
 
 
-def bq_create_table_empty(dataset_id, table_id):
+@instrument
+def bq_create_table_empty(dataset_id, table_id, schema=None, partitioning=None, clustering=None):
     '''
         Creates an empty BigQuery Table
         
         USAGE:
         bq_create_table_empty('ztest1', 'ztable1')
+        bq_create_table_empty('ztest1', 'ztable_loans', schema='gs://zdatasets1/loan_200k.csv')
+        bq_create_table_empty('ztest1', 'zevents', schema, partitioning={'field': 'created', 'require_filter': True}, clustering=['state'])
+        
+        schema:
+        Optional list of bigquery.SchemaField, or a schema registry key (gcp_bigquery_schema.py)
+        
+        partitioning / clustering:
+        Time, ingestion-time or integer-range partitioning and up to 4 clustering columns
+        (see gcp_bigquery_partitioning.py)
         
         Required Permissions:
         To create a table, you must have WRITER access at the dataset level,
@@ -551,39 +692,58 @@ def bq_create_table_empty(dataset_id, table_id):
     
     '''
     try:
-        client      = bigquery.Client()
+        from google.cloud import bigquery
+        from gcp_bigquery_schema import lookup_schema
+        
+        client      = get_client()
         dataset_ref = client.dataset(dataset_id)
         
-        schema = [
-            bigquery.SchemaField('full_name', 'STRING', mode='REQUIRED'),
-            bigquery.SchemaField('age', 'INTEGER', mode='REQUIRED'),
-        ]
+        if schema is None:
+            schema = [
+                bigquery.SchemaField('full_name', 'STRING', mode='REQUIRED'),
+                bigquery.SchemaField('age', 'INTEGER', mode='REQUIRED'),
+            ]
+        schema = lookup_schema(schema)
         
         table_ref = dataset_ref.table(table_id)
-        table     = bigquery.Table(table_ref, schema=schema)
+        table     = apply_partitioning(bigquery.Table(table_ref, schema=schema), partitioning, clustering)
         table     = client.create_table(table)
+        invalidate_metadata(dataset_id, table_id)
         
         assert table.table_id == table_id
     except Exception as e:
+        record_error(e)
         print('[ ERROR] {}'.format(e))
 
 
 
 
-def bq_create_table_from_query(dataset_id, table_id, sql_query, location='US'):
+@instrument
+def bq_create_table_from_query(dataset_id, table_id, sql_query, location='US', job_manager=None, partitioning=None, clustering=None):
     '''
         Create a table from a query result, write the results to a destination table.
         
         USAGE:
         bq_create_table_from_query('ztest1', 'ztable2', """SELECT corpus FROM `bigquery-public-data.samples.shakespeare`GROUP BY corpus;""", 'US')
+        bq_create_table_from_query('ztest1', 'zevents_daily', sql_query, partitioning='event_date', clustering=['country'])
+        
+        partitioning / clustering:
+        Partitioning and clustering of the destination table when the query creates it (see gcp_bigquery_partitioning.py)
+        
+        job_manager:
+        Optional JobManager (gcp_bigquery_jobs.py). The query job is submitted through it and a Future
+        with the job statistics is returned instead of waiting for the job to finish.
     
     '''
     try:
-        client     = bigquery.Client()
+        from google.cloud import bigquery
+        
+        client     = get_client()
         job_config = bigquery.QueryJobConfig()
         # Set the destination table
         table_ref = client.dataset(dataset_id).table(table_id)
         job_config.destination = table_ref
+        apply_partitioning(job_config, partitioning, clustering)
         
         # Example Query
         '''
@@ -595,28 +755,38 @@ def bq_create_table_from_query(dataset_id, table_id, sql_query, location='US'):
         '''
         
         # Start the query, passing in the extra configuration.
+        # Location must match that of the dataset(s) referenced in the query and of the destination table.
+        if job_manager is not None:
+            future = job_manager.submit(lambda: client.query(sql_query, location=location, job_config=job_config),
+                                        label='query -> {}.{}'.format(dataset_id, table_id))
+            future.add_done_callback(lambda _: invalidate_metadata(dataset_id, table_id))
+            if partitioning:
+                future.add_done_callback(lambda f: f.exception() or enforce_partition_filter(client, table_ref, partitioning))
+            return future
         
         query_job = client.query(
             sql_query,
-            # Location must match that of the dataset(s) referenced
-            # in the query and of the destination table.
-            location='US',
+            location=location,
             job_config=job_config)
         
         query_job.result()  # Waits for the query to finish
+        invalidate_metadata(dataset_id, table_id)
+        enforce_partition_filter(client, table_ref, partitioning)
         print('Query results loaded to table {}'.format(table_ref.path))
     except Exception as e:
+        record_error(e)
         print('[ ERROR] {}'.format(e))
 
         
         
 
-def bq_copy_table(project_id, source_dataset, source_table, dest_dataset, dest_table):
+@instrument
+def bq_copy_table(project_id, source_dataset, source_table, dest_dataset, dest_table, job_manager=None):
     '''
         Copies a BigQuery Table
         
         USAGE:
-        
+        bq_copy_table('zproject201807', 'ztest1', 'ztable1', 'ztest2', 'ztable1_copy')
         
         NOTE: Multiple source files can be copied to a destination table by using the CLI or API.
         
@@ -629,26 +799,285 @@ def bq_copy_table(project_id, source_dataset, source_table, dest_dataset, dest_t
             - When copying tables, the destination dataset must reside in the same location as the dataset containing the table being copied.
             - Copying multiple source tables into a destination table is not supported by the web UI.
             - IDENTICAL SCHEMAS - When copying multiple source tables to a destination table using the CLI or API, all source tables must have identical schemas
+        
+        job_manager:
+        Optional JobManager (gcp_bigquery_jobs.py). The copy job is submitted through it and a Future
+        with the job statistics is returned instead of waiting for the job to finish.
     
     '''
-client = bigquery.Client()
+    try:
+        client           = get_client()
+        
+        source_dataset   = client.dataset(source_dataset, project=project_id)
+        source_table_ref = source_dataset.table(source_table)
+        
+        dest_table_ref   = client.dataset(dest_dataset).table(dest_table)
+        
+        if job_manager is not None:
+            # Location must match that of the source and destination tables.
+            future = job_manager.submit(lambda: client.copy_table(source_table_ref, dest_table_ref, location='US'),
+                                        label='copy {}.{} -> {}.{}'.format(source_dataset.dataset_id, source_table, dest_dataset, dest_table))
+            future.add_done_callback(lambda _: invalidate_metadata(dest_dataset, dest_table))
+            return future
+        
+        # Waits for the job to complete, starting it again if it fails with a retryable reason (gcp_bigquery_quota.py)
+        job = run_job(lambda: client.copy_table(
+            source_table_ref,
+            dest_table_ref,
+            # Location must match that of the source and destination tables.
+            location='US'))
+        invalidate_metadata(dest_dataset, dest_table)
+        
+        assert job.state == 'DONE'
+        print('[ INFO ] Copied {} to {}'.format(source_table_ref.path, dest_table_ref.path))
+    except Exception as e:
+        record_error(e)
+        print('[ ERROR] {}'.format(e))
+
+
+
 
-source_dataset   = client.dataset(source_dataset, project=project_id)
-source_table_ref = source_dataset.table(source_table)
 
-dest_table_ref   = client.dataset(dest_dataset).table(dest_table)
 
-job = client.copy_table(
-    source_table_ref,
-    dest_table_ref,
-    # Location must match that of the source and destination tables.
-    location='US')
+def _dataset_reference_pattern(project_id, dataset_id):
+    # Matches dataset_id (optionally qualified with project_id) as the dataset of a table reference, e.g.
+    # ds.t, `ds.t`, `ds`.`t`, project.ds.t, `project.ds.t`, `project`.`ds`.`t`, [project:ds.t] (legacy SQL)
+    return re.compile(r'(?<![\w\-.:`])(?P<head>`?(?:(?P<project>{})`?[.:]`?)?){}(?P<tail>`?\.`?)(?P<table>[\w\-]+)'.format(
+                      re.escape(project_id), re.escape(dataset_id)))
 
-job.result()  # Waits for job to complete.
 
-assert job.state == 'DONE'
 
 
+def _rewrite_view_query(query, project_id, source_dataset, dest_project, dest_dataset):
+    def replace(match):
+        head = match.group('head')
+        if match.group('project'):
+            head = head.replace(match.group('project'), dest_project, 1)
+        return '{}{}{}{}'.format(head, dest_dataset, match.group('tail'), match.group('table'))
+    return _dataset_reference_pattern(project_id, source_dataset).sub(replace, query)
+
+
+
+
+def _error_reason(error):
+    errors = getattr(error, 'errors', None) or [{}]
+    return errors[0].get('reason')
+
+
+
+
+@instrument
+def bq_clone_dataset(project_id, source_dataset, dest_dataset, max_in_flight=CLONE_MAX_IN_FLIGHT, state_file=None,
+                     delete_source=False, max_retries=CLONE_MAX_RETRIES, job_manager=None):
+    '''
+        Clones every table and view of a dataset into a new (or existing) dataset
+        
+        USAGE:
+        report = bq_clone_dataset('zproject201807', 'ztest1', 'ztest1_copy', state_file='/tmp/ztest1_copy.json')
+        bq_clone_dataset('zproject201807', 'ztest1', 'ztest1_renamed', delete_source=True)      # Rename a dataset
+        
+        Steps:
+            1. Creates dest_dataset (in the source location, with its description, labels and default expiration)
+            2. Copies the tables with concurrent copy jobs (at most max_in_flight running at once, through a JobManager).
+               Copy jobs failing with rateLimitExceeded / quotaExceeded / backendError are resubmitted with
+               exponential backoff, up to max_retries times, so a large clone backs off instead of failing.
+            3. Recreates external tables from their definitions
+            4. Recreates views and materialized views with references to source_dataset rewritten to dest_dataset,
+               in dependency order (a view is created once every view it selects from exists)
+            5. Deletes source_dataset if delete_source=True and nothing failed
+        
+        state_file:
+        JSON file recording every table and view already cloned. A rerun with the same state_file skips them,
+        so a clone that stopped part way (or had failures) resumes where it left off. Tables are copied with
+        WRITE_TRUNCATE, so copying a table twice is harmless. The file records project_id, source_dataset and
+        dest_dataset; a state_file written by a different clone is refused (ValueError) instead of skipping
+        tables that were never copied.
+        
+        Output:     {'tables', 'views', 'copied', 'created', 'resumed', 'retried', 'failed': {table_id: error}, 'elapsed'}
+    
+    '''
+    try:
+        import concurrent.futures
+        import heapq
+        import json
+        import random
+        from google.api_core.exceptions import Conflict
+        from google.cloud import bigquery
+        from gcp_bigquery_jobs import JobManager
+        
+        start       = time.time()
+        client      = get_client()
+        source_ref  = client.dataset(source_dataset, project=project_id)
+        dest_ref    = client.dataset(dest_dataset)
+        
+        clone = {'project_id': project_id, 'source_dataset': source_dataset, 'dest_dataset': dest_dataset,
+                 'source': source_ref.path, 'dest': dest_ref.path}
+        state = dict(clone, done={})
+        if state_file and os.path.exists(state_file):
+            with open(state_file) as f:
+                state = json.load(f)
+            mismatched = sorted(name for name in clone if state.get(name, clone[name]) != clone[name])
+            if mismatched:
+                raise ValueError('state_file {} belongs to another clone ({} -> {}), not {} -> {}'.format(
+                    state_file, state.get('source'), state.get('dest'), source_ref.path, dest_ref.path))
+            state.update(clone)
+        
+        source      = client.get_dataset(source_ref)
+        dataset     = bigquery.Dataset(dest_ref)
+        dataset.location                    = source.location
+        dataset.description                 = source.description
+        dataset.labels                      = source.labels
+        dataset.default_table_expiration_ms = source.default_table_expiration_ms
+        client.create_dataset(dataset, exists_ok=True)
+        
+        def save_state():
+            if state_file:
+                with open(state_file + '.tmp', 'w') as f:
+                    json.dump(state, f, indent=2, sort_keys=True)
+                os.replace(state_file + '.tmp', state_file)
+        
+        items   = dict((item.table_id, item.table_type) for item in client.list_tables(source_ref))
+        todo    = dict((table_id, table_type) for table_id, table_type in items.items() if table_id not in state['done'])
+        report  = {'tables':  sum(1 for table_type in items.values() if table_type not in ('VIEW', 'MATERIALIZED_VIEW')),
+                   'views':   sum(1 for table_type in items.values() if table_type in ('VIEW', 'MATERIALIZED_VIEW')),
+                   'copied':  0,
+                   'created': 0,
+                   'resumed': len(items) - len(todo),
+                   'retried': 0,
+                   'failed':  {}}
+        
+        def done(table_id, job_id=None):
+            state['done'][table_id] = {'type': items[table_id], 'job_id': job_id}
+            save_state()
+        
+        # Copy the tables
+        copy_config = bigquery.CopyJobConfig()
+        copy_config.write_disposition = bigquery.WriteDisposition.WRITE_TRUNCATE
+        
+        manager  = job_manager or JobManager(max_in_flight=max_in_flight)
+        pending  = {}
+        retries  = []                           # heap of (resubmit at, table_id)
+        attempts = dict((table_id, 0) for table_id in todo)
+        
+        def submit(table_id):
+            attempts[table_id] += 1
+            start_copy = lambda: client.copy_table(source_ref.table(table_id), dest_ref.table(table_id),
+                                                   job_config=copy_config, location=source.location)
+            label      = 'copy {}.{} -> {}.{}'.format(source_dataset, table_id, dest_dataset, table_id)
+            pending[manager.submit(start_copy, label=label)] = table_id
+        
+        try:
+            for table_id in sorted(todo):
+                if todo[table_id] == 'TABLE':
+                    submit(table_id)
+            
+            while pending or retries:
+                while retries and retries[0][0] <= time.time():
+                    submit(heapq.heappop(retries)[1])
+                timeout = max(0, retries[0][0] - time.time()) if retries else None
+                if not pending:
+                    time.sleep(timeout)
+                    continue
+                finished, _ = concurrent.futures.wait(pending, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    table_id = pending.pop(future)
+                    try:
+                        stats = future.result()
+                    except Exception as e:
+                        if _error_reason(e) in CLONE_RETRY_REASONS and attempts[table_id] <= max_retries:
+                            report['retried'] += 1
+                            delay = min(2 ** attempts[table_id], 60) * random.uniform(0.5, 1.0)
+                            heapq.heappush(retries, (time.time() + delay, table_id))
+                        else:
+                            report['failed'][table_id] = str(e)
+                        continue
+                    report['copied'] += 1
+                    done(table_id, stats['job_id'])
+        finally:
+            if job_manager is None:
+                manager.shutdown(wait=True)
+        
+        # Recreate external tables and views (definitions only, fetched concurrently)
+        definition_ids = sorted(table_id for table_id, table_type in todo.items() if table_type != 'TABLE')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(16, len(definition_ids)))) as executor:
+            definitions = dict(zip(definition_ids, executor.map(in_span_context(lambda table_id: client.get_table(source_ref.table(table_id))),
+                                                                definition_ids)))
+        
+        def recreate(table_id):
+            source_table = definitions[table_id]
+            table        = bigquery.Table(dest_ref.table(table_id), schema=source_table.schema)
+            table.description = source_table.description
+            table.labels      = source_table.labels
+            if source_table.table_type == 'VIEW':
+                table.schema              = None
+                table.view_use_legacy_sql = source_table.view_use_legacy_sql
+                table.view_query          = _rewrite_view_query(source_table.view_query, project_id, source_dataset,
+                                                                dest_ref.project, dest_dataset)
+            elif source_table.table_type == 'MATERIALIZED_VIEW':
+                table.schema      = None
+                table.mview_query = _rewrite_view_query(source_table.mview_query, project_id, source_dataset,
+                                                        dest_ref.project, dest_dataset)
+            elif source_table.external_data_configuration is not None:
+                table.external_data_configuration = source_table.external_data_configuration
+            else:
+                raise ValueError('Cannot clone {} {}'.format(source_table.table_type, table_id))
+            try:
+                client.create_table(table)
+            except Conflict:
+                client.delete_table(table.reference)
+                client.create_table(table)
+        
+        pattern      = _dataset_reference_pattern(project_id, source_dataset)
+        dependencies = {}
+        for table_id, source_table in definitions.items():
+            query = source_table.view_query or source_table.mview_query or ''
+            dependencies[table_id] = set(match.group('table') for match in pattern.finditer(query)) & set(definitions)
+            dependencies[table_id].discard(table_id)
+        
+        remaining = set(definitions)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(16, len(definition_ids)))) as executor:
+            while remaining:
+                blocked = dict((table_id, sorted(dependencies[table_id] & set(report['failed'])))
+                               for table_id in remaining if dependencies[table_id] & set(report['failed']))
+                for table_id, failed_ids in blocked.items():
+                    report['failed'][table_id] = 'Depends on {} which failed'.format(', '.join(failed_ids))
+                remaining -= set(blocked)
+                
+                ready = sorted(table_id for table_id in remaining if not dependencies[table_id] & remaining)
+                if not ready:
+                    for table_id in remaining:
+                        report['failed'][table_id] = 'Circular view dependency'
+                    break
+                remaining -= set(ready)
+                
+                futures = dict((executor.submit(in_span_context(recreate), table_id), table_id) for table_id in ready)
+                for future in concurrent.futures.as_completed(futures):
+                    table_id = futures[future]
+                    try:
+                        future.result()
+                    except Exception as e:
+                        report['failed'][table_id] = str(e)
+                        continue
+                    report['created'] += 1
+                    done(table_id)
+        
+        invalidate_metadata(dest_dataset)
+        if delete_source and not report['failed']:
+            client.delete_dataset(source_ref, delete_contents=True)
+            invalidate_metadata(source_dataset, project=project_id)
+            print('[ INFO ] Deleted {}'.format(source_ref.path))
+        
+        report['elapsed'] = time.time() - start
+        print('[ INFO ] Cloned {} to {}: {} tables copied, {} views / definitions created, {} resumed, {} retried, {} failed ({:.1f}s)'.format(
+              source_ref.path, dest_ref.path, report['copied'], report['created'], report['resumed'], report['retried'],
+              len(report['failed']), report['elapsed']))
+        for table_id, error in sorted(report['failed'].items()):
+            print('[ ERROR] {}: {}'.format(table_id, error))
+        return report
+    except Exception as e:
+        record_error(e)
+        print('[ ERROR] {}'.format(e))
+
 
 
 
@@ -658,25 +1087,173 @@ assert job.state == 'DONE'
 
 # Query Table
 
+# Read Table (Storage Read API)
+@instrument
+def bq_read_table(dataset_id, table_id, columns=None, row_filter=None, max_streams=8, compression='LZ4_FRAME'):
+    '''
+        Read a table (or the selected columns / filtered rows of it) into a pyarrow.Table through parallel read streams
+        
+        USAGE:
+        table = bq_read_table('ztest1', 'table_loans', columns=['member_id', 'loan_amnt'], row_filter="grade = 'A'")
+        df    = bq_read_table('ztest1', 'table_loans', max_streams=16).to_pandas()
+        
+        The columns and the row filter are applied by BigQuery, so only matching data is sent. Streams arrive
+        as Arrow record batches and are read concurrently (see gcp_bigquery_read.py for batch iterators,
+        query results and per-batch processing in worker processes).
+        Requires google-cloud-bigquery-storage and pyarrow.
+        
+    '''
+    try:
+        from gcp_bigquery_read import read_table
+        start = time.time()
+        table = read_table('{}.{}'.format(dataset_id, table_id), columns=columns, row_filter=row_filter,
+                           max_streams=max_streams, compression=compression)
+        elapsed = time.time() - start
+        
+        print('[ INFO ] Read {} row(s), {} column(s) of {}.{} in {:.2f} s ({:.1f} MB/s)'.format(
+              table.num_rows, table.num_columns, dataset_id, table_id, elapsed, table.nbytes / 1e6 / elapsed if elapsed else 0))
+        return table
+    
+    except Exception as e:
+        record_error(e)
+        print('[ ERROR] {}'.format(e))
+
 
 
 # Create BigQuery Table (Ingestion-Time Partitioned Table)
+#   bq_create_table_empty('ztest1', 'ztable_ingestion', schema, partitioning={'type': 'DAY'})
 
-# Load Data (into Ingestion-Time Partitioned Table)
+# Create BigQuery Table (Partitioned Table)
+#   bq_create_table_empty('ztest1', 'ztable_partitioned', schema, partitioning='TS', clustering=['a'])
+#   bq_create_table_empty('ztest1', 'ztable_range', schema, partitioning={'field': 'a', 'range': (0, 100, 10)})
 
-# Query (into Ingestion-Time Partitioned Table)
 
 
+# Load Data (into Partitioned Table / Ingestion-Time Partitioned Table)
+@instrument
+def bq_load_partition(dataset_id, table_id, gcs_path, partition, partition_type='DAY', write_disposition='WRITE_TRUNCATE',
+                      job_config=None, location='US'):
+    '''
+        Loads Cloud Storage file(s) into a single partition of a partitioned table (partition decorator),
+        by default replacing that partition only: reloading a day does not touch the other days.
+        
+        USAGE:
+        bq_load_partition('ztest1', 'ztable_partitioned', 'gs://zdatasets1/events/2018-07-01/*.csv', '2018-07-01')
+        bq_load_partition('ztest1', 'ztable_ingestion', 'gs://zdatasets1/events/2018-07-01.csv', datetime.date(2018, 7, 1))
+        bq_load_partition('ztest1', 'ztable_range', 'gs://zdatasets1/customers/0-999.csv', 0)     # Range starting at 0
+        
+        partition:          date / datetime / 'YYYY-MM-DD' string / partition ID ('20180701'), or the start of an integer range
+        partition_type:     HOUR, DAY, MONTH or YEAR, the partitioning type of the table
+        write_disposition:  WRITE_TRUNCATE (replace the partition), WRITE_APPEND or WRITE_EMPTY (only into an empty partition)
+        job_config:         bigquery.LoadJobConfig (default: CSV with a header row, the schema of the table)
+        
+        For a column-partitioned table every row must fall in the partition, otherwise the load fails.
+        For an ingestion-time table the rows are assigned to the partition (_PARTITIONTIME = partition).
+        
+    '''
+    try:
+        from google.cloud import bigquery
+        
+        client = get_client()
+        if job_config is None:
+            job_config = bigquery.LoadJobConfig()
+            job_config.skip_leading_rows = 1
+            job_config.source_format     = bigquery.SourceFormat.CSV
+        job_config.write_disposition = write_disposition
+        
+        decorated = partition_decorator(table_id, partition, partition_type)
+        load_job  = client.load_table_from_uri(gcs_path, client.dataset(dataset_id).table(decorated),
+                                               job_config=job_config, location=location)
+        print('[ INFO ] Starting BigQuery load job {} into {}.{}'.format(load_job.job_id, dataset_id, decorated))
+        load_job.result()
+        invalidate_metadata(dataset_id, table_id)
+        
+        print('[ INFO ] Loaded {} rows into {}.{}'.format(load_job.output_rows, dataset_id, decorated))
+        return load_job
+    
+    except Exception as e:
+        record_error(e)
+        print('[ ERROR] {}'.format(e))
+
 
-# Create BigQuery Table (Partitioned Table)
 
-# Load Data (into Partitioned Table)
+# Query (into Ingestion-Time Partitioned Table)
+#   bq_create_table_from_query('ztest1', 'ztable_ingestion$20180701', sql_query)   # The query result replaces that day
 
 # Query (Partitioned Table)
+@instrument
+def bq_query_partitioned(query, location='US', max_results=11, partition_filter='error'):
+    '''
+        Query partitioned table(s), refusing (or warning about) queries that would scan every partition
+        
+        USAGE:
+        bq_query_partitioned('select * from `ztest1.ztable_partitioned` where TS >= "2018-02-01"')
+        bq_query_partitioned('select * from `ztest1.ztable_ingestion` where _PARTITIONTIME = "2018-07-01"')
+        bq_query_partitioned('select a from `ztest1.ztable_partitioned`', partition_filter='warn')
+        
+        partition_filter:
+        'error' does not run a query that has no filter on the partitioning column of a partitioned table
+        it reads, 'warn' prints a warning and runs it (see check_partition_filter in gcp_bigquery_partitioning.py).
+        The check costs one dry run, which is free.
+        
+    '''
+    try:
+        client = get_client()
+        report = check_partition_filter(query, location=location, mode=partition_filter, client=client)
+        print('[ INFO ] Query will process {} bytes'.format(report['bytes_processed']))
+        
+        rows = client.query(query, location=location).result(max_results=max_results)
+        for row in rows:
+            print(row)
+        
+        print('[ INFO ] Query returned {} row(s)'.format(rows.total_rows))
+    
+    except Exception as e:
+        record_error(e)
+        print('[ ERROR] {}'.format(e))
 
 
 
 # Export Data
+@instrument
+def bq_export_table(dataset_id, table_id, destination_uri, local_dir=None, destination_format='AVRO', compression=None,
+                    max_workers=8, storage_client=None, location='US'):
+    '''
+        Export a table to Cloud Storage in shards and (optionally) download the shards in parallel
+        
+        USAGE:
+        bq_export_table('ztest1', 'table_loans', 'gs://zdatasets1/exports/loans/', local_dir='/tmp/loans')
+        bq_export_table('ztest1', 'table_loans', 'gs://zdatasets1/exports/loans-*.parquet', destination_format='PARQUET', compression='SNAPPY')
+        bq_export_table('ztest1', 'table_loans', 'gs://zdatasets1/exports/loans-*.csv.gz', local_dir='/tmp/loans',
+                        destination_format='CSV', compression='GZIP')
+        
+        destination_format: AVRO, PARQUET, CSV or NEWLINE_DELIMITED_JSON
+        compression:        DEFLATE / SNAPPY (Avro), SNAPPY / GZIP / ZSTD (Parquet), GZIP (CSV, JSON)
+        
+        A destination ending in '/' gets <table_id>-*.<extension>. Downloads resume where they broke off
+        (rerunning the export resumes them across runs) and are checked against the CRC32C of each shard
+        (see gcp_bigquery_export.py).
+        
+    '''
+    try:
+        from gcp_bigquery_export import export_table
+        report = export_table(dataset_id, table_id, destination_uri, local_dir=local_dir, destination_format=destination_format,
+                              compression=compression, max_workers=max_workers, location=location, storage_client=storage_client)
+        
+        print('[ INFO ] Exported {}.{} to {} file(s), {} bytes ({})'.format(dataset_id, table_id, report['files'],
+                                                                           report['input_bytes'], report['destination_uri']))
+        if local_dir:
+            print('[ INFO ] Downloaded {} bytes to {} at {:.1f} MB/s ({} resumed, {} already on disk, {} failed)'.format(
+                  report['downloaded_bytes'], local_dir, report['mb_per_second'] or 0, report['resumed_shards'],
+                  report['skipped_shards'], report['failed_shards']))
+        for shard in report['shards']:
+            if shard['state'] == 'FAILED':
+                print('[ ERROR] {}: {}'.format(shard['uri'], shard['error']))
+        return report
+    
+    except Exception as e:
+        record_error(e)
+        print('[ ERROR] {}'.format(e))
 
 
 
@@ -0,0 +1,432 @@
+####################################################################################################
+#
+#   Google BigQuery - asyncio Helpers
+#
+#   https://docs.python.org/3/library/asyncio.html
+#
+####################################################################################################
+
+
+
+'''
+NOTES
+
+    The BigQuery client library is blocking: every API call holds its thread until the response arrives.
+    Calling the helpers in gcp_bigquery.py from a coroutine stalls the whole event loop.
+
+    The *_async helpers below never block the loop:
+        - Each API request runs on a shared thread pool sized like the HTTP connection pool
+          (set_max_workers()), so thousands of concurrent coroutines share a bounded number of
+          threads and connections; the rest wait in the pool's queue.
+        - Jobs (queries, loads, copies) are polled with asyncio.sleep() between polls, so a coroutine
+          waiting for a long job holds no thread at all.
+        - Every helper takes timeout= (seconds). On timeout or task cancellation, a running job is
+          cancelled server-side (best effort) and asyncio.TimeoutError / CancelledError is raised.
+
+    Unlike the printing helpers, these return the API objects and raise errors.
+
+    USAGE:
+    async def main():
+        table = await bq_table_metadata_async('demo_dataset1', 'table_loans')
+        rows  = await bq_query_async('select count(*) as count from `zproject201807.demo_dataset1.table_loans`', timeout=60)
+        print(table.num_rows, rows[0]['count'])
+    asyncio.run(main())
+
+'''
+
+
+####################################################################################################
+#
+#   Python Libraries
+#
+####################################################################################################
+
+
+import asyncio
+import concurrent.futures
+import functools
+import threading
+
+from google.cloud import bigquery
+
+import gcp_bigquery_clients
+from gcp_bigquery_clients import get_client
+from gcp_bigquery_metadata import get_metadata_cache, invalidate_metadata
+from gcp_bigquery_schema import get_registry, infer_gcs_schema, lookup_schema, source_key
+from gcp_bigquery_demoflow import (INSERT_MAX_ROWS_PER_REQUEST, INSERT_MAX_BYTES_PER_REQUEST,
+                                   _insert_row_ids, _insert_chunks, _insert_chunk)
+from gcp_bigquery_telemetry import in_span_context
+
+
+####################################################################################################
+
+
+
+_executor      = None
+_executor_lock = threading.Lock()
+_max_workers   = gcp_bigquery_clients.DEFAULT_POOL_SIZE
+
+
+
+
+def set_max_workers(max_workers):
+    '''
+        Sets how many API requests the async helpers run at once (keep it <= the client pool size)
+
+        USAGE:
+        set_pool_size(64)
+        set_max_workers(64)
+
+    '''
+    global _executor, _max_workers
+    if max_workers < 1:
+        raise ValueError('max_workers must be at least 1, got {}'.format(max_workers))
+    with _executor_lock:
+        executor     = _executor
+        _executor    = None
+        _max_workers = max_workers
+    if executor is not None:
+        executor.shutdown(wait=False)
+
+
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = concurrent.futures.ThreadPoolExecutor(max_workers=_max_workers, thread_name_prefix='bq-async')
+    return _executor
+
+
+
+
+async def _run(fn, *args, **kwargs):
+    '''
+        Runs one blocking call on the shared pool without blocking the event loop
+    '''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), in_span_context(functools.partial(fn, *args, **kwargs)))
+
+
+
+
+def _supports_timeout(coroutine_function):
+    '''
+        Adds a timeout= keyword (seconds) to an async helper
+    '''
+    @functools.wraps(coroutine_function)
+    async def wrapper(*args, timeout=None, **kwargs):
+        if timeout is None:
+            return await coroutine_function(*args, **kwargs)
+        return await asyncio.wait_for(coroutine_function(*args, **kwargs), timeout)
+    return wrapper
+
+
+
+
+async def _wait_for_job(job, initial_poll_interval=0.1, max_poll_interval=5.0):
+    '''
+        Polls job until it is DONE, sleeping (not holding a thread) between polls
+
+        Cancelling the waiting task cancels the job server-side.
+    '''
+    interval = initial_poll_interval
+    try:
+        while True:
+            await _run(job.reload)
+            if job.state == 'DONE':
+                if job.error_result:
+                    raise job.exception()
+                return job
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, max_poll_interval)
+    except asyncio.CancelledError:
+        _get_executor().submit(job.cancel)
+        raise
+
+
+
+
+def _next_page(pages):
+    page = next(pages, None)
+    return None if page is None else list(page)
+
+
+
+
+####################################################################################################
+#
+#   Datasets
+#
+####################################################################################################
+
+
+
+@_supports_timeout
+async def bq_create_dataset_async(dataset_id, location='US'):
+    '''
+        Creates a BigQuery Dataset, returning the bigquery.Dataset
+
+        USAGE:
+        dataset = await bq_create_dataset_async('demo_dataset1', location='US', timeout=30)
+
+    '''
+    client               = await _run(get_client)
+    dataset_obj          = bigquery.Dataset(client.dataset(dataset_id))
+    dataset_obj.location = location
+    dataset              = await _run(client.create_dataset, dataset_obj)
+    invalidate_metadata(dataset_id)
+    return dataset
+
+
+
+
+@_supports_timeout
+async def bq_list_datasets_async():
+    '''
+        Lists the Datasets within the Project, returning a list of bigquery.DatasetListItem
+    '''
+    client = await _run(get_client)
+    return await _run(lambda: list(client.list_datasets()))
+
+
+
+
+@_supports_timeout
+async def bq_dataset_metadata_async(dataset_id):
+    '''
+        Returns the bigquery.Dataset (labels, access entries, location, ...) for dataset_id, from the metadata cache
+    '''
+    client = await _run(get_client)
+    return await _run(get_metadata_cache().get_dataset, client, client.dataset(dataset_id))
+
+
+
+
+@_supports_timeout
+async def bq_delete_dataset_async(dataset_id, delete_contents=True):
+    '''
+        Deletes a Dataset (Deleting a dataset is permanent)
+    '''
+    client = await _run(get_client)
+    await _run(client.delete_dataset, client.dataset(dataset_id), delete_contents=delete_contents)
+    invalidate_metadata(dataset_id)
+
+
+
+
+####################################################################################################
+#
+#   Tables
+#
+####################################################################################################
+
+
+
+@_supports_timeout
+async def bq_table_metadata_async(dataset_id, table_id):
+    '''
+        Returns the bigquery.Table (schema, num_rows, num_bytes, partitioning, ...) for dataset_id.table_id,
+        from the metadata cache
+
+        USAGE:
+        table = await bq_table_metadata_async('demo_dataset1', 'table_loans', timeout=10)
+
+    '''
+    client = await _run(get_client)
+    return await _run(get_metadata_cache().get_table, client, client.dataset(dataset_id).table(table_id))
+
+
+
+
+@_supports_timeout
+async def bq_list_tables_async(dataset_id):
+    '''
+        Lists the tables within a Dataset, returning a list of bigquery.TableListItem (from the metadata cache)
+    '''
+    client = await _run(get_client)
+    return await _run(get_metadata_cache().list_tables, client, client.dataset(dataset_id))
+
+
+
+
+@_supports_timeout
+async def bq_create_table_async(dataset_id, table_id, schema):
+    '''
+        Creates a BigQuery Table with the given schema (list of bigquery.SchemaField)
+    '''
+    client = await _run(get_client)
+    table  = await _run(client.create_table, bigquery.Table(client.dataset(dataset_id).table(table_id), schema=schema))
+    invalidate_metadata(dataset_id, table_id)
+    return table
+
+
+
+
+@_supports_timeout
+async def bq_create_view_async(view_dataset_id, view_id, query):
+    '''
+        Creates a BigQuery View defined by query
+    '''
+    client          = await _run(get_client)
+    view            = bigquery.Table(client.dataset(view_dataset_id).table(view_id))
+    view.view_query = query
+    view            = await _run(client.create_table, view)
+    invalidate_metadata(view_dataset_id, view_id)
+    return view
+
+
+
+
+####################################################################################################
+#
+#   Jobs
+#
+####################################################################################################
+
+
+
+@_supports_timeout
+async def bq_query_async(query, location='US', query_parameters=None, page_size=10000):
+    '''
+        Runs a query and returns all result rows (list of bigquery.Row)
+
+        USAGE:
+        rows = await bq_query_async('select count(*) as count from `zproject201807.demo_dataset1.table_loans`', timeout=60)
+
+    '''
+    client     = await _run(get_client)
+    job_config = bigquery.QueryJobConfig()
+    job_config.query_parameters = query_parameters or []
+
+    query_job = await _run(client.query, query, location=location, job_config=job_config)
+    await _wait_for_job(query_job)
+
+    result = await _run(query_job.result, page_size=page_size)
+    pages  = result.pages
+    rows   = []
+    while True:
+        page = await _run(_next_page, pages)
+        if page is None:
+            return rows
+        rows.extend(page)
+
+
+
+
+@_supports_timeout
+async def bq_create_table_from_query_async(dataset_id, table_id, sql_query, location='US'):
+    '''
+        Writes the result of sql_query to dataset_id.table_id, returning the finished QueryJob
+    '''
+    client     = await _run(get_client)
+    job_config = bigquery.QueryJobConfig()
+    job_config.destination = client.dataset(dataset_id).table(table_id)
+    query_job  = await _run(client.query, sql_query, location=location, job_config=job_config)
+    try:
+        return await _wait_for_job(query_job)
+    finally:
+        invalidate_metadata(dataset_id, table_id)
+
+
+
+
+@_supports_timeout
+async def bq_create_table_from_gcs_async(dataset_id, table_id, gcs_path, schema=None, storage_client=None):
+    '''
+        Loads a CSV file from Google Cloud Storage into dataset_id.table_id, returning the finished LoadJob
+        (see load_job.output_rows)
+
+        USAGE:
+        load_job = await bq_create_table_from_gcs_async('demo_dataset1', 'table_loans', 'gs://zdatasets1/loan_200k.csv')
+
+        The schema comes from the schema registry like in bq_create_table_from_gcs (inferred from samples
+        and registered on the first load of gcs_path); schema= (list of bigquery.SchemaField or a registry
+        key) overrides it. Autodetect is only used when no sample can be read.
+    '''
+    def resolve_schema():
+        if schema is not None:
+            return lookup_schema(schema)
+        try:
+            return get_registry().resolve(source_key(gcs_path), infer=lambda: infer_gcs_schema(gcs_path, storage_client))
+        except Exception:
+            return None
+
+    client     = await _run(get_client)
+    job_config = bigquery.LoadJobConfig()
+    job_config.skip_leading_rows = 1
+    job_config.source_format     = bigquery.SourceFormat.CSV
+    resolved   = await _run(resolve_schema)         # Inference reads from GCS
+    if resolved is not None:
+        job_config.schema     = resolved
+    else:
+        job_config.autodetect = True
+    load_job   = await _run(client.load_table_from_uri, gcs_path, client.dataset(dataset_id).table(table_id), job_config=job_config)
+    try:
+        return await _wait_for_job(load_job)
+    finally:
+        invalidate_metadata(dataset_id, table_id)
+
+
+
+
+@_supports_timeout
+async def bq_copy_table_async(project_id, source_dataset, source_table, dest_dataset, dest_table, location='US'):
+    '''
+        Copies a BigQuery Table, returning the finished CopyJob
+    '''
+    client   = await _run(get_client)
+    copy_job = await _run(client.copy_table,
+                          client.dataset(source_dataset, project=project_id).table(source_table),
+                          client.dataset(dest_dataset).table(dest_table),
+                          location=location)
+    try:
+        return await _wait_for_job(copy_job)
+    finally:
+        invalidate_metadata(dest_dataset, dest_table)
+
+
+
+
+@_supports_timeout
+async def bq_insert_rows_async(dataset_id, table_id, rows_to_insert,
+                               max_rows_per_request=INSERT_MAX_ROWS_PER_REQUEST,
+                               max_bytes_per_request=INSERT_MAX_BYTES_PER_REQUEST,
+                               max_retries=3, insert_id_prefix=None):
+    '''
+        Streams rows into a BigQuery Table; same chunking, retries and result dict as bq_insert_rows
+
+        USAGE:
+        result = await bq_insert_rows_async('demo_dataset1', 'table_empty', rows_to_insert, timeout=120)
+
+    '''
+    loop      = asyncio.get_running_loop()
+    start     = loop.time()
+    client    = await _run(get_client)
+    table     = await _run(get_metadata_cache().get_table, client, client.dataset(dataset_id).table(table_id))
+
+    row_ids   = _insert_row_ids(rows_to_insert, insert_id_prefix)
+    chunks    = _insert_chunks(rows_to_insert, row_ids, [field.name for field in table.schema],
+                               max_rows_per_request, max_bytes_per_request)
+    outcomes  = await asyncio.gather(*[_run(_insert_chunk, client, table, rows_to_insert, row_ids, chunk, max_retries)
+                                       for chunk in chunks])
+
+    failed = {}
+    for _, chunk_failed in outcomes:
+        failed.update(chunk_failed)
+    if failed:
+        invalidate_metadata(dataset_id, table_id)
+
+    return {
+        'rows_sent':   len(rows_to_insert) - len(failed),
+        'rows_failed': len(failed),
+        'requests':    sum(requests for requests, _ in outcomes),
+        'elapsed':     loop.time() - start,
+        'errors':      [{'index': i, 'row': rows_to_insert[i], 'errors': failed[i]} for i in sorted(failed)],
+    }
+
+
+
+#ZEND
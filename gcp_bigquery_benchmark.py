@@ -0,0 +1,1346 @@
+######################################################################################
+#
+#   Google Cloud BigQuery - Benchmarks
+#
+#   Runs against the in-memory backend in gcp_bigquery_fake.py (no GCP project needed)
+#
+#   python gcp_bigquery_benchmark.py --output baseline.json         # every benchmark, results as JSON
+#   python gcp_bigquery_benchmark.py --compare baseline.json        # flags metrics >10% worse than the baseline
+#
+######################################################################################
+
+
+import argparse
+import inspect
+import json
+import multiprocessing
+import resource
+import sys
+import time
+
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import bigquery
+
+import gcp_bigquery_clients
+from gcp_bigquery_fake import FakeBigQueryBackend, FakeTransport, SyntheticRows, fake_client_factory
+
+
+######################################################################################
+#
+#   Benchmarks
+#
+######################################################################################
+
+
+
+def benchmark_bulk_metadata(tables=1000, request_latency=0.005):
+    '''
+        Wall time and API requests to get row counts / sizes / partitioning of every table in a dataset:
+        one get_table() per table (serial) vs bulk_table_metadata() falling back to concurrent get_table() calls
+        vs bulk_table_metadata() with its single INFORMATION_SCHEMA query
+
+        USAGE:
+        benchmark_bulk_metadata(tables=1000, request_latency=0.005)
+
+        The fake cannot run INFORMATION_SCHEMA queries, so for the query case the result is registered up front.
+
+    '''
+    from gcp_bigquery_metadata import BULK_METADATA_FIELDS, _bulk_metadata_sql, _table_metadata_row, bulk_table_metadata
+
+    backend = FakeBigQueryBackend(request_latency=request_latency)
+    base    = '/bigquery/v2/projects/{}/datasets'.format(backend.project)
+    backend.handle('POST', base, {}, {'datasetReference': {'projectId': backend.project, 'datasetId': 'bench_dataset'}})
+    for i in range(tables):
+        backend.handle('POST', base + '/bench_dataset/tables', {},
+                       {'tableReference': {'projectId': backend.project, 'datasetId': 'bench_dataset', 'tableId': 'table_{:05d}'.format(i)},
+                        'schema': {'fields': [{'name': 'id', 'type': 'INTEGER'}, {'name': 'created', 'type': 'TIMESTAMP'}]},
+                        'timePartitioning': {'type': 'DAY', 'field': 'created'}})
+
+    results = {}
+    gcp_bigquery_clients.set_client_factory(fake_client_factory(backend))
+    try:
+        client = gcp_bigquery_clients.get_client()
+
+        def measure(name, fn):
+            requests = backend.request_count
+            start    = time.perf_counter()
+            fn()
+            results[name] = {'seconds': time.perf_counter() - start, 'requests': backend.request_count - requests}
+            print('[ INFO ] {:<28} {:8.2f} s  {:6d} requests'.format(name, results[name]['seconds'], results[name]['requests']))
+
+        measure('get_table per table', lambda: [client.get_table(item.reference) for item in client.list_tables('bench_dataset')])
+        measure('bulk (get_table fallback)', lambda: bulk_table_metadata('bench_dataset'))
+
+        fields = [{'name': name, 'type': field_type, 'mode': 'NULLABLE'} for name, field_type in BULK_METADATA_FIELDS]
+        rows   = [_table_metadata_row(client.get_table(item.reference)) for item in client.list_tables('bench_dataset')]
+        for row in rows:
+            row['created'], row['modified'] = row['created'].timestamp(), row['modified'].timestamp()
+        backend.add_query_result(_bulk_metadata_sql(backend.project, 'bench_dataset', 'US'), fields, rows)
+        measure('bulk (INFORMATION_SCHEMA)', lambda: bulk_table_metadata('bench_dataset', fallback=False))
+    finally:
+        gcp_bigquery_clients.set_client_factory(None)
+    return results
+
+
+
+
+def benchmark_client_pool(calls=200, handshake_latency=0.020, request_latency=0.001):
+    '''
+        Calls/sec of a get_dataset() helper call with a new client per call vs the shared client pool
+
+        USAGE:
+        benchmark_client_pool(calls=200, handshake_latency=0.020, request_latency=0.001)
+
+        handshake_latency models credential loading + TLS handshake for each new HTTP session,
+        request_latency models the round-trip of each API request.
+
+    '''
+    backend = FakeBigQueryBackend(request_latency=request_latency)
+    backend.handle('POST', '/bigquery/v2/projects/{}/datasets'.format(backend.project), {},
+                   {'datasetReference': {'projectId': backend.project, 'datasetId': 'bench_dataset'}})
+
+    # Before: a brand-new client (and HTTP session) for every call
+    start = time.perf_counter()
+    for _ in range(calls):
+        client = bigquery.Client(project     = backend.project,
+                                 credentials = AnonymousCredentials(),
+                                 _http       = FakeTransport(backend, handshake_latency))
+        client.get_dataset(client.dataset('bench_dataset'))
+    per_call_elapsed = time.perf_counter() - start
+
+    # After: every call shares the pooled client
+    gcp_bigquery_clients.set_client_factory(fake_client_factory(backend, handshake_latency))
+    try:
+        start = time.perf_counter()
+        for _ in range(calls):
+            client = gcp_bigquery_clients.get_client()
+            client.get_dataset(client.dataset('bench_dataset'))
+        pooled_elapsed = time.perf_counter() - start
+    finally:
+        gcp_bigquery_clients.set_client_factory(None)
+
+    results = {
+        'calls':                         calls,
+        'per_call_client_calls_per_sec': calls / per_call_elapsed,
+        'pooled_client_calls_per_sec':   calls / pooled_elapsed,
+        'speedup':                       per_call_elapsed / pooled_elapsed,
+    }
+    print('[ INFO ] Client per call:  {:10.1f} calls/sec'.format(results['per_call_client_calls_per_sec']))
+    print('[ INFO ] Pooled client:    {:10.1f} calls/sec'.format(results['pooled_client_calls_per_sec']))
+    print('[ INFO ] Speedup:          {:10.1f}x'.format(results['speedup']))
+    return results
+
+
+
+
+def benchmark_client_overhead(calls=500):
+    '''
+        Time per call of common requests with no simulated latency, split into the time the fake backend
+        spends serving them and the client side (request building, JSON encoding / decoding, response parsing
+        in the client library and the helpers)
+
+        USAGE:
+        benchmark_client_overhead(calls=500)
+
+    '''
+    from gcp_bigquery_demoflow import bq_insert_rows
+
+    backend = FakeBigQueryBackend()
+    backend.handle('POST', '/bigquery/v2/projects/{}/datasets'.format(backend.project), {},
+                   {'datasetReference': {'projectId': backend.project, 'datasetId': 'bench_dataset'}})
+    backend.handle('POST', '/bigquery/v2/projects/{}/datasets/bench_dataset/tables'.format(backend.project), {},
+                   {'tableReference': {'projectId': backend.project, 'datasetId': 'bench_dataset', 'tableId': 'events'},
+                    'schema': {'fields': [{'name': 'id', 'type': 'INTEGER'}, {'name': 'value', 'type': 'FLOAT'}]}})
+    backend.rows[('bench_dataset', 'events')] = [{'id': i, 'value': i * 0.5} for i in range(100)]
+
+    results = {'calls': calls}
+    gcp_bigquery_clients.set_client_factory(fake_client_factory(backend))
+    try:
+        client = gcp_bigquery_clients.get_client()
+        table  = client.get_table('bench_dataset.events')
+        rows   = [(i, i * 0.5) for i in range(10)]
+        paths  = [('get_dataset',          lambda: client.get_dataset('bench_dataset')),
+                  ('get_table',            lambda: client.get_table('bench_dataset.events')),
+                  ('list_rows (100 rows)', lambda: list(client.list_rows(table, max_results=100))),
+                  ('insert (10 rows)',     lambda: bq_insert_rows('bench_dataset', 'events', rows)),
+                  ('query (count)',        lambda: list(client.query('select count(*) from `bench_dataset.events`').result()))]
+
+        print('[ INFO ] {:22} {:>10} {:>14} {:>14} {:>9}'.format('call', 'calls/s', 'client us/call', 'server us/call', 'requests'))
+        for name, fn in paths:
+            fn()                            # Warm up (imports, pooled connections, cached metadata)
+            requests = backend.request_count
+            served   = backend.handler_seconds
+            start    = time.perf_counter()
+            for _ in range(calls):
+                fn()
+            elapsed  = time.perf_counter() - start
+            server   = backend.handler_seconds - served
+            results[name] = {'calls_per_sec':      calls / elapsed,
+                             'client_us_per_call': (elapsed - server) / calls * 1e6,
+                             'server_us_per_call': server / calls * 1e6,
+                             'requests_per_call':  (backend.request_count - requests) / float(calls)}
+            print('[ INFO ] {:22} {:10.0f} {:14.0f} {:14.0f} {:9.1f}'.format(
+                name, results[name]['calls_per_sec'], results[name]['client_us_per_call'],
+                results[name]['server_us_per_call'], results[name]['requests_per_call']))
+    finally:
+        gcp_bigquery_clients.set_client_factory(None)
+    return results
+
+
+
+
+def _write_loan_csv(f, rows, seed=0):
+    '''
+        Writes a synthetic CSV (header row + rows) with the loan_200k.csv schema to the text file f
+    '''
+    import csv
+    import random
+    from gcp_bigquery_schema import LOAN_SCHEMA
+
+    rnd    = random.Random(seed)
+    writer = csv.writer(f)
+    writer.writerow([field.name for field in LOAN_SCHEMA])
+    for i in range(rows):
+        grade = rnd.choice('ABCDEFG')
+        writer.writerow([i, 'm{}'.format(1000000 + i), rnd.randint(1000, 40000), rnd.choice((36, 60)),
+                         round(rnd.uniform(5, 26), 2), round(rnd.uniform(30, 1500), 2), grade, grade + str(rnd.randint(1, 5)),
+                         rnd.randint(0, 10) if rnd.random() > 0.05 else '', rnd.randint(0, 1), rnd.randint(15000, 250000),
+                         rnd.randint(0, 1), int(rnd.random() < 0.15), rnd.choice(('car', 'credit_card', 'debt_consolidation', 'house')),
+                         '{:03d}xx'.format(rnd.randint(0, 999)), rnd.choice(('CA', 'NC', 'NY', 'TX', 'WA')),
+                         rnd.randint(1, 40), rnd.randint(0, 100000)])
+
+
+
+
+def _measure(fn):
+    '''
+        Runs fn in a forked child process, returning (seconds, peak resident memory growth in MB)
+
+        A separate process per measurement keeps peaks independent and avoids tracemalloc's slowdown.
+    '''
+    reader, writer = multiprocessing.Pipe(duplex=False)
+
+    def child():
+        base    = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start   = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        writer.send((elapsed, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base) / 1024.0))
+
+    process = multiprocessing.get_context('fork').Process(target=child)
+    process.start()
+    result  = reader.recv()
+    process.join()
+    return result
+
+
+
+
+def benchmark_clone_dataset(tables=500, views=20, job_latency=0.5, serial_sample=10, max_in_flight=50):
+    '''
+        Wall time of cloning a dataset with one blocking bq_copy_table() per table vs bq_clone_dataset
+
+        USAGE:
+        benchmark_clone_dataset(tables=500, views=20, job_latency=0.5)
+
+        Every fake copy job stays RUNNING for job_latency seconds. The serial time is extrapolated
+        from serial_sample bq_copy_table() calls; each view selects from a table and the previous view.
+
+    '''
+    from gcp_bigquery import bq_clone_dataset, bq_copy_table
+
+    backend = FakeBigQueryBackend()
+    backend.job_latency = job_latency
+    base    = '/bigquery/v2/projects/{}/datasets'.format(backend.project)
+    backend.handle('POST', base, {}, {'datasetReference': {'projectId': backend.project, 'datasetId': 'bench_dataset'}})
+    backend.handle('POST', base, {}, {'datasetReference': {'projectId': backend.project, 'datasetId': 'bench_serial'}})
+    for i in range(tables):
+        backend.handle('POST', base + '/bench_dataset/tables', {},
+                       {'tableReference': {'projectId': backend.project, 'datasetId': 'bench_dataset', 'tableId': 'table_{:05d}'.format(i)},
+                        'schema': {'fields': [{'name': 'id', 'type': 'INTEGER'}]}})
+    for i in range(views):
+        query = 'SELECT id FROM bench_dataset.table_{:05d}'.format(i)
+        if i:
+            query += ' UNION ALL SELECT id FROM `{}.bench_dataset.view_{:05d}`'.format(backend.project, i - 1)
+        backend.handle('POST', base + '/bench_dataset/tables', {},
+                       {'tableReference': {'projectId': backend.project, 'datasetId': 'bench_dataset', 'tableId': 'view_{:05d}'.format(i)},
+                        'view': {'query': query, 'useLegacySql': False}})
+
+    gcp_bigquery_clients.set_client_factory(fake_client_factory(backend))
+    try:
+        start = time.perf_counter()
+        for i in range(serial_sample):
+            bq_copy_table(backend.project, 'bench_dataset', 'table_{:05d}'.format(i), 'bench_serial', 'table_{:05d}'.format(i))
+        serial_elapsed = (time.perf_counter() - start) / serial_sample * (tables + views)
+
+        start  = time.perf_counter()
+        report = bq_clone_dataset(backend.project, 'bench_dataset', 'bench_clone', max_in_flight=max_in_flight)
+        clone_elapsed = time.perf_counter() - start
+    finally:
+        gcp_bigquery_clients.set_client_factory(None)
+
+    results = {'tables': tables, 'views': views, 'job_latency': job_latency, 'serial_seconds': serial_elapsed,
+               'clone_seconds': clone_elapsed, 'copied': report['copied'], 'created': report['created']}
+    print('[ INFO ] bq_copy_table per table:  {:8.2f} s  (estimated from {} copies)'.format(serial_elapsed, serial_sample))
+    print('[ INFO ] bq_clone_dataset:         {:8.2f} s  ({} tables copied, {} views created)'.format(
+        clone_elapsed, report['copied'], report['created']))
+    return results
+
+
+
+
+def benchmark_columnar(rows=10000000, page_size=20000):
+    '''
+        Rows/sec and peak memory decoding a synthetic result into Row objects vs NumPy / Arrow columns
+
+        USAGE:
+        benchmark_columnar(rows=1000000)
+
+        The result (id INTEGER, amount FLOAT, flag BOOLEAN, created TIMESTAMP, state STRING) is generated lazily
+        by the fake backend page by page, so the server side holds no more than one page.
+        Every path pays the same JSON transport cost (the fake runs in-process, so it is in the peak memory too);
+        raw_pages fetches the pages without decoding them, which is the floor for the other paths.
+
+    '''
+    from gcp_bigquery_columnar import fetch_columns
+
+    backend = FakeBigQueryBackend()
+    fields  = [{'name': 'id',      'type': 'INTEGER',   'mode': 'NULLABLE'},
+               {'name': 'amount',  'type': 'FLOAT',     'mode': 'NULLABLE'},
+               {'name': 'flag',    'type': 'BOOLEAN',   'mode': 'NULLABLE'},
+               {'name': 'created', 'type': 'TIMESTAMP', 'mode': 'NULLABLE'},
+               {'name': 'state',   'type': 'STRING',    'mode': 'NULLABLE'}]
+    states  = ['NC', 'CA', 'NV', 'NY', None]
+    backend.add_query_result('select * from synthetic', fields,
+                             SyntheticRows(rows, lambda i: {'id':      i,
+                                                            'amount':  i * 0.25,
+                                                            'flag':    i % 2 == 0,
+                                                            'created': 1530000000 + i,
+                                                            'state':   states[i % 5]}))
+
+    gcp_bigquery_clients.set_client_factory(fake_client_factory(backend))
+    try:
+        client = gcp_bigquery_clients.get_client()
+
+        def raw_pages():
+            query_job = client.query('select * from synthetic')
+            query_job.result(max_results=0)
+            params = {'maxResults': page_size, 'formatOptions.useInt64Timestamp': True}
+            while True:
+                page = client._connection.api_request(method='GET', query_params=params,
+                                                      path='/projects/{}/queries/{}'.format(query_job.project, query_job.job_id))
+                if 'pageToken' not in page:
+                    break
+                params['pageToken'] = page['pageToken']
+
+        paths  = {
+            'raw_pages':     raw_pages,
+            'row_objects':   lambda: list(client.query('select * from synthetic').result(page_size=page_size)),
+            'numpy_columns': lambda: fetch_columns(client, client.query('select * from synthetic'), page_size=page_size),
+            'arrow_table':   lambda: fetch_columns(client, client.query('select * from synthetic'), page_size=page_size, output='arrow'),
+        }
+        results = {'rows': rows}
+        for name, fn in sorted(paths.items()):
+            elapsed, peak = _measure(fn)
+            results[name] = {'rows_per_sec': rows / elapsed, 'peak_mb': peak}
+            print('[ INFO ] {:14s} {:12.0f} rows/sec   peak {:8.1f} MB'.format(name, rows / elapsed, peak))
+    finally:
+        gcp_bigquery_clients.set_client_factory(None)
+    return results
+
+
+
+
+def benchmark_demoflow(rows=200000, request_latency=0.02, job_latency=0.5):
+    '''
+        End-to-end wall time of the demoflow, step by step (gcp_bigquery_demoflow.run_demoflow), vs the same
+        steps run as a pipeline (gcp_bigquery_demoflow.yaml, gcp_bigquery_pipeline.py)
+
+        USAGE:
+        benchmark_demoflow(rows=200000, request_latency=0.02, job_latency=0.5)
+
+        The flow runs unattended against the fake backend, loading a synthetic loan_200k.csv of rows rows
+        from its in-memory Cloud Storage. Every request takes request_latency, every job job_latency.
+
+    '''
+    import contextlib
+    import io
+    import os
+    from gcp_bigquery_demoflow import run_demoflow
+    from gcp_bigquery_pipeline import load_pipeline
+
+    backend = FakeBigQueryBackend(request_latency=request_latency)
+    backend.job_latency = job_latency
+    csv_file = io.StringIO()
+    _write_loan_csv(csv_file, rows)
+    backend.storage.upload('gs://zdatasets1/loan_200k.csv', csv_file.getvalue())
+
+    gcp_bigquery_clients.set_client_factory(fake_client_factory(backend))
+    try:
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            results = run_demoflow(backend.project, 'bench_demoflow', 'US', 'table_empty', 'table_loans',
+                                   'gs://zdatasets1/loan_200k.csv', 'view_loans', confirm=lambda prompt: True)
+        requests = backend.request_count
+        pipeline = load_pipeline(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gcp_bigquery_demoflow.yaml'),
+                                 project_id=backend.project, dataset_id='bench_pipeline')
+        with contextlib.redirect_stdout(output):
+            report = pipeline.run(report=False)
+    finally:
+        gcp_bigquery_clients.set_client_factory(None)
+
+    errors = [line for line in output.getvalue().splitlines() if line.startswith('[ ERROR]')]
+    results.update({'rows': rows, 'requests': requests, 'errors': len(errors),
+                    'pipeline': {'total': report['elapsed'], 'critical_path': report['critical_path'],
+                                 'critical_path_seconds': report['critical_path_seconds'], 'failed': report['failed'],
+                                 'requests': backend.request_count - requests}})
+    for name in ('create', 'query', 'insert', 'view', 'delete', 'total'):
+        if name in results:
+            print('[ INFO ] {:8} {:8.2f} s'.format(name, results[name]))
+    print('[ INFO ] {:8} {:8.2f} s  (critical path: {})'.format('pipeline', report['elapsed'], ' -> '.join(report['critical_path'])))
+    for line in errors:
+        print(line)
+    return results
+
+
+
+
+def benchmark_import(modules=('gcp_bigquery', 'gcp_bigquery_clients', 'gcp_bigquery_jobs'), runs=10):
+    '''
+        Milliseconds to import each helper module in a fresh interpreter, as a short-lived worker process would
+
+        USAGE:
+        benchmark_import(modules=('gcp_bigquery',), runs=10)
+
+        Times come from python -X importtime (median of runs, after one run that writes the bytecode cache).
+        google.cloud.bigquery is timed the same way, as the one-off cost paid by the first helper call,
+        and the heavy libraries (google.cloud, numpy, pyarrow, requests) each module imported are listed.
+
+    '''
+    import os
+    import statistics
+    import subprocess
+    import sys
+
+    heavy = ('google.cloud', 'numpy', 'pyarrow', 'requests')
+    env   = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    cwd   = os.path.dirname(os.path.abspath(__file__))
+
+    def import_ms(module):
+        code    = 'import sys, {}; print(" ".join(name for name in {!r} if name in sys.modules))'.format(module, heavy)
+        timings = []
+        for run in range(runs + 1):
+            result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=cwd, env=env,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+            line   = [line for line in result.stderr.splitlines() if line.split('|')[-1].strip() == module][-1]
+            if run:
+                timings.append(int(line.split('|')[1]) / 1000.0)
+        return statistics.median(timings), result.stdout.split()
+
+    results = {}
+    for module in list(modules) + ['google.cloud.bigquery']:
+        milliseconds, loaded = import_ms(module)
+        results[module] = {'import_ms': milliseconds, 'heavy_modules': loaded}
+        print('[ INFO ] import {:<24} {:8.1f} ms  (loads: {})'.format(module, milliseconds, ', '.join(loaded) or 'none'))
+    return results
+
+
+
+
+def benchmark_insert_rows(rows=50000, request_latency=0.01, max_workers=8, error_rate=0.02, requests_per_second=50):
+    '''
+        Rows/sec of bq_insert_rows() (tabledata.insertAll) with one worker, max_workers workers, and
+        max_workers workers against a backend that fails error_rate of the requests (backendError) and
+        rate-limits insertAll to requests_per_second (rateLimitExceeded)
+
+        USAGE:
+        benchmark_insert_rows(rows=50000, max_workers=8, error_rate=0.02, requests_per_second=50)
+
+        Injected errors are retried by the client library with its own backoff; 'stored' checks that
+        the retries neither lose nor duplicate rows (insertId deduplication).
+
+    '''
+    from gcp_bigquery_demoflow import bq_insert_rows
+
+    backend = FakeBigQueryBackend(request_latency=request_latency, seed=0)
+    backend.handle('POST', '/bigquery/v2/projects/{}/datasets'.format(backend.project), {},
+                   {'datasetReference': {'projectId': backend.project, 'datasetId': 'bench_dataset'}})
+    runs = [('serial', 1, False), ('parallel', max_workers, False), ('parallel, faults', max_workers, True)]
+    for i in range(len(runs)):
+        backend.handle('POST', '/bigquery/v2/projects/{}/datasets/bench_dataset/tables'.format(backend.project), {},
+                       {'tableReference': {'projectId': backend.project, 'datasetId': 'bench_dataset', 'tableId': 'loans_{}'.format(i)},
+                        'schema': {'fields': [{'name': 'id', 'type': 'INTEGER'}, {'name': 'loan_amnt', 'type': 'FLOAT'},
+                                              {'name': 'grade', 'type': 'STRING'}, {'name': 'state', 'type': 'STRING'}]}})
+    data = [(i, 1000.0 + i % 39000, 'ABCDEFG'[i % 7], ('CA', 'NC', 'NY', 'TX', 'WA')[i % 5]) for i in range(rows)]
+
+    results = {'rows': rows}
+    gcp_bigquery_clients.set_client_factory(fake_client_factory(backend))
+    try:
+        print('[ INFO ] {:18} {:>9} {:>12} {:>9} {:>9} {:>8}'.format('run', 'seconds', 'rows/s', 'requests', 'injected', 'stored'))
+        for i, (name, workers, faults) in enumerate(runs):
+            if faults:
+                backend.error_rate = error_rate
+                backend.quotas     = {'insert_all': (requests_per_second, 1.0)}
+            requests = backend.request_count
+            injected = backend.injected_errors
+            start    = time.perf_counter()
+            result   = bq_insert_rows('bench_dataset', 'loans_{}'.format(i), data, max_workers=workers)
+            elapsed  = time.perf_counter() - start
+            results[name] = {'seconds':      elapsed,
+                             'rows_per_sec': result['rows_sent'] / elapsed,
+                             'requests':     backend.request_count - requests,
+                             'injected':     backend.injected_errors - injected,
+                             'stored':       len(backend.rows.get(('bench_dataset', 'loans_{}'.format(i)), []))}
+            print('[ INFO ] {:18} {:9.2f} {:12,.0f} {:9} {:9} {:8}'.format(
+                name, elapsed, results[name]['rows_per_sec'], results[name]['requests'], results[name]['injected'], results[name]['stored']))
+    finally:
+        backend.error_rate = 0.0
+        backend.quotas     = {}
+        gcp_bigquery_clients.set_client_factory(None)
+    return results
+
+
+
+
+def benchmark_job_manager(jobs=20, job_latency=0.5, max_in_flight=50):
+    '''
+        Wall time of copy jobs run one after another (job.result() each) vs through a JobManager
+
+        USAGE:
+        benchmark_job_manager(jobs=20, job_latency=0.5)
+
+        Every fake job stays RUNNING for job_latency seconds.
+
+    '''
+    from gcp_bigquery_jobs import JobManager
+
+    backend = FakeBigQueryBackend()
+    backend.job_latency = job_latency
+    backend.handle('POST', '/bigquery/v2/projects/{}/datasets'.format(backend.project), {},
+                   {'datasetReference': {'projectId': backend.project, 'datasetId': 'bench_dataset'}})
+    backend.handle('POST', '/bigquery/v2/projects/{}/datasets/bench_dataset/tables'.format(backend.project), {},
+                   {'tableReference': {'tableId': 'source'}, 'schema': {'fields': [{'name': 'id', 'type': 'INTEGER'}]}})
+
+    gcp_bigquery_clients.set_client_factory(fake_client_factory(backend))
+    try:
+        client = gcp_bigquery_clients.get_client()
+        source = client.dataset('bench_dataset').table('source')
+
+        start = time.perf_counter()
+        for i in range(jobs):
+            client.copy_table(source, client.dataset('bench_dataset').table('serial_{}'.format(i))).result()
+        serial_elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with JobManager(max_in_flight=max_in_flight) as manager:
+            futures = [manager.submit(lambda i=i: client.copy_table(source, client.dataset('bench_dataset').table('managed_{}'.format(i))))
+                       for i in range(jobs)]
+        for future in futures:
+            future.result()
+        managed_elapsed = time.perf_counter() - start
+    finally:
+        gcp_bigquery_clients.set_client_factory(None)
+
+    results = {'jobs': jobs, 'job_latency': job_latency, 'serial_seconds': serial_elapsed, 'managed_seconds': managed_elapsed}
+    print('[ INFO ] Serial:       {:8.2f} s'.format(serial_elapsed))
+    print('[ INFO ] JobManager:   {:8.2f} s'.format(managed_elapsed))
+    return results
+
+
+
+
+def benchmark_async(calls=2000, request_latency=0.005, max_workers=32):
+    '''
+        Wall time of `calls` table lookups made one after another vs concurrently from asyncio
+
+        USAGE:
+        benchmark_async(calls=2000, request_latency=0.005, max_workers=32)
+
+        All coroutines share max_workers threads / connections; peak_in_flight is the most requests the
+        fake backend served at once. The metadata cache is disabled so every lookup is an API request.
+
+    '''
+    import asyncio
+    import gcp_bigquery_async
+    from gcp_bigquery_metadata import MetadataCache, set_metadata_cache
+
+    backend = FakeBigQueryBackend(request_latency=request_latency)
+    backend.handle('POST', '/bigquery/v2/projects/{}/datasets'.format(backend.project), {},
+                   {'datasetReference': {'projectId': backend.project, 'datasetId': 'bench_dataset'}})
+    backend.handle('POST', '/bigquery/v2/projects/{}/datasets/bench_dataset/tables'.format(backend.project), {},
+                   {'tableReference': {'tableId': 'source'}, 'schema': {'fields': [{'name': 'id', 'type': 'INTEGER'}]}})
+
+    async def lookups():
+        return await asyncio.gather(*[gcp_bigquery_async.bq_table_metadata_async('bench_dataset', 'source', timeout=60)
+                                      for _ in range(calls)])
+
+    gcp_bigquery_clients.set_client_factory(fake_client_factory(backend))
+    gcp_bigquery_async.set_max_workers(max_workers)
+    set_metadata_cache(MetadataCache(max_entries=0))
+    try:
+        client = gcp_bigquery_clients.get_client()
+        serial_calls = min(calls, 200)
+        start = time.perf_counter()
+        for _ in range(serial_calls):
+            client.get_table(client.dataset('bench_dataset').table('source'))
+        serial_elapsed = (time.perf_counter() - start) * calls / serial_calls     # Extrapolated
+
+        backend.peak_in_flight = 0
+        start = time.perf_counter()
+        asyncio.run(lookups())
+        async_elapsed = time.perf_counter() - start
+    finally:
+        set_metadata_cache(None)
+        gcp_bigquery_async.set_max_workers(gcp_bigquery_clients.DEFAULT_POOL_SIZE)
+        gcp_bigquery_clients.set_client_factory(None)
+
+    results = {'calls': calls, 'request_latency': request_latency, 'max_workers': max_workers,
+               'serial_seconds': serial_elapsed, 'async_seconds': async_elapsed, 'peak_in_flight': backend.peak_in_flight}
+    print('[ INFO ] Serial (est): {:8.2f} s'.format(serial_elapsed))
+    print('[ INFO ] asyncio:      {:8.2f} s  ({} requests in flight at most)'.format(async_elapsed, backend.peak_in_flight))
+    return results
+
+
+
+
+def benchmark_listing(datasets=2000, tables_per_dataset=5, request_latency=0.005, max_workers=32, measure_memory=False):
+    '''
+        Wall time and peak memory of a project-wide table inventory:
+        list(list_datasets()) then list(list_tables()) per dataset (serial) vs the iter_project_tables() fan-out
+
+        USAGE:
+        benchmark_listing(datasets=2000, tables_per_dataset=5, request_latency=0.005, max_workers=32)
+
+        request_latency models the round-trip of each datasets.list / tables.list page.
+        measure_memory=True repeats each listing under tracemalloc for its peak memory (tracemalloc slows it down several times).
+
+    '''
+    import tracemalloc
+    from gcp_bigquery_listing import iter_project_tables
+
+    backend = FakeBigQueryBackend(request_latency=request_latency)
+    base    = '/bigquery/v2/projects/{}/datasets'.format(backend.project)
+    for d in range(datasets):
+        dataset_id = 'dataset_{:05d}'.format(d)
+        backend.handle('POST', base, {}, {'datasetReference': {'projectId': backend.project, 'datasetId': dataset_id}})
+        for t in range(tables_per_dataset):
+            backend.handle('POST', base + '/{}/tables'.format(dataset_id), {},
+                           {'tableReference': {'projectId': backend.project, 'datasetId': dataset_id, 'tableId': 'table_{}'.format(t)}})
+
+    def serial():
+        client = gcp_bigquery_clients.get_client()
+        tables = []
+        for dataset in list(client.list_datasets()):
+            tables.extend(list(client.list_tables(dataset)))
+        return len(tables)
+
+    def fan_out():
+        return sum(1 for _ in iter_project_tables(max_workers=max_workers))
+
+    results = {}
+    gcp_bigquery_clients.set_client_factory(fake_client_factory(backend))
+    try:
+        for name, fn in (('serial', serial), ('fan-out', fan_out)):
+            requests = backend.request_count
+            start    = time.perf_counter()
+            tables   = fn()
+            results[name] = {'seconds': time.perf_counter() - start, 'requests': backend.request_count - requests, 'tables': tables}
+            if measure_memory:
+                tracemalloc.start()
+                fn()
+                results[name]['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            print('[ INFO ] {:<8} {:8.2f} s  {:6d} requests  {:6d} tables{}'.format(
+                name, results[name]['seconds'], results[name]['requests'], tables,
+                '  peak {:.1f} MB'.format(results[name]['peak_bytes'] / 1e6) if measure_memory else ''))
+    finally:
+        gcp_bigquery_clients.set_client_factory(None)
+    return results
+
+
+
+
+def benchmark_metadata_cache(inserts=200, request_latency=0.005):
+    '''
+        API requests and wall time of many small bq_insert_rows() calls without vs with the metadata cache
+
+        USAGE:
+        benchmark_metadata_cache(inserts=200, request_latency=0.005)
+
+        request_latency models the round-trip of each API request. Without the cache every insert
+        fetches the table (for its schema) before the insertAll request.
+
+    '''
+    from gcp_bigquery_demoflow import bq_insert_rows
+    from gcp_bigquery_metadata import MetadataCache, set_metadata_cache
+
+    backend = FakeBigQueryBackend(request_latency=request_latency)
+    backend.handle('POST', '/bigquery/v2/projects/{}/datasets'.format(backend.project), {},
+                   {'datasetReference': {'projectId': backend.project, 'datasetId': 'bench_dataset'}})
+    backend.handle('POST', '/bigquery/v2/projects/{}/datasets/bench_dataset/tables'.format(backend.project), {},
+                   {'tableReference': {'projectId': backend.project, 'datasetId': 'bench_dataset', 'tableId': 'events'},
+                    'schema': {'fields': [{'name': 'id', 'type': 'INTEGER'}, {'name': 'value', 'type': 'FLOAT'}]}})
+
+    results = {}
+    gcp_bigquery_clients.set_client_factory(fake_client_factory(backend))
+    try:
+        for name, cache in (('uncached', MetadataCache(max_entries=0)), ('cached', MetadataCache())):
+            set_metadata_cache(cache)
+            requests = backend.request_count
+            start    = time.perf_counter()
+            for i in range(inserts):
+                bq_insert_rows('bench_dataset', 'events', [(i, i * 0.5)])
+            results[name] = {'seconds': time.perf_counter() - start, 'requests': backend.request_count - requests}
+            print('[ INFO ] {:<9} {:8.2f} s  {:6d} requests  ({:.1f} per insert)'.format(
+                name, results[name]['seconds'], results[name]['requests'], results[name]['requests'] / float(inserts)))
+    finally:
+        set_metadata_cache(None)
+        gcp_bigquery_clients.set_client_factory(None)
+    return results
+
+
+
+
+def benchmark_export(rows=200000, rows_per_file=20000, bytes_per_second=2000000, max_workers=8):
+    '''
+        Wall time of downloading the shards of a sharded export one after another vs in parallel (download_shards)
+
+        USAGE:
+        benchmark_export(rows=200000, rows_per_file=20000, bytes_per_second=2000000)
+
+        Every fake download streams at bytes_per_second (a single connection's throughput); one shard
+        breaks off halfway on its first download and is resumed.
+
+    '''
+    import os
+    import shutil
+    import tempfile
+    from gcp_bigquery_export import download_shards, export_table, list_export_shards
+
+    backend = FakeBigQueryBackend()
+    backend.extract_rows_per_file = rows_per_file
+    backend.handle('POST', '/bigquery/v2/projects/{}/datasets'.format(backend.project), {},
+                   {'datasetReference': {'projectId': backend.project, 'datasetId': 'bench_dataset'}})
+    backend.handle('POST', '/bigquery/v2/projects/{}/datasets/bench_dataset/tables'.format(backend.project), {},
+                   {'tableReference': {'projectId': backend.project, 'datasetId': 'bench_dataset', 'tableId': 'loans'},
+                    'schema': {'fields': [{'name': 'id', 'type': 'INTEGER'}, {'name': 'loan_amnt', 'type': 'INTEGER'},
+                                          {'name': 'grade', 'type': 'STRING'}]}})
+    backend.rows[('bench_dataset', 'loans')] = [{'id': i, 'loan_amnt': 1000 + i % 39000, 'grade': 'ABCDEFG'[i % 7]} for i in range(rows)]
+
+    temp_dir = tempfile.mkdtemp(prefix='bq_export_')
+    gcp_bigquery_clients.set_client_factory(fake_client_factory(backend))
+    try:
+        destination = 'gs://bench-bucket/exports/loans-*.csv'
+        report      = export_table('bench_dataset', 'loans', destination, destination_format='CSV', storage_client=backend.storage)
+        blobs       = list_export_shards(destination, backend.storage)
+        backend.storage.bytes_per_second = bytes_per_second
+
+        start = time.perf_counter()
+        download_shards(blobs, os.path.join(temp_dir, 'serial'), max_workers=1)
+        serial_elapsed = time.perf_counter() - start
+
+        backend.storage.failing_downloads = {destination.replace('*', '{:012d}'.format(len(blobs) // 2)): 1}
+        start  = time.perf_counter()
+        shards = download_shards(blobs, os.path.join(temp_dir, 'parallel'), max_workers=max_workers, retry_delay=0)
+        parallel_elapsed = time.perf_counter() - start
+    finally:
+        gcp_bigquery_clients.set_client_factory(None)
+        shutil.rmtree(temp_dir)
+
+    resumed = sum(1 for shard in shards if shard['attempts'] > 1)
+    failed  = sum(1 for shard in shards if shard['state'] == 'FAILED')
+    results = {'files': report['files'], 'bytes': report['input_bytes'], 'serial_seconds': serial_elapsed,
+               'parallel_seconds': parallel_elapsed, 'resumed_shards': resumed, 'failed_shards': failed}
+    print('[ INFO ] One shard at a time: {:8.2f} s  ({} files, {:,d} bytes)'.format(serial_elapsed, report['files'], report['input_bytes']))
+    print('[ INFO ] download_shards:     {:8.2f} s  ({} workers, {} shard(s) resumed, {} failed)'.format(
+        parallel_elapsed, max_workers, resumed, failed))
+    return results
+
+
+
+
+def benchmark_storage_read(rows=500000, max_streams=8, page_size=20000, request_latency=0.02, stream_bytes_per_second=20000000):
+    '''
+        Read throughput of tabledata.list JSON pages (REST) vs the Storage Read API with 1 and max_streams streams
+
+        USAGE:
+        benchmark_storage_read(rows=500000, max_streams=8, stream_bytes_per_second=20000000)
+
+        The REST pages come from the fake backend (request_latency per page); the read streams from a local
+        FakeReadServer over gRPC, each stream capped at stream_bytes_per_second.
+
+    '''
+    from gcp_bigquery_fake import FakeReadServer
+    from gcp_bigquery_read import create_read_session, read_table
+
+    backend = FakeBigQueryBackend(request_latency=request_latency)
+    backend.handle('POST', '/bigquery/v2/projects/{}/datasets'.format(backend.project), {},
+                   {'datasetReference': {'projectId': backend.project, 'datasetId': 'bench_dataset'}})
+    backend.handle('POST', '/bigquery/v2/projects/{}/datasets/bench_dataset/tables'.format(backend.project), {},
+                   {'tableReference': {'projectId': backend.project, 'datasetId': 'bench_dataset', 'tableId': 'loans'},
+                    'schema': {'fields': [{'name': 'id', 'type': 'INTEGER'}, {'name': 'loan_amnt', 'type': 'FLOAT'},
+                                          {'name': 'grade', 'type': 'STRING'}, {'name': 'state', 'type': 'STRING'}]}})
+    backend.rows[('bench_dataset', 'loans')] = [{'id': i, 'loan_amnt': 1000.0 + i % 39000, 'grade': 'ABCDEFG'[i % 7],
+                                                 'state': ('CA', 'NC', 'NY', 'TX', 'WA')[i % 5]} for i in range(rows)]
+
+    server = FakeReadServer(backend, batch_rows=page_size, bytes_per_second=stream_bytes_per_second)
+    gcp_bigquery_clients.set_client_factory(fake_client_factory(backend))
+    gcp_bigquery_clients.set_read_client_factory(server.client_factory())
+    results = {'rows': rows}
+    try:
+        client = gcp_bigquery_clients.get_client()
+        table  = client.get_table('{}.bench_dataset.loans'.format(backend.project))
+        start  = time.perf_counter()
+        count  = sum(1 for _ in client.list_rows(table, page_size=page_size))
+        rest_elapsed = time.perf_counter() - start
+
+        create_read_session('bench_dataset.loans', max_streams=1)       # The fake server builds its Arrow copy once
+        arrow_bytes = None
+        for streams in (1, max_streams):
+            start  = time.perf_counter()
+            arrow  = read_table('bench_dataset.loans', max_streams=streams)
+            results['storage_read_{}_seconds'.format(streams)] = time.perf_counter() - start
+            arrow_bytes = arrow.nbytes
+    finally:
+        gcp_bigquery_clients.set_read_client_factory(None)
+        gcp_bigquery_clients.set_client_factory(None)
+        server.stop()
+
+    results.update({'rest_seconds': rest_elapsed, 'rest_rows': count, 'arrow_bytes': arrow_bytes})
+    print('[ INFO ] {:28} {:>9} {:>12} {:>9}'.format('path', 'seconds', 'rows/s', 'MB/s'))
+    for name, elapsed in [('tabledata.list (REST pages)', rest_elapsed),
+                          ('Read API, 1 stream', results['storage_read_1_seconds']),
+                          ('Read API, {} streams'.format(max_streams), results['storage_read_{}_seconds'.format(max_streams)])]:
+        print('[ INFO ] {:28} {:9.2f} {:12,.0f} {:9.1f}'.format(name, elapsed, rows / elapsed, arrow_bytes / 1e6 / elapsed))
+    return results
+
+
+
+
+def benchmark_storage_write(rows=100000, request_latency=0.01, append_latency=0.01, max_streams=4):
+    '''
+        Insert throughput of tabledata.insertAll (bq_insert_rows) vs the Storage Write API modes
+
+        USAGE:
+        benchmark_storage_write(rows=100000, max_streams=4)
+
+        insertAll requests go to the fake backend (request_latency each); appends go to a local
+        FakeWriteServer over gRPC (append_latency each), max_streams streams at once.
+
+    '''
+    from gcp_bigquery_demoflow import bq_insert_rows
+    from gcp_bigquery_fake import FakeWriteServer
+
+    backend = FakeBigQueryBackend(request_latency=request_latency)
+    backend.handle('POST', '/bigquery/v2/projects/{}/datasets'.format(backend.project), {},
+                   {'datasetReference': {'projectId': backend.project, 'datasetId': 'bench_dataset'}})
+    runs = [('insert_all', 'json'), ('default', 'proto'), ('committed', 'proto'), ('committed', 'arrow'), ('pending', 'proto')]
+    for mode, data_format in runs:
+        backend.handle('POST', '/bigquery/v2/projects/{}/datasets/bench_dataset/tables'.format(backend.project), {},
+                       {'tableReference': {'projectId': backend.project, 'datasetId': 'bench_dataset',
+                                           'tableId': 'loans_{}_{}'.format(mode, data_format)},
+                        'schema': {'fields': [{'name': 'id', 'type': 'INTEGER', 'mode': 'REQUIRED'},
+                                              {'name': 'loan_amnt', 'type': 'FLOAT'}, {'name': 'grade', 'type': 'STRING'},
+                                              {'name': 'state', 'type': 'STRING'}]}})
+    data = [(i, 1000.0 + i % 39000, 'ABCDEFG'[i % 7], ('CA', 'NC', 'NY', 'TX', 'WA')[i % 5]) for i in range(rows)]
+
+    server = FakeWriteServer(backend, append_latency=append_latency)
+    gcp_bigquery_clients.set_client_factory(fake_client_factory(backend))
+    gcp_bigquery_clients.set_write_client_factory(server.client_factory())
+    results = {'rows': rows}
+    try:
+        print('[ INFO ] {:22} {:>9} {:>12} {:>9} {:>8}'.format('mode', 'seconds', 'rows/s', 'requests', 'stored'))
+        for mode, data_format in runs:
+            table_id = 'loans_{}_{}'.format(mode, data_format)
+            start    = time.perf_counter()
+            result   = bq_insert_rows('bench_dataset', table_id, data, max_workers=max_streams, mode=mode,
+                                      data_format=data_format if mode != 'insert_all' else 'proto')
+            elapsed  = time.perf_counter() - start
+            stored   = len(backend.rows.get(('bench_dataset', table_id), []))
+            results['{}_{}_seconds'.format(mode, data_format)] = elapsed
+            print('[ INFO ] {:22} {:9.2f} {:12,.0f} {:9} {:8}'.format('{} ({})'.format(mode, data_format), elapsed,
+                                                                     result['rows_sent'] / elapsed, result['requests'], stored))
+    finally:
+        gcp_bigquery_clients.set_write_client_factory(None)
+        gcp_bigquery_clients.set_client_factory(None)
+        server.stop()
+    return results
+
+
+
+
+def benchmark_sharded_load(shards=40, rows_per_shard=100, job_latency=0.1, max_uris_per_job=10):
+    '''
+        Wall time of loading CSV shards with one load job per file (serial) vs load_gcs_shards
+
+        USAGE:
+        benchmark_sharded_load(shards=40, job_latency=0.1, max_uris_per_job=10)
+
+        Every fake load job stays RUNNING for job_latency seconds; one shard fails on its first read. Rate limiting
+        is off: every job loads into the same table, and the limiter would pace them at the table update quota.
+
+    '''
+    import gcp_bigquery_quota
+    from gcp_bigquery_load import load_gcs_shards
+
+    backend = FakeBigQueryBackend()
+    backend.job_latency = job_latency
+    backend.handle('POST', '/bigquery/v2/projects/{}/datasets'.format(backend.project), {},
+                   {'datasetReference': {'projectId': backend.project, 'datasetId': 'bench_dataset'}})
+    uris = ['gs://bench-bucket/loans/part-{:05d}.csv'.format(i) for i in range(shards)]
+    for i, uri in enumerate(uris):
+        backend.storage.upload(uri, 'id,loan_amnt,grade\n' + ''.join('{},{},B\n'.format(i * rows_per_shard + j, 1000 + j)
+                                                                     for j in range(rows_per_shard)))
+
+    job_config = bigquery.LoadJobConfig()
+    job_config.autodetect        = True
+    job_config.skip_leading_rows = 1
+    job_config.source_format     = bigquery.SourceFormat.CSV
+
+    gcp_bigquery_clients.set_client_factory(fake_client_factory(backend))
+    try:
+        gcp_bigquery_quota.set_rate_limits(None)
+        client = gcp_bigquery_clients.get_client()
+        start  = time.perf_counter()
+        for uri in uris:
+            client.load_table_from_uri(uri, client.dataset('bench_dataset').table('serial'), job_config=job_config).result()
+        serial_elapsed = time.perf_counter() - start
+
+        backend.failing_uris = {uris[shards // 2]: 1}
+        start  = time.perf_counter()
+        report = load_gcs_shards('bench_dataset', 'sharded', 'gs://bench-bucket/loans/*.csv', job_config=job_config,
+                                 max_uris_per_job=max_uris_per_job, storage_client=backend.storage)
+        sharded_elapsed = time.perf_counter() - start
+    finally:
+        gcp_bigquery_clients.set_client_factory(None)
+        gcp_bigquery_quota.set_rate_limits()
+
+    results = {'shards': shards, 'job_latency': job_latency, 'serial_seconds': serial_elapsed,
+               'sharded_seconds': sharded_elapsed, 'jobs': report['jobs'], 'retried_shards': report['retried_shards'],
+               'output_rows': report['output_rows']}
+    print('[ INFO ] One job per file:  {:8.2f} s  ({} jobs)'.format(serial_elapsed, shards))
+    print('[ INFO ] load_gcs_shards:   {:8.2f} s  ({} jobs, {} shards retried, {} rows)'.format(
+        sharded_elapsed, report['jobs'], report['retried_shards'], report['output_rows']))
+    return results
+
+
+
+
+def benchmark_local_load(rows=200000):
+    '''
+        Load preparation time, bytes uploaded and peak memory of CSV (autodetect) vs Parquet / Avro (explicit schema)
+
+        USAGE:
+        benchmark_local_load(rows=200000)
+
+        Uses a synthetic CSV with the loan_200k.csv schema. The CSV is uploaded as is (no preparation);
+        the other formats are converted from it by write_load_file() in a forked child each.
+
+    '''
+    import os
+    import shutil
+    import tempfile
+    from gcp_bigquery_local_load import LOAN_SCHEMA, write_load_file
+
+    temp_dir = tempfile.mkdtemp(prefix='bq_local_load_')
+    csv_path = os.path.join(temp_dir, 'loans.csv')
+    with open(csv_path, 'w', newline='') as f:
+        _write_loan_csv(f, rows)
+
+    variants = [('PARQUET', 'snappy'), ('PARQUET', 'zstd'), ('AVRO', 'deflate'), ('AVRO', 'null')]
+    csv_bytes = os.path.getsize(csv_path)
+    results   = {'rows': rows, 'CSV': {'prepare_seconds': 0.0, 'bytes': csv_bytes, 'peak_mb': 0.0}}
+    try:
+        print('[ INFO ] {:18} {:>10} {:>14} {:>9} {:>10}'.format('format', 'prepare s', 'bytes', 'vs CSV', 'peak MB'))
+        print('[ INFO ] {:18} {:10.2f} {:14,d} {:9.2f} {:10.1f}'.format('CSV (autodetect)', 0.0, csv_bytes, 1.0, 0.0))
+        for source_format, compression in variants:
+            path = os.path.join(temp_dir, 'loans.{}.{}'.format(compression, source_format.lower()))
+            elapsed, peak_mb = _measure(lambda: write_load_file(csv_path, LOAN_SCHEMA, path, source_format, compression))
+            name = '{} ({})'.format(source_format, compression)
+            results[name] = {'prepare_seconds': elapsed, 'bytes': os.path.getsize(path), 'peak_mb': peak_mb}
+            print('[ INFO ] {:18} {:10.2f} {:14,d} {:9.2f} {:10.1f}'.format(
+                name, elapsed, os.path.getsize(path), os.path.getsize(path) / float(csv_bytes), peak_mb))
+    finally:
+        shutil.rmtree(temp_dir)
+    return results
+
+
+
+
+def benchmark_query_scheduler(backfill=40, interactive=20, distinct=5, max_workers=32, interactive_limit=10,
+                              job_latency=0.2, request_latency=0.005):
+    '''
+        Backfill plus interactive queries: all INTERACTIVE from a thread pool vs QueryScheduler (backfill as BATCH,
+        limits on queries in flight per class, single-flight for repeated interactive queries)
+
+        USAGE:
+        benchmark_query_scheduler(backfill=40, interactive=20, distinct=5, interactive_limit=10)
+
+        The fake backend keeps each job RUNNING for job_latency seconds and answers interactive queries beyond
+        interactive_limit running at once with rateLimitExceeded. The backfill is submitted first; the interactive
+        queries (distinct different SQL statements, repeated) right after it. Latency is measured from submission.
+
+    '''
+    import concurrent.futures
+    import contextlib
+    import io
+    from gcp_bigquery_scheduler import QueryScheduler
+
+    backfill_sql    = ['select count(*) as backfill_{} from `bench_dataset.table_1`'.format(i) for i in range(backfill)]
+    interactive_sql = ['select count(*) as dashboard_{} from `bench_dataset.table_1`'.format(i % distinct) for i in range(interactive)]
+    results = {'backfill': backfill, 'interactive': interactive, 'interactive_limit': interactive_limit}
+    print('[ INFO ] {:10} {:>9} {:>9} {:>13} {:>13} {:>6} {:>9} {:>6}'.format(
+        'run', 'seconds', 'queries/s', 'interactive50', 'interactive95', 'jobs', 'rejected', 'failed'))
+    try:
+        for name in ('pool', 'scheduler'):
+            backend = FakeBigQueryBackend(request_latency=request_latency)
+            backend.handle('POST', '/bigquery/v2/projects/{}/datasets'.format(backend.project), {},
+                           {'datasetReference': {'projectId': backend.project, 'datasetId': 'bench_dataset'}})
+            backend.handle('POST', '/bigquery/v2/projects/{}/datasets/bench_dataset/tables'.format(backend.project), {},
+                           {'tableReference': {'projectId': backend.project, 'datasetId': 'bench_dataset', 'tableId': 'table_1'}})
+            backend.job_latency             = job_latency
+            backend.max_interactive_queries = interactive_limit
+            gcp_bigquery_clients.set_client_factory(fake_client_factory(backend))
+            client = gcp_bigquery_clients.get_client()
+
+            latencies = []
+            failed    = 0
+            start     = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                if name == 'pool':
+                    def run(sql, submitted):
+                        client.query(sql).result()
+                        return time.perf_counter() - submitted
+                    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+                        for sql in backfill_sql:
+                            executor.submit(run, sql, time.perf_counter())
+                        futures = [executor.submit(run, sql, time.perf_counter()) for sql in interactive_sql]
+                    for future in futures:
+                        try:
+                            latencies.append(future.result())
+                        except Exception:
+                            failed += 1
+                else:
+                    with QueryScheduler(max_in_flight={'INTERACTIVE': interactive_limit, 'BATCH': max_workers},
+                                        client=client, initial_poll_interval=0.05) as scheduler:
+                        for sql in backfill_sql:
+                            scheduler.submit(sql, priority='BATCH')
+                        submitted = [(scheduler.submit(sql), time.perf_counter()) for sql in interactive_sql]
+                        for future, at in submitted:
+                            try:
+                                future.result()
+                                latencies.append(time.perf_counter() - at)
+                            except Exception:
+                                failed += 1
+                    results['scheduler_metrics'] = scheduler.metrics()
+            elapsed   = time.perf_counter() - start
+            latencies = sorted(latencies) or [float('nan')]
+            results[name] = {'seconds':                 elapsed,
+                             'queries_per_sec':         (backfill + interactive) / elapsed,
+                             'interactive_p50_seconds': latencies[int(0.50 * (len(latencies) - 1))],
+                             'interactive_p95_seconds': latencies[int(0.95 * (len(latencies) - 1))],
+                             'jobs':                    len(backend.jobs),
+                             'rejected':                backend.injected_errors,
+                             'failed':                  failed}
+            print('[ INFO ] {:10} {:9.2f} {:9.1f} {:13.2f} {:13.2f} {:6d} {:9d} {:6d}'.format(
+                name, elapsed, results[name]['queries_per_sec'], results[name]['interactive_p50_seconds'],
+                results[name]['interactive_p95_seconds'], results[name]['jobs'], results[name]['rejected'], failed))
+    finally:
+        gcp_bigquery_clients.set_client_factory(None)
+    return results
+
+
+
+
+def benchmark_rate_limit(updates=60, tables=3, max_workers=16, requests=5, seconds=1.0, request_latency=0.005):
+    '''
+        Fan-out of table metadata updates against a per-table rate limit: client library retries only vs the
+        shared rate limiter (gcp_bigquery_quota.py) in front of them
+
+        USAGE:
+        benchmark_rate_limit(updates=60, tables=3, max_workers=16, requests=5, seconds=1.0)
+
+        The fake backend answers tables.patch beyond requests per seconds per table with rateLimitExceeded
+        (BigQuery allows 5 per 10 seconds; the window is shortened to keep the run short).
+
+    '''
+    import concurrent.futures
+    import contextlib
+    import io
+    import gcp_bigquery_quota
+    from gcp_bigquery import bq_update_table_metadata
+
+    limits   = dict(gcp_bigquery_quota.OPERATION_LIMITS, table_update=(requests, seconds, 'table'))
+    variants = [('library retries', None),
+                ('rate limiter',    limits)]
+    results  = {'updates': updates, 'tables': tables, 'limit': '{} per {}s per table'.format(requests, seconds)}
+    print('[ INFO ] {:16} {:>9} {:>10} {:>9} {:>9} {:>8}'.format('run', 'seconds', 'updates/s', 'requests', 'rejected', 'failed'))
+    try:
+        for name, variant_limits in variants:
+            backend = FakeBigQueryBackend(request_latency=request_latency)
+            backend.handle('POST', '/bigquery/v2/projects/{}/datasets'.format(backend.project), {},
+                           {'datasetReference': {'projectId': backend.project, 'datasetId': 'bench_dataset'}})
+            for i in range(tables):
+                backend.handle('POST', '/bigquery/v2/projects/{}/datasets/bench_dataset/tables'.format(backend.project), {},
+                               {'tableReference': {'projectId': backend.project, 'datasetId': 'bench_dataset',
+                                                   'tableId': 'table_{}'.format(i)}})
+            backend.quotas = {'patch_table': (requests, seconds, 'table')}
+            gcp_bigquery_clients.set_client_factory(fake_client_factory(backend))
+            gcp_bigquery_quota.set_rate_limits(variant_limits)
+
+            output = io.StringIO()
+            start  = time.perf_counter()
+            with contextlib.redirect_stdout(output), concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+                list(executor.map(lambda i: bq_update_table_metadata('bench_dataset', 'table_{}'.format(i % tables),
+                                                                     new_description='update {}'.format(i)), range(updates)))
+            elapsed = time.perf_counter() - start
+            results[name] = {'seconds':           elapsed,
+                             'updates_per_sec':   updates / elapsed,
+                             'requests':          backend.request_count,
+                             'rejected':          backend.injected_errors,
+                             'failed':            output.getvalue().count('[ ERROR')}
+            print('[ INFO ] {:16} {:9.2f} {:10.1f} {:9d} {:9d} {:8d}'.format(
+                name, elapsed, updates / elapsed, backend.request_count, backend.injected_errors, results[name]['failed']))
+    finally:
+        gcp_bigquery_clients.set_client_factory(None)
+        gcp_bigquery_quota.set_rate_limits()
+    results['ceiling_updates_per_sec'] = tables * requests / seconds
+    return results
+
+
+
+
+def benchmark_telemetry(calls=500, rounds=3):
+    '''
+        Time per helper call with telemetry off (undecorated helper on a client without instrumented requests,
+        no sinks) and on (histogram, JSON lines)
+
+        USAGE:
+        benchmark_telemetry(calls=500, rounds=3)
+
+        Calls bq_query() on a count query against the fake backend (no simulated latency), so the numbers are
+        dominated by client side overhead and the telemetry cost is as visible as it gets.
+
+    '''
+    import contextlib
+    import os
+    import gcp_bigquery_quota
+    import gcp_bigquery_telemetry
+    from gcp_bigquery_demoflow import bq_query
+
+    backend = FakeBigQueryBackend()
+    backend.handle('POST', '/bigquery/v2/projects/{}/datasets'.format(backend.project), {},
+                   {'datasetReference': {'projectId': backend.project, 'datasetId': 'bench_dataset'}})
+    backend.handle('POST', '/bigquery/v2/projects/{}/datasets/bench_dataset/tables'.format(backend.project), {},
+                   {'tableReference': {'projectId': backend.project, 'datasetId': 'bench_dataset', 'tableId': 'events'},
+                    'schema': {'fields': [{'name': 'id', 'type': 'INTEGER'}]}})
+    backend.rows[('bench_dataset', 'events')] = [{'id': i} for i in range(100)]
+
+    query   = 'select count(*) from `bench_dataset.events`'
+    devnull = open(os.devnull, 'w')
+    results = {'calls': calls, 'rounds': rounds}
+    instrument_session = gcp_bigquery_clients.instrument_session
+    gcp_bigquery_telemetry.clear_sinks()
+    gcp_bigquery_quota.set_rate_limits(None)             # Pacing jobs.insert would hide the per-call cost
+    try:
+        variants = [('undecorated', lambda: bq_query.__wrapped__(query), None),
+                    ('disabled',    lambda: bq_query(query),             None),
+                    ('histogram',   lambda: bq_query(query),             gcp_bigquery_telemetry.HistogramSink()),
+                    ('json lines',  lambda: bq_query(query),             gcp_bigquery_telemetry.JsonLinesSink(devnull, flush=False))]
+
+        best = {}
+        for _ in range(rounds):                             # Variants interleaved, best round kept: less noise
+            for name, fn, sink in variants:
+                # The baseline's pooled client is built without request instrumentation, the others with it
+                gcp_bigquery_clients.instrument_session = (lambda session: session) if name == 'undecorated' else instrument_session
+                gcp_bigquery_clients.set_client_factory(fake_client_factory(backend))
+                if sink is not None:
+                    gcp_bigquery_telemetry.add_sink(sink)
+                try:
+                    with contextlib.redirect_stdout(devnull):    # bq_query() prints the result preview
+                        for _ in range(max(1, calls // 10)):    # Warm up (imports, pooled connections)
+                            fn()
+                        start   = time.perf_counter()
+                        for _ in range(calls):
+                            fn()
+                        elapsed = time.perf_counter() - start
+                finally:
+                    gcp_bigquery_telemetry.clear_sinks()
+                best[name] = min(best.get(name, elapsed), elapsed)
+
+        print('[ INFO ] {:14} {:>10} {:>10} {:>12}'.format('telemetry', 'calls/s', 'us/call', 'overhead us'))
+        for name, _, _ in variants:
+            results[name] = {'calls_per_sec': calls / best[name],
+                             'us_per_call':   best[name] / calls * 1e6,
+                             'overhead_us':   (best[name] - best['undecorated']) / calls * 1e6}
+            print('[ INFO ] {:14} {:10.0f} {:10.0f} {:12.1f}'.format(
+                name, results[name]['calls_per_sec'], results[name]['us_per_call'], results[name]['overhead_us']))
+    finally:
+        gcp_bigquery_clients.instrument_session = instrument_session
+        gcp_bigquery_clients.set_client_factory(None)
+        gcp_bigquery_quota.set_rate_limits()
+        devnull.close()
+    return results
+
+
+
+
+BENCHMARKS = {
+    'async':           benchmark_async,
+    'bulk_metadata':   benchmark_bulk_metadata,
+    'client_overhead': benchmark_client_overhead,
+    'client_pool':     benchmark_client_pool,
+    'clone_dataset':   benchmark_clone_dataset,
+    'columnar':        benchmark_columnar,
+    'demoflow':        benchmark_demoflow,
+    'export':          benchmark_export,
+    'import':          benchmark_import,
+    'insert_rows':     benchmark_insert_rows,
+    'job_manager':     benchmark_job_manager,
+    'listing':         benchmark_listing,
+    'local_load':      benchmark_local_load,
+    'metadata_cache':  benchmark_metadata_cache,
+    'query_scheduler': benchmark_query_scheduler,
+    'rate_limit':      benchmark_rate_limit,
+    'sharded_load':    benchmark_sharded_load,
+    'storage_read':    benchmark_storage_read,
+    'storage_write':   benchmark_storage_write,
+    'telemetry':       benchmark_telemetry,
+}
+
+
+
+######################################################################################
+#
+#   Results
+#
+######################################################################################
+
+
+
+def benchmark_environment():
+    '''
+        Python, platform, CPU count and library versions, stored with the results so runs can be told apart
+    '''
+    import datetime
+    import platform
+    from importlib import metadata
+
+    packages = {}
+    for package in ('google-cloud-bigquery', 'google-cloud-bigquery-storage', 'google-cloud-storage', 'grpcio', 'pyarrow'):
+        try:
+            packages[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            packages[package] = None
+    return {'created':  datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'python':   platform.python_version(),
+            'platform': platform.platform(),
+            'cpus':     multiprocessing.cpu_count(),
+            'packages': packages}
+
+
+
+
+# The last part of a metric name decides which direction is better ('seconds', 'rows_per_sec', ...)
+LOWER_IS_BETTER  = ('seconds', 'us_per_call', 'peak_mb')
+HIGHER_IS_BETTER = ('per_sec', 'speedup')
+
+
+
+
+def _metrics(value, prefix=''):
+    '''
+        The numbers of a nested results dict as {'benchmark.results.name.metric': number}
+    '''
+    if isinstance(value, dict):
+        metrics = {}
+        for key, item in value.items():
+            metrics.update(_metrics(item, '{}.{}'.format(prefix, key) if prefix else str(key)))
+        return metrics
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {prefix: value}
+    return {}
+
+
+
+
+def compare_results(baseline, current, threshold=0.10):
+    '''
+        Compares the timing / throughput metrics two reports (see --output) have in common and prints them
+
+        USAGE:
+        regressions = compare_results(json.load(open('baseline.json')), json.load(open('current.json')), threshold=0.10)
+
+        A metric regressed when it changed by more than threshold in its worse direction (LOWER_IS_BETTER /
+        HIGHER_IS_BETTER); counts and sizes are not compared. Returns the regressions as
+        [{'metric', 'baseline', 'current', 'change'}], change being relative to the baseline.
+    '''
+    before      = _metrics(baseline['benchmarks'])
+    after       = _metrics(current['benchmarks'])
+    regressions = []
+    print('\n[ INFO ] {:64} {:>12} {:>12} {:>8}'.format('metric', 'baseline', 'current', 'change'))
+    for metric in sorted(set(before) & set(after)):
+        name = metric.rsplit('.', 1)[-1]
+        if name.endswith(LOWER_IS_BETTER):
+            worse = 1
+        elif name.endswith(HIGHER_IS_BETTER):
+            worse = -1
+        else:
+            continue
+        if not before[metric]:
+            continue
+        change = (after[metric] - before[metric]) / float(before[metric])
+        flag   = 'REGRESSION' if change * worse > threshold else ''
+        if flag:
+            regressions.append({'metric': metric, 'baseline': before[metric], 'current': after[metric], 'change': change})
+        print('[ INFO ] {:64} {:12.4g} {:12.4g} {:+7.1%} {}'.format(metric, before[metric], after[metric], change, flag))
+    print('[ INFO ] {} regression(s) beyond {:.0%}'.format(len(regressions), threshold))
+    return regressions
+
+
+
+######################################################################################
+#
+#   Main
+#
+######################################################################################
+
+
+if __name__ == "__main__":
+
+    # Arguments
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--benchmark", default="all", choices=['all'] + sorted(BENCHMARKS), help="Benchmark to run")
+    ap.add_argument("--rows",      type=int,      help="Override the number of rows used by row-based benchmarks")
+    ap.add_argument("--output",                   help="Write the results as JSON to this file")
+    ap.add_argument("--compare",                  help="Compare the results with a JSON file written by --output (exits with 1 on a regression)")
+    ap.add_argument("--threshold", type=float,    default=0.10, help="Relative change --compare reports as a regression")
+    args = vars(ap.parse_args())
+
+    results = {}
+    for name, benchmark in sorted(BENCHMARKS.items()):
+        if args['benchmark'] in ('all', name):
+            print('\n[ INFO ] Running benchmark: {}'.format(name))
+            kwargs = {}
+            if args['rows'] and 'rows' in inspect.signature(benchmark).parameters:
+                kwargs['rows'] = args['rows']
+            start = time.perf_counter()
+            results[name] = {'arguments': kwargs, 'results': benchmark(**kwargs), 'seconds': time.perf_counter() - start}
+
+    report = {'environment': benchmark_environment(), 'benchmarks': results}
+    if args['output']:
+        with open(args['output'], 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True, default=str)
+        print('\n[ INFO ] Results written to {}'.format(args['output']))
+
+    if args['compare']:
+        with open(args['compare']) as f:
+            baseline = json.load(f)
+        regressions = compare_results(baseline, report, args['threshold'])
+        sys.exit(1 if regressions else 0)
+
+
+
+
+#ZEND
@@ -0,0 +1,266 @@
+####################################################################################################
+#
+#   Google BigQuery - Local Query Result Cache
+#
+#   https://cloud.google.com/bigquery/docs/cached-results
+#
+####################################################################################################
+
+
+
+'''
+NOTES
+
+    BigQuery caches query results per user for ~24 hours, but a cached query still costs a jobs.insert,
+    a getQueryResults and one request per result page. QueryResultCache keeps results on the client instead.
+
+    Key:            normalized SQL (whitespace collapsed, trailing ; removed) + location + query parameters
+    Freshness:      every entry remembers the modified time of each table the query referenced
+                    (QueryJob.referenced_tables). On lookup one get_table() per referenced table checks that
+                    none has changed and none has a streaming buffer; otherwise the entry is dropped.
+    Memory tier:    LRU bounded by max_entries and max_bytes
+    Disk tier:      optional (disk_path), one pickle file per entry, LRU by last use bounded by disk_max_bytes
+
+    Like BigQuery's own cache, only deterministic SELECT queries are cached: DML / DDL / scripts, queries using
+    non-deterministic functions (CURRENT_TIMESTAMP(), RAND(), ...) and queries without referenced tables
+    (external tables, INFORMATION_SCHEMA, table functions: nothing would ever invalidate them) never are.
+    A result is also not cached when a referenced table was modified after the query job started, since
+    it is unclear whether the query saw that change.
+
+    USAGE:
+    cache = QueryResultCache(max_entries=256, disk_path='/tmp/bq_cache', disk_max_bytes=512 * 1024 * 1024)
+    rows  = bq_query('select count(*) as count from `zproject201807.demo_dataset1.table_loans`', cache=cache)
+    print(cache.stats())
+
+'''
+
+
+####################################################################################################
+#
+#   Python Libraries
+#
+####################################################################################################
+
+
+import collections
+import hashlib
+import json
+import os
+import pickle
+import re
+import threading
+
+from google.cloud import bigquery
+
+
+####################################################################################################
+
+
+
+_NON_DETERMINISTIC = re.compile(r'\b(current_(timestamp|date|time|datetime)|now|rand|generate_uuid|session_user)\s*\(', re.IGNORECASE)
+_READ_ONLY         = re.compile(r'^\(*\s*(select|with)\b', re.IGNORECASE)
+
+
+
+
+def normalize_sql(sql):
+    '''
+        Collapses whitespace and drops a trailing semicolon (case is kept: string literals are case-sensitive)
+    '''
+    return ' '.join(sql.split()).rstrip(';').rstrip()
+
+
+
+
+def cacheable(sql):
+    '''
+        True for a single deterministic read-only statement (SELECT / WITH ... SELECT), whose result only changes
+        when the tables it reads change
+    '''
+    sql = normalize_sql(sql)
+    return bool(_READ_ONLY.match(sql)) and ';' not in sql and not _NON_DETERMINISTIC.search(sql)
+
+
+
+
+class _Entry(object):
+    '''
+        One cached result: rows as tuples plus what is needed to rebuild Row objects and check freshness
+    '''
+    def __init__(self, field_names, values, referenced, bytes_billed, round_trips):
+        self.field_names  = field_names         # Column names in result order
+        self.values       = values              # List of row tuples
+        self.referenced   = referenced          # {table path: modified time when the result was cached}
+        self.bytes_billed = bytes_billed
+        self.round_trips  = round_trips         # API requests the original query took
+        self.size         = 0
+
+    def rows(self):
+        field_to_index = dict((name, i) for i, name in enumerate(self.field_names))
+        return [bigquery.Row(values, field_to_index) for values in self.values]
+
+
+
+
+class QueryResultCache(object):
+    '''
+        Client-side LRU cache of query results, invalidated when a referenced table changes
+
+        USAGE:
+        cache = QueryResultCache(max_entries=128)
+        rows  = cache.get(client, sql, 'US')                # None on a miss
+        cache.put(client, sql, 'US', None, query_job, rows.schema, list(rows))
+
+    '''
+    def __init__(self, max_entries=128, max_bytes=256 * 1024 * 1024, disk_path=None, disk_max_bytes=1024 * 1024 * 1024):
+        self.max_entries    = max_entries
+        self.max_bytes      = max_bytes
+        self.disk_path      = disk_path
+        self.disk_max_bytes = disk_max_bytes
+        self._entries       = collections.OrderedDict()     # key -> _Entry, least recently used first
+        self._bytes         = 0
+        self._lock          = threading.RLock()
+        self.counters       = collections.Counter()
+
+        if disk_path:
+            os.makedirs(disk_path, exist_ok=True)
+
+    def stats(self):
+        '''
+            Hit / miss / eviction counters plus the round-trips and bytes billed the cache has saved
+        '''
+        with self._lock:
+            stats = dict((name, self.counters[name]) for name in
+                         ('hits', 'memory_hits', 'disk_hits', 'misses', 'invalidations', 'evictions', 'disk_evictions',
+                          'round_trips_saved', 'bytes_billed_saved'))
+            stats.update({'entries': len(self._entries), 'bytes': self._bytes})
+            return stats
+
+    def cacheable(self, sql):
+        return cacheable(sql)
+
+    def key(self, sql, location, query_parameters=None):
+        parameters = [parameter.to_api_repr() for parameter in (query_parameters or [])]
+        payload    = json.dumps([normalize_sql(sql), location, parameters], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _disk_file(self, key):
+        return os.path.join(self.disk_path, key + '.pickle')
+
+    def _load_from_disk(self, key):
+        if not self.disk_path:
+            return None
+        try:
+            with open(self._disk_file(key), 'rb') as f:
+                entry = pickle.load(f)
+            os.utime(self._disk_file(key))                  # Disk LRU order is by last use (mtime)
+            return entry
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def _save_to_disk(self, key, entry):
+        if not self.disk_path or entry.size > self.disk_max_bytes:
+            return
+        temp_file = self._disk_file(key) + '.tmp'
+        with open(temp_file, 'wb') as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file, self._disk_file(key))
+
+        files = []
+        for name in os.listdir(self.disk_path):
+            if name.endswith('.pickle'):
+                stat = os.stat(os.path.join(self.disk_path, name))
+                files.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.disk_max_bytes:
+                break
+            os.remove(os.path.join(self.disk_path, name))
+            total -= size
+            self.counters['disk_evictions'] += 1
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size
+        if self.disk_path and os.path.exists(self._disk_file(key)):
+            os.remove(self._disk_file(key))
+
+    def _remember(self, key, entry):
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key).size
+        self._entries[key] = entry
+        self._bytes       += entry.size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, evicted   = self._entries.popitem(last=False)
+            self._bytes -= evicted.size
+            self.counters['evictions'] += 1
+
+    def _is_fresh(self, client, entry):
+        for path, modified in entry.referenced.items():
+            table = client.get_table(path)
+            if table.modified != modified or table.streaming_buffer is not None:
+                return False
+        return True
+
+    def get(self, client, sql, location, query_parameters=None):
+        '''
+            Returns the cached rows (list of bigquery.Row) or None on a miss
+        '''
+        key = self.key(sql, location, query_parameters)
+        with self._lock:
+            entry = self._entries.get(key)
+            tier  = 'memory_hits'
+            if entry is None:
+                entry = self._load_from_disk(key)
+                tier  = 'disk_hits'
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+
+        if not self._is_fresh(client, entry):
+            with self._lock:
+                self._discard(key)
+                self.counters['invalidations'] += 1
+                self.counters['misses']        += 1
+            return None
+
+        with self._lock:
+            self._remember(key, entry)
+            self.counters['hits']               += 1
+            self.counters[tier]                 += 1
+            self.counters['round_trips_saved']  += max(entry.round_trips - len(entry.referenced), 0)
+            self.counters['bytes_billed_saved'] += entry.bytes_billed
+        return entry.rows()
+
+    def put(self, client, sql, location, query_parameters, query_job, schema, rows, round_trips=2):
+        '''
+            Stores the complete result rows of a finished query_job
+
+            Results are not cached when the query is not a deterministic SELECT, references no table, or a
+            referenced table has a streaming buffer or was modified after the job started (the recorded
+            modified time could belong to a write the query did not see).
+        '''
+        if not self.cacheable(sql) or query_job.statement_type != 'SELECT' or not query_job.referenced_tables:
+            return
+
+        referenced = {}
+        for table_ref in query_job.referenced_tables:
+            table = client.get_table(table_ref)
+            if table.streaming_buffer is not None or query_job.started is None or table.modified >= query_job.started:
+                return
+            referenced['{}.{}.{}'.format(table_ref.project, table_ref.dataset_id, table_ref.table_id)] = table.modified
+
+        entry      = _Entry([field.name for field in schema], [tuple(row.values()) for row in rows], referenced,
+                            query_job.total_bytes_billed or 0, round_trips)
+        entry.size = len(pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL))
+
+        key = self.key(sql, location, query_parameters)
+        with self._lock:
+            if entry.size <= self.max_bytes:
+                self._remember(key, entry)
+            self._save_to_disk(key, entry)
+
+
+
+#ZEND
@@ -0,0 +1,281 @@
+####################################################################################################
+#
+#   Google BigQuery - Shared Client Pool
+#
+#   https://googleapis.github.io/google-cloud-python/latest/bigquery/reference.html
+#
+####################################################################################################
+
+
+
+'''
+NOTES
+
+    Creating a bigquery.Client() loads credentials and opens a new HTTP session, so every new client
+    pays for credential discovery plus a fresh TLS handshake on its first request.
+
+    The helpers in gcp_bigquery.py and gcp_bigquery_demoflow.py get their client from get_client(),
+    which keeps one client per (project, location, credentials) and reuses it for the life of the process.
+    Each pooled client owns a requests.Session whose urllib3 connection pool holds up to pool_size
+    keep-alive connections, so the client can be shared by many threads at once.
+
+    USAGE:
+    client = get_client()                                   # Default project / location / credentials
+    client = get_client(project='zproject201807', location='EU')
+    set_pool_size(32)                                       # Applies to clients created afterwards
+    read_client = get_read_client()                         # BigQuery Storage Read API (gRPC) client
+    write_client = get_write_client()                       # BigQuery Storage Write API (gRPC) client
+    close_clients()                                         # Close every pooled HTTP session and gRPC channel
+
+    google.cloud.bigquery and requests are imported when the first client is built, not on import.
+    The Storage Read / Write API clients (one of each per credentials) multiplex their streams over
+    one gRPC channel each.
+
+    Every request of a pooled client is rate limited per operation class and resource (see
+    gcp_bigquery_quota.py); retryable errors are retried by the client library.
+
+'''
+
+
+####################################################################################################
+#
+#   Python Libraries
+#
+####################################################################################################
+
+
+import atexit
+import threading
+
+from gcp_bigquery_quota import limit_session
+from gcp_bigquery_telemetry import instrument_session
+
+
+####################################################################################################
+
+
+
+DEFAULT_POOL_SIZE = 10
+
+_clients        = {}                    # (project, location, id(credentials)) -> (client, credentials)
+_clients_lock   = threading.Lock()
+_pool_size      = DEFAULT_POOL_SIZE
+_client_factory = None
+
+_storage_clients         = {}           # ('read' / 'write', id(credentials)) -> (Storage API client, credentials)
+_read_client_factory     = None
+_write_client_factory    = None
+
+
+
+
+def _default_client_factory(project, location, credentials, pool_size):
+    '''
+        Builds a bigquery.Client whose HTTP session keeps up to pool_size connections open
+    '''
+    import requests
+    from google.cloud import bigquery
+
+    client  = bigquery.Client(project=project, location=location, credentials=credentials)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    client._http.mount('https://', adapter)
+    return client
+
+
+
+
+def get_client(project=None, location=None, credentials=None):
+    '''
+        Returns the shared BigQuery client for (project, location, credentials), creating it on first use
+
+        USAGE:
+        client = get_client()
+        client = get_client(project='zproject201807', location='US')
+
+        Note:
+            Clients are keyed by the identity of the credentials object, so pass the same
+            credentials object to share a client.
+
+    '''
+    key   = (project, location, id(credentials) if credentials is not None else None)
+    entry = _clients.get(key)
+    if entry is None:
+        with _clients_lock:
+            entry = _clients.get(key)
+            if entry is None:
+                factory = _client_factory or _default_client_factory
+                client  = factory(project, location, credentials, _pool_size)
+                instrument_session(client._http)        # Request spans while telemetry is on (gcp_bigquery_telemetry.py)
+                limit_session(client._http)             # Rate limits (gcp_bigquery_quota.py)
+                entry   = (client, credentials)
+                _clients[key] = entry
+    return entry[0]
+
+
+
+
+def _default_read_client_factory(credentials):
+    '''
+        Builds a bigquery_storage_v1.BigQueryReadClient
+    '''
+    from google.cloud import bigquery_storage_v1
+    return bigquery_storage_v1.BigQueryReadClient(credentials=credentials)
+
+
+
+
+def _default_write_client_factory(credentials):
+    '''
+        Builds a bigquery_storage_v1.BigQueryWriteClient
+    '''
+    from google.cloud import bigquery_storage_v1
+    return bigquery_storage_v1.BigQueryWriteClient(credentials=credentials)
+
+
+
+
+def _get_storage_client(kind, credentials):
+    key   = (kind, id(credentials) if credentials is not None else None)
+    entry = _storage_clients.get(key)
+    if entry is None:
+        with _clients_lock:
+            entry = _storage_clients.get(key)
+            if entry is None:
+                if kind == 'read':
+                    factory = _read_client_factory or _default_read_client_factory
+                else:
+                    factory = _write_client_factory or _default_write_client_factory
+                entry = (factory(credentials), credentials)
+                _storage_clients[key] = entry
+    return entry[0]
+
+
+
+
+def get_read_client(credentials=None):
+    '''
+        Returns the shared BigQuery Storage Read API client for credentials, creating it on first use
+
+        USAGE:
+        read_client = get_read_client()
+
+    '''
+    return _get_storage_client('read', credentials)
+
+
+
+
+def get_write_client(credentials=None):
+    '''
+        Returns the shared BigQuery Storage Write API client for credentials, creating it on first use
+
+        USAGE:
+        write_client = get_write_client()
+
+    '''
+    return _get_storage_client('write', credentials)
+
+
+
+
+def set_pool_size(pool_size):
+    '''
+        Sets the number of HTTP connections each pooled client keeps open
+
+        USAGE:
+        set_pool_size(32)
+
+        Note:
+            Only clients created after this call use the new size.
+            Call close_clients() first to rebuild the existing clients.
+
+    '''
+    global _pool_size
+    if pool_size < 1:
+        raise ValueError('pool_size must be at least 1, got {}'.format(pool_size))
+    _pool_size = pool_size
+
+
+
+
+def set_client_factory(factory=None):
+    '''
+        Replaces the function used to build pooled clients (None restores the default)
+
+        The factory is called as factory(project, location, credentials, pool_size).
+        Existing clients are closed so every helper picks up clients from the new factory.
+
+        USAGE:
+        set_client_factory(gcp_bigquery_fake.fake_client_factory(backend))
+
+    '''
+    global _client_factory
+    close_clients()
+    _client_factory = factory
+
+
+
+
+def set_read_client_factory(factory=None):
+    '''
+        Replaces the function used to build Storage Read API clients (None restores the default)
+
+        The factory is called as factory(credentials). Worker processes of gcp_bigquery_read.map_batches()
+        build their own clients with it, so it has to be picklable there.
+
+        USAGE:
+        set_read_client_factory(fake_read_server.client_factory())
+
+    '''
+    global _read_client_factory
+    close_clients()
+    _read_client_factory = factory
+
+
+
+
+def set_write_client_factory(factory=None):
+    '''
+        Replaces the function used to build Storage Write API clients (None restores the default)
+
+        The factory is called as factory(credentials).
+
+        USAGE:
+        set_write_client_factory(fake_write_server.client_factory())
+
+    '''
+    global _write_client_factory
+    close_clients()
+    _write_client_factory = factory
+
+
+
+
+def close_clients():
+    '''
+        Closes every pooled client (BigQuery and Storage Read / Write API) and empties the pool
+
+        USAGE:
+        close_clients()
+
+    '''
+    with _clients_lock:
+        entries = list(_clients.values())
+        _clients.clear()
+        storage_entries = list(_storage_clients.values())
+        _storage_clients.clear()
+
+    for client, _ in entries:
+        close = getattr(client, 'close', None)
+        if close is not None:
+            close()
+    for storage_client, _ in storage_entries:
+        storage_client.transport.close()
+
+
+
+atexit.register(close_clients)
+
+
+
+#ZEND
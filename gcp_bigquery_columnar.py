@@ -0,0 +1,194 @@
+####################################################################################################
+#
+#   Google BigQuery - Columnar Result Decoding
+#
+#   https://cloud.google.com/bigquery/docs/reference/rest/v2/jobs/getQueryResults
+#
+####################################################################################################
+
+
+
+'''
+NOTES
+
+    Iterating a query result builds one bigquery.Row object per row, converting every cell through Python.
+    For analytical results pulled into NumPy / pandas / Arrow that per-row decoding is the CPU hot spot.
+
+    fetch_columns() reads the raw result pages and decodes each page column by column straight into
+    pre-allocated NumPy buffers sized from the job's total_rows, keeping a boolean null mask per column.
+    Only one page of raw JSON is held in memory at a time.
+
+    BigQuery type -> NumPy dtype:
+        INTEGER / INT64                 int64
+        FLOAT / FLOAT64                 float64
+        BOOLEAN / BOOL                  bool
+        TIMESTAMP / DATETIME            datetime64[us]
+        DATE                            datetime64[D]
+        STRING, BYTES, NUMERIC, ...     object (raw values as returned by the API)
+        REPEATED / RECORD fields        object (raw values as returned by the API)
+
+    USAGE:
+    columns = fetch_columns(client, query_job)                  # {'name': numpy.ma.MaskedArray, ...}
+    table   = fetch_columns(client, query_job, output='arrow')  # pyarrow.Table
+
+'''
+
+
+####################################################################################################
+#
+#   Python Libraries
+#
+####################################################################################################
+
+
+import numpy
+
+
+####################################################################################################
+
+
+
+_NUMPY_DTYPES = {
+    'INTEGER':   numpy.int64,
+    'INT64':     numpy.int64,
+    'FLOAT':     numpy.float64,
+    'FLOAT64':   numpy.float64,
+    'BOOLEAN':   numpy.bool_,
+    'BOOL':      numpy.bool_,
+    'TIMESTAMP': numpy.dtype('datetime64[us]'),
+    'DATETIME':  numpy.dtype('datetime64[us]'),
+    'DATE':      numpy.dtype('datetime64[D]'),
+}
+
+# Placeholder parsed in place of NULL cells (the null mask hides them)
+_NULL_FILL = {
+    'INTEGER':   '0',
+    'INT64':     '0',
+    'FLOAT':     '0',
+    'FLOAT64':   '0',
+    'BOOLEAN':   'false',
+    'BOOL':      'false',
+    'TIMESTAMP': '0',
+    'DATETIME':  '1970-01-01T00:00:00',
+    'DATE':      '1970-01-01',
+}
+
+
+
+
+def _column_dtype(field):
+    if field.mode == 'REPEATED':
+        return numpy.dtype(object)
+    return numpy.dtype(_NUMPY_DTYPES.get(field.field_type, object))
+
+
+
+
+def _decode_column(field, values, mask):
+    '''
+        Converts the raw string cells of one column (one page) into a typed NumPy array
+    '''
+    dtype = _column_dtype(field)
+    if dtype == object:
+        result    = numpy.empty(len(values), dtype=object)
+        result[:] = values
+        return result
+
+    if mask.any():
+        fill   = _NULL_FILL[field.field_type]
+        values = [fill if value is None else value for value in values]
+
+    raw = numpy.array(values)
+    if field.field_type in ('BOOLEAN', 'BOOL'):
+        return raw == 'true'
+    if field.field_type == 'TIMESTAMP':
+        return raw.astype(numpy.int64).view('datetime64[us]')           # formatOptions.useInt64Timestamp
+    if field.field_type in ('INTEGER', 'INT64'):
+        return raw.astype(numpy.int64)
+    if field.field_type in ('FLOAT', 'FLOAT64'):
+        return raw.astype(numpy.float64)
+    return raw.astype(dtype)
+
+
+
+
+def _to_arrow(schema, buffers, masks):
+    import pyarrow
+
+    arrow_types = {
+        'INTEGER':   pyarrow.int64(),
+        'INT64':     pyarrow.int64(),
+        'FLOAT':     pyarrow.float64(),
+        'FLOAT64':   pyarrow.float64(),
+        'BOOLEAN':   pyarrow.bool_(),
+        'BOOL':      pyarrow.bool_(),
+        'STRING':    pyarrow.string(),
+        'TIMESTAMP': pyarrow.timestamp('us', tz='UTC'),
+        'DATETIME':  pyarrow.timestamp('us'),
+        'DATE':      pyarrow.date32(),
+    }
+    arrays = []
+    for field, data, mask in zip(schema, buffers, masks):
+        arrow_type = arrow_types.get(field.field_type) if field.mode != 'REPEATED' else None
+        if field.field_type == 'TIMESTAMP' and arrow_type is not None:
+            data = data.view(numpy.int64)
+        arrays.append(pyarrow.array(data, mask=mask, type=arrow_type, from_pandas=False))
+    return pyarrow.Table.from_arrays(arrays, names=[field.name for field in schema])
+
+
+
+
+def fetch_columns(client, query_job, page_size=100000, output='numpy'):
+    '''
+        Waits for query_job and decodes its result column by column
+
+        USAGE:
+        columns = fetch_columns(get_client(), client.query(sql))
+        columns['loan_amnt'].mean()                                 # Masked arrays skip NULLs
+
+        Input(s):   output:     'numpy' returns {column name: numpy.ma.MaskedArray}
+                                'arrow' returns a pyarrow.Table
+                    page_size:  Rows requested per result page
+
+    '''
+    if output not in ('numpy', 'arrow'):
+        raise ValueError("output must be 'numpy' or 'arrow', got {!r}".format(output))
+
+    rows       = query_job.result(max_results=0)        # Waits for the job, fetches no rows
+    schema     = list(rows.schema)
+    total_rows = rows.total_rows or 0
+    buffers    = [numpy.empty(total_rows, dtype=_column_dtype(field)) for field in schema]
+    masks      = [numpy.zeros(total_rows, dtype=bool) for _ in schema]
+
+    path   = '/projects/{}/queries/{}'.format(query_job.project, query_job.job_id)
+    params = {'maxResults': page_size, 'location': query_job.location, 'formatOptions.useInt64Timestamp': True}
+    offset = 0
+    while offset < total_rows:
+        page      = client._connection.api_request(method='GET', path=path, query_params=params)
+        page_rows = page.get('rows', [])
+        count     = len(page_rows)
+        if count == 0:
+            break
+
+        for j, field in enumerate(schema):
+            values = [row['f'][j]['v'] for row in page_rows]
+            mask   = numpy.fromiter((value is None for value in values), dtype=bool, count=count)
+            masks[j][offset:offset + count]   = mask
+            buffers[j][offset:offset + count] = _decode_column(field, values, mask)
+
+        offset += count
+        if 'pageToken' not in page:
+            break
+        params['pageToken'] = page['pageToken']
+
+    if offset < total_rows:
+        buffers = [buffer[:offset] for buffer in buffers]
+        masks   = [mask[:offset] for mask in masks]
+
+    if output == 'arrow':
+        return _to_arrow(schema, buffers, masks)
+    return dict((field.name, numpy.ma.MaskedArray(data, mask=mask)) for field, data, mask in zip(schema, buffers, masks))
+
+
+
+#ZEND
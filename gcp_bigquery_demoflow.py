@@ -10,10 +10,38 @@
 ######################################################################################
 
 
-import sys
+import os
+import json
+import time
+import hashlib
+import uuid
 import argparse
+import concurrent.futures
 from google.cloud import bigquery
 
+from gcp_bigquery_cache import QueryResultCache
+from gcp_bigquery_clients import get_client
+from gcp_bigquery_metadata import get_metadata_cache, invalidate_metadata
+from gcp_bigquery_partitioning import apply_partitioning, check_partition_filter, enforce_partition_filter
+from gcp_bigquery_quota import run_job
+from gcp_bigquery_schema import get_registry, infer_gcs_schema, lookup_schema, source_key
+from gcp_bigquery_telemetry import in_span_context, instrument, record_error, record_stats
+
+
+# Streaming insert limits (https://cloud.google.com/bigquery/quotas#streaming_inserts)
+INSERT_MAX_ROWS_PER_REQUEST  = 500                  # Recommended maximum number of rows per insertAll request
+INSERT_MAX_BYTES_PER_REQUEST = 9 * 1024 * 1024      # The HTTP request limit is 10 MB, leave room for the envelope
+INSERT_RETRYABLE_REASONS     = ('stopped', 'backendError', 'internalError', 'timeout')
+
+# Default schema of bq_create_table_empty (the rows inserted by bq_insert_rows in __main__)
+TABLE_EMPTY_SCHEMA = [
+    bigquery.SchemaField('id',        'INTEGER',  mode='REQUIRED'),
+    bigquery.SchemaField('name',      'STRING',   mode='NULLABLE'),
+    bigquery.SchemaField('state',     'STRING',   mode='NULLABLE'),
+    bigquery.SchemaField('loan_amnt', 'FLOAT',    mode='NULLABLE'),
+    bigquery.SchemaField('flag',      'INTEGER',  mode='NULLABLE'),
+]
+
 
 ######################################################################################
 #
@@ -24,6 +52,7 @@ from google.cloud import bigquery
 
 
 # Create BigQuery Dataset
+@instrument
 def bq_create_dataset(dataset_id, location):
     '''
         Creates a BigQuery Dataset
@@ -69,20 +98,23 @@ def bq_create_dataset(dataset_id, location):
     
     '''
     try:
-        client               = bigquery.Client()
+        client               = get_client()
         dataset_ref          = client.dataset(dataset_id)
         dataset_obj          = bigquery.Dataset(dataset_ref)
         dataset_obj.location = location
         dataset              = client.create_dataset(dataset_obj)
+        invalidate_metadata(dataset_id)
         print('[ INFO ] Created {} at {}'.format(dataset_id, dataset.created))
     except Exception as e:
+        record_error(e)
         print('[ ERROR ] {}'.format(e))
 
 
 
 
 
-def bq_create_table_empty(dataset_id, table_id):
+@instrument
+def bq_create_table_empty(dataset_id, table_id, schema=None, partitioning=None, clustering=None):
     '''
         Creates an empty BigQuery Table
         
@@ -90,6 +122,13 @@ def bq_create_table_empty(dataset_id, table_id):
         bq_create_table_empty(  dataset_id = 'ztest1',
                                 table_id = 'ztable1')
         
+        schema:
+        Optional list of bigquery.SchemaField, or a schema registry key (gcp_bigquery_schema.py)
+        such as 'gs://zdatasets1/loan_200k.csv'. Defaults to TABLE_EMPTY_SCHEMA.
+        
+        partitioning / clustering:
+        e.g. partitioning={'field': 'id', 'range': (0, 1000000, 10000)}, clustering=['state'] (see gcp_bigquery_partitioning.py)
+        
         Required Permissions:
         To create a table, you must have WRITER access at the dataset level,
         or you must be assigned a project-level IAM role that includes bigquery.tables.create permissions.
@@ -100,135 +139,437 @@ def bq_create_table_empty(dataset_id, table_id):
     
     '''
     try:
-        schema = [
-                                            bigquery.SchemaField('id',        'INTEGER',  mode='REQUIRED'),
-                                            bigquery.SchemaField('name',      'STRING',   mode='NULLABLE'),
-                                            bigquery.SchemaField('state',     'STRING',   mode='NULLABLE'),
-                                            bigquery.SchemaField('loan_amnt', 'FLOAT',    mode='NULLABLE'),
-                                            bigquery.SchemaField('flag',      'INTEGER',  mode='NULLABLE'),
-                                         ]
-        
-        client      = bigquery.Client()
+        schema = lookup_schema(schema) if schema is not None else TABLE_EMPTY_SCHEMA
+        
+        client      = get_client()
         dataset_ref = client.dataset(dataset_id)
         table_ref   = dataset_ref.table(table_id)
-        table       = bigquery.Table(table_ref, schema=schema)
+        table       = apply_partitioning(bigquery.Table(table_ref, schema=schema), partitioning, clustering)
         table       = client.create_table(table)
+        invalidate_metadata(dataset_id, table_id)
         
         assert table.table_id == table_id
         print('[ INFO ] Created {} at {}'.format(table_id, table.created))
     except Exception as e:
+        record_error(e)
         print('[ ERROR] {}'.format(e))
 
 
 
 
 
-def bq_create_table_from_gcs(dataset_id, table_id, gcs_path):
+@instrument
+def bq_create_table_from_gcs(dataset_id, table_id, gcs_path, job_manager=None, schema=None, storage_client=None,
+                             partitioning=None, clustering=None):
     '''
-        Create BigQuery Native Table from Google Cloud Storage (Schema is auto-detected)
+        Create BigQuery Native Table from Google Cloud Storage (CSV with a header row)
         
         USAGE:
         bq_create_table_from_gcs( dataset_id = 'demo_dataset1',
                                   table_id   = 'table_loans',
                                   gcs_path   = 'gs://zdatasets1/loan_200k.csv')
         
-        Optional Schema Config:
-        schema= [
-                    bigquery.SchemaField('id',              'STRING',   mode='REQUIRED'),
-                    bigquery.SchemaField('member_id',       'STRING',   mode='REQUIRED'),
-                    bigquery.SchemaField('loan_amnt',       'INTEGER',  mode='NULLABLE'),
-                    bigquery.SchemaField('term_in_months',  'INTEGER',  mode='NULLABLE'),
-                    bigquery.SchemaField('interest_rate',   'FLOAT',    mode='NULLABLE'),
-                    bigquery.SchemaField('payment',         'FLOAT',    mode='NULLABLE'),
-                    bigquery.SchemaField('grade',           'STRING',   mode='NULLABLE'),
-                    bigquery.SchemaField('sub_grade',       'STRING',   mode='NULLABLE'),
-                    bigquery.SchemaField('employment_length', 'INTEGER',mode='NULLABLE'),
-                    bigquery.SchemaField('home_owner',      'INTEGER',  mode='NULLABLE'),
-                    bigquery.SchemaField('income',          'INTEGER',  mode='NULLABLE'),
-                    bigquery.SchemaField('verified',        'INTEGER',  mode='NULLABLE'),
-                    bigquery.SchemaField('default',         'INTEGER',  mode='NULLABLE'),
-                    bigquery.SchemaField('purpose',         'STRING',   mode='NULLABLE'),
-                    bigquery.SchemaField('zip_code',        'STRING',   mode='NULLABLE'),
-                    bigquery.SchemaField('addr_state',      'STRING',   mode='NULLABLE'),
-                    bigquery.SchemaField('open_accts',      'INTEGER',  mode='NULLABLE'),
-                    bigquery.SchemaField('credit_debt',     'INTEGER',  mode='NULLABLE')
-                ],
+        Schema:
+        Taken from the schema registry (gcp_bigquery_schema.py), keyed by gcs_path (see source_key for a list).
+        On the first load of a new source the schema is inferred from samples of a few of its files and
+        registered, so every later load (and every shard) uses the same explicit schema and BigQuery
+        never runs autodetect. Pass schema= (list of bigquery.SchemaField or a registry key) to override;
+        if no sample can be read, the load falls back to autodetect.
+        The loans schema is gcp_bigquery_schema.LOAN_SCHEMA (registered as 'gs://zdatasets1/loan_200k.csv').
+        
+        job_manager:
+        Optional JobManager (gcp_bigquery_jobs.py). The load job is submitted through it and a Future
+        with the job statistics (output_rows, input_file_bytes, ...) is returned instead of waiting.
+        
+        Sharded loads:
+        gcs_path may also be a list of paths and/or wildcards ('gs://zdatasets1/loans/*.csv'). The files are
+        then loaded by parallel batch load jobs appending to the table (see gcp_bigquery_load.load_gcs_shards,
+        which also takes staging=True), a failed file is retried on its own, and the per-shard report is returned.
+        
+        partitioning / clustering:
+        Partitioning and clustering of the table when the load creates it (see gcp_bigquery_partitioning.py).
+        table_id may be a partition decorator ('table_loans$20180701') to append to one partition.
     
     '''
     try:
-        client      = bigquery.Client()
+        client      = get_client()
         dataset_ref = client.dataset(dataset_id)
         
         job_config = bigquery.LoadJobConfig()
-        job_config.autodetect = True
         job_config.skip_leading_rows = 1
         job_config.source_format = bigquery.SourceFormat.CSV
-        load_job = client.load_table_from_uri(
-            gcs_path,
-            dataset_ref.table(table_id),
-            job_config=job_config)
+        apply_partitioning(job_config, partitioning, clustering)
+        
+        schema_key = source_key(gcs_path)
+        if schema is not None:
+            job_config.schema = lookup_schema(schema)
+        else:
+            try:
+                job_config.schema = get_registry().resolve(schema_key, infer=lambda: infer_gcs_schema(gcs_path, storage_client))
+            except Exception as e:
+                print('[ WARN ] No schema for {} ({}), using autodetect'.format(schema_key, e))
+                job_config.autodetect = True
         
-        print('[ INFO ] Starting BigQuery load job {}'.format(load_job.job_id))
-        load_job.result()
+        if not isinstance(gcs_path, str) or '*' in gcs_path:
+            from gcp_bigquery_load import load_gcs_shards
+            report = load_gcs_shards(dataset_id, table_id, gcs_path, job_config=job_config, job_manager=job_manager,
+                                     storage_client=storage_client)
+            print('[ INFO ] Loaded {} rows from {} files in {} jobs into {} ({:.1f} MB/s, {} retried, {} failed)'.format(
+                report['output_rows'], len(report['shards']), report['jobs'], table_id,
+                report['mb_per_second'] or 0, report['retried_shards'], report['failed_shards']))
+            for shard in report['shards']:
+                if shard['state'] == 'FAILED':
+                    print('[ ERROR] {}: {}'.format(shard['uri'], shard['error']))
+            return report
+        
+        if job_manager is not None:
+            future = job_manager.submit(lambda: client.load_table_from_uri(gcs_path, dataset_ref.table(table_id), job_config=job_config),
+                                        label='load {} -> {}.{}'.format(gcs_path, dataset_id, table_id))
+            future.add_done_callback(lambda _: invalidate_metadata(dataset_id, table_id))
+            return future
+        
+        def start_load():
+            load_job = client.load_table_from_uri(
+                gcs_path,
+                dataset_ref.table(table_id),
+                job_config=job_config)
+            print('[ INFO ] Starting BigQuery load job {}'.format(load_job.job_id))
+            return load_job
+        
+        run_job(start_load)     # Starts the job again if it fails with a retryable reason (gcp_bigquery_quota.py)
+        table_id = table_id.split('$')[0]
+        invalidate_metadata(dataset_id, table_id)
+        enforce_partition_filter(client, dataset_ref.table(table_id), partitioning)
         
         destination_table = client.get_table(dataset_ref.table(table_id))
         print('[ INFO ] Loaded {} rows into {}'.format(destination_table.num_rows, table_id))
     
     except Exception as e:
+        record_error(e)
         print('[ ERROR] {}'.format(e))
 
 
 
 
 
-def bq_insert_rows(dataset_id, table_id, rows_to_insert):
+def _insert_row_ids(rows_to_insert, insert_id_prefix=None):
+    '''
+        insertIds for best-effort dedup: a row at the same position with the same values gets the same ID
+        within one call, so retrying a chunk does not duplicate rows.
+        
+        Without insert_id_prefix each call gets a random prefix, so a separate call inserting the same rows
+        is not dropped as a duplicate. Pass an explicit prefix (e.g. the source file name) to get
+        deterministic IDs that also dedupe a batch re-sent by another call.
+    '''
+    if insert_id_prefix is None:
+        insert_id_prefix = '{}-'.format(uuid.uuid4().hex)
+    return ['{}{}-{}'.format(insert_id_prefix, i, hashlib.sha1(repr(row).encode('utf-8')).hexdigest()[:16])
+            for i, row in enumerate(rows_to_insert)]
+
+
+
+
+
+def _insert_chunks(rows_to_insert, row_ids, field_names, max_rows_per_request, max_bytes_per_request):
+    '''
+        Splits row positions into chunks of at most max_rows_per_request rows and (approximately) max_bytes_per_request bytes
+    '''
+    field_overhead = sum(len(name) + 4 for name in field_names) + 32        # {"json": {"name": ...}, "insertId": ...}
+    chunks         = []
+    chunk          = []
+    chunk_bytes    = 0
+    for i, row in enumerate(rows_to_insert):
+        if isinstance(row, dict):
+            row_bytes = len(json.dumps(row, default=str)) + len(row_ids[i]) + 32
+        else:
+            row_bytes = len(json.dumps(list(row), default=str)) + len(row_ids[i]) + field_overhead
+        
+        if chunk and (len(chunk) >= max_rows_per_request or chunk_bytes + row_bytes > max_bytes_per_request):
+            chunks.append(chunk)
+            chunk       = []
+            chunk_bytes = 0
+        chunk.append(i)
+        chunk_bytes += row_bytes
+    
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+
+
+
+def _insert_chunk(client, table, rows_to_insert, row_ids, chunk, max_retries):
+    '''
+        Sends one chunk, re-sending only the rows that came back with a retryable error
+
+        Returns (number of requests sent, {row position: errors} for rows that were not inserted)
+    '''
+    pending  = chunk
+    failed   = {}
+    requests = 0
+    for attempt in range(max_retries + 1):
+        if attempt:
+            time.sleep(min(0.1 * 2 ** attempt, 5.0))
+        
+        requests += 1
+        try:
+            errors = client.insert_rows(table,
+                                        [rows_to_insert[i] for i in pending],
+                                        row_ids=[row_ids[i] for i in pending])
+        except Exception as e:
+            # The client library already retried transient request failures
+            failed.update({i: [{'reason': 'requestError', 'message': str(e)}] for i in pending})
+            return requests, failed
+        
+        retry = []
+        for error in errors:
+            i = pending[error['index']]
+            if any(e.get('reason') in INSERT_RETRYABLE_REASONS for e in error['errors']) and attempt < max_retries:
+                retry.append(i)
+            else:
+                failed[i] = error['errors']
+        
+        pending = retry
+        if not pending:
+            break
+    
+    return requests, failed
+
+
+
+
+
+@instrument
+def bq_insert_rows(dataset_id, table_id, rows_to_insert,
+                   max_rows_per_request=INSERT_MAX_ROWS_PER_REQUEST,
+                   max_bytes_per_request=INSERT_MAX_BYTES_PER_REQUEST,
+                   max_workers=8, max_retries=3, insert_id_prefix=None, mode='insert_all', data_format='proto'):
     '''
         Insert rows into a BigQuery Table via the streaming API
         
+        USAGE:
+        result = bq_insert_rows('demo_dataset1', 'table_empty', rows_to_insert)
+        print(result['rows_sent'], result['rows_failed'])
+        
+        result = bq_insert_rows('demo_dataset1', 'table_empty', rows_to_insert, mode='pending')     # Storage Write API, exactly once
+        
+        mode:
+            'insert_all'    (default) Legacy streaming inserts (tabledata.insertAll), best-effort dedup by insertId
+            'default'       Storage Write API, the table's _default stream (at-least-once)
+            'committed'     Storage Write API, committed streams with offsets (exactly once, rows visible as written)
+            'pending'       Storage Write API, pending streams with offsets, committed atomically at the end
+                            (exactly once, all or nothing)
+        The Storage Write API modes send the rows as protobuf (data_format='proto') or Arrow (data_format='arrow')
+        over max_workers parallel streams and return the same dict with 'requests' counting appends, plus
+        'mode', 'streams', 'retried_appends', 'committed' and 'commit_time' (see gcp_bigquery_write.py).
+        max_rows_per_request / max_bytes_per_request and insert_id_prefix only apply to 'insert_all'.
+        
+        Returns:
+            {'rows_sent': 4, 'rows_failed': 0, 'requests': 1, 'elapsed': 0.21, 'errors': []}
+            errors holds {'index', 'row', 'errors'} for every row that could not be inserted.
+        
         Note:
             The table must already exist and have a defined schema
             rows_to_insert = List of variables (id, date, value1, value2, etc.)
+            
+            Rows are split into requests of at most max_rows_per_request rows / max_bytes_per_request bytes,
+            which are sent concurrently by max_workers threads. Rows rejected with a retryable reason
+            (e.g. "stopped" because another row in the request was invalid) are re-sent on their own,
+            up to max_retries times. Each row gets an insertId that is stable within the call (random
+            prefix per call); pass an explicit insert_id_prefix per batch (e.g. the source file name)
+            to make re-sending the same batch in a later call dedupe as well.
+            
+            The table schema comes from the metadata cache (gcp_bigquery_metadata.py), so repeated inserts
+            cost no get_table() round-trip. If any row fails the cached table is dropped, so the next insert
+            picks up a schema changed outside these helpers.
 
     '''
     try:
-        client    = bigquery.Client()
+        if mode != 'insert_all':
+            from gcp_bigquery_write import write_rows
+            result = write_rows(dataset_id, table_id, rows_to_insert, mode=mode, data_format=data_format,
+                                max_streams=max_workers, max_retries=max_retries)
+            record_stats(rows_sent=result['rows_sent'], rows_failed=result['rows_failed'])
+            return result
+        
+        start     = time.time()
+        client    = get_client()
         table_ref = client.dataset(dataset_id).table(table_id)
-        table     = client.get_table(table_ref)
-        errors    = client.insert_rows(table, rows_to_insert)
-        if errors == []:
-            print('[ INFO ] Inserted {} rows into BigQuery table {}'.format(len(rows_to_insert), table_id))
+        table     = get_metadata_cache().get_table(client, table_ref)
+        
+        row_ids   = _insert_row_ids(rows_to_insert, insert_id_prefix)
+        chunks    = _insert_chunks(rows_to_insert, row_ids, [field.name for field in table.schema],
+                                   max_rows_per_request, max_bytes_per_request)
+        
+        if len(chunks) <= 1 or max_workers <= 1:
+            outcomes = [_insert_chunk(client, table, rows_to_insert, row_ids, chunk, max_retries) for chunk in chunks]
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                outcomes = list(executor.map(in_span_context(
+                    lambda chunk: _insert_chunk(client, table, rows_to_insert, row_ids, chunk, max_retries)), chunks))
+        
+        failed = {}
+        for _, chunk_failed in outcomes:
+            failed.update(chunk_failed)
+        if failed:
+            invalidate_metadata(dataset_id, table_id)
+        record_stats(rows_sent=len(rows_to_insert) - len(failed), rows_failed=len(failed))
+        
+        return {
+            'rows_sent':   len(rows_to_insert) - len(failed),
+            'rows_failed': len(failed),
+            'requests':    sum(requests for requests, _ in outcomes),
+            'elapsed':     time.time() - start,
+            'errors':      [{'index': i, 'row': rows_to_insert[i], 'errors': failed[i]} for i in sorted(failed)],
+        }
     except Exception as e:
+        record_error(e)
         print('[ ERROR] {}'.format(e))
 
 
 
 
 
-def bq_query(query, location='US'):
+def _iter_query_rows(query_job, page_size):
+    '''
+        Yields the rows of a query result, downloading one page of page_size rows per request
+    '''
+    for page in query_job.result(page_size=page_size).pages:
+        for row in page:
+            yield row
+
+
+
+
+
+def _cached_query(client, query, location, job_config, cache, max_results, page_size):
+    '''
+        Serves a query from a QueryResultCache, running it (and caching the complete result) on a miss
+    '''
+    rows   = cache.get(client, query, location, job_config.query_parameters)
+    source = 'cache'
+    if rows is None:
+        query_job = client.query(query, location=location, job_config=job_config)
+        result    = query_job.result(page_size=page_size)
+        rows      = []
+        pages     = 0
+        for page in result.pages:
+            rows.extend(page)
+            pages += 1
+        cache.put(client, query, location, job_config.query_parameters, query_job, result.schema, rows, round_trips=2 + pages)
+        source = 'BigQuery'
+    record_stats(local_cache_hit=source == 'cache', rows=len(rows))
+    
+    for row in rows[:max_results]:
+        print(row)
+    
+    print('[ INFO ] Query returned {} row(s) from {}'.format(len(rows), source))
+    return rows
+
+
+
+
+
+@instrument
+def bq_query(query, location='US', max_results=11, stream=False, page_size=10000, columnar=None,
+             query_parameters=None, cache=None, partition_filter=None, read_streams=None, priority='INTERACTIVE',
+             scheduler=None):
     '''
         Query BigQuery Table(s)
         
+        USAGE:
+        bq_query('select count(*) as count from `zproject201807.demo_dataset1.table_loans`')
+        
+        for row in bq_query('select * from `zproject201807.demo_dataset1.table_loans`', stream=True, page_size=50000):
+            print(row['member_id'])
+        
         location: US, EU, asia-northeast1 (Tokyo), europe-west2 (London), asia-southeast1 (Singapore), australia-southeast1 (Sydney)
         
+        Preview (default):
+            Downloads only the first max_results rows and prints them. The row count comes from the
+            job's result metadata (total_rows), so the rest of the result is never fetched.
+            Returns the QueryJob.
+        
+        Stream (stream=True):
+            Returns a generator that fetches page_size rows per request and yields them page by page,
+            so memory stays flat regardless of the size of the result.
+        
+        Columnar (columnar='numpy' or columnar='arrow'):
+            Decodes the whole result column by column into typed NumPy buffers with null masks
+            (see gcp_bigquery_columnar.py). Returns {column: numpy.ma.MaskedArray} or a pyarrow.Table.
+            Requires numpy (and pyarrow for 'arrow').
+        
+        Cached (cache=QueryResultCache(...)):
+            Returns the complete result as a list of rows, served from the client-side cache when the
+            same SQL + location + query_parameters ran before and no referenced table has changed since
+            (see gcp_bigquery_cache.py).
+        
+        Storage Read API (read_streams=8):
+            Reads the whole result through that many parallel gRPC streams of Arrow record batches instead of
+            JSON pages (see gcp_bigquery_read.py). Returns a pyarrow.Table, or with stream=True a generator
+            of pyarrow.RecordBatch. Requires google-cloud-bigquery-storage and pyarrow.
+        
+        query_parameters: list of bigquery.ScalarQueryParameter / ArrayQueryParameter for @name placeholders
+        
+        partition_filter: 'warn' or 'error' dry-runs the query first and warns about / refuses a query that
+        reads a partitioned table without filtering on its partitioning column (see gcp_bigquery_partitioning.py)
+        
+        priority: 'INTERACTIVE' (default, also for None) or 'BATCH'. BATCH queries wait for idle slots and do not count against
+        the concurrent interactive query limit, which suits backfills.
+        
+        Scheduled (scheduler=QueryScheduler(...)):
+            Queues the query in the scheduler's class for priority (limits on queries in flight, single-flight,
+            deadlines, see gcp_bigquery_scheduler.py). Returns a Future resolving to the job statistics;
+            future.result()['job'].result() fetches the rows.
+        
     '''
     try:
-        client = bigquery.Client()
+        client     = get_client()
+        job_config = bigquery.QueryJobConfig()
+        job_config.query_parameters = query_parameters or []
+        job_config.priority         = (priority or 'INTERACTIVE').upper()
+        
+        if partition_filter:
+            check_partition_filter(query, location=location, mode=partition_filter, query_parameters=query_parameters, client=client)
+        
+        if scheduler is not None:
+            return scheduler.submit(query, priority=priority, location=location, job_config=job_config)
         
-        query_job = client.query(query, location=location)
+        if cache is not None:
+            return _cached_query(client, query, location, job_config, cache, max_results, page_size)
         
-        for i, row in enumerate(query_job):
-            if i <= 10:
-                print(row)
+        query_job = client.query(query, location=location, job_config=job_config)
         
-        print('[ INFO ] Query returned {} row(s)'.format( i+1 ))
+        if read_streams:
+            from gcp_bigquery_read import iter_batches, read_table
+            query_job.result()
+            if stream:
+                return iter_batches(query_job.destination, max_streams=read_streams)
+            return read_table(query_job.destination, max_streams=read_streams)
+        
+        if stream:
+            return _iter_query_rows(query_job, page_size)
+        
+        if columnar:
+            from gcp_bigquery_columnar import fetch_columns
+            return fetch_columns(client, query_job, page_size=page_size, output=columnar)
+        
+        rows = query_job.result(max_results=max_results)
+        for row in rows:
+            print(row)
+        
+        print('[ INFO ] Query returned {} row(s)'.format(rows.total_rows))
         return query_job
     except Exception as e:
+        record_error(e)
         print('[ ERROR] {}'.format(e))
 
 
 
 
 
+@instrument
 def bq_create_view(view_dataset_id, view_id, query):
     '''
         Create BigQuery View
@@ -241,7 +582,7 @@ def bq_create_view(view_dataset_id, view_id, query):
         
     '''
     try:
-        client = bigquery.Client()
+        client = get_client()
         shared_dataset_ref = client.dataset(view_dataset_id)
         
         view_ref = shared_dataset_ref.table(view_id)
@@ -249,15 +590,18 @@ def bq_create_view(view_dataset_id, view_id, query):
         
         view.view_query = query
         view = client.create_table(view)
+        invalidate_metadata(view_dataset_id, view_id)
         
         print('[ INFO ] Successfully created view at {}'.format(view.full_table_id))
     except Exception as e:
+        record_error(e)
         print('[ ERROR] {}'.format(e))
 
 
 
 
 
+@instrument
 def bq_delete_dataset(dataset_id):
     '''
         Deletes a Dataset (Deleting a dataset is permanent)
@@ -275,118 +619,183 @@ def bq_delete_dataset(dataset_id):
     
     '''
     try:
-        client = bigquery.Client()
+        client = get_client()
         dataset_ref = client.dataset(dataset_id)
         client.delete_dataset(dataset_ref, delete_contents=True)  # Set delete_contents=True to delete Dataset Tables
+        invalidate_metadata(dataset_id)
         print('Dataset {} has been deleted.'.format(dataset_id))
     except Exception as e:
+        record_error(e)
         print('[ ERROR] {}'.format(e))
 
 
 
 
 
-######################################################################################
-#
-#   Main
-#
-######################################################################################
+def _confirm(prompt):
+    return input(prompt) == 'y'
 
 
-if __name__ == "__main__":
 
-    # ARGS - Used for Testing
+
+
+@instrument
+def run_demoflow(project_id, dataset_id, location, table1_id, table2_id, gcs_path, view_id, confirm=None):
     '''
-    args =  {
-                "project_id":   "zproject201807",
-                "dataset_id":   "demo_dataset1",
-                "location":     "US",
-                "table1_id":    "table_empty",
-                "table2_id":    "table_loans",
-                "gcs_path":     "gs://zdatasets1/loan_200k.csv"
-            }
+        Runs the demo end to end: creates a dataset with an empty table and a table loaded from gcs_path,
+        queries both, inserts rows, creates a view and deletes the dataset
+        
+        USAGE:
+        timings = run_demoflow('zproject201807', 'demo_dataset1', 'US', 'table_empty', 'table_loans',
+                               'gs://zdatasets1/loan_200k.csv', 'view_loans', confirm=lambda prompt: True)
+        
+        confirm(prompt) is asked before each next step and the flow stops when it returns False
+        (default: the prompt is shown and the user types y to continue).
+        
+        Returns the wall time of every step that ran, in seconds:
+            {'create': 4.1, 'query': 1.2, 'insert': 0.4, 'view': 0.3, 'delete': 0.6, 'total': 6.6}
+        
+        The steps run one after another. `python gcp_bigquery_demoflow.py` runs the same steps as a pipeline
+        instead (gcp_bigquery_demoflow.yaml, see gcp_bigquery_pipeline.py): independent steps run concurrently
+        and completed steps are checkpointed.
+    
     '''
+    confirm = confirm or _confirm
+    timings = {}
+    start   = time.perf_counter()
     
-    # Arguments
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--project_id", required=True, help="GCP Project ID")
-    ap.add_argument("--dataset_id", required=True, help="BigQuery Dataset ID")
-    ap.add_argument("--location",   required=True, help="BigQuery Dataset Geographic Location")
-    ap.add_argument("--table1_id",  required=True, help="BigQuery Table Name (empty table)")
-    ap.add_argument("--table2_id",  required=True, help="BigQuery Table Name (GCS loaded table)")
-    ap.add_argument("--gcs_path",   required=True, help="Google Cloud Storage location")
-    ap.add_argument("--view_id",    required=True, help="Name/ID of BigQuery View")
-    args = vars(ap.parse_args())
+    def step(name, step_start):
+        timings[name]     = time.perf_counter() - step_start
+        timings['total']  = time.perf_counter() - start
     
     # Create BigQuery Dataset
-    bq_create_dataset(dataset_id=args['dataset_id'], location=args['location'])
+    step_start = time.perf_counter()
+    bq_create_dataset(dataset_id=dataset_id, location=location)
     
     # Create BigQuery Table (empty table)
-    bq_create_table_empty(dataset_id=args['dataset_id'], table_id=args['table1_id'] )
+    bq_create_table_empty(dataset_id=dataset_id, table_id=table1_id)
     
     # Create BigQuery Table (from Google Cloud Storage)
-    bq_create_table_from_gcs( dataset_id=args['dataset_id'], table_id=args['table2_id'], gcs_path=args['gcs_path'] )
+    bq_create_table_from_gcs(dataset_id=dataset_id, table_id=table2_id, gcs_path=gcs_path)
+    step('create', step_start)
     
     # Pause for user input
-    input_resp = input('[ INFO ] BigQuery datasets and tables have been created. Press y to continue:  ')
-    if input_resp == 'y':
-        pass
-    else:
-        sys.exit()
+    if not confirm('[ INFO ] BigQuery datasets and tables have been created. Press y to continue:  '):
+        return timings
+    
+    # Repeated count queries are served from a local cache until the table changes
+    query_cache = QueryResultCache()
     
     # Query Table1
-    query = ''' select count(*) as count from `{}.{}.{}` '''.format(args['project_id'], args['dataset_id'], args['table1_id'])
-    print('\n[ INFO ] Executing query against {}\n{}'.format(args['table1_id'], query) )
-    bq_query( query, location=args['location'] )
+    step_start = time.perf_counter()
+    query = ''' select count(*) as count from `{}.{}.{}` '''.format(project_id, dataset_id, table1_id)
+    print('\n[ INFO ] Executing query against {}\n{}'.format(table1_id, query))
+    bq_query(query, location=location, cache=query_cache)
     
     # Query Table2
-    query = ''' select count(*) as count from `{}.{}.{}` '''.format(args['project_id'], args['dataset_id'], args['table2_id'])
-    print('\n[ INFO ] Executing query against {}\n{}'.format(args['table2_id'], query) )
-    bq_query( query, location=args['location'] )
+    query = ''' select count(*) as count from `{}.{}.{}` '''.format(project_id, dataset_id, table2_id)
+    print('\n[ INFO ] Executing query against {}\n{}'.format(table2_id, query))
+    bq_query(query, location=location, cache=query_cache)
+    step('query', step_start)
     
     # Pause for user input
-    input_resp = input('[ INFO ] Table 1 still needs data, so the next step will insert records into the empty table.\n[ INFO ] Press y to continue:  ')
-    if input_resp == 'y':
-        pass
-    else:
-        sys.exit()
+    if not confirm('[ INFO ] Table 1 still needs data, so the next step will insert records into the empty table.\n[ INFO ] Press y to continue:  '):
+        return timings
     
     # Insert data
+    step_start = time.perf_counter()
     rows_to_insert = [
             ('1000', 'dan',   'NC', 100.20, 0),
             ('1001', 'dan',   'NC',  50.00, 1),
             ('1002', 'frank', 'CA', 500.00, 0),
             ('1003', 'dean',  'NV',  10.10, 1)
         ]
-    bq_insert_rows(args['dataset_id'], args['table1_id'], rows_to_insert)
+    result = bq_insert_rows(dataset_id, table1_id, rows_to_insert)
+    if result:
+        print('[ INFO ] Inserted {} rows into BigQuery table {} ({} failed, {} requests, {:.2f}s)'.format(
+            result['rows_sent'], table1_id, result['rows_failed'], result['requests'], result['elapsed']))
+        for error in result['errors']:
+            print('[ ERROR] Row {} {}: {}'.format(error['index'], error['row'], error['errors']))
     
     # Query Table2 (again)
-    query = ''' select count(*) as count from `{}.{}.{}` '''.format(args['project_id'], args['dataset_id'], args['table1_id'])
-    print('\n[ INFO ] Executing query against {}\n{}'.format(args['table1_id'], query) )
-    bq_query( query, location=args['location'] )
+    query = ''' select count(*) as count from `{}.{}.{}` '''.format(project_id, dataset_id, table1_id)
+    print('\n[ INFO ] Executing query against {}\n{}'.format(table1_id, query))
+    bq_query(query, location=location, cache=query_cache)
+    print('[ INFO ] Query cache: {}'.format(query_cache.stats()))
+    step('insert', step_start)
     
     # Pause for user input
-    input_resp = input('[ INFO ] Data is loaded in both tables. Next step will create a view on top of table 2.\n[ INFO ] Press y to continue:  ')
-    if input_resp == 'y':
-        pass
-    else:
-        sys.exit()
+    if not confirm('[ INFO ] Data is loaded in both tables. Next step will create a view on top of table 2.\n[ INFO ] Press y to continue:  '):
+        return timings
     
     # Create View on Loan Table
-    bq_create_view( view_dataset_id = args['dataset_id'],
-                        view_id = args['view_id'],
-                        query = " select member_id, loan_amnt, zip_code, `default` from `{}.{}.{}` ".format(args['project_id'], args['dataset_id'], args['table2_id'])
-                      )
+    step_start = time.perf_counter()
+    bq_create_view( view_dataset_id = dataset_id,
+                    view_id = view_id,
+                    query = " select member_id, loan_amnt, zip_code, `default` from `{}.{}.{}` ".format(project_id, dataset_id, table2_id)
+                  )
+    step('view', step_start)
     
     # Pause for user input
-    input_resp = input('[ INFO ] Demoflow is complete. Press y to DELETE all assets or any other key to keep the assets:  ')
-    if input_resp == 'y':
-        pass
-    else:
-        sys.exit()
+    if not confirm('[ INFO ] Demoflow is complete. Press y to DELETE all assets or any other key to keep the assets:  '):
+        return timings
     
     # Cleanup - Delete Dataset and Tables
-    bq_delete_dataset(args['dataset_id'])
+    step_start = time.perf_counter()
+    bq_delete_dataset(dataset_id)
+    step('delete', step_start)
+    return timings
+
+
+
+
+
+######################################################################################
+#
+#   Main
+#
+######################################################################################
+
+
+if __name__ == "__main__":
+
+    # ARGS - Used for Testing
+    '''
+    args =  {
+                "project_id":   "zproject201807",
+                "dataset_id":   "demo_dataset1",
+                "location":     "US",
+                "table1_id":    "table_empty",
+                "table2_id":    "table_loans",
+                "gcs_path":     "gs://zdatasets1/loan_200k.csv"
+            }
+    '''
+    
+    # Arguments
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--project_id", required=True, help="GCP Project ID")
+    ap.add_argument("--dataset_id", required=True, help="BigQuery Dataset ID")
+    ap.add_argument("--location",   required=True, help="BigQuery Dataset Geographic Location")
+    ap.add_argument("--table1_id",  required=True, help="BigQuery Table Name (empty table)")
+    ap.add_argument("--table2_id",  required=True, help="BigQuery Table Name (GCS loaded table)")
+    ap.add_argument("--gcs_path",   required=True, help="Google Cloud Storage location")
+    ap.add_argument("--view_id",    required=True, help="Name/ID of BigQuery View")
+    ap.add_argument("--yes",        action="store_true", help="Run every step without prompting (also deletes the assets at the end)")
+    ap.add_argument("--state_file", default=None,        help="Checkpoint file: a rerun with the same file skips the steps already done")
+    ap.add_argument("--max_workers", type=int, default=8, help="Steps run at once")
+    ap.add_argument("--sequential", action="store_true", help="Run the steps one after another (run_demoflow) instead of as a pipeline")
+    args = vars(ap.parse_args())
+    
+    interactive = not args.pop('yes')
+    state_file  = args.pop('state_file')
+    max_workers = args.pop('max_workers')
+    if args.pop('sequential'):
+        run_demoflow(confirm=None if interactive else (lambda prompt: True), **args)
+    else:
+        # The steps and their dependencies are declared in gcp_bigquery_demoflow.yaml (see gcp_bigquery_pipeline.py)
+        from gcp_bigquery_pipeline import load_pipeline
+        pipeline = load_pipeline(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gcp_bigquery_demoflow.yaml'), **args)
+        pipeline.run(state_file=state_file, max_workers=max_workers, interactive=interactive)
 
 
 
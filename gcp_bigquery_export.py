@@ -0,0 +1,342 @@
+####################################################################################################
+#
+#   Google BigQuery - Sharded Table Exports with Parallel, Resumable Downloads
+#
+#   https://cloud.google.com/bigquery/docs/exporting-data
+#   https://cloud.google.com/storage/docs/hashes-etags
+#
+####################################################################################################
+
+
+
+'''
+NOTES
+
+    An extract job writes at most 1 GB per file: a larger table needs a wildcard destination
+    ('gs://bucket/path/table-*.avro'), which BigQuery expands to numbered shards (table-000000000000.avro, ...).
+
+    export_table():
+        1. Runs one extract job (destination_format AVRO, PARQUET, CSV or NEWLINE_DELIMITED_JSON, with an
+           optional compression, see EXPORT_FORMATS)
+        2. Lists the shards the job wrote (one Cloud Storage listing per wildcard)
+        3. (local_dir) Downloads max_workers shards at once, each streamed straight to disk
+
+    Downloads:
+        - A shard is written to <name>.<generation>.part and renamed to <name> only once it has been verified,
+          so a file with the final name is always complete
+        - A download that breaks off is resumed from the size of the .part file (ranged request), up to
+          max_retries times, also across runs. Naming the .part after the object generation means a shard
+          rewritten in the meantime is never stitched onto bytes of the old one (and the ranged request
+          is pinned to the generation with if_generation_match)
+        - Verified against the CRC32C of the object (or its MD5 when there is no CRC32C). The checksum is
+          computed while the bytes are written, so only one chunk of a shard is ever held in memory.
+          A mismatch discards the .part file and downloads the shard again from the start
+        - Objects are fetched raw (no decompressive transcoding), so a .gz shard stays compressed on disk
+          and matches its stored checksum
+        - Shards already on disk with a matching checksum are skipped
+
+    USAGE:
+    report = export_table('demo_dataset1', 'table_loans', 'gs://zdatasets1/exports/loans/', local_dir='/tmp/loans')
+    report = export_table('demo_dataset1', 'table_loans', 'gs://zdatasets1/exports/loans-*.csv.gz',
+                          destination_format='CSV', compression='GZIP', local_dir='/tmp/loans')
+    print(report['files'], report['downloaded_bytes'], report['failed_shards'])
+
+'''
+
+
+####################################################################################################
+#
+#   Python Libraries
+#
+####################################################################################################
+
+
+import concurrent.futures
+import fnmatch
+import glob
+import os
+import time
+
+from google.api_core.exceptions import NotFound
+
+from gcp_bigquery_clients import get_client
+from gcp_bigquery_load import _split_uri
+from gcp_bigquery_telemetry import in_span_context, instrument
+
+
+####################################################################################################
+
+
+
+# destination_format -> (file extension, supported compressions)
+EXPORT_FORMATS = {'AVRO':                   ('avro',    ('DEFLATE', 'SNAPPY')),
+                  'PARQUET':                ('parquet', ('SNAPPY', 'GZIP', 'ZSTD')),
+                  'CSV':                    ('csv',     ('GZIP',)),
+                  'NEWLINE_DELIMITED_JSON': ('json',    ('GZIP',))}
+
+EXPORT_CHUNK_BYTES = 1024 * 1024        # Read size when re-hashing a .part file or a finished shard
+
+
+
+
+def export_extension(destination_format='AVRO', compression=None):
+    '''
+        File extension of an export, e.g. export_extension('CSV', 'GZIP') == 'csv.gz'
+    '''
+    destination_format, compression = _export_format(destination_format, compression)
+    extension = EXPORT_FORMATS[destination_format][0]
+    return extension + '.gz' if compression == 'GZIP' and destination_format in ('CSV', 'NEWLINE_DELIMITED_JSON') else extension
+
+
+
+
+def _export_format(destination_format, compression):
+    destination_format = (destination_format or 'AVRO').upper()
+    compression        = (compression or 'NONE').upper()
+    if destination_format not in EXPORT_FORMATS:
+        raise ValueError('destination_format must be one of {}, got {!r}'.format(sorted(EXPORT_FORMATS), destination_format))
+    if compression != 'NONE' and compression not in EXPORT_FORMATS[destination_format][1]:
+        raise ValueError('{} exports support compression {}, got {!r}'.format(
+                         destination_format, EXPORT_FORMATS[destination_format][1], compression))
+    return destination_format, compression
+
+
+
+
+def extract_table(dataset_id, table_id, destination_uris, destination_format='AVRO', compression=None,
+                  print_header=True, field_delimiter=',', location='US', client=None):
+    '''
+        Runs an extract job of dataset_id.table_id to gs:// destination_uris and waits for it
+
+        USAGE:
+        job = extract_table('demo_dataset1', 'table_loans', 'gs://zdatasets1/exports/loans-*.parquet', 'PARQUET', 'SNAPPY')
+        print(job.destination_uri_file_counts)
+
+        print_header and field_delimiter only apply to CSV.
+    '''
+    from google.cloud import bigquery
+
+    destination_format, compression = _export_format(destination_format, compression)
+    if isinstance(destination_uris, str):
+        destination_uris = [destination_uris]
+    for uri in destination_uris:
+        _split_uri(uri)
+
+    job_config = bigquery.ExtractJobConfig()
+    job_config.destination_format = destination_format
+    if compression != 'NONE':
+        job_config.compression = compression
+    if destination_format == 'CSV':
+        job_config.print_header    = print_header
+        job_config.field_delimiter = field_delimiter
+    if destination_format == 'AVRO':
+        job_config.use_avro_logical_types = True
+
+    client = client or get_client()
+    job    = client.extract_table(client.dataset(dataset_id).table(table_id), destination_uris,
+                                  job_config=job_config, location=location)
+    job.result()
+    return job
+
+
+
+
+def list_export_shards(destination_uris, storage_client=None, written_after=None):
+    '''
+        The Cloud Storage blobs written for destination_uris (gs:// paths or wildcards), sorted by URI
+
+        A missing explicit path raises NotFound. written_after (datetime, e.g. the extract job's start) drops
+        wildcard matches created before it: leftovers of an earlier, larger export to the same path.
+    '''
+    if isinstance(destination_uris, str):
+        destination_uris = [destination_uris]
+    if storage_client is None:
+        from google.cloud import storage
+        storage_client = storage.Client()
+
+    blobs = {}
+    for uri in destination_uris:
+        bucket_name, name = _split_uri(uri)
+        if '*' not in name:
+            blob = storage_client.bucket(bucket_name).get_blob(name)
+            if blob is None:
+                raise NotFound('{} does not exist'.format(uri))
+            blobs[uri] = blob
+            continue
+        for blob in storage_client.list_blobs(bucket_name, prefix=name.split('*', 1)[0]):
+            if blob.name.endswith('/') or not fnmatch.fnmatchcase(blob.name, name):
+                continue
+            if written_after is not None and blob.time_created is not None and blob.time_created < written_after:
+                continue
+            blobs['gs://{}/{}'.format(bucket_name, blob.name)] = blob
+    return [blobs[uri] for uri in sorted(blobs)]
+
+
+
+
+class _ChecksumWriter(object):
+    '''
+        File object that hashes (CRC32C and MD5) the bytes written through it
+    '''
+    def __init__(self, file_obj):
+        import hashlib
+        import google_crc32c
+        self.file_obj = file_obj
+        self.crc32c   = google_crc32c.Checksum()
+        self.md5      = hashlib.md5()
+        self.written  = 0
+
+    def write(self, data):
+        self.file_obj.write(data)
+        self.update(data)
+        return len(data)
+
+    def update(self, data):
+        self.crc32c.update(data)
+        self.md5.update(data)
+        self.written += len(data)
+
+    def matches(self, blob):
+        import base64
+        if blob.crc32c:
+            return base64.b64encode(self.crc32c.digest()).decode('ascii') == blob.crc32c
+        if blob.md5_hash:
+            return base64.b64encode(self.md5.digest()).decode('ascii') == blob.md5_hash
+        return True                     # Objects without stored hashes can only be checked by size
+
+
+
+
+def _hash_file(path, writer):
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(EXPORT_CHUNK_BYTES), b''):
+            writer.update(chunk)
+    return writer
+
+
+
+
+def download_shard(blob, local_dir, max_retries=3, retry_delay=1.0):
+    '''
+        Streams one Cloud Storage blob to local_dir/<basename>, resuming and verifying it (see NOTES)
+
+        Output:     {'uri', 'path', 'bytes', 'state' (DONE, SKIPPED or FAILED), 'attempts', 'resumed_bytes',
+                     'downloaded_bytes', 'checksum_failures', 'seconds', 'error'}
+    '''
+    uri    = 'gs://{}/{}'.format(blob.bucket.name, blob.name)
+    path   = os.path.join(local_dir, os.path.basename(blob.name))
+    part   = '{}.{}.part'.format(path, blob.generation)
+    report = {'uri': uri, 'path': path, 'bytes': blob.size, 'state': 'PENDING', 'attempts': 0, 'resumed_bytes': 0,
+              'downloaded_bytes': 0, 'checksum_failures': 0, 'seconds': None, 'error': None}
+    start  = time.time()
+
+    if os.path.exists(path) and os.path.getsize(path) == blob.size and _hash_file(path, _ChecksumWriter(None)).matches(blob):
+        report.update({'state': 'SKIPPED', 'seconds': time.time() - start})
+        return report
+    for stale in glob.glob(glob.escape(path) + '.*.part'):
+        if stale != part:
+            os.remove(stale)
+
+    while True:
+        report['attempts'] += 1
+        if os.path.exists(part) and os.path.getsize(part) > blob.size:
+            os.remove(part)
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        if offset and report['attempts'] == 1:
+            report['resumed_bytes'] = offset
+
+        try:
+            with open(part, 'ab') as f:
+                writer = _hash_file(part, _ChecksumWriter(f)) if offset else _ChecksumWriter(f)
+                if offset < blob.size:
+                    try:
+                        blob.download_to_file(writer, start=offset, raw_download=True, checksum=None,
+                                              if_generation_match=blob.generation)
+                    finally:
+                        f.flush()
+                        report['downloaded_bytes'] += os.path.getsize(part) - offset
+            size = os.path.getsize(part)
+            if size != blob.size or not writer.matches(blob):
+                os.remove(part)
+                report['checksum_failures'] += 1
+                raise ValueError('Checksum mismatch for {} ({} of {} bytes)'.format(uri, size, blob.size))
+        except Exception as e:
+            report['error'] = '{}: {}'.format(type(e).__name__, e)
+            if report['attempts'] > max_retries:
+                report.update({'state': 'FAILED', 'seconds': time.time() - start})
+                return report
+            time.sleep(retry_delay * 2 ** (report['attempts'] - 1))
+            continue
+
+        os.replace(part, path)
+        report.update({'state': 'DONE', 'error': None, 'seconds': time.time() - start})
+        return report
+
+
+
+
+def download_shards(blobs, local_dir, max_workers=8, max_retries=3, retry_delay=1.0):
+    '''
+        Downloads Cloud Storage blobs to local_dir, max_workers at once (see download_shard)
+    '''
+    os.makedirs(local_dir, exist_ok=True)
+    if not blobs:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(blobs)))) as executor:
+        return list(executor.map(in_span_context(lambda blob: download_shard(blob, local_dir, max_retries, retry_delay)), blobs))
+
+
+
+
+@instrument
+def export_table(dataset_id, table_id, destination_uri, local_dir=None, destination_format='AVRO', compression=None,
+                 print_header=True, field_delimiter=',', max_workers=8, max_retries=3, retry_delay=1.0,
+                 location='US', client=None, storage_client=None):
+    '''
+        Exports dataset_id.table_id to Cloud Storage in shards and (local_dir) downloads them in parallel
+
+        USAGE:
+        report = export_table('demo_dataset1', 'table_loans', 'gs://zdatasets1/exports/loans/', local_dir='/tmp/loans')
+
+        Input(s):   destination_uri:    gs:// URI with a '*' (sharded), without one (a single file, at most 1 GB),
+                                        or ending in '/' for <table_id>-*.<extension> in that folder
+                    local_dir:          Download the shards there (None: leave them in Cloud Storage only)
+                    max_workers:        Shards downloaded at once
+                    max_retries:        Times a broken or corrupt download of a shard is retried
+
+        Output:     {'table', 'job_id', 'destination_uri', 'files', 'input_bytes', 'shards': [{...}, ...],
+                     'downloaded_bytes', 'resumed_shards', 'skipped_shards', 'failed_shards', 'elapsed', 'mb_per_second'}
+
+    '''
+    start = time.time()
+    if destination_uri.endswith('/'):
+        destination_uri += '{}-*.{}'.format(table_id, export_extension(destination_format, compression))
+
+    client = client or get_client()
+    job    = extract_table(dataset_id, table_id, destination_uri, destination_format, compression,
+                           print_header, field_delimiter, location, client)
+    blobs  = list_export_shards(destination_uri, storage_client, written_after=job.started)
+    if job.destination_uri_file_counts and len(blobs) != sum(job.destination_uri_file_counts):
+        print('[ WARN ] Extract job {} wrote {} file(s) but {} match {}'.format(
+              job.job_id, sum(job.destination_uri_file_counts), len(blobs), destination_uri))
+    shards = download_shards(blobs, local_dir, max_workers, max_retries, retry_delay) if local_dir else \
+             [{'uri': 'gs://{}/{}'.format(blob.bucket.name, blob.name), 'bytes': blob.size, 'state': 'EXPORTED'} for blob in blobs]
+
+    elapsed    = time.time() - start
+    downloaded = sum(shard.get('downloaded_bytes', 0) for shard in shards)
+    return {'table':            '{}.{}'.format(dataset_id, table_id),
+            'job_id':           job.job_id,
+            'destination_uri':  destination_uri,
+            'files':            len(blobs),
+            'input_bytes':      sum(blob.size for blob in blobs),
+            'shards':           shards,
+            'downloaded_bytes': downloaded,
+            'resumed_shards':   sum(1 for shard in shards if shard.get('resumed_bytes') or shard.get('attempts', 0) > 1),
+            'skipped_shards':   sum(1 for shard in shards if shard['state'] == 'SKIPPED'),
+            'failed_shards':    sum(1 for shard in shards if shard['state'] == 'FAILED'),
+            'elapsed':          elapsed,
+            'mb_per_second':    downloaded / 1e6 / elapsed if elapsed else None}
+
+
+
+#ZEND
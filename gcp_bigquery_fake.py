@@ -0,0 +1,1697 @@
+####################################################################################################
+#
+#   Google BigQuery - Local Fake Backend
+#
+#   https://cloud.google.com/bigquery/docs/reference/rest/
+#
+####################################################################################################
+
+
+
+'''
+NOTES
+
+    An in-memory stand-in for the BigQuery REST API, used to exercise and benchmark the helpers without a GCP project.
+
+    FakeTransport replaces the requests.Session a bigquery.Client sends its HTTP requests through,
+    so the real client library builds every request and parses every response as it would in production.
+    Only the network is simulated:
+        - handshake_latency: paid once by each new transport (credential loading + TLS handshake)
+        - request_latency:   paid by every request (round-trip time), or per request kind with latencies
+
+    Failures and quotas can be injected per request kind (see FakeBigQueryBackend): scripted errors,
+    a random error rate and request-rate / total quotas, answered the way BigQuery answers them.
+
+    USAGE:
+    backend = FakeBigQueryBackend(project='fake-project', request_latency=0.002)
+    set_client_factory(fake_client_factory(backend, handshake_latency=0.050))
+    bq_create_dataset('demo_dataset1')          # Runs against the in-memory backend
+
+'''
+
+
+####################################################################################################
+#
+#   Python Libraries
+#
+####################################################################################################
+
+
+import collections
+import csv
+import datetime
+import fnmatch
+import io
+import json
+import random
+import re
+import threading
+import time
+from types import SimpleNamespace
+from urllib.parse import urlsplit, parse_qsl
+
+import requests
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import bigquery
+
+
+####################################################################################################
+
+
+
+_ROUTES = [
+    ('GET',    r'/projects/(?P<project>[^/]+)/datasets',                                      'list_datasets'),
+    ('POST',   r'/projects/(?P<project>[^/]+)/datasets',                                      'insert_dataset'),
+    ('GET',    r'/projects/(?P<project>[^/]+)/datasets/(?P<dataset>[^/]+)',                   'get_dataset'),
+    ('PATCH',  r'/projects/(?P<project>[^/]+)/datasets/(?P<dataset>[^/]+)',                   'patch_dataset'),
+    ('PUT',    r'/projects/(?P<project>[^/]+)/datasets/(?P<dataset>[^/]+)',                   'patch_dataset'),
+    ('DELETE', r'/projects/(?P<project>[^/]+)/datasets/(?P<dataset>[^/]+)',                   'delete_dataset'),
+    ('GET',    r'/projects/(?P<project>[^/]+)/datasets/(?P<dataset>[^/]+)/tables',            'list_tables'),
+    ('POST',   r'/projects/(?P<project>[^/]+)/datasets/(?P<dataset>[^/]+)/tables',            'insert_table'),
+    ('GET',    r'/projects/(?P<project>[^/]+)/datasets/(?P<dataset>[^/]+)/tables/(?P<table>[^/]+)', 'get_table'),
+    ('PATCH',  r'/projects/(?P<project>[^/]+)/datasets/(?P<dataset>[^/]+)/tables/(?P<table>[^/]+)', 'patch_table'),
+    ('PUT',    r'/projects/(?P<project>[^/]+)/datasets/(?P<dataset>[^/]+)/tables/(?P<table>[^/]+)', 'patch_table'),
+    ('DELETE', r'/projects/(?P<project>[^/]+)/datasets/(?P<dataset>[^/]+)/tables/(?P<table>[^/]+)', 'delete_table'),
+    ('POST',   r'/projects/(?P<project>[^/]+)/datasets/(?P<dataset>[^/]+)/tables/(?P<table>[^/]+)/insertAll', 'insert_all'),
+    ('GET',    r'/projects/(?P<project>[^/]+)/datasets/(?P<dataset>[^/]+)/tables/(?P<table>[^/]+)/data',      'list_table_data'),
+    ('POST',   r'/projects/(?P<project>[^/]+)/jobs',                                          'insert_job'),
+    ('GET',    r'/projects/(?P<project>[^/]+)/jobs/(?P<job>[^/]+)',                           'get_job'),
+    ('POST',   r'/projects/(?P<project>[^/]+)/jobs/(?P<job>[^/]+)/cancel',                    'cancel_job'),
+    ('GET',    r'/projects/(?P<project>[^/]+)/queries/(?P<job>[^/]+)',                        'get_query_results'),
+]
+
+_ROUTES = [(method, re.compile('^/bigquery/v2{}$'.format(pattern)), handler) for method, pattern, handler in _ROUTES]
+
+
+
+
+# HTTP status BigQuery answers with for an error reason (anything else: 400)
+_ERROR_STATUS = {
+    'accessDenied':      403,
+    'backendError':      503,
+    'internalError':     500,
+    'notFound':          404,
+    'quotaExceeded':     403,
+    'rateLimitExceeded': 403,
+    'responseTooLarge':  403,
+}
+
+
+
+
+class FakeApiError(Exception):
+    '''
+        Raised inside the backend to return an error response (code + reason) to the client
+    '''
+    def __init__(self, code, reason, message):
+        super().__init__(message)
+        self.code    = code
+        self.reason  = reason
+        self.message = message
+
+
+
+
+def _now_ms():
+    return str(int(time.time() * 1000))
+
+
+
+
+def _timestamp_seconds(value):
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return datetime.datetime.fromisoformat(value.replace('Z', '+00:00').replace(' UTC', '+00:00')).timestamp()
+    if isinstance(value, datetime.datetime):
+        return (value if value.tzinfo else value.replace(tzinfo=datetime.timezone.utc)).timestamp()
+    return float(value)
+
+
+
+
+def _cell_formatter(field, int64_timestamp):
+    '''
+        Returns a function formatting stored values of field the way tabledata.list / getQueryResults return them
+    '''
+    if field['type'] in ('BOOLEAN', 'BOOL'):
+        return lambda value: None if value is None else ('true' if value in (True, 'true', 'True') else 'false')
+    if field['type'] == 'TIMESTAMP' and int64_timestamp:
+        return lambda value: None if value is None else str(int(round(_timestamp_seconds(value) * 1000000)))
+    if field['type'] == 'TIMESTAMP':
+        return lambda value: None if value is None else repr(_timestamp_seconds(value))
+    return lambda value: None if value is None else str(value)
+
+
+
+
+def _typed_cell(field, value):
+    '''
+        A stored value of field as the Python type of its column (stored values may be strings, e.g. loaded CSV)
+    '''
+    if value is None:
+        return None
+    if field['type'] in ('INTEGER', 'INT64'):
+        return int(value)
+    if field['type'] in ('FLOAT', 'FLOAT64'):
+        return float(value)
+    if field['type'] in ('BOOLEAN', 'BOOL'):
+        return value in (True, 'true', 'True')
+    return value if isinstance(value, str) else str(value)
+
+
+
+
+def _estimate_bytes(rows):
+    '''
+        Approximate logical size of stored rows, sampled so lazily generated results stay lazy
+    '''
+    if not len(rows):
+        return 0
+    sample = rows[:100]
+    return len(json.dumps(sample, default=str)) * len(rows) // len(sample)
+
+
+
+
+_PARTITION_FORMATS = {'HOUR': '%Y%m%d%H', 'DAY': '%Y%m%d', 'MONTH': '%Y%m', 'YEAR': '%Y'}
+
+
+
+
+def _partition_of(resource, row):
+    '''
+        Partition ID of a stored row in a partitioned table (None when the table is not partitioned)
+    '''
+    range_spec = resource.get('rangePartitioning')
+    if range_spec:
+        value = row.get(range_spec['field'])
+        if value is None:
+            return '__NULL__'
+        start, end, interval = (int(range_spec['range'][key]) for key in ('start', 'end', 'interval'))
+        if not start <= int(value) < end:
+            return '__UNPARTITIONED__'
+        return str(start + (int(value) - start) // interval * interval)
+
+    time_spec = resource.get('timePartitioning')
+    if not time_spec:
+        return None
+    if not time_spec.get('field'):
+        return row.get('_PARTITIONTIME')
+    value = row.get(time_spec['field'])
+    if value is None:
+        return '__NULL__'
+    if isinstance(value, datetime.datetime):
+        moment = value
+    elif isinstance(value, datetime.date):
+        moment = datetime.datetime(value.year, value.month, value.day)
+    else:
+        try:
+            moment = datetime.datetime.fromtimestamp(float(value), datetime.timezone.utc)
+        except ValueError:
+            moment = datetime.datetime.fromisoformat(value.replace('T', ' ')[:19])
+    return moment.strftime(_PARTITION_FORMATS[time_spec.get('type', 'DAY')])
+
+
+
+
+class SyntheticRows(object):
+    '''
+        A lazily generated, read-only list of rows: make_row(i) builds row i on demand
+
+        Lets the backend serve very large results without holding them in memory.
+
+        USAGE:
+        rows = SyntheticRows(10000000, lambda i: {'id': i, 'amount': i * 0.5})
+        backend.add_query_result('select * from big', fields, rows)
+
+    '''
+    def __init__(self, num_rows, make_row):
+        self.num_rows = num_rows
+        self.make_row = make_row
+
+    def __len__(self):
+        return self.num_rows
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.make_row(i) for i in range(*index.indices(self.num_rows))]
+        if index < 0:
+            index += self.num_rows
+        if not 0 <= index < self.num_rows:
+            raise IndexError(index)
+        return self.make_row(index)
+
+    def __iter__(self):
+        return (self.make_row(i) for i in range(self.num_rows))
+
+
+
+
+def _normalize_sql(sql):
+    return ' '.join(sql.split()).rstrip(';').strip().lower()
+
+
+
+
+_SQL_COUNT  = re.compile(r'^select count\(\*\)(?: as `?(?P<alias>\w+)`?)? from `?(?P<table>[\w\-\.]+)`?$', re.IGNORECASE)
+_SQL_TABLES = re.compile(r'\b(?:from|join)\s+`?([\w\-]+(?:\.[\w\-]+){1,2})`?', re.IGNORECASE)
+_SQL_SELECT = re.compile(r'^select (?P<columns>.+?) from `?(?P<table>[\w\-\.]+)`?(?: limit (?P<limit>\d+))?$', re.IGNORECASE)
+
+
+
+
+class FakeStorage(object):
+    '''
+        In-memory stand-in for the google.cloud.storage.Client calls used by the loaders and exporters
+        (list_blobs, bucket().get_blob(), blob.download_to_file()); load jobs on a FakeBigQueryBackend read
+        their files from it and extract jobs write theirs to it
+
+        Blobs carry size, generation, time_created, md5_hash and crc32c (base64, like Cloud Storage). download_to_file()
+        streams chunk_bytes at a time at bytes_per_second per download (None: unthrottled), and the next
+        failing_downloads[uri] downloads of an object break off after half of the requested bytes.
+
+        USAGE:
+        backend.storage.upload('gs://zdatasets1/loans/part-0001.csv', b'id,amount\n1,100\n')
+        load_gcs_shards('demo_dataset1', 'table_loans', 'gs://zdatasets1/loans/*.csv', storage_client=backend.storage)
+
+    '''
+    def __init__(self, chunk_bytes=256 * 1024, bytes_per_second=None):
+        self.objects           = {}         # gs:// URI -> file contents (bytes)
+        self.generations       = {}         # gs:// URI -> generation (changes on every upload)
+        self.created           = {}         # gs:// URI -> time of the last upload (UTC datetime)
+        self.chunk_bytes       = chunk_bytes
+        self.bytes_per_second  = bytes_per_second
+        self.failing_downloads = {}         # gs:// URI -> number of downloads that break off midway
+        self.bytes_downloaded  = 0
+        self._checksums        = {}         # (gs:// URI, generation) -> (md5_hash, crc32c)
+        self._lock             = threading.Lock()
+
+    def upload(self, uri, data):
+        with self._lock:
+            self.objects[uri]     = data if isinstance(data, bytes) else data.encode('utf-8')
+            self.generations[uri] = self.generations.get(uri, 0) + 1
+            self.created[uri]     = datetime.datetime.now(datetime.timezone.utc)
+
+    def delete(self, uri):
+        with self._lock:
+            self.objects.pop(uri, None)
+
+    def match(self, pattern):
+        return sorted(uri for uri in self.objects if fnmatch.fnmatchcase(uri, pattern))
+
+    def _blob(self, uri):
+        import base64
+        import hashlib
+        import google_crc32c
+
+        bucket_name, _, name = uri[len('gs://'):].partition('/')
+        data    = self.objects[uri]
+        storage = self
+
+        def download_as_bytes(start=None, end=None, **kwargs):
+            return data[start or 0:None if end is None else end + 1]
+
+        def download_to_file(file_obj, start=None, end=None, **kwargs):
+            requested = data[start or 0:None if end is None else end + 1]
+            with storage._lock:
+                failing = storage.failing_downloads.get(uri, 0) > 0
+                if failing:
+                    storage.failing_downloads[uri] -= 1
+            stop = len(requested) // 2 if failing else len(requested)
+            for offset in range(0, stop, storage.chunk_bytes):
+                chunk = requested[offset:min(offset + storage.chunk_bytes, stop)]
+                if storage.bytes_per_second:
+                    time.sleep(len(chunk) / float(storage.bytes_per_second))
+                file_obj.write(chunk)
+                with storage._lock:
+                    storage.bytes_downloaded += len(chunk)
+            if failing:
+                raise requests.exceptions.ConnectionError('Connection reset while downloading {}'.format(uri))
+
+        generation = self.generations.get(uri, 1)
+        if (uri, generation) not in self._checksums:
+            self._checksums[(uri, generation)] = (base64.b64encode(hashlib.md5(data).digest()).decode('ascii'),
+                                                  base64.b64encode(google_crc32c.Checksum(data).digest()).decode('ascii'))
+        md5_hash, crc32c = self._checksums[(uri, generation)]
+        return SimpleNamespace(name=name, size=len(data), bucket=SimpleNamespace(name=bucket_name), generation=generation,
+                               time_created=self.created.get(uri), md5_hash=md5_hash, crc32c=crc32c,
+                               download_as_bytes=download_as_bytes, download_to_file=download_to_file)
+
+    def list_blobs(self, bucket_or_name, prefix=None, **kwargs):
+        prefix = 'gs://{}/{}'.format(getattr(bucket_or_name, 'name', bucket_or_name), prefix or '')
+        return [self._blob(uri) for uri in sorted(self.objects) if uri.startswith(prefix)]
+
+    def bucket(self, bucket_name):
+        def get_blob(name, **kwargs):
+            uri = 'gs://{}/{}'.format(bucket_name, name)
+            return self._blob(uri) if uri in self.objects else None
+        return SimpleNamespace(name=bucket_name, get_blob=get_blob)
+
+
+
+
+class FakeBigQueryBackend(object):
+    '''
+        In-memory BigQuery state (datasets, tables, rows) shared by every FakeTransport pointed at it
+
+        USAGE:
+        backend = FakeBigQueryBackend(project='fake-project', request_latency=0.002)
+
+        Requests are named after their handler in _ROUTES ('get_table', 'insert_all', 'insert_job', ...):
+            latencies           {name: seconds} replaces request_latency for those requests
+            failing_requests    {name: [reason, ...]} fails the next requests of that name, one reason each,
+                                e.g. {'insert_all': ['backendError', 'rateLimitExceeded']}
+            error_rate          fails that fraction of all requests at random with one of error_reasons
+                                (seed= makes the sequence repeatable)
+            quotas              {name or '*': (requests, seconds)} fails requests beyond that many in any
+                                window of seconds with rateLimitExceeded; (requests, None) is a total budget,
+                                after which they fail with quotaExceeded. (requests, seconds, 'table') or
+                                (..., 'dataset') counts per table / dataset, like BigQuery's metadata update
+                                limits, e.g. {'patch_table': (5, 10.0, 'table')}
+        An injected error is answered before the request has any effect, with the status BigQuery uses
+        for the reason (403 rateLimitExceeded, 503 backendError, ...), so the client library retries the
+        reasons it retries in production. injected_errors counts them.
+
+    '''
+    def __init__(self, project='fake-project', location='US', request_latency=0.0, seed=None):
+        self.project         = project
+        self.location        = location
+        self.request_latency = request_latency
+        self.latencies       = {}           # request name -> latency replacing request_latency
+        self.failing_requests = {}          # request name -> error reasons of its next requests
+        self.error_rate      = 0.0          # Fraction of requests failing at random
+        self.error_reasons   = ('backendError',)
+        self.quotas          = {}           # request name or '*' -> (requests, seconds or None)
+        self.injected_errors = 0            # Requests failed by failing_requests / error_rate / quotas / max_interactive_queries
+        self.handler_seconds = 0.0          # Time spent serving requests, without the simulated latency
+        self.request_count   = 0
+        self.in_flight       = 0            # Requests being served right now
+        self.peak_in_flight  = 0            # Most requests ever served at once (bounded by the client pools)
+        self.datasets        = {}           # dataset_id -> dataset resource
+        self.tables          = {}           # (dataset_id, table_id) -> table resource
+        self.rows            = {}           # (dataset_id, table_id) -> list of {column: value} rows
+        self.insert_ids      = {}           # (dataset_id, table_id) -> set of insertIds already seen
+        self.jobs            = {}           # job_id -> job resource
+        self.query_results   = {}           # normalized SQL -> (schema fields, rows) registered with add_query_result()
+        self.query_dml_stats = {}           # normalized SQL -> dmlStats of a registered DML statement
+        self.job_latency     = 0.0          # Seconds a job stays RUNNING after it is inserted
+        self.max_interactive_queries = None # Interactive query jobs RUNNING at once; more fail with rateLimitExceeded
+        self.peak_interactive_queries = 0   # Most interactive query jobs ever RUNNING at once (BATCH queries are not limited)
+        self._interactive_running     = set()
+        self.storage         = FakeStorage()  # Files read by load jobs
+        self.failing_uris    = {}           # gs:// URI -> number of load jobs reading it that fail before it loads
+        self.failing_copies  = {}           # 'dataset.table' -> error reasons of the next copy jobs reading it, e.g. ['rateLimitExceeded']
+        self.extract_rows_per_file = 10000  # Rows per file written by extract jobs (BigQuery cuts files at about 1 GB)
+        self.bytes_uploaded  = 0            # Bytes received by load_table_from_file() uploads
+        self._uploads        = {}           # resumable upload_id -> (job resource, bytearray received so far)
+        self._uploaded       = {}           # job_id -> uploaded file contents, read by _run_load_job
+        self._job_done_at    = {}           # job_id -> time.time() at which the job finishes
+        self._lock           = threading.RLock()
+        self._etag           = 0
+        self._random         = random.Random(seed)
+        self._quota_calls    = {}           # quota key -> deque of request times (windowed) or request count (total)
+
+    def handle(self, method, path, params, body):
+        '''
+            Dispatches one REST request, returning (status_code, payload)
+        '''
+        with self._lock:
+            self.request_count  += 1
+            self.in_flight      += 1
+            self.peak_in_flight  = max(self.peak_in_flight, self.in_flight)
+        try:
+            return self._dispatch(method, path, params, body)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def _injected_error(self, name, resource=None):
+        '''
+            The FakeApiError a request named name (on resource, its route's {'dataset', 'table', ...})
+            fails with (failing_requests, quotas, error_rate), or None
+        '''
+        with self._lock:
+            failures = self.failing_requests.get(name)
+            if failures:
+                reason = failures.pop(0)
+                return FakeApiError(_ERROR_STATUS.get(reason, 400), reason, 'Injected {} error ({})'.format(reason, name))
+
+            now = time.time()
+            for key in (name, '*'):
+                if key not in self.quotas:
+                    continue
+                limit, seconds = self.quotas[key][:2]
+                scope          = self.quotas[key][2] if len(self.quotas[key]) > 2 else None
+                calls_key      = (key, (resource or {}).get('dataset'), (resource or {}).get('table') if scope == 'table' else None) if scope else key
+                if seconds is None:
+                    used = self._quota_calls[calls_key] = self._quota_calls.get(calls_key, 0) + 1
+                    if used > limit:
+                        return FakeApiError(403, 'quotaExceeded', 'Quota exceeded: {} requests ({})'.format(limit, key))
+                    continue
+                calls = self._quota_calls.setdefault(calls_key, collections.deque())
+                while calls and calls[0] <= now - seconds:
+                    calls.popleft()
+                if len(calls) >= limit:
+                    return FakeApiError(403, 'rateLimitExceeded',
+                                        'Exceeded rate limits: {} requests per {} seconds ({})'.format(limit, seconds, key))
+                calls.append(now)
+
+            if self.error_rate and self._random.random() < self.error_rate:
+                reason = self._random.choice(self.error_reasons)
+                return FakeApiError(_ERROR_STATUS.get(reason, 400), reason, 'Injected {} error ({})'.format(reason, name))
+        return None
+
+    def _dispatch(self, method, path, params, body):
+        for route_method, pattern, handler in _ROUTES:
+            match = pattern.match(path)
+            if match and route_method == method:
+                latency = self.latencies.get(handler, self.request_latency)
+                if latency:
+                    time.sleep(latency)
+                start = time.perf_counter()
+                try:
+                    error = self._injected_error(handler, match.groupdict())
+                    if error is not None:
+                        with self._lock:
+                            self.injected_errors += 1
+                        raise error
+                    with self._lock:
+                        return 200, getattr(self, '_' + handler)(params, body, **match.groupdict())
+                except FakeApiError as e:
+                    return e.code, {'error': {'code': e.code, 'message': e.message,
+                                              'errors': [{'reason': e.reason, 'message': e.message}]}}
+                finally:
+                    with self._lock:
+                        self.handler_seconds += time.perf_counter() - start
+
+        if self.request_latency:
+            time.sleep(self.request_latency)
+        return 404, {'error': {'code': 404, 'message': 'No route for {} {}'.format(method, path),
+                               'errors': [{'reason': 'notFound', 'message': path}]}}
+
+    def handle_upload(self, method, path, params, headers, data):
+        '''
+            Serves the multipart and resumable media uploads of load_table_from_file(),
+            returning (status_code, payload, response headers)
+        '''
+        with self._lock:
+            self.request_count  += 1
+            self.bytes_uploaded += len(data or b'')
+        if self.request_latency:
+            time.sleep(self.request_latency)
+
+        match = re.match(r'^/upload/bigquery/v2/projects/(?P<project>[^/]+)/jobs$', path)
+        if match is None:
+            return 404, {'error': {'code': 404, 'message': 'No route for {} {}'.format(method, path)}}, {}
+        project = match.group('project')
+        headers = dict((key.lower(), value) for key, value in (headers or {}).items())
+
+        if params.get('uploadType') == 'multipart':
+            boundary = headers['content-type'].split('boundary=')[1].strip('"').encode('utf-8')
+            parts    = data.split(b'--' + boundary)
+            resource = json.loads(parts[1].split(b'\r\n\r\n', 1)[1].rstrip(b'\r\n'))
+            content  = parts[2].split(b'\r\n\r\n', 1)[1][:-2]
+            return self._finish_upload(project, resource, content)
+
+        if method == 'POST':
+            upload_id = 'upload_{}'.format(len(self._uploads) + 1)
+            with self._lock:
+                self._uploads[upload_id] = (json.loads(data), bytearray())
+            location = 'https://bigquery.googleapis.com{}?uploadType=resumable&upload_id={}'.format(path, upload_id)
+            return 200, {}, {'location': location}
+
+        resource, received = self._uploads[params['upload_id']]
+        received          += data or b''
+        total              = headers.get('content-range', '').rsplit('/', 1)[-1]
+        if total != '*' and len(received) >= int(total):
+            del self._uploads[params['upload_id']]
+            return self._finish_upload(project, resource, bytes(received))
+        return 308, None, {'range': 'bytes=0-{}'.format(len(received) - 1)}
+
+    def _finish_upload(self, project, resource, content):
+        with self._lock:
+            self._uploaded[resource['jobReference']['jobId']] = content
+            try:
+                return 200, self._insert_job({}, resource, project), {}
+            except FakeApiError as e:
+                return e.code, {'error': {'code': e.code, 'message': e.message,
+                                          'errors': [{'reason': e.reason, 'message': e.message}]}}, {}
+
+    def _next_etag(self):
+        self._etag += 1
+        return 'etag{}'.format(self._etag)
+
+    def _require_dataset(self, project, dataset):
+        if dataset not in self.datasets:
+            raise FakeApiError(404, 'notFound', 'Not found: Dataset {}:{}'.format(project, dataset))
+        return self.datasets[dataset]
+
+    def _require_table(self, project, dataset, table):
+        self._require_dataset(project, dataset)
+        if (dataset, table) not in self.tables:
+            raise FakeApiError(404, 'notFound', 'Not found: Table {}:{}.{}'.format(project, dataset, table))
+        return self.tables[(dataset, table)]
+
+    # Datasets
+
+    def _list_datasets(self, params, body, project):
+        datasets = [resource for dataset, resource in sorted(self.datasets.items())
+                    if params.get('all') in ('true', 'True') or not dataset.startswith('_')]
+        for condition in (params.get('filter') or '').split():
+            key, _, value = condition[len('labels.'):].partition(':')
+            datasets = [resource for resource in datasets
+                        if key in resource.get('labels', {}) and (not value or resource['labels'][key] == value)]
+        response = self._list_page('datasets', [{'kind': 'bigquery#dataset',
+                                                 'id': resource['id'],
+                                                 'datasetReference': resource['datasetReference'],
+                                                 'labels': resource.get('labels', {}),
+                                                 'location': resource['location']} for resource in datasets], params)
+        response['kind'] = 'bigquery#datasetList'
+        return response
+
+    def _insert_dataset(self, params, body, project):
+        dataset = body['datasetReference']['datasetId']
+        if dataset in self.datasets:
+            raise FakeApiError(409, 'duplicate', 'Already Exists: Dataset {}:{}'.format(project, dataset))
+        resource = dict(body)
+        resource.update({'kind':             'bigquery#dataset',
+                         'id':               '{}:{}'.format(project, dataset),
+                         'datasetReference': {'projectId': project, 'datasetId': dataset},
+                         'location':         body.get('location') or self.location,
+                         'creationTime':     _now_ms(),
+                         'lastModifiedTime': _now_ms(),
+                         'etag':             self._next_etag()})
+        self.datasets[dataset] = resource
+        return resource
+
+    def _get_dataset(self, params, body, project, dataset):
+        return self._require_dataset(project, dataset)
+
+    def _patch_dataset(self, params, body, project, dataset):
+        resource = self._require_dataset(project, dataset)
+        resource.update({key: value for key, value in body.items() if key != 'datasetReference'})
+        resource.update({'lastModifiedTime': _now_ms(), 'etag': self._next_etag()})
+        return resource
+
+    def _delete_dataset(self, params, body, project, dataset):
+        self._require_dataset(project, dataset)
+        tables = [key for key in self.tables if key[0] == dataset]
+        if tables and params.get('deleteContents') != 'true':
+            raise FakeApiError(400, 'resourceInUse', 'Dataset {}:{} is still in use'.format(project, dataset))
+        for key in tables:
+            del self.tables[key]
+        del self.datasets[dataset]
+        return {}
+
+    # Tables
+
+    def _list_tables(self, params, body, project, dataset):
+        self._require_dataset(project, dataset)
+        tables   = [resource for _, resource in sorted(item for item in self.tables.items() if item[0][0] == dataset)]
+        response = self._list_page('tables', [{'kind': 'bigquery#table',
+                                               'id': resource['id'],
+                                               'tableReference': resource['tableReference'],
+                                               'type': resource['type'],
+                                               'timePartitioning': resource.get('timePartitioning'),
+                                               'labels': resource.get('labels', {})} for resource in tables], params)
+        response.update({'kind': 'bigquery#tableList', 'totalItems': len(tables)})
+        return response
+
+    def _insert_table(self, params, body, project, dataset):
+        dataset_resource = self._require_dataset(project, dataset)
+        table = body['tableReference']['tableId']
+        if (dataset, table) in self.tables:
+            raise FakeApiError(409, 'duplicate', 'Already Exists: Table {}:{}.{}'.format(project, dataset, table))
+        resource = dict(body)
+        resource.update({'kind':             'bigquery#table',
+                         'id':               '{}:{}.{}'.format(project, dataset, table),
+                         'tableReference':   {'projectId': project, 'datasetId': dataset, 'tableId': table},
+                         'type':             'VIEW' if 'view' in body else 'TABLE',
+                         'location':         dataset_resource['location'],
+                         'numRows':          '0',
+                         'numBytes':         '0',
+                         'creationTime':     _now_ms(),
+                         'lastModifiedTime': _now_ms(),
+                         'etag':             self._next_etag()})
+        self.tables[(dataset, table)] = resource
+        return resource
+
+    def _get_table(self, params, body, project, dataset, table):
+        return self._require_table(project, dataset, table)
+
+    def _patch_table(self, params, body, project, dataset, table):
+        resource = self._require_table(project, dataset, table)
+        resource.update({key: value for key, value in body.items() if key != 'tableReference'})
+        resource.update({'lastModifiedTime': _now_ms(), 'etag': self._next_etag()})
+        return resource
+
+    def _delete_table(self, params, body, project, dataset, table):
+        self._require_table(project, dataset, table)
+        del self.tables[(dataset, table)]
+        self.rows.pop((dataset, table), None)
+        self.insert_ids.pop((dataset, table), None)
+        return {}
+
+    # Table data
+
+    def _insert_all(self, params, body, project, dataset, table):
+        '''
+            Streaming insert: like BigQuery, one invalid row stops the whole request (other rows get reason "stopped")
+        '''
+        resource = self._require_table(project, dataset, table)
+        fields   = resource.get('schema', {}).get('fields', [])
+        names    = set(field['name'] for field in fields)
+        required = [field['name'] for field in fields if field.get('mode') == 'REQUIRED']
+        rows     = body.get('rows', [])
+
+        errors = []
+        for i, row in enumerate(rows):
+            missing = [name for name in required if row['json'].get(name) is None]
+            unknown = [name for name in row['json'] if name not in names]
+            if missing or unknown:
+                errors.append({'index': i, 'errors': [{'reason':   'invalid',
+                                                       'location': (missing + unknown)[0],
+                                                       'message':  'Missing required field(s) {} / no such field(s) {}'.format(missing, unknown)}]})
+        if errors and not body.get('skipInvalidRows'):
+            invalid = set(error['index'] for error in errors)
+            errors += [{'index': i, 'errors': [{'reason': 'stopped', 'message': ''}]} for i in range(len(rows)) if i not in invalid]
+            return {'kind': 'bigquery#tableDataInsertAllResponse', 'insertErrors': sorted(errors, key=lambda error: error['index'])}
+
+        invalid    = set(error['index'] for error in errors)
+        stored     = self.rows.setdefault((dataset, table), [])
+        if isinstance(stored, SyntheticRows):
+            stored = self.rows[(dataset, table)] = list(stored)
+        insert_ids = self.insert_ids.setdefault((dataset, table), set())
+        for i, row in enumerate(rows):
+            insert_id = row.get('insertId')
+            if i in invalid or (insert_id is not None and insert_id in insert_ids):
+                continue
+            insert_ids.add(insert_id)
+            stored.append(row['json'])
+
+        resource['numRows']         = str(len(stored))
+        resource['numBytes']        = str(_estimate_bytes(stored))
+        resource['streamingBuffer'] = {'estimatedRows': str(len(rows) - len(invalid)), 'oldestEntryTime': _now_ms()}
+        response = {'kind': 'bigquery#tableDataInsertAllResponse'}
+        if errors:
+            response['insertErrors'] = errors
+        return response
+
+    def _list_page(self, key, items, params):
+        '''
+            One page of a datasets.list / tables.list answer (pageToken is the next item offset)
+        '''
+        start       = int(params.get('pageToken') or 0)
+        max_results = int(params.get('maxResults') or 1000)
+        page        = {key: items[start:start + max_results]}
+        if start + max_results < len(items):
+            page['nextPageToken'] = str(start + max_results)
+        return page
+
+    def _page(self, fields, rows, params):
+        '''
+            One page of rows for tabledata.list / getQueryResults (pageToken is the next row offset)
+        '''
+        start           = int(params.get('pageToken') or params.get('startIndex') or 0)
+        max_results     = int(params.get('maxResults', 100000))
+        int64_timestamp = params.get('formatOptions.useInt64Timestamp') in ('true', 'True')
+        if params.get('selectedFields'):
+            selected = params['selectedFields'].split(',')
+            fields   = [field for field in fields if field['name'] in selected]
+
+        columns = [(field['name'], _cell_formatter(field, int64_timestamp)) for field in fields]
+        page    = {'totalRows': str(len(rows)),
+                   'rows':      [{'f': [{'v': format_cell(row.get(name))} for name, format_cell in columns]}
+                                 for row in rows[start:start + max_results]]}
+        if start + max_results < len(rows):
+            page['pageToken'] = str(start + max_results)
+        return page
+
+    def _list_table_data(self, params, body, project, dataset, table):
+        resource = self._require_table(project, dataset, table)
+        response = self._page(resource.get('schema', {}).get('fields', []), self.rows.get((dataset, table), []), params)
+        response.update({'kind': 'bigquery#tableDataList', 'etag': resource['etag']})
+        return response
+
+    # Jobs
+
+    def add_query_result(self, sql, fields, rows, dml_stats=None):
+        '''
+            Registers the result returned for a query the built-in SQL subset cannot run
+
+            USAGE:
+            backend.add_query_result('select 1 as x', [{'name': 'x', 'type': 'INTEGER'}], [{'x': 1}])
+            backend.add_query_result('merge ...', [], [], dml_stats={'insertedRowCount': 3, 'updatedRowCount': 2})
+
+            dml_stats makes the query a DML statement (MERGE) reporting these row counts.
+        '''
+        with self._lock:
+            self.query_results[_normalize_sql(sql)] = (fields, rows)
+            if dml_stats is not None:
+                self.query_dml_stats[_normalize_sql(sql)] = dml_stats
+
+    def _resolve_table(self, name):
+        parts = name.split('.')
+        if len(parts) == 3 and parts[0] != self.project:
+            raise FakeApiError(404, 'notFound', 'Not found: Project {}'.format(parts[0]))
+        if len(parts) not in (2, 3):
+            raise FakeApiError(400, 'invalidQuery', 'Table name "{}" missing dataset'.format(name))
+        return self._require_table(self.project, parts[-2], parts[-1]), (parts[-2], parts[-1])
+
+    def _execute_sql(self, sql):
+        '''
+            Runs the small SQL subset the fake understands, returning (schema fields, rows, bytes processed, referenced tables)
+
+            Supported: results registered with add_query_result(), SELECT COUNT(*) [AS alias] FROM table,
+            and SELECT * | col1, col2, ... FROM table [LIMIT n].
+        '''
+        if _normalize_sql(sql) in self.query_results:
+            fields, rows = self.query_results[_normalize_sql(sql)]
+            return fields, rows, _estimate_bytes(rows), []
+
+        normalized = ' '.join(sql.split()).rstrip(';').strip()
+
+        match = _SQL_COUNT.match(normalized)
+        if match:
+            resource, key = self._resolve_table(match.group('table'))
+            alias = match.group('alias') or 'f0_'
+            return [{'name': alias, 'type': 'INTEGER', 'mode': 'NULLABLE'}], [{alias: len(self.rows.get(key, []))}], 0, [resource['tableReference']]
+
+        match = _SQL_SELECT.match(normalized)
+        if match:
+            resource, key = self._resolve_table(match.group('table'))
+            fields  = resource.get('schema', {}).get('fields', [])
+            columns = [column.strip(' `') for column in match.group('columns').split(',')]
+            if columns != ['*']:
+                by_name = dict((field['name'].lower(), field) for field in fields)
+                missing = [column for column in columns if column.lower() not in by_name]
+                if missing:
+                    raise FakeApiError(400, 'invalidQuery', 'Unrecognized name: {}'.format(missing[0]))
+                fields = [by_name[column.lower()] for column in columns]
+            rows = self.rows.get(key, [])
+            if match.group('limit'):
+                rows = rows[:int(match.group('limit'))]
+            rows = [dict((field['name'], row.get(field['name'])) for field in fields) for row in rows]
+            return fields, rows, _estimate_bytes(rows), [resource['tableReference']]
+
+        raise FakeApiError(400, 'invalidQuery', 'The fake backend cannot run this query: {}'.format(sql))
+
+    def _write_table(self, dataset, table, fields, rows, write_disposition, create_disposition='CREATE_IF_NEEDED', config=None):
+        '''
+            Writes job output to a table (or to one partition: 'table$20180701'), honouring the write / create
+            dispositions; a table created here takes the partitioning and clustering of the job config
+        '''
+        table, _, partition = table.partition('$')
+        key = (dataset, table)
+        if key not in self.tables:
+            if create_disposition == 'CREATE_NEVER':
+                raise FakeApiError(404, 'notFound', 'Not found: Table {}:{}.{}'.format(self.project, dataset, table))
+            if dataset not in self.datasets:
+                self._insert_dataset({}, {'datasetReference': {'projectId': self.project, 'datasetId': dataset}}, self.project)
+            body = dict((option, value) for option, value in (config or {}).items()
+                        if option in ('timePartitioning', 'rangePartitioning', 'clustering'))
+            body.update({'tableReference': {'projectId': self.project, 'datasetId': dataset, 'tableId': table},
+                         'schema': {'fields': fields}})
+            self._insert_table({}, body, self.project, dataset)
+        elif write_disposition == 'WRITE_EMPTY' and not partition and self.rows.get(key):
+            raise FakeApiError(409, 'duplicate', 'Already Exists: Table {}:{}.{}'.format(self.project, dataset, table))
+
+        resource  = self.tables[key]
+        time_spec = resource.get('timePartitioning')
+        if time_spec and not time_spec.get('field') and not isinstance(rows, SyntheticRows):
+            stamp = partition or datetime.datetime.now(datetime.timezone.utc).strftime(_PARTITION_FORMATS[time_spec.get('type', 'DAY')])
+            rows  = [dict(row, _PARTITIONTIME=stamp) for row in rows]
+
+        if partition:
+            if not time_spec and not resource.get('rangePartitioning'):
+                raise FakeApiError(400, 'invalid', 'Cannot write to partition {} of non-partitioned table {}.{}'.format(partition, dataset, table))
+            outside = [row for row in rows if _partition_of(resource, row) != partition]
+            if outside:
+                raise FakeApiError(400, 'invalid', '{} row(s) do not belong to the destination partition {}'.format(len(outside), partition))
+            existing = list(self.rows.get(key, []))
+            if write_disposition == 'WRITE_EMPTY' and any(_partition_of(resource, row) == partition for row in existing):
+                raise FakeApiError(409, 'duplicate', 'Already Exists: Partition {}:{}.{}${}'.format(self.project, dataset, table, partition))
+            if write_disposition == 'WRITE_TRUNCATE':
+                existing = [row for row in existing if _partition_of(resource, row) != partition]
+            if not resource.get('schema', {}).get('fields'):
+                resource['schema'] = {'fields': fields}
+            self.rows[key] = existing + list(rows)
+        elif write_disposition == 'WRITE_TRUNCATE' or not self.rows.get(key):
+            resource['schema'] = {'fields': fields}
+            self.rows[key] = rows if isinstance(rows, SyntheticRows) else list(rows)
+        else:
+            self.rows[key] = list(self.rows[key]) + list(rows)
+
+        stored = self.rows[key]
+        resource.update({'numRows':          str(len(stored)),
+                         'numBytes':         str(_estimate_bytes(stored)),
+                         'lastModifiedTime': _now_ms(),
+                         'etag':             self._next_etag()})
+
+    def _run_query_job(self, job_id, config):
+        fields, rows, bytes_processed, referenced = self._execute_sql(config['query'])
+        destination = config.get('destinationTable')
+        if destination is None:
+            destination = {'projectId': self.project, 'datasetId': '_fake_anonymous', 'tableId': 'anon_' + job_id.replace('-', '_')}
+            config['destinationTable'] = destination
+        self._write_table(destination['datasetId'], destination['tableId'], fields, rows,
+                          config.get('writeDisposition', 'WRITE_EMPTY'), config.get('createDisposition', 'CREATE_IF_NEEDED'), config)
+        billed = max(bytes_processed, 10 * 1024 * 1024) if bytes_processed else 0       # 10 MB minimum per billed query
+        statistics = {'totalBytesProcessed': str(bytes_processed),
+                      'query': {'totalBytesProcessed': str(bytes_processed),
+                                'totalBytesBilled':    str(billed),
+                                'totalSlotMs':         str(1 + bytes_processed // 100000),
+                                'cacheHit':            False,
+                                'statementType':       'SELECT',
+                                'referencedTables':    referenced,
+                                'schema':              {'fields': fields}}}
+        dml_stats = self.query_dml_stats.get(_normalize_sql(config['query']))
+        if dml_stats is not None:
+            statistics['query'].update({'statementType':       config['query'].split(None, 1)[0].upper(),
+                                        'dmlStats':            dict((key, str(value)) for key, value in dml_stats.items()),
+                                        'numDmlAffectedRows':  str(sum(int(value) for value in dml_stats.values()))})
+        return statistics
+
+    def _run_copy_job(self, job_id, config):
+        sources = config.get('sourceTables') or [config['sourceTable']]
+        fields  = None
+        rows    = []
+        for source in sources:
+            resource = self._require_table(source['projectId'], source['datasetId'], source['tableId'])
+            failures = self.failing_copies.get('{}.{}'.format(source['datasetId'], source['tableId']))
+            if failures:
+                reason = failures.pop(0)
+                raise FakeApiError(_ERROR_STATUS.get(reason, 400), reason,
+                                   'Copy of {}.{} failed: {}'.format(source['datasetId'], source['tableId'], reason))
+            if fields is not None and resource.get('schema', {}).get('fields', []) != fields:
+                raise FakeApiError(400, 'invalid', 'Source tables must have identical schemas')
+            fields = resource.get('schema', {}).get('fields', [])
+            rows  += list(self.rows.get((source['datasetId'], source['tableId']), []))
+
+        destination = config['destinationTable']
+        self._write_table(destination['datasetId'], destination['tableId'], fields, rows,
+                          config.get('writeDisposition', 'WRITE_EMPTY'), config.get('createDisposition', 'CREATE_IF_NEEDED'), config)
+        return {'copy': {'copiedRows': str(len(rows)), 'copiedLogicalBytes': str(_estimate_bytes(rows))}}
+
+    def _parse_load_file(self, content, config, fields):
+        source_format = config.get('sourceFormat', 'CSV')
+        if source_format == 'PARQUET':
+            import pyarrow.parquet
+            table = pyarrow.parquet.read_table(io.BytesIO(content))
+            return table.column_names, table.to_pylist()
+        if source_format == 'AVRO':
+            import fastavro
+            reader = fastavro.reader(io.BytesIO(content))
+            return [field['name'] for field in reader.writer_schema['fields']], list(reader)
+
+        text = content.decode('utf-8')
+        if source_format == 'NEWLINE_DELIMITED_JSON':
+            return None, [json.loads(line) for line in text.splitlines() if line.strip()]
+
+        lines  = list(csv.reader(io.StringIO(text), delimiter=config.get('fieldDelimiter', ',')))
+        skip   = int(config.get('skipLeadingRows', 0))
+        header = lines[0] if skip and lines else None
+        names  = [field['name'] for field in fields] if fields else header
+        if names is None:
+            names = ['string_field_{}'.format(i) for i in range(len(lines[0]) if lines else 0)]
+        return names, [dict(zip(names, [value if value != '' else None for value in line])) for line in lines[skip:]]
+
+    def _detect_fields(self, names, rows):
+        def is_integer(value):
+            return (isinstance(value, int) and not isinstance(value, bool)) or (isinstance(value, str) and value.lstrip('-').isdigit())
+
+        def is_float(value):
+            try:
+                return not isinstance(value, bool) and float(value) is not None
+            except (TypeError, ValueError):
+                return False
+
+        fields = []
+        for name in names:
+            values = [row.get(name) for row in rows if row.get(name) is not None]
+            kind   = 'STRING'
+            if values and all(isinstance(value, bool) for value in values):
+                kind = 'BOOLEAN'
+            elif values and all(is_integer(value) for value in values):
+                kind = 'INTEGER'
+            elif values and all(is_float(value) for value in values):
+                kind = 'FLOAT'
+            fields.append({'name': name, 'type': kind, 'mode': 'NULLABLE'})
+        return fields
+
+    def _run_load_job(self, job_id, config):
+        if job_id in self._uploaded:
+            sources = [('upload', self._uploaded.pop(job_id))]
+        else:
+            uris = []
+            for pattern in config['sourceUris']:
+                matches = self.storage.match(pattern)
+                if not matches:
+                    raise FakeApiError(404, 'notFound', 'Not found: URI {}'.format(pattern))
+                uris += matches
+            for uri in uris:
+                if self.failing_uris.get(uri):
+                    self.failing_uris[uri] -= 1
+                    raise FakeApiError(400, 'invalid', 'Error while reading data, error message: '
+                                                       'CSV table encountered too many errors, giving up. File: {}'.format(uri))
+            sources = [(uri, self.storage.objects[uri]) for uri in uris]
+
+        destination = config['destinationTable']
+        existing    = self.tables.get((destination['datasetId'], destination['tableId'].split('$')[0]))
+        fields      = config.get('schema', {}).get('fields') or (existing or {}).get('schema', {}).get('fields')
+        names, rows = None, []
+        for _, content in sources:
+            file_names, file_rows = self._parse_load_file(content, config, fields)
+            names  = names or file_names
+            rows  += file_rows
+        if not fields:
+            names  = names or sorted(set(name for row in rows for name in row))
+            fields = self._detect_fields(names, rows)
+
+        self._write_table(destination['datasetId'], destination['tableId'], fields, rows,
+                          config.get('writeDisposition', 'WRITE_APPEND'), config.get('createDisposition', 'CREATE_IF_NEEDED'), config)
+        return {'load': {'inputFiles':     str(len(sources)),
+                         'inputFileBytes': str(sum(len(content) for _, content in sources)),
+                         'outputRows':     str(len(rows)),
+                         'outputBytes':    str(_estimate_bytes(rows))}}
+
+    def _extract_file(self, fields, rows, config):
+        '''
+            One exported file: rows in destinationFormat, compressed with compression
+        '''
+        destination_format = config.get('destinationFormat', 'CSV')
+        compression        = config.get('compression', 'NONE')
+
+        records = [dict((field['name'], _typed_cell(field, row.get(field['name']))) for field in fields) for row in rows]
+        if destination_format == 'PARQUET':
+            import pyarrow
+            import pyarrow.parquet
+            output = io.BytesIO()
+            pyarrow.parquet.write_table(pyarrow.Table.from_pylist(records), output,
+                                        compression=compression.lower() if compression != 'NONE' else 'none')
+            return output.getvalue()
+        if destination_format == 'AVRO':
+            import fastavro
+            avro_types = {'INTEGER': 'long', 'INT64': 'long', 'FLOAT': 'double', 'FLOAT64': 'double', 'BOOLEAN': 'boolean', 'BOOL': 'boolean'}
+            schema = {'type': 'record', 'name': 'Root',
+                      'fields': [{'name': field['name'], 'type': ['null', avro_types.get(field['type'], 'string')]} for field in fields]}
+            output = io.BytesIO()
+            fastavro.writer(output, schema, records, codec=compression.lower() if compression != 'NONE' else 'null')
+            return output.getvalue()
+
+        if destination_format == 'NEWLINE_DELIMITED_JSON':
+            text = ''.join(json.dumps(record) + '\n' for record in records)
+        else:
+            output = io.StringIO()
+            writer = csv.writer(output, delimiter=config.get('fieldDelimiter', ','), lineterminator='\n')
+            if config.get('printHeader', True):
+                writer.writerow([field['name'] for field in fields])
+            writer.writerows([['' if record[field['name']] is None else record[field['name']] for field in fields] for record in records])
+            text = output.getvalue()
+        data = text.encode('utf-8')
+        if compression == 'GZIP':
+            import gzip
+            data = gzip.compress(data)
+        return data
+
+    def _run_extract_job(self, job_id, config):
+        source   = config['sourceTable']
+        resource = self._require_table(source['projectId'], source['datasetId'], source['tableId'])
+        fields   = resource.get('schema', {}).get('fields', [])
+        rows     = self.rows.get((source['datasetId'], source['tableId']), [])
+
+        counts = []
+        for uri in config['destinationUris']:
+            if '*' not in uri:
+                if len(rows) > self.extract_rows_per_file:
+                    raise FakeApiError(400, 'invalid', 'Table {}.{} is too large to be exported to a single file. '
+                                                       'Specify a uri including a * to shard export.'.format(source['datasetId'], source['tableId']))
+                self.storage.upload(uri, self._extract_file(fields, rows, config))
+                counts.append('1')
+                continue
+            shards = max(1, -(-len(rows) // self.extract_rows_per_file))
+            for shard in range(shards):
+                part = rows[shard * self.extract_rows_per_file:(shard + 1) * self.extract_rows_per_file]
+                self.storage.upload(uri.replace('*', '{:012d}'.format(shard)), self._extract_file(fields, part, config))
+            counts.append(str(shards))
+        return {'extract': {'destinationUriFileCounts': counts, 'inputBytes': resource.get('numBytes', '0')}}
+
+    def _insert_job(self, params, body, project):
+        reference = dict(body.get('jobReference', {}))
+        job_id    = reference.get('jobId') or 'job_{}'.format(len(self.jobs) + 1)
+        reference.update({'projectId': project, 'jobId': job_id, 'location': reference.get('location') or self.location})
+        if job_id in self.jobs:
+            raise FakeApiError(409, 'duplicate', 'Already Exists: Job {}:{}.{}'.format(project, reference['location'], job_id))
+
+        configuration = json.loads(json.dumps(body.get('configuration', {})))
+        if configuration.get('dryRun'):
+            return self._dry_run(reference, configuration)
+        job = {'kind':          'bigquery#job',
+               'id':            '{}:{}.{}'.format(project, reference['location'], job_id),
+               'jobReference':  reference,
+               'configuration': configuration,
+               'statistics':    {'creationTime': _now_ms(), 'startTime': _now_ms()},
+               'status':        {'state': 'RUNNING'},
+               'user_email':    'fake@{}.iam.gserviceaccount.com'.format(project)}
+
+        kind = [key for key in ('query', 'load', 'copy', 'extract') if key in configuration]
+        if kind == ['query'] and configuration['query'].get('priority', 'INTERACTIVE') != 'BATCH':
+            self._interactive_running = set(running for running in self._interactive_running
+                                            if self._job_state(running)['status']['state'] != 'DONE')
+            if self.max_interactive_queries is not None and len(self._interactive_running) >= self.max_interactive_queries:
+                self.injected_errors += 1
+                raise FakeApiError(403, 'rateLimitExceeded', 'Exceeded rate limits: too many concurrent queries for this '
+                                   'project_and_region ({} interactive queries running)'.format(len(self._interactive_running)))
+            self._interactive_running.add(job_id)
+            self.peak_interactive_queries = max(self.peak_interactive_queries, len(self._interactive_running))
+        try:
+            if not kind or not hasattr(self, '_run_{}_job'.format(kind[0])):
+                raise FakeApiError(400, 'invalid', 'Unsupported job configuration: {}'.format(sorted(configuration)))
+            job['statistics'].update(getattr(self, '_run_{}_job'.format(kind[0]))(job_id, configuration[kind[0]]))
+        except FakeApiError as e:
+            job['status']['errorResult'] = {'reason': e.reason, 'message': e.message}
+            job['status']['errors']      = [job['status']['errorResult']]
+
+        self.jobs[job_id]         = job
+        self._job_done_at[job_id] = time.time() + self.job_latency
+        return self._job_state(job_id)
+
+    def _dry_run(self, reference, configuration):
+        '''
+            Validates a query job without running it: returns the tables it reads and the bytes it would process.
+            For SQL outside the supported subset, the tables after FROM / JOIN are taken as read in full.
+        '''
+        if 'query' not in configuration:
+            raise FakeApiError(400, 'invalid', 'Only query jobs can be dry run')
+        sql = configuration['query']['query']
+        try:
+            fields, _, bytes_processed, referenced = self._execute_sql(sql)
+        except FakeApiError as e:
+            if e.reason != 'invalidQuery' or not _SQL_TABLES.findall(sql):
+                raise
+            resources       = [self._resolve_table(name)[0] for name in _SQL_TABLES.findall(sql)]
+            fields          = []
+            bytes_processed = sum(int(resource.get('numBytes', 0)) for resource in resources)
+            referenced      = [resource['tableReference'] for resource in resources]
+        return {'kind':          'bigquery#job',
+                'jobReference':  dict(reference, jobId=None),
+                'configuration': configuration,
+                'statistics':    {'creationTime': _now_ms(),
+                                  'totalBytesProcessed': str(bytes_processed),
+                                  'query': {'totalBytesProcessed': str(bytes_processed),
+                                            'statementType':       'SELECT',
+                                            'referencedTables':    referenced,
+                                            'schema':              {'fields': fields}}},
+                'status':        {'state': 'DONE'}}
+
+    def _job_state(self, job_id):
+        job = self.jobs[job_id]
+        if job['status']['state'] != 'DONE' and time.time() >= self._job_done_at[job_id]:
+            job['status']['state']         = 'DONE'
+            job['statistics']['endTime']   = _now_ms()
+        return job
+
+    def _require_job(self, project, job):
+        if job not in self.jobs:
+            raise FakeApiError(404, 'notFound', 'Not found: Job {}:{}'.format(project, job))
+        return self._job_state(job)
+
+    def _get_job(self, params, body, project, job):
+        return self._require_job(project, job)
+
+    def _cancel_job(self, params, body, project, job):
+        resource = self._require_job(project, job)
+        if resource['status']['state'] != 'DONE':
+            resource['status'] = {'state': 'DONE', 'errorResult': {'reason': 'stopped', 'message': 'Job execution was cancelled: User requested cancellation'}}
+            resource['status']['errors'] = [resource['status']['errorResult']]
+            resource['statistics']['endTime'] = _now_ms()
+        return {'kind': 'bigquery#jobCancelResponse', 'job': resource}
+
+    def _get_query_results(self, params, body, project, job):
+        resource = self._require_job(project, job)
+        response = {'kind': 'bigquery#getQueryResultsResponse', 'jobReference': resource['jobReference']}
+        if resource['status']['state'] != 'DONE':
+            response['jobComplete'] = False
+            return response
+        if 'errorResult' in resource['status']:
+            error = resource['status']['errorResult']
+            raise FakeApiError(400, error['reason'], error['message'])
+
+        destination = resource['configuration']['query']['destinationTable']
+        statistics  = resource['statistics']['query']
+        response.update(self._page(statistics['schema']['fields'],
+                                   self.rows.get((destination['datasetId'], destination['tableId']), []), params))
+        response.update({'jobComplete':         True,
+                         'schema':              statistics['schema'],
+                         'totalBytesProcessed': statistics['totalBytesProcessed'],
+                         'cacheHit':            statistics['cacheHit']})
+        return response
+
+
+
+
+class FakeTransport(object):
+    '''
+        Stand-in for the requests.Session used by bigquery.Client, routing every request to a FakeBigQueryBackend
+
+        The first request on each transport sleeps handshake_latency to model a new HTTP session.
+
+    '''
+    is_mtls = False
+
+    def __init__(self, backend, handshake_latency=0.0):
+        self.backend           = backend
+        self.handshake_latency = handshake_latency
+        self._connected        = False
+        self._lock             = threading.Lock()
+        self._auth_request     = SimpleNamespace(session=self)     # bigquery.Client.close() closes this too
+
+    def request(self, method, url, data=None, headers=None, timeout=None, **kwargs):
+        with self._lock:
+            if not self._connected:
+                if self.handshake_latency:
+                    time.sleep(self.handshake_latency)
+                self._connected = True
+
+        parts  = urlsplit(url)
+        params = dict(parse_qsl(parts.query))
+        if parts.path.startswith('/upload/'):
+            if hasattr(data, 'read'):
+                data = data.read()
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            status, payload, extra_headers = self.backend.handle_upload(method, parts.path, params, headers, data)
+        else:
+            if isinstance(data, bytes):
+                data = data.decode('utf-8')
+            body   = json.loads(data) if data else {}
+            status, payload = self.backend.handle(method, parts.path, params, body)
+            extra_headers   = {}
+            etag            = (headers or {}).get('If-None-Match')
+            if method == 'GET' and status == 200 and etag and etag == payload.get('etag'):
+                status, payload = 304, None         # Conditional GET: the resource has not changed
+
+        response             = requests.Response()
+        response.status_code = status
+        response.url         = url
+        response.request     = requests.Request(method, url).prepare()
+        response.headers['Content-Type'] = 'application/json'
+        response.headers.update(extra_headers)
+        response._content    = json.dumps(payload).encode('utf-8') if payload is not None else b''
+        return response
+
+    def close(self):
+        self._connected = False
+
+
+
+
+class FakeReadClientFactory(object):
+    '''
+        Read client factory (see gcp_bigquery_clients.set_read_client_factory) for a FakeReadServer.
+        Picklable, so worker processes can build their own clients from it.
+    '''
+    def __init__(self, address):
+        self.address = address
+
+    def __call__(self, credentials=None):
+        import grpc
+        from google.cloud import bigquery_storage_v1
+        from google.cloud.bigquery_storage_v1.services.big_query_read.transports import BigQueryReadGrpcTransport
+        channel = grpc.insecure_channel(self.address, options=[('grpc.max_receive_message_length', -1)])
+        return bigquery_storage_v1.BigQueryReadClient(transport=BigQueryReadGrpcTransport(channel=channel))
+
+
+
+
+class FakeReadServer(object):
+    '''
+        Local gRPC server speaking the BigQuery Storage Read API (CreateReadSession, ReadRows) for the tables of a
+        FakeBigQueryBackend, so read sessions run over a real channel, from threads or from other processes
+
+        A session splits the table into at most max_stream_count streams (contiguous row ranges). ReadRows sends
+        Arrow record batches of batch_rows rows (LZ4_FRAME / ZSTD compressed when the session asks for it), at most
+        bytes_per_second per stream (None: unthrottled). Column projection (selected_fields) and row filters
+        (row_restriction: comparisons of a column with a literal and IS [NOT] NULL, joined with AND) are applied
+        by the server. The next failing_reads ReadRows calls break off (UNAVAILABLE) after their first batch.
+
+        USAGE:
+        server = FakeReadServer(backend, batch_rows=10000)
+        set_read_client_factory(server.client_factory())
+        table  = read_table('demo_dataset1.table_loans', columns=['id', 'amount'], max_streams=8)
+        server.stop()
+
+    '''
+    def __init__(self, backend, batch_rows=10000, bytes_per_second=None, max_workers=64):
+        import concurrent.futures
+        import grpc
+        from google.cloud.bigquery_storage_v1 import types
+
+        self.backend          = backend
+        self.batch_rows       = batch_rows
+        self.bytes_per_second = bytes_per_second
+        self.failing_reads    = 0
+        self.sessions_created = 0
+        self.read_rows_calls  = 0
+        self.bytes_sent       = 0
+        self._streams         = {}          # stream name -> (pyarrow.Table, first row, end row, compression)
+        self._arrow           = {}          # (dataset_id, table_id) -> (id(rows), len(rows), pyarrow.Table)
+        self._lock            = threading.Lock()
+
+        handler = grpc.method_handlers_generic_handler('google.cloud.bigquery.storage.v1.BigQueryRead', {
+            'CreateReadSession': grpc.unary_unary_rpc_method_handler(
+                self._create_read_session, request_deserializer=types.CreateReadSessionRequest.pb().FromString,
+                response_serializer=lambda message: message.SerializeToString()),
+            'ReadRows':          grpc.unary_stream_rpc_method_handler(
+                self._read_rows, request_deserializer=types.ReadRowsRequest.pb().FromString,
+                response_serializer=lambda message: message.SerializeToString()),
+        })
+        self.server  = grpc.server(concurrent.futures.ThreadPoolExecutor(max_workers=max_workers),
+                                   options=[('grpc.max_send_message_length', -1)])
+        self.server.add_generic_rpc_handlers((handler,))
+        self.address = '127.0.0.1:{}'.format(self.server.add_insecure_port('127.0.0.1:0'))
+        self.server.start()
+
+    def client_factory(self):
+        return FakeReadClientFactory(self.address)
+
+    def stop(self, grace=None):
+        self.server.stop(grace)
+
+    def _arrow_table(self, dataset_id, table_id):
+        import pyarrow
+
+        resource = self.backend.tables[(dataset_id, table_id)]
+        rows     = self.backend.rows.get((dataset_id, table_id), [])
+        cached   = self._arrow.get((dataset_id, table_id))
+        if cached and cached[0] == id(rows) and cached[1] == len(rows):
+            return cached[2]
+
+        arrow_types = {'INTEGER': pyarrow.int64(), 'INT64': pyarrow.int64(), 'FLOAT': pyarrow.float64(), 'FLOAT64': pyarrow.float64(),
+                       'BOOLEAN': pyarrow.bool_(), 'BOOL': pyarrow.bool_(), 'TIMESTAMP': pyarrow.timestamp('us', tz='UTC'),
+                       'DATE': pyarrow.date32()}
+        columns = {}
+        for field in resource.get('schema', {}).get('fields', []):
+            values = [row.get(field['name']) for row in rows]
+            if field['type'] == 'TIMESTAMP':
+                values = [None if value is None else datetime.datetime.fromtimestamp(_timestamp_seconds(value), datetime.timezone.utc)
+                          for value in values]
+            elif field['type'] == 'DATE':
+                values = [datetime.date.fromisoformat(value) if isinstance(value, str) else value for value in values]
+            else:
+                values = [_typed_cell(field, value) for value in values]
+            columns[field['name']] = pyarrow.array(values, type=arrow_types.get(field['type'], pyarrow.string()))
+        table = pyarrow.table(columns)
+        self._arrow[(dataset_id, table_id)] = (id(rows), len(rows), table)
+        return table
+
+    def _row_filter(self, restriction, schema):
+        import pyarrow.compute
+
+        expression = None
+        for condition in re.split(r'\s+AND\s+', restriction.strip(), flags=re.IGNORECASE):
+            match = re.match(r'^`?(\w+)`?\s*(?:(IS\s+NOT\s+NULL|IS\s+NULL)|(=|!=|<>|<=|>=|<|>)\s*(.+?))\s*$', condition, re.IGNORECASE)
+            if match is None or match.group(1) not in schema.names:
+                raise ValueError('Unsupported row_restriction: {!r}'.format(condition))
+            column = pyarrow.compute.field(match.group(1))
+            if match.group(2):
+                term = column.is_valid() if 'NOT' in match.group(2).upper() else column.is_null()
+            else:
+                literal = match.group(4)
+                if literal[0] in '\'"' and literal[-1] == literal[0]:
+                    value = literal[1:-1]
+                elif literal.upper() in ('TRUE', 'FALSE'):
+                    value = literal.upper() == 'TRUE'
+                else:
+                    value = float(literal) if re.search(r'[.eE]', literal) else int(literal)
+                term = {'=': column == value, '!=': column != value, '<>': column != value, '<': column < value,
+                        '<=': column <= value, '>': column > value, '>=': column >= value}[match.group(3)]
+            expression = term if expression is None else expression & term
+        return expression
+
+    def _create_read_session(self, request, context):
+        import grpc
+        import pyarrow
+        from google.cloud.bigquery_storage_v1 import types
+
+        match = re.match(r'^projects/([^/]+)/datasets/([^/]+)/tables/([^/]+)$', request.read_session.table)
+        if match is None or (match.group(2), match.group(3)) not in self.backend.tables:
+            context.abort(grpc.StatusCode.NOT_FOUND, 'Not found: Table {}'.format(request.read_session.table))
+        if request.read_session.data_format != types.DataFormat.ARROW:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, 'FakeReadServer only serves data_format=ARROW')
+
+        table   = self._arrow_table(match.group(2), match.group(3))
+        options = request.read_session.read_options
+        try:
+            if options.selected_fields:
+                unknown = [name for name in options.selected_fields if name not in table.schema.names]
+                if unknown:
+                    raise ValueError('Unknown selected_fields {}'.format(unknown))
+                table = table.select([name for name in table.schema.names if name in options.selected_fields])
+            if options.row_restriction:
+                table = table.filter(self._row_filter(options.row_restriction, table.schema))
+        except (ValueError, pyarrow.ArrowException) as e:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+        table = table.combine_chunks()
+
+        with self._lock:
+            self.sessions_created += 1
+            name = 'projects/{}/locations/us/sessions/fake{:06d}'.format(match.group(1), self.sessions_created)
+        codec       = types.ArrowSerializationOptions.CompressionCodec(options.arrow_serialization_options.buffer_compression)
+        compression = {'LZ4_FRAME': 'lz4', 'ZSTD': 'zstd'}.get(codec.name)
+        max_streams = request.max_stream_count or 1000
+        count       = min(max_streams, -(-table.num_rows // self.batch_rows))
+        bounds      = [table.num_rows * i // count for i in range(count + 1)] if count else []
+
+        session = types.ReadSession.pb()()
+        session.name        = name
+        session.table       = request.read_session.table
+        session.data_format = types.DataFormat.ARROW
+        session.read_options.CopyFrom(options)
+        session.arrow_schema.serialized_schema = table.schema.serialize().to_pybytes()
+        session.estimated_row_count            = table.num_rows
+        for i in range(count):
+            stream = session.streams.add()
+            stream.name = '{}/streams/{}'.format(name, i)
+            self._streams[stream.name] = (table, bounds[i], bounds[i + 1], compression)
+        return session
+
+    def _read_rows(self, request, context):
+        import grpc
+        import pyarrow
+        from google.cloud.bigquery_storage_v1 import types
+
+        if request.read_stream not in self._streams:
+            context.abort(grpc.StatusCode.NOT_FOUND, 'Not found: Stream {}'.format(request.read_stream))
+        table, first, end, compression = self._streams[request.read_stream]
+        with self._lock:
+            self.read_rows_calls += 1
+            failing = self.failing_reads > 0
+            if failing:
+                self.failing_reads -= 1
+        options = pyarrow.ipc.IpcWriteOptions(compression=compression)
+
+        for position in range(first + request.offset, end, self.batch_rows):
+            batch = table.slice(position, min(self.batch_rows, end - position)).to_batches()[0]
+            sink  = pyarrow.BufferOutputStream()
+            with pyarrow.ipc.new_stream(sink, batch.schema, options=options) as writer:
+                writer.write_batch(batch)
+            reader = pyarrow.ipc.MessageReader.open_stream(sink.getvalue())
+            reader.read_next_message()                  # Schema message, sent once in the session
+            payload = reader.read_next_message().serialize().to_pybytes()
+
+            response = types.ReadRowsResponse.pb()()
+            response.row_count                                 = batch.num_rows
+            response.arrow_record_batch.serialized_record_batch = payload
+            response.arrow_record_batch.row_count              = batch.num_rows
+            response.stats.progress.at_response_start          = float(position - first) / (end - first)
+            response.stats.progress.at_response_end            = float(position - first + batch.num_rows) / (end - first)
+            if self.bytes_per_second:
+                time.sleep(len(payload) / float(self.bytes_per_second))
+            with self._lock:
+                self.bytes_sent += len(payload)
+            yield response
+            if failing:
+                context.abort(grpc.StatusCode.UNAVAILABLE, 'Connection reset by peer (RST_STREAM)')
+
+
+
+
+class FakeWriteClientFactory(object):
+    '''
+        Write client factory (see gcp_bigquery_clients.set_write_client_factory) for a FakeWriteServer
+    '''
+    def __init__(self, address):
+        self.address = address
+
+    def __call__(self, credentials=None):
+        import grpc
+        from google.cloud import bigquery_storage_v1
+        from google.cloud.bigquery_storage_v1.services.big_query_write.transports import BigQueryWriteGrpcTransport
+        channel = grpc.insecure_channel(self.address, options=[('grpc.max_send_message_length', -1)])
+        return bigquery_storage_v1.BigQueryWriteClient(transport=BigQueryWriteGrpcTransport(channel=channel))
+
+
+
+
+class FakeWriteServer(object):
+    '''
+        Local gRPC server speaking the BigQuery Storage Write API (CreateWriteStream, AppendRows, FinalizeWriteStream,
+        BatchCommitWriteStreams) for the tables of a FakeBigQueryBackend
+
+        Rows arrive as protobuf (decoded with the writer's DescriptorProto) or Arrow record batches. The _default
+        and COMMITTED streams add them to backend.rows as they are appended, PENDING streams when they are
+        committed. Offsets are checked like BigQuery does (ALREADY_EXISTS below the end of the stream,
+        OUT_OF_RANGE past it), and a NULL in a REQUIRED column rejects the append with row_errors.
+        The next failing_appends appends (after the first of a connection) are written but their connection
+        breaks (UNAVAILABLE) before the acknowledgement, and every append takes append_latency seconds.
+
+        USAGE:
+        server = FakeWriteServer(backend)
+        set_write_client_factory(server.client_factory())
+        write_rows('demo_dataset1', 'table_empty', rows, mode='pending')
+        server.stop()
+
+    '''
+    def __init__(self, backend, append_latency=0.0, max_workers=64):
+        import concurrent.futures
+        import grpc
+        from google.cloud.bigquery_storage_v1 import types
+
+        self.backend         = backend
+        self.append_latency  = append_latency
+        self.failing_appends = 0
+        self.appends         = 0
+        self.streams         = {}           # stream name -> {'type', 'table', 'rows', 'finalized', 'committed'}
+        self._lock           = threading.Lock()
+
+        def unary(method, request_type):
+            return grpc.unary_unary_rpc_method_handler(method, request_deserializer=request_type.pb().FromString,
+                                                       response_serializer=lambda message: message.SerializeToString())
+        handler = grpc.method_handlers_generic_handler('google.cloud.bigquery.storage.v1.BigQueryWrite', {
+            'CreateWriteStream':       unary(self._create_write_stream, types.CreateWriteStreamRequest),
+            'FinalizeWriteStream':     unary(self._finalize_write_stream, types.FinalizeWriteStreamRequest),
+            'BatchCommitWriteStreams': unary(self._batch_commit_write_streams, types.BatchCommitWriteStreamsRequest),
+            'AppendRows':              grpc.stream_stream_rpc_method_handler(
+                self._append_rows, request_deserializer=types.AppendRowsRequest.pb().FromString,
+                response_serializer=lambda message: message.SerializeToString()),
+        })
+        self.server  = grpc.server(concurrent.futures.ThreadPoolExecutor(max_workers=max_workers),
+                                   options=[('grpc.max_receive_message_length', -1)])
+        self.server.add_generic_rpc_handlers((handler,))
+        self.address = '127.0.0.1:{}'.format(self.server.add_insecure_port('127.0.0.1:0'))
+        self.server.start()
+
+    def client_factory(self):
+        return FakeWriteClientFactory(self.address)
+
+    def stop(self, grace=None):
+        self.server.stop(grace)
+
+    def _table(self, stream_name):
+        match = re.match(r'^projects/([^/]+)/datasets/([^/]+)/tables/([^/]+)(?:/streams/([^/]+))?$', stream_name)
+        if match is None or (match.group(2), match.group(3)) not in self.backend.tables:
+            return None
+        return (match.group(2), match.group(3))
+
+    def _stream(self, stream_name):
+        with self._lock:
+            if stream_name not in self.streams and stream_name.endswith('/streams/_default') and self._table(stream_name):
+                self.streams[stream_name] = {'type': 'DEFAULT', 'table': self._table(stream_name), 'rows': [],
+                                             'finalized': False, 'committed': True}
+            return self.streams.get(stream_name)
+
+    def _create_write_stream(self, request, context):
+        import grpc
+        from google.cloud.bigquery_storage_v1 import types
+
+        table = self._table(request.parent)
+        if table is None:
+            context.abort(grpc.StatusCode.NOT_FOUND, 'Not found: Table {}'.format(request.parent))
+        stream_type = types.WriteStream.Type(request.write_stream.type_).name
+        if stream_type not in ('COMMITTED', 'PENDING'):
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, 'FakeWriteServer supports COMMITTED and PENDING streams')
+
+        stream = types.WriteStream.pb()()
+        with self._lock:
+            stream.name = '{}/streams/fake{:06d}'.format(request.parent, len(self.streams) + 1)
+            self.streams[stream.name] = {'type': stream_type, 'table': table, 'rows': [], 'finalized': False,
+                                         'committed': stream_type == 'COMMITTED'}
+        stream.type_ = request.write_stream.type_
+        stream.create_time.GetCurrentTime()
+        return stream
+
+    def _finalize_write_stream(self, request, context):
+        import grpc
+        from google.cloud.bigquery_storage_v1 import types
+
+        stream = self._stream(request.name)
+        if stream is None or stream['type'] == 'DEFAULT':
+            context.abort(grpc.StatusCode.NOT_FOUND, 'Not found: Stream {}'.format(request.name))
+        stream['finalized'] = True
+        response = types.FinalizeWriteStreamResponse.pb()()
+        response.row_count = len(stream['rows'])
+        return response
+
+    def _batch_commit_write_streams(self, request, context):
+        from google.cloud.bigquery_storage_v1 import types
+
+        response = types.BatchCommitWriteStreamsResponse.pb()()
+        streams  = [(name, self._stream(name)) for name in request.write_streams]
+        for name, stream in streams:
+            code = None
+            if stream is None or stream['type'] != 'PENDING':
+                code = 'STREAM_NOT_FOUND' if stream is None else 'INVALID_STREAM_TYPE'
+            elif stream['committed']:
+                code = 'STREAM_ALREADY_COMMITTED'
+            elif not stream['finalized']:
+                code = 'INVALID_STREAM_STATE'
+            if code:
+                error = response.stream_errors.add()
+                error.code          = types.StorageError.StorageErrorCode[code]
+                error.entity        = name
+                error.error_message = '{} is not a finalized, uncommitted PENDING stream'.format(name)
+        if response.stream_errors:
+            return response
+
+        with self.backend._lock:
+            for _, stream in streams:
+                self.backend.rows.setdefault(stream['table'], []).extend(stream['rows'])
+                stream['committed'] = True
+        response.commit_time.GetCurrentTime()
+        return response
+
+    def _decode(self, request, writer):
+        '''
+            The rows of an AppendRowsRequest as {column: value} dicts, with the writer schema of the connection
+        '''
+        import pyarrow
+        from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+
+        if request.HasField('proto_rows'):
+            if request.proto_rows.HasField('writer_schema'):
+                pool = descriptor_pool.DescriptorPool()
+                pool.Add(descriptor_pb2.FileDescriptorProto(name='writer.proto', syntax='proto2',
+                                                            message_type=[request.proto_rows.writer_schema.proto_descriptor]))
+                writer['message_class'] = message_factory.GetMessageClass(
+                    pool.FindMessageTypeByName(request.proto_rows.writer_schema.proto_descriptor.name))
+            def to_dict(message):
+                row = {}
+                for descriptor, value in message.ListFields():
+                    if descriptor.message_type is not None:
+                        value = [to_dict(item) for item in value] if descriptor.is_repeated else to_dict(value)
+                    elif descriptor.is_repeated:
+                        value = list(value)
+                    row[descriptor.name] = value
+                return row
+            return [to_dict(writer['message_class'].FromString(payload)) for payload in request.proto_rows.rows.serialized_rows]
+
+        if request.arrow_rows.HasField('writer_schema'):
+            writer['arrow_schema'] = pyarrow.ipc.read_schema(pyarrow.py_buffer(request.arrow_rows.writer_schema.serialized_schema))
+        batch = pyarrow.ipc.read_record_batch(pyarrow.py_buffer(request.arrow_rows.rows.serialized_record_batch), writer['arrow_schema'])
+        return batch.to_pylist()
+
+    def _stored_row(self, fields, row):
+        '''
+            A decoded row in the form the fake backend stores (TIMESTAMP as epoch seconds, DATE as 'YYYY-MM-DD')
+        '''
+        stored = {}
+        for field in fields:
+            value = row.get(field['name'])
+            if field['type'] == 'TIMESTAMP' and value is not None:
+                value = [_timestamp_seconds(item) if isinstance(item, datetime.datetime) else item / 1e6 for item in value] \
+                        if field.get('mode') == 'REPEATED' else \
+                        (_timestamp_seconds(value) if isinstance(value, datetime.datetime) else value / 1e6)
+            elif field['type'] == 'DATE' and value is not None and field.get('mode') != 'REPEATED':
+                value = value.isoformat() if isinstance(value, datetime.date) else (datetime.date(1970, 1, 1) + datetime.timedelta(days=value)).isoformat()
+            stored[field['name']] = value
+        return stored
+
+    def _append_rows(self, request_iterator, context):
+        import grpc
+        from google.cloud.bigquery_storage_v1 import types
+
+        writer = {'stream': None, 'appends': 0}
+        for request in request_iterator:
+            writer['appends'] += 1
+            if request.write_stream:
+                writer['stream'] = request.write_stream
+            stream   = self._stream(writer['stream'] or '')
+            response = types.AppendRowsResponse.pb()()
+            response.write_stream = writer['stream'] or ''
+            if self.append_latency:
+                time.sleep(self.append_latency)
+
+            if stream is None:
+                response.error.code, response.error.message = grpc.StatusCode.NOT_FOUND.value[0], 'Not found: Stream {}'.format(writer['stream'])
+                yield response
+                continue
+            try:
+                rows = self._decode(request, writer)
+            except Exception as e:
+                response.error.code, response.error.message = grpc.StatusCode.INVALID_ARGUMENT.value[0], 'Cannot decode rows: {}'.format(e)
+                yield response
+                continue
+
+            fields  = self.backend.tables[stream['table']].get('schema', {}).get('fields', [])
+            unknown = sorted(set(name for row in rows for name in row) - set(field['name'] for field in fields))
+            missing = [(index, field['name']) for index, row in enumerate(rows) for field in fields
+                       if field.get('mode') == 'REQUIRED' and row.get(field['name']) is None]
+
+            with self._lock:
+                self.appends += 1
+                end = len(stream['rows'])
+                if stream['finalized']:
+                    response.error.code, response.error.message = grpc.StatusCode.INVALID_ARGUMENT.value[0], 'Stream is finalized'
+                elif unknown:
+                    response.error.code, response.error.message = grpc.StatusCode.INVALID_ARGUMENT.value[0], \
+                        'Input schema has more fields than BigQuery schema, extra fields: {}'.format(unknown)
+                elif request.HasField('offset') and request.offset.value < end:
+                    response.error.code, response.error.message = grpc.StatusCode.ALREADY_EXISTS.value[0], \
+                        'The offset is within stream, expected offset {}, received {}'.format(end, request.offset.value)
+                elif request.HasField('offset') and request.offset.value > end:
+                    response.error.code, response.error.message = grpc.StatusCode.OUT_OF_RANGE.value[0], \
+                        'The offset is beyond stream, expected offset {}, received {}'.format(end, request.offset.value)
+                elif missing:
+                    response.error.code, response.error.message = grpc.StatusCode.INVALID_ARGUMENT.value[0], \
+                        'Errors found while processing rows. Please refer to the row_errors field for details.'
+                    for index, name in missing:
+                        row_error = response.row_errors.add()
+                        row_error.index   = index
+                        row_error.code    = types.RowError.RowErrorCode.FIELDS_ERROR
+                        row_error.message = 'Field {} is REQUIRED but has no value'.format(name)
+                else:
+                    stored = [self._stored_row(fields, row) for row in rows]
+                    stream['rows'].extend(stored)
+                    if stream['committed']:
+                        with self.backend._lock:
+                            self.backend.rows.setdefault(stream['table'], []).extend(stored)
+                    response.append_result.offset.value = end
+                    if self.failing_appends > 0 and writer['appends'] > 1:
+                        self.failing_appends -= 1
+                        context.abort(grpc.StatusCode.UNAVAILABLE, 'Connection reset by peer (RST_STREAM)')
+            yield response
+
+
+
+
+def fake_client_factory(backend, handshake_latency=0.0):
+    '''
+        Returns a client factory (see gcp_bigquery_clients.set_client_factory) whose clients talk to backend
+
+        USAGE:
+        set_client_factory(fake_client_factory(backend, handshake_latency=0.050))
+
+    '''
+    def factory(project, location, credentials, pool_size):
+        return bigquery.Client(project     = project or backend.project,
+                               location    = location,
+                               credentials = AnonymousCredentials(),
+                               _http       = FakeTransport(backend, handshake_latency))
+    return factory
+
+
+
+#ZEND
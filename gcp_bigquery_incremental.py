@@ -0,0 +1,379 @@
+####################################################################################################
+#
+#   Google BigQuery - Incremental Loads (high-watermark + MERGE upserts)
+#
+#   https://cloud.google.com/bigquery/docs/reference/standard-sql/dml-syntax#merge_statement
+#   https://cloud.google.com/bigquery/docs/using-dml-with-partitioned-tables
+#
+####################################################################################################
+
+
+
+'''
+NOTES
+
+    Reloading a whole table every night (bq_create_table_from_query / bq_create_table_from_gcs with
+    WRITE_TRUNCATE) rewrites every row although only a few changed. incremental_load() moves only the
+    rows whose watermark column (e.g. updated_at, or an increasing id) is past the one recorded for the
+    target table by the previous run:
+
+        1. Stage:   the source query, filtered on watermark_column > @watermark, runs into a staging table
+                    (a gs:// source is loaded into the staging table and filtered in the next steps).
+                    Every run has its own staging table ({table}__incremental_staging_{run id}), so concurrent
+                    runs for the same table do not overwrite each other's rows; it expires after
+                    STAGING_EXPIRATION in case the run dies before deleting it
+        2. Inspect: one query over the staged rows returns their count, their highest watermark and
+                    (to limit the MERGE to the affected partitions) the range of the partitioning column
+        3. Apply:   a generated MERGE keyed on primary_key updates the matched rows (only when the staged
+                    row is newer) and inserts the others. Staged rows are deduplicated per key, keeping the
+                    newest, so a key changed twice between runs is applied once. On the first run the
+                    target table is created from the staged rows instead (with partitioning / clustering).
+        4. Commit:  the new watermark is saved in the WatermarkStore only after the MERGE succeeded, so a
+                    failed run is simply repeated by the next one (the MERGE is idempotent)
+
+    Partitions: with limit_partitions=True (default) and a target partitioned on a column, the MERGE only
+    scans target partitions between the lowest and highest partitioning value of the staged rows. This
+    assumes a row never moves to another partition (its partitioning value does not change), so a target
+    partitioned on the watermark column itself is always merged in full.
+
+    Watermarks are persisted as JSON (WatermarkStore), keyed by 'project.dataset.table'.
+
+    USAGE:
+    report = incremental_load('demo_dataset1', 'table_loans', 'select * from `zproject201807.raw.loans`',
+                              primary_key=['member_id'], watermark_column='updated_at')
+    print(report['inserted'], report['updated'], report['bytes_processed'])
+    incremental_load('demo_dataset1', 'events', 'gs://zdatasets1/events/*.csv', ['event_id'], 'event_ts',
+                     schema='gs://zdatasets1/events/*.csv', partitioning='event_ts')
+    get_watermark_store().get('zproject201807.demo_dataset1.table_loans')
+
+'''
+
+
+####################################################################################################
+#
+#   Python Libraries
+#
+####################################################################################################
+
+
+import datetime
+import decimal
+import json
+import os
+import threading
+import time
+import uuid
+
+from gcp_bigquery_clients import get_client
+from gcp_bigquery_metadata import get_metadata_cache, invalidate_metadata
+from gcp_bigquery_partitioning import apply_partitioning
+from gcp_bigquery_telemetry import instrument
+
+
+####################################################################################################
+
+
+
+DEFAULT_WATERMARK_PATH = os.path.join(os.path.expanduser('~'), '.gcp_bigquery', 'watermarks.json')
+STAGING_EXPIRATION     = datetime.timedelta(hours=24)    # A run that dies before its cleanup leaves nothing behind for long
+
+# Legacy type names of table schemas -> the type names of query parameters
+_PARAMETER_TYPES = {'INTEGER': 'INT64', 'FLOAT': 'FLOAT64', 'BOOLEAN': 'BOOL'}
+
+
+
+
+class WatermarkStore(object):
+    '''
+        High-watermarks of incremental loads persisted as JSON (path), keyed by 'project.dataset.table'
+
+        USAGE:
+        store = WatermarkStore('/data/watermarks.json')
+        store.get('zproject201807.demo_dataset1.table_loans')   # {'column', 'value', 'type', 'updated'} or None
+        store.remove('zproject201807.demo_dataset1.table_loans')  # The next incremental_load() reloads everything
+
+    '''
+    def __init__(self, path=DEFAULT_WATERMARK_PATH):
+        self.path     = path
+        self._lock    = threading.RLock()
+        self._entries = None
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path) as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_file = self.path + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(self._entries, f, indent=2, sort_keys=True)
+        os.replace(temp_file, self.path)
+
+    def keys(self):
+        with self._lock:
+            return sorted(self._load())
+
+    def get(self, key):
+        with self._lock:
+            entry = self._load().get(key)
+            return dict(entry) if entry is not None else None
+
+    def put(self, key, column, value, field_type):
+        with self._lock:
+            self._load()[key] = {'column':  column,
+                                 'value':   value,
+                                 'type':    field_type,
+                                 'updated': datetime.datetime.now(datetime.timezone.utc).isoformat()}
+            self._save()
+
+    def remove(self, key):
+        with self._lock:
+            if self._load().pop(key, None) is not None:
+                self._save()
+
+
+
+
+_store      = None
+_store_lock = threading.Lock()
+
+
+
+
+def get_watermark_store():
+    '''
+        Returns the shared WatermarkStore (DEFAULT_WATERMARK_PATH unless set_watermark_store() was called)
+    '''
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = WatermarkStore()
+    return _store
+
+
+
+
+def set_watermark_store(store):
+    '''
+        Replaces the shared WatermarkStore (e.g. WatermarkStore('/data/watermarks.json'))
+    '''
+    global _store
+    with _store_lock:
+        _store = store
+
+
+
+
+def _json_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    return value
+
+
+
+
+def _changed_rows_sql(staging, primary_key, watermark_column, since_watermark):
+    '''
+        The staged rows past the watermark, one per primary key (the newest)
+    '''
+    return ('SELECT * FROM `{staging}`\n'
+            'WHERE {condition}\n'
+            'QUALIFY ROW_NUMBER() OVER (PARTITION BY {key} ORDER BY `{watermark}` DESC) = 1').format(
+            staging=staging, watermark=watermark_column,
+            condition='`{}` > @watermark'.format(watermark_column) if since_watermark else 'TRUE',
+            key=', '.join('`{}`'.format(column) for column in primary_key))
+
+
+
+
+def _merge_sql(target, changed_rows, columns, primary_key, watermark_column, partition_column=None):
+    '''
+        MERGE of changed_rows into target: newer rows update their key, new keys are inserted
+    '''
+    condition = ' AND '.join('T.`{0}` = S.`{0}`'.format(column) for column in primary_key)
+    if partition_column:
+        condition += ' AND T.`{}` BETWEEN @partition_min AND @partition_max'.format(partition_column)
+
+    updates = ', '.join('`{0}` = S.`{0}`'.format(column) for column in columns if column not in primary_key)
+    sql     = 'MERGE `{}` T\nUSING (\n{}\n) S\nON {}\n'.format(target, changed_rows, condition)
+    if updates:
+        sql += 'WHEN MATCHED AND (T.`{0}` IS NULL OR S.`{0}` > T.`{0}`) THEN\n  UPDATE SET {1}\n'.format(watermark_column, updates)
+    sql += 'WHEN NOT MATCHED THEN\n  INSERT ({}) VALUES ({})'.format(
+           ', '.join('`{}`'.format(column) for column in columns), ', '.join('S.`{}`'.format(column) for column in columns))
+    return sql
+
+
+
+
+def _stage_source(client, source, staging_ref, watermark, watermark_column, location, schema):
+    '''
+        Runs (query source) or loads (gs:// source) the candidate rows into the staging table, returning the job
+    '''
+    from google.cloud import bigquery
+    from gcp_bigquery_schema import get_registry, infer_gcs_schema, lookup_schema
+
+    if isinstance(source, (list, tuple)) or source.startswith('gs://'):
+        job_config = bigquery.LoadJobConfig()
+        job_config.skip_leading_rows = 1
+        job_config.source_format     = bigquery.SourceFormat.CSV
+        job_config.write_disposition = 'WRITE_TRUNCATE'
+        schema_key = source if isinstance(source, str) else source[0]
+        job_config.schema = lookup_schema(schema) if schema is not None else \
+                            get_registry().resolve(schema_key, infer=lambda: infer_gcs_schema(source))
+        return client.load_table_from_uri(source, staging_ref, job_config=job_config, location=location)
+
+    query = source if any(character.isspace() for character in source.strip()) else 'SELECT * FROM `{}`'.format(source.strip('`'))
+    job_config = bigquery.QueryJobConfig()
+    job_config.destination       = staging_ref
+    job_config.write_disposition = 'WRITE_TRUNCATE'
+    if watermark is not None:
+        query = 'SELECT * FROM (\n{}\n) WHERE `{}` > @watermark'.format(query, watermark_column)
+        job_config.query_parameters = [bigquery.ScalarQueryParameter('watermark', watermark['type'], watermark['value'])]
+    return client.query(query, location=location, job_config=job_config)
+
+
+
+
+@instrument
+def incremental_load(dataset_id, table_id, source, primary_key, watermark_column, limit_partitions=True,
+                     partitioning=None, clustering=None, schema=None, staging_dataset=None, location='US', store=None):
+    '''
+        Applies the rows of source changed since the last run to dataset_id.table_id with a MERGE on primary_key
+
+        USAGE:
+        report = incremental_load('demo_dataset1', 'table_loans', 'zproject201807.raw.loans', ['member_id'], 'updated_at')
+
+        Input(s):   source:             SQL query, table name ('project.dataset.table'), or gs:// path / wildcard / list of them (CSV)
+                    primary_key:        Column(s) identifying a row (str or list)
+                    watermark_column:   Column that grows whenever a row is inserted or changed (TIMESTAMP, DATE, INT64, ...)
+                    limit_partitions:   Restrict the MERGE to the target partitions the staged rows fall in
+                    partitioning:       Partitioning / clustering of the target when the first run creates it
+                    clustering:         (gcp_bigquery_partitioning.py)
+                    schema:             Schema of a gs:// source (default: the schema registry, inferred on first use)
+                    staging_dataset:    Dataset of the staging table (default: dataset_id; same location as the target)
+                    store:              WatermarkStore (default: get_watermark_store())
+
+        Output:     {'table', 'previous_watermark', 'watermark', 'staged_rows', 'inserted', 'updated', 'created',
+                     'partitions', 'bytes_processed', 'bytes_billed', 'elapsed'}
+    '''
+    from google.api_core.exceptions import NotFound
+    from google.cloud import bigquery
+
+    start       = time.time()
+    client      = get_client()
+    store       = store or get_watermark_store()
+    primary_key = [primary_key] if isinstance(primary_key, str) else list(primary_key)
+    target_ref  = client.dataset(dataset_id).table(table_id)
+    target      = '{}.{}.{}'.format(client.project, dataset_id, table_id)
+    staging_ref = client.dataset(staging_dataset or dataset_id).table(
+        '{}__incremental_staging_{}'.format(table_id, uuid.uuid4().hex[:12]))
+    staging     = '{}.{}.{}'.format(client.project, staging_ref.dataset_id, staging_ref.table_id)
+
+    watermark = store.get(target)
+    if watermark is not None and watermark['column'] != watermark_column:
+        raise ValueError('{} was loaded with watermark column {}, not {}'.format(target, watermark['column'], watermark_column))
+
+    report = {'table': target, 'previous_watermark': watermark['value'] if watermark else None, 'watermark': None,
+              'staged_rows': 0, 'inserted': 0, 'updated': 0, 'created': False, 'partitions': None,
+              'bytes_processed': 0, 'bytes_billed': 0, 'elapsed': None}
+
+    def run_query(sql, parameters=(), job_config=None):
+        job_config = job_config or bigquery.QueryJobConfig()
+        job_config.query_parameters = list(parameters)
+        job = client.query(sql, location=location, job_config=job_config)
+        rows = list(job.result())
+        report['bytes_processed'] += job.total_bytes_processed or 0
+        report['bytes_billed']    += job.total_bytes_billed or 0
+        return job, rows
+
+    staging_table         = bigquery.Table(staging_ref)
+    staging_table.expires = datetime.datetime.now(datetime.timezone.utc) + STAGING_EXPIRATION
+    client.create_table(staging_table)
+
+    try:
+        stage_job = _stage_source(client, source, staging_ref, watermark, watermark_column, location, schema)
+        stage_job.result()
+        if isinstance(stage_job, bigquery.QueryJob):
+            report['bytes_processed'] += stage_job.total_bytes_processed or 0
+            report['bytes_billed']    += stage_job.total_bytes_billed or 0
+
+        staged_table = client.get_table(staging_ref)
+        columns      = [field.name for field in staged_table.schema]
+        field_types  = dict((field.name, field.field_type) for field in staged_table.schema)
+        missing      = [column for column in primary_key + [watermark_column] if column not in field_types]
+        if missing:
+            raise ValueError('Source has no column(s) {}'.format(missing))
+
+        watermark_parameters = []
+        if watermark is not None:
+            watermark_parameters = [bigquery.ScalarQueryParameter('watermark', watermark['type'], watermark['value'])]
+        changed_rows = _changed_rows_sql(staging, primary_key, watermark_column, watermark is not None)
+
+        try:
+            target_table = get_metadata_cache().get_table(client, target_ref)
+        except NotFound:
+            target_table = None
+
+        partition_column = None
+        if limit_partitions and target_table is not None:
+            if target_table.range_partitioning is not None:
+                partition_column = target_table.range_partitioning.field
+            elif target_table.time_partitioning is not None and target_table.time_partitioning.field:
+                partition_column = target_table.time_partitioning.field
+            if partition_column == watermark_column:
+                partition_column = None         # A changed row moves to another partition: the old one must be scanned too
+
+        _, stats = run_query('SELECT COUNT(*) AS staged_rows, MAX(`{0}`) AS watermark{1}\nFROM (\n{2}\n)'.format(
+                             watermark_column,
+                             ', MIN(`{0}`) AS partition_min, MAX(`{0}`) AS partition_max'.format(partition_column) if partition_column else '',
+                             changed_rows), watermark_parameters)
+        stats = stats[0]
+        report['staged_rows'] = stats['staged_rows']
+        if not stats['staged_rows']:
+            report['watermark'] = report['previous_watermark']
+            return report
+
+        if target_table is None:
+            job_config = bigquery.QueryJobConfig()
+            job_config.destination       = target_ref
+            job_config.write_disposition = 'WRITE_EMPTY'
+            apply_partitioning(job_config, partitioning, clustering)
+            run_query(changed_rows, watermark_parameters, job_config)
+            report.update({'created': True, 'inserted': stats['staged_rows']})
+        else:
+            parameters = list(watermark_parameters)
+            if partition_column:
+                partition_type = _PARAMETER_TYPES.get(field_types[partition_column], field_types[partition_column])
+                parameters    += [bigquery.ScalarQueryParameter('partition_min', partition_type, stats['partition_min']),
+                                  bigquery.ScalarQueryParameter('partition_max', partition_type, stats['partition_max'])]
+                report['partitions'] = (_json_value(stats['partition_min']), _json_value(stats['partition_max']))
+            merge_job, _ = run_query(_merge_sql(target, changed_rows, columns, primary_key, watermark_column, partition_column),
+                                     parameters)
+            dml_stats = merge_job.dml_stats
+            report.update({'inserted': dml_stats.inserted_row_count if dml_stats else None,
+                           'updated':  dml_stats.updated_row_count if dml_stats else None})
+        invalidate_metadata(dataset_id, table_id)
+
+        report['watermark'] = _json_value(stats['watermark'])
+        store.put(target, watermark_column, report['watermark'],
+                  _PARAMETER_TYPES.get(field_types[watermark_column], field_types[watermark_column]))
+        return report
+    finally:
+        client.delete_table(staging_ref, not_found_ok=True)
+        invalidate_metadata(staging_ref.dataset_id, staging_ref.table_id)
+        report['elapsed'] = time.time() - start
+
+
+
+
+#ZEND
@@ -0,0 +1,322 @@
+####################################################################################################
+#
+#   Google BigQuery - Job Manager (load, query, copy and extract jobs)
+#
+#   https://cloud.google.com/bigquery/docs/managing-jobs
+#
+####################################################################################################
+
+
+
+'''
+NOTES
+
+    Load, query, copy and extract jobs run server-side: the client only has to submit them and wait.
+    Calling job.result() on each one in turn runs a pipeline strictly serially, although BigQuery
+    would happily run the jobs side by side.
+
+    JobManager submits jobs as soon as a slot is free (at most max_in_flight running at once) and tracks
+    every running job from a single background polling thread. The poll interval starts at
+    initial_poll_interval and grows by backoff_multiplier (up to max_poll_interval) while nothing changes;
+    it resets whenever a job is started or finishes.
+
+    cancel(future) skips a queued job or cancels a running one in BigQuery.
+
+    Jobs are started without waiting for the rate limiter (gcp_bigquery_quota.py): a start that would have
+    to wait goes back to the front of the queue until its tokens are due, and the other jobs are started
+    and polled meanwhile.
+
+    Each job is started and polled in the context it was submitted from, so its requests and statistics
+    are recorded under the helper span that submitted it (gcp_bigquery_telemetry.py).
+
+    submit() returns a concurrent.futures.Future resolving to a dict of per-job statistics
+    (or raising the job's error):
+        {'job': <the finished job>, 'job_id': ..., 'job_type': 'load', 'label': ..., 'state': 'DONE',
+         'queued_seconds': ..., 'wall_seconds': ..., 'run_seconds': ..., 'polls': ...,
+         'total_bytes_processed' / 'output_rows' / ... whichever the job type reports}
+
+    USAGE:
+    with JobManager(max_in_flight=20) as manager:
+        futures = [bq_create_table_from_gcs('demo_dataset1', 'loans_{}'.format(i), path, job_manager=manager)
+                   for i, path in enumerate(gcs_paths)]
+        for future in concurrent.futures.as_completed(futures):
+            print(future.result()['output_rows'])
+
+'''
+
+
+####################################################################################################
+#
+#   Python Libraries
+#
+####################################################################################################
+
+
+import collections
+import concurrent.futures
+import contextvars
+import threading
+import time
+
+from gcp_bigquery_quota import Throttled, without_waiting
+
+
+####################################################################################################
+
+
+
+_JOB_STATISTICS = ('total_bytes_processed', 'total_bytes_billed', 'slot_millis', 'cache_hit',
+                   'output_rows', 'output_bytes', 'input_files', 'input_file_bytes', 'destination_uri_file_counts')
+
+
+
+
+def _resolve(future, result=None, exception=None):
+    '''
+        Sets the outcome of future unless it already has one (a job cancelled while it finished)
+    '''
+    try:
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    except concurrent.futures.InvalidStateError:
+        pass
+
+
+
+
+class _TrackedJob(object):
+    def __init__(self, start_job, label, future):
+        self.start_job   = start_job
+        self.label       = label
+        self.future      = future
+        self.job         = None
+        self.queued_at   = time.time()
+        self.not_before  = 0.0                              # time.monotonic() before which a throttled start waits
+        self.started_at  = None
+        self.polls       = 0
+        self.poll_errors = 0
+        self.context     = contextvars.copy_context()     # The submitter's open spans (gcp_bigquery_telemetry.py)
+
+
+
+
+class JobManager(object):
+    '''
+        Runs many BigQuery jobs concurrently, tracked by one polling thread
+
+        USAGE:
+        manager = JobManager(max_in_flight=50)
+        future  = manager.submit(lambda: client.copy_table(source_ref, dest_ref), label='copy loans')
+        print(future.result()['run_seconds'])
+        manager.shutdown()
+
+        Input(s):   max_in_flight:          Jobs running at once (the rest wait in submission order)
+                    initial_poll_interval:  Seconds between polls right after a change
+                    max_poll_interval:      Upper bound for the poll interval
+                    backoff_multiplier:     Growth of the poll interval while nothing changes
+                    max_poll_errors:        Consecutive failed polls before a job's future fails
+
+    '''
+    def __init__(self, max_in_flight=50, initial_poll_interval=0.25, max_poll_interval=10.0,
+                 backoff_multiplier=2.0, max_poll_errors=5):
+        if max_in_flight < 1:
+            raise ValueError('max_in_flight must be at least 1, got {}'.format(max_in_flight))
+        self.max_in_flight         = max_in_flight
+        self.initial_poll_interval = initial_poll_interval
+        self.max_poll_interval     = max_poll_interval
+        self.backoff_multiplier    = backoff_multiplier
+        self.max_poll_errors       = max_poll_errors
+        self._queued               = collections.deque()
+        self._running              = []
+        self._cancelled            = set()          # Futures cancelled while their job was being started
+        self._condition            = threading.Condition()
+        self._thread               = None
+        self._closed               = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown(wait=True)
+
+    def submit(self, start_job, label=None):
+        '''
+            Queues start_job (a callable that submits one job and returns it) and returns a Future
+
+            start_job is called from the polling thread once fewer than max_in_flight jobs are running.
+            Cancelling the Future before then skips the job.
+        '''
+        future  = concurrent.futures.Future()
+        tracked = _TrackedJob(start_job, label, future)
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('cannot submit jobs after shutdown()')
+            self._queued.append(tracked)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._poll_loop, name='bq-job-manager', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return future
+
+    def cancel(self, future):
+        '''
+            Cancels a submitted job: a queued job is skipped, a running job is cancelled in BigQuery
+            (job.cancel()) and its Future fails with concurrent.futures.CancelledError
+
+            Returns False if the job had already finished.
+        '''
+        with self._condition:
+            if future.done():
+                return False
+            for tracked in self._queued:
+                if tracked.future is future:
+                    self._queued.remove(tracked)
+                    if not future.cancel():         # Running already: its start was deferred by the rate limiter
+                        _resolve(future, exception=concurrent.futures.CancelledError('Job {} was cancelled'.format(tracked.label)))
+                    return True
+            running = [tracked for tracked in self._running if tracked.future is future]
+            if not running:
+                self._cancelled.add(future)         # Being started right now, cancelled once it has started
+                return True
+            self._running.remove(running[0])
+        self._cancel_running(running[0])
+        return True
+
+    def _cancel_running(self, tracked):
+        try:
+            tracked.context.copy().run(tracked.job.cancel)
+        except Exception as e:
+            print('[ WARN ] Could not cancel job {}: {}'.format(tracked.job.job_id, e))
+        _resolve(tracked.future, exception=concurrent.futures.CancelledError('Job {} was cancelled'.format(tracked.job.job_id)))
+
+    def in_flight(self):
+        with self._condition:
+            return len(self._running)
+
+    def pending(self):
+        with self._condition:
+            return len(self._queued)
+
+    def shutdown(self, wait=True):
+        '''
+            Stops accepting jobs; with wait=True blocks until every submitted job has finished
+        '''
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            thread = self._thread
+        if wait and thread is not None:
+            thread.join()
+
+    def _start_jobs(self):
+        with self._condition:
+            now, to_start, waiting = time.monotonic(), [], []
+            while self._queued and len(self._running) + len(to_start) < self.max_in_flight:
+                tracked = self._queued.popleft()
+                (waiting if tracked.not_before > now else to_start).append(tracked)
+            self._queued.extendleft(reversed(waiting))
+
+        deferred = []
+        for tracked in to_start:
+            if not tracked.future.running() and not tracked.future.set_running_or_notify_cancel():
+                continue
+            try:
+                tracked.job        = tracked.context.run(without_waiting, tracked.start_job)
+                tracked.started_at = time.time()
+            except Throttled as e:
+                tracked.not_before = time.monotonic() + e.wait
+                deferred.append(tracked)
+                continue
+            except Exception as e:
+                _resolve(tracked.future, exception=e)
+                continue
+            with self._condition:
+                cancelled = tracked.future in self._cancelled
+                if cancelled:
+                    self._cancelled.discard(tracked.future)
+                else:
+                    self._running.append(tracked)
+            if cancelled:
+                self._cancel_running(tracked)
+
+        with self._condition:
+            for tracked in reversed(deferred):
+                if tracked.future in self._cancelled:
+                    self._cancelled.discard(tracked.future)
+                    _resolve(tracked.future, exception=concurrent.futures.CancelledError('Job {} was cancelled'.format(tracked.label)))
+                else:
+                    self._queued.appendleft(tracked)
+        return len(to_start) - len(deferred)
+
+    def _finish(self, tracked):
+        job   = tracked.job
+        now   = time.time()
+        stats = {'job':            job,
+                 'job_id':         job.job_id,
+                 'job_type':       getattr(job, 'job_type', type(job).__name__),
+                 'label':          tracked.label,
+                 'state':          job.state,
+                 'queued_seconds': tracked.started_at - tracked.queued_at,
+                 'wall_seconds':   now - tracked.started_at,
+                 'run_seconds':    (job.ended - job.started).total_seconds() if job.ended and job.started else None,
+                 'polls':          tracked.polls}
+        for name in _JOB_STATISTICS:
+            value = getattr(job, name, None)
+            if value is not None:
+                stats[name] = value
+
+        if job.error_result:
+            error = job.exception()
+            error.job_statistics = stats
+            _resolve(tracked.future, exception=error)
+        else:
+            _resolve(tracked.future, result=stats)
+
+    def _poll_jobs(self):
+        finished = []
+        for tracked in list(self._running):
+            try:
+                tracked.context.run(tracked.job.reload)
+                tracked.polls      += 1
+                tracked.poll_errors = 0
+            except Exception as e:
+                tracked.poll_errors += 1
+                if tracked.poll_errors >= self.max_poll_errors:
+                    finished.append(tracked)
+                    _resolve(tracked.future, exception=e)
+                continue
+            if tracked.job.state == 'DONE':
+                finished.append(tracked)
+                self._finish(tracked)
+
+        with self._condition:
+            for tracked in finished:
+                if tracked in self._running:        # Not cancelled in the meantime
+                    self._running.remove(tracked)
+        return len(finished)
+
+    def _poll_loop(self):
+        interval = self.initial_poll_interval
+        while True:
+            changed  = self._start_jobs()
+            changed += self._poll_jobs()
+            interval = self.initial_poll_interval if changed else min(interval * self.backoff_multiplier, self.max_poll_interval)
+
+            with self._condition:
+                if self._closed and not self._queued and not self._running:
+                    return
+                timeout = interval if self._running else None
+                if self._queued and len(self._running) < self.max_in_flight:
+                    ready_in = min(tracked.not_before for tracked in self._queued) - time.monotonic()
+                    if ready_in <= 0:
+                        continue
+                    timeout = min(timeout, ready_in) if timeout is not None else ready_in
+                self._condition.wait(timeout)
+                if timeout is None:
+                    interval = self.initial_poll_interval
+
+
+
+#ZEND
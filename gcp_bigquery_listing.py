@@ -0,0 +1,206 @@
+####################################################################################################
+#
+#   Google BigQuery - Streaming Dataset and Table Listings
+#
+#   https://cloud.google.com/bigquery/docs/reference/rest/v2/datasets/list
+#   https://cloud.google.com/bigquery/docs/reference/rest/v2/tables/list
+#
+####################################################################################################
+
+
+
+'''
+NOTES
+
+    list(client.list_datasets()) / list(client.list_tables(...)) fetch every page before the first
+    item is used, and a project-wide inventory listed one dataset after another spends nearly all of
+    its time waiting on tables.list round-trips.
+
+    iter_datasets() / iter_tables() are generators: one page (page_size items) is fetched when the
+    previous one has been consumed, so memory stays at one page whatever the size of the project.
+
+    iter_project_tables() lists the tables of many datasets at once: max_workers threads each list one
+    dataset's tables, page by page, into a queue of at most max_pending items that the generator drains.
+    Memory is bounded by the queue and the pages in flight; items of different datasets interleave.
+    Closing the generator early (break) stops the workers.
+
+    Filters are applied during the scan, before an item is yielded:
+        prefix=         dataset_id / table_id starts with the prefix
+        labels=         {'key': 'value'} every label must match; {'key': None} only requires the label
+    Dataset label filters are sent to the API (datasets.list filter=labels.key:value); tables.list
+    has no filter, so table labels are matched on the listed items.
+
+    USAGE:
+    for dataset in iter_datasets(prefix='demo_', labels={'env': 'prod'}):
+        print(dataset.dataset_id)
+    for table in iter_tables('demo_dataset1', prefix='table_'):
+        print(table.table_id)
+    for table in iter_project_tables(dataset_labels={'env': 'prod'}, table_prefix='events_', max_workers=32):
+        print(table.full_table_id)
+
+'''
+
+
+####################################################################################################
+#
+#   Python Libraries
+#
+####################################################################################################
+
+
+import threading
+
+from gcp_bigquery_clients import get_client
+from gcp_bigquery_telemetry import in_span_context
+
+
+####################################################################################################
+
+
+
+LIST_PAGE_SIZE      = 1000              # Items per datasets.list / tables.list page (the API maximum is 1000 for tables)
+LIST_MAX_WORKERS    = 16                # Datasets whose tables are listed at once by iter_project_tables()
+LIST_MAX_PENDING    = 10000             # Listed tables held for the consumer before the workers wait
+
+
+
+
+def _labels_match(item_labels, labels):
+    item_labels = item_labels or {}
+    for key, value in labels.items():
+        if key not in item_labels or (value is not None and item_labels[key] != value):
+            return False
+    return True
+
+
+
+
+def _label_filter(labels):
+    return ' '.join('labels.{}'.format(key) if value is None else 'labels.{}:{}'.format(key, value)
+                    for key, value in sorted(labels.items()))
+
+
+
+
+def iter_datasets(project=None, prefix=None, labels=None, include_all=False, page_size=LIST_PAGE_SIZE, client=None):
+    '''
+        Yields the bigquery.dataset.DatasetListItem of a project, one page at a time
+
+        USAGE:
+        for dataset in iter_datasets(prefix='demo_', labels={'env': 'prod'}):
+            print(dataset.dataset_id)
+
+        include_all=True also lists hidden datasets (names starting with an underscore).
+    '''
+    client   = client or get_client()
+    iterator = client.list_datasets(project=project, include_all=include_all, page_size=page_size,
+                                    filter=_label_filter(labels) if labels else None)
+    for dataset in iterator:
+        if prefix and not dataset.dataset_id.startswith(prefix):
+            continue
+        if labels and not _labels_match(dataset.labels, labels):
+            continue
+        yield dataset
+
+
+
+
+def iter_tables(dataset, prefix=None, labels=None, page_size=LIST_PAGE_SIZE, client=None):
+    '''
+        Yields the bigquery.table.TableListItem of a dataset, one page at a time
+
+        USAGE:
+        for table in iter_tables('demo_dataset1', prefix='table_'):
+            print(table.table_id, table.table_type)
+
+        dataset can be a dataset_id, 'project.dataset_id', a DatasetReference or a Dataset(ListItem).
+    '''
+    client = client or get_client()
+    for table in client.list_tables(dataset, page_size=page_size):
+        if prefix and not table.table_id.startswith(prefix):
+            continue
+        if labels and not _labels_match(table.labels, labels):
+            continue
+        yield table
+
+
+
+
+def iter_project_tables(project=None, datasets=None, dataset_prefix=None, dataset_labels=None, table_prefix=None,
+                        table_labels=None, max_workers=LIST_MAX_WORKERS, max_pending=LIST_MAX_PENDING,
+                        page_size=LIST_PAGE_SIZE, client=None):
+    '''
+        Yields the bigquery.table.TableListItem of every (matching) table of many datasets,
+        listing max_workers datasets at once
+
+        USAGE:
+        for table in iter_project_tables(dataset_prefix='demo_', table_labels={'pii': None}):
+            print(table.full_table_id)
+        tables = sum(1 for _ in iter_project_tables(datasets=['demo_dataset1', 'demo_dataset2']))
+
+        datasets defaults to iter_datasets(project, dataset_prefix, dataset_labels). A dataset deleted while
+        the scan runs is skipped; any other error stops the scan and is raised by the generator.
+    '''
+    import queue
+    from google.api_core.exceptions import NotFound
+
+    client   = client or get_client()
+    if datasets is None:
+        datasets = iter_datasets(project, prefix=dataset_prefix, labels=dataset_labels, page_size=page_size, client=client)
+    datasets = iter(datasets)
+
+    items    = queue.Queue(maxsize=max(1, max_pending))
+    stop     = threading.Event()
+    lock     = threading.Lock()        # Workers take the next dataset in turn, so the dataset pages stream too
+    done     = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def work():
+        try:
+            while not stop.is_set():
+                with lock:
+                    dataset = next(datasets, None)
+                if dataset is None:
+                    break
+                try:
+                    for table in iter_tables(dataset, prefix=table_prefix, labels=table_labels, page_size=page_size, client=client):
+                        if not put(table):
+                            return
+                except NotFound:
+                    pass
+        except BaseException as e:
+            put(e)
+        finally:
+            put(done)
+
+    workers = [threading.Thread(target=in_span_context(work), name='bq-list-{}'.format(i), daemon=True) for i in range(max(1, max_workers))]
+    for worker in workers:
+        worker.start()
+
+    try:
+        running = len(workers)
+        while running:
+            item = items.get()
+            if item is done:
+                running -= 1
+            elif isinstance(item, BaseException):
+                raise item
+            else:
+                yield item
+    finally:
+        stop.set()
+        for worker in workers:
+            worker.join()
+
+
+
+
+#ZEND
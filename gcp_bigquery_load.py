@@ -0,0 +1,313 @@
+####################################################################################################
+#
+#   Google BigQuery - Parallel Sharded Loads from Google Cloud Storage
+#
+#   https://cloud.google.com/bigquery/docs/batch-loading-data
+#   https://cloud.google.com/bigquery/quotas#load_jobs
+#
+####################################################################################################
+
+
+
+'''
+NOTES
+
+    A daily drop of thousands of CSV shards loaded with one load job per file runs strictly serially,
+    and one wildcard load job fails (and has to be restarted) as a whole when a single file is bad.
+
+    load_gcs_shards():
+        1. Expands the gs:// paths and wildcards to the list of files (one Cloud Storage listing per wildcard)
+        2. Groups the files into batches within the per-job limits (max_uris_per_job, max_bytes_per_job)
+        3. Runs the batch load jobs in parallel through a JobManager, either
+               - directly into the destination table with WRITE_APPEND, or
+               - (staging=True) into one staging table per batch, copied into the destination in a
+                 single copy job once every shard has loaded, so the destination never holds a partial load
+        4. A load job is atomic, so when a batch fails none of its rows were written: each shard of the
+           failed batch is retried alone (up to max_shard_retries times), and only the bad shard fails
+
+    Every batch job must load with the same schema: with autodetect each job would infer its own from its
+    files (a column all-null in one batch comes out STRING there and INTEGER in the next), and the appends
+    would fail or widen the table depending on which job finishes first. When there is more than one batch
+    and job_config has no schema, a CSV schema is inferred once up front from a sample of the shards and used
+    by every batch of this call; with register_schema=True it is taken from / registered in the schema
+    registry instead (gcp_bigquery_schema.py, keyed by the full path list, see source_key()). Other
+    autodetected formats need job_config.schema.
+
+    The report lists every shard with its attempts, job and throughput. A load job only reports totals,
+    so each shard is credited with the throughput (input bytes / job run time) of the job that loaded it.
+
+    USAGE:
+    report = load_gcs_shards('demo_dataset1', 'table_loans', 'gs://zdatasets1/loans/2018-07-01/*.csv')
+    print(report['output_rows'], report['mb_per_second'], report['failed_shards'])
+
+'''
+
+
+####################################################################################################
+#
+#   Python Libraries
+#
+####################################################################################################
+
+
+import concurrent.futures
+import fnmatch
+import time
+
+from google.api_core.exceptions import NotFound
+from google.cloud import bigquery
+
+from gcp_bigquery_clients import get_client
+from gcp_bigquery_jobs import JobManager
+from gcp_bigquery_metadata import invalidate_metadata
+from gcp_bigquery_telemetry import instrument
+
+
+####################################################################################################
+
+
+
+# Load job limits (https://cloud.google.com/bigquery/quotas#load_jobs)
+LOAD_MAX_URIS_PER_JOB  = 10000                      # Maximum source URIs per load job
+LOAD_MAX_BYTES_PER_JOB = 15 * 1024 ** 4             # Maximum size of all input files per load job (15 TB)
+
+
+
+
+def _split_uri(uri):
+    if not uri.startswith('gs://'):
+        raise ValueError('Expected a gs:// URI, got {!r}'.format(uri))
+    bucket_name, _, name = uri[len('gs://'):].partition('/')
+    return bucket_name, name
+
+
+
+
+def expand_gcs_uris(gcs_paths, storage_client=None, max_workers=16):
+    '''
+        Expands gs:// paths and wildcards to a sorted list of (uri, size_bytes), one per file
+
+        USAGE:
+        shards = expand_gcs_uris(['gs://zdatasets1/loans/*.csv', 'gs://zdatasets1/loan_200k.csv'])
+
+        A wildcard ('*', may span '/') costs one listing of the bucket prefix before the first '*';
+        explicit paths are looked up concurrently. A missing explicit path raises NotFound.
+    '''
+    if isinstance(gcs_paths, str):
+        gcs_paths = [gcs_paths]
+    if storage_client is None:
+        from google.cloud import storage
+        storage_client = storage.Client()
+
+    shards   = {}
+    explicit = []
+    for path in gcs_paths:
+        bucket_name, name = _split_uri(path)
+        if '*' not in name:
+            explicit.append((bucket_name, name))
+            continue
+        for blob in storage_client.list_blobs(bucket_name, prefix=name.split('*', 1)[0]):
+            if not blob.name.endswith('/') and fnmatch.fnmatchcase(blob.name, name):
+                shards['gs://{}/{}'.format(bucket_name, blob.name)] = blob.size
+
+    def lookup(bucket_and_name):
+        bucket_name, name = bucket_and_name
+        blob = storage_client.bucket(bucket_name).get_blob(name)
+        if blob is None:
+            raise NotFound('gs://{}/{} does not exist'.format(bucket_name, name))
+        return 'gs://{}/{}'.format(bucket_name, name), blob.size
+
+    if explicit:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(explicit))) as executor:
+            shards.update(executor.map(lookup, explicit))
+
+    return sorted(shards.items())
+
+
+
+
+def plan_load_batches(shards, max_uris_per_job=LOAD_MAX_URIS_PER_JOB, max_bytes_per_job=LOAD_MAX_BYTES_PER_JOB):
+    '''
+        Groups (uri, size_bytes) shards into batches of at most max_uris_per_job files and max_bytes_per_job bytes
+
+        A single shard larger than max_bytes_per_job gets a batch of its own.
+    '''
+    batches, batch, batch_bytes = [], [], 0
+    for uri, size in shards:
+        if batch and (len(batch) >= max_uris_per_job or batch_bytes + size > max_bytes_per_job):
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append((uri, size))
+        batch_bytes += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+
+
+def _default_job_config():
+    job_config = bigquery.LoadJobConfig()
+    job_config.autodetect        = True
+    job_config.skip_leading_rows = 1
+    job_config.source_format     = bigquery.SourceFormat.CSV
+    return job_config
+
+
+
+
+_SELF_DESCRIBING = (bigquery.SourceFormat.AVRO, bigquery.SourceFormat.PARQUET, bigquery.SourceFormat.ORC,
+                    bigquery.SourceFormat.DATASTORE_BACKUP)
+
+
+
+
+def _shared_schema_config(job_config, gcs_paths, storage_client, register=False):
+    '''
+        Returns job_config with one schema for every batch job in place of autodetect
+
+        A CSV schema is inferred from a sample of the shards (with register=True resolved through the schema
+        registry, keyed by the full path list); for other autodetected formats there is nothing to infer
+        from locally, so a schema is required.
+    '''
+    from gcp_bigquery_schema import get_registry, infer_gcs_schema, source_key
+
+    if job_config.schema or job_config.source_format in _SELF_DESCRIBING:
+        return job_config
+    if job_config.source_format not in (None, bigquery.SourceFormat.CSV):
+        raise ValueError('Loading {} in more than one batch job needs job_config.schema (autodetect would infer a '
+                         'schema per job)'.format(job_config.source_format))
+
+    infer  = lambda: infer_gcs_schema(gcs_paths, storage_client, skip_leading_rows=job_config.skip_leading_rows or 0,
+                                      delimiter=job_config.field_delimiter or ',')
+    config = bigquery.LoadJobConfig.from_api_repr(job_config.to_api_repr())
+    config.schema     = get_registry().resolve(source_key(gcs_paths), infer=infer) if register else infer()
+    config.autodetect = False
+    return config
+
+
+
+
+@instrument
+def load_gcs_shards(dataset_id, table_id, gcs_paths, job_config=None, staging=False,
+                    max_uris_per_job=LOAD_MAX_URIS_PER_JOB, max_bytes_per_job=LOAD_MAX_BYTES_PER_JOB,
+                    max_in_flight=20, max_shard_retries=2, location='US', storage_client=None, job_manager=None,
+                    register_schema=False):
+    '''
+        Loads many Cloud Storage files into dataset_id.table_id with parallel batch load jobs
+
+        USAGE:
+        report = load_gcs_shards('demo_dataset1', 'table_loans', ['gs://zdatasets1/loans/*.csv'], max_uris_per_job=500)
+
+        Input(s):   gcs_paths:          gs:// path, wildcard, or a list of them
+                    job_config:         bigquery.LoadJobConfig (default: CSV, header row, schema inferred once);
+                                        its write_disposition is ignored, shards are always appended.
+                                        With more than one batch, a CSV job_config without a schema gets one
+                                        inferred for this call; other non self-describing formats need a schema
+                    staging:            Load batches into staging tables and copy them into table_id at the end
+                                        (if a shard still fails, nothing is copied and the staging tables are kept)
+                    max_in_flight:      Load jobs running at once (ignored when job_manager is given)
+                    max_shard_retries:  Times a shard of a failed batch is retried on its own
+                    register_schema:    Take the inferred schema from / keep it in the schema registry
+
+        Output:     {'shards': [{'uri', 'bytes', 'state', 'attempts', 'job_id', 'seconds', 'mb_per_second', 'error'}, ...],
+                     'batches', 'jobs', 'retried_shards', 'failed_shards', 'output_rows', 'input_bytes',
+                     'committed', 'elapsed', 'mb_per_second'}
+
+    '''
+    start       = time.time()
+    client      = get_client()
+    dataset_ref = client.dataset(dataset_id)
+    job_config  = job_config or _default_job_config()
+
+    shards = expand_gcs_uris(gcs_paths, storage_client)
+    if not shards:
+        raise NotFound('No files match {}'.format(gcs_paths))
+    batches = plan_load_batches(shards, max_uris_per_job, max_bytes_per_job)
+    if len(batches) > 1:
+        job_config = _shared_schema_config(job_config, gcs_paths, storage_client, register_schema)
+
+    report = dict((uri, {'uri': uri, 'bytes': size, 'state': 'PENDING', 'attempts': 0, 'job_id': None,
+                         'seconds': None, 'mb_per_second': None, 'error': None}) for uri, size in shards)
+
+    def start_load(batch, destination_id, write_disposition):
+        config = bigquery.LoadJobConfig.from_api_repr(job_config.to_api_repr())
+        config.write_disposition = write_disposition
+        uris   = [uri for uri, _ in batch]
+        return lambda: client.load_table_from_uri(uris, dataset_ref.table(destination_id), job_config=config, location=location)
+
+    manager = job_manager or JobManager(max_in_flight=max_in_flight)
+    pending = {}
+    jobs    = 0
+    rows    = 0
+
+    def submit(batch, destination_id, write_disposition):
+        for uri, _ in batch:
+            report[uri]['attempts'] += 1
+        label = 'load {} file(s) -> {}.{}'.format(len(batch), dataset_id, destination_id)
+        pending[manager.submit(start_load(batch, destination_id, write_disposition), label=label)] = (batch, destination_id)
+
+    staging_ids = []
+    for i, batch in enumerate(batches):
+        destination_id = table_id
+        if staging:
+            destination_id = '{}__staging_{:05d}'.format(table_id, i)
+            staging_ids.append(destination_id)
+        submit(batch, destination_id, 'WRITE_TRUNCATE' if staging else 'WRITE_APPEND')
+
+    try:
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                batch, destination_id = pending.pop(future)
+                jobs += 1
+                try:
+                    stats = future.result()
+                except Exception as e:
+                    for uri, size in batch:
+                        if report[uri]['attempts'] <= max_shard_retries:
+                            submit([(uri, size)], destination_id, 'WRITE_APPEND')
+                        else:
+                            report[uri].update({'state': 'FAILED', 'error': str(e),
+                                                'job_id': getattr(e, 'job_statistics', {}).get('job_id')})
+                    continue
+
+                rows   += stats.get('output_rows', 0)
+                seconds = stats['run_seconds'] or stats['wall_seconds']
+                mbps    = stats.get('input_file_bytes', 0) / 1e6 / seconds if seconds else None
+                for uri, _ in batch:
+                    report[uri].update({'state': 'DONE', 'job_id': stats['job_id'], 'seconds': seconds, 'mb_per_second': mbps})
+    finally:
+        if job_manager is None:
+            manager.shutdown(wait=True)
+        invalidate_metadata(dataset_id)
+
+    shard_reports = [report[uri] for uri, _ in shards]
+    failed        = [shard for shard in shard_reports if shard['state'] == 'FAILED']
+
+    committed = not failed
+    if staging and committed:
+        copy_config = bigquery.CopyJobConfig()
+        copy_config.write_disposition = bigquery.WriteDisposition.WRITE_APPEND
+        client.copy_table([dataset_ref.table(staging_id) for staging_id in staging_ids], dataset_ref.table(table_id),
+                          job_config=copy_config, location=location).result()
+        for staging_id in staging_ids:
+            client.delete_table(dataset_ref.table(staging_id), not_found_ok=True)
+        invalidate_metadata(dataset_id)
+
+    elapsed     = time.time() - start
+    input_bytes = sum(shard['bytes'] for shard in shard_reports if shard['state'] == 'DONE')
+    return {'shards':         shard_reports,
+            'batches':        len(batches),
+            'jobs':           jobs,
+            'retried_shards': sum(1 for shard in shard_reports if shard['attempts'] > 1),
+            'failed_shards':  len(failed),
+            'output_rows':    rows,
+            'input_bytes':    input_bytes,
+            'committed':      committed,
+            'elapsed':        elapsed,
+            'mb_per_second':  input_bytes / 1e6 / elapsed if elapsed else None}
+
+
+
+#ZEND
@@ -0,0 +1,496 @@
+####################################################################################################
+#
+#   Google BigQuery - Table and Dataset Metadata (cache and bulk lookups)
+#
+#   https://cloud.google.com/bigquery/docs/reference/rest/v2/tables/get
+#   https://cloud.google.com/bigquery/docs/reference/rest/v2/datasets/get
+#   https://cloud.google.com/bigquery/docs/information-schema-tables
+#
+####################################################################################################
+
+
+
+'''
+NOTES
+
+    Table and dataset metadata changes rarely, but bq_insert_rows() used to fetch the table (for its schema)
+    before every insert, and the metadata helpers fetched the dataset / table list on every call.
+    MetadataCache keeps tables (with their schemas), datasets, dataset locations and table listings in memory.
+
+    Freshness:      every entry expires after its TTL (per kind, or the ttl= of the call that stored it):
+                        tables TABLE_TTL, datasets DATASET_TTL, table listings LIST_TTL,
+                        locations never (a dataset cannot change location; a deleted dataset is invalidated)
+    Revalidation:   an expired table / dataset is re-fetched with If-None-Match: <etag>. A 304 Not Modified
+                    answer renews the entry without transferring the resource again.
+    Invalidation:   the create / update / delete / load / copy helpers of this repo call invalidate_metadata()
+                    for what they change, so they never read their own stale metadata. Changes made elsewhere
+                    (another process, the console) are seen once the entry expires.
+    Size:           LRU bounded by max_entries (0 disables the cache)
+
+    Cached objects are shared by every caller: read them, but copy before modifying (e.g. for update_table).
+
+    Bulk metadata:  row counts, sizes, partitioning, clustering and columns of every table in a dataset
+                    (or a whole project) would take one get_table() per table. bulk_table_metadata() gets them
+                    with a single query over INFORMATION_SCHEMA.TABLES / COLUMNS and __TABLES__
+                    (INFORMATION_SCHEMA.TABLE_STORAGE for a project), returned column by column like
+                    gcp_bigquery_columnar.fetch_columns(). Where the views cannot be queried (no permission,
+                    unsupported location, ...) it falls back to concurrent get_table() calls with the same output.
+
+    USAGE:
+    table  = get_metadata_cache().get_table(client, client.dataset('demo_dataset1').table('table_loans'))
+    schema = get_metadata_cache().get_schema(client, 'zproject201807.demo_dataset1.table_loans')
+    invalidate_metadata('demo_dataset1', 'table_loans')     # After changing the table outside these helpers
+    set_metadata_cache(MetadataCache(max_entries=0))        # Disable caching
+    print(get_metadata_cache().stats())
+    columns = bulk_table_metadata('demo_dataset1')          # {'table_id': array, 'num_rows': array, ...}
+    table   = bulk_table_metadata(project='zproject201807', location='US', output='arrow')
+
+'''
+
+
+####################################################################################################
+#
+#   Python Libraries
+#
+####################################################################################################
+
+
+import collections
+import json
+import threading
+import time
+
+from gcp_bigquery_telemetry import in_span_context, instrument
+
+
+####################################################################################################
+
+
+
+TABLE_TTL   = 60.0                  # Seconds a cached table (and schema) is used before it is revalidated
+DATASET_TTL = 300.0                 # Seconds a cached dataset is used before it is revalidated
+LIST_TTL    = 30.0                  # Seconds a cached table listing is used before it is fetched again
+
+
+# Columns returned by bulk_table_metadata(), in order
+BULK_METADATA_FIELDS = [
+    ('project',      'STRING'),
+    ('dataset_id',   'STRING'),
+    ('table_id',     'STRING'),
+    ('table_type',   'STRING'),         # TABLE, VIEW, MATERIALIZED_VIEW, EXTERNAL, SNAPSHOT, ...
+    ('created',      'TIMESTAMP'),
+    ('modified',     'TIMESTAMP'),
+    ('num_rows',     'INTEGER'),        # NULL for views
+    ('num_bytes',    'INTEGER'),
+    ('partitioning', 'STRING'),         # PARTITION BY expression of the table DDL, e.g. 'DATE(created)', '_PARTITIONDATE'
+    ('clustering',   'STRING'),         # Clustering columns, e.g. 'state, grade'
+    ('columns',      'STRING'),         # JSON list of {"name", "type", "nullable"} (standard SQL type names)
+]
+
+_BULK_METADATA_SQL = '''
+    SELECT
+        t.table_catalog                                                     AS project,
+        t.table_schema                                                      AS dataset_id,
+        t.table_name                                                        AS table_id,
+        IF(t.table_type = 'BASE TABLE', 'TABLE', REPLACE(t.table_type, ' ', '_')) AS table_type,
+        t.creation_time                                                     AS created,
+        s.modified                                                          AS modified,
+        s.num_rows                                                          AS num_rows,
+        s.num_bytes                                                         AS num_bytes,
+        REGEXP_EXTRACT(t.ddl, r'PARTITION BY ([^\\n]+)')                    AS partitioning,
+        c.clustering                                                        AS clustering,
+        c.columns                                                           AS columns
+    FROM `{scope}.INFORMATION_SCHEMA.TABLES` AS t
+    LEFT JOIN ({storage}) AS s
+        ON s.table_schema = t.table_schema AND s.table_name = t.table_name
+    LEFT JOIN (
+        SELECT
+            table_schema,
+            table_name,
+            STRING_AGG(IF(clustering_ordinal_position IS NULL, NULL, column_name), ', ' ORDER BY clustering_ordinal_position) AS clustering,
+            TO_JSON_STRING(ARRAY_AGG(IF(is_hidden = 'YES', NULL, STRUCT(column_name AS name, data_type AS type, is_nullable = 'YES' AS nullable))
+                                     IGNORE NULLS ORDER BY ordinal_position)) AS columns
+        FROM `{scope}.INFORMATION_SCHEMA.COLUMNS`
+        GROUP BY table_schema, table_name
+    ) AS c
+        ON c.table_schema = t.table_schema AND c.table_name = t.table_name
+    ORDER BY dataset_id, table_id
+'''
+
+# Row counts / sizes: __TABLES__ for one dataset, INFORMATION_SCHEMA.TABLE_STORAGE for a whole project (per region)
+_DATASET_STORAGE_SQL = ('SELECT dataset_id AS table_schema, table_id AS table_name, TIMESTAMP_MILLIS(last_modified_time) AS modified, '
+                        'row_count AS num_rows, size_bytes AS num_bytes FROM `{project}.{dataset_id}.__TABLES__`')
+_PROJECT_STORAGE_SQL = ('SELECT table_schema, table_name, storage_last_modified_time AS modified, '
+                        'total_rows AS num_rows, total_logical_bytes AS num_bytes FROM `{scope}.INFORMATION_SCHEMA.TABLE_STORAGE`')
+
+_STANDARD_SQL_TYPES = {'INTEGER': 'INT64', 'FLOAT': 'FLOAT64', 'BOOLEAN': 'BOOL'}
+
+
+
+
+class _Entry(object):
+    def __init__(self, value, etag, ttl):
+        self.value   = value
+        self.etag    = etag
+        self.ttl     = ttl
+        self.expires = None if ttl is None else time.time() + ttl
+
+    def expired(self):
+        return self.expires is not None and time.time() >= self.expires
+
+    def renew(self):
+        if self.ttl is not None:
+            self.expires = time.time() + self.ttl
+
+
+
+
+class MetadataCache(object):
+    '''
+        In-memory TTL / LRU cache of tables, datasets, locations and table listings
+
+        USAGE:
+        cache = MetadataCache(max_entries=1024, table_ttl=60)
+        table = cache.get_table(client, table_ref)          # Same as client.get_table(table_ref), cached
+        cache.invalidate('demo_dataset1', 'table_loans')
+
+    '''
+    def __init__(self, max_entries=1024, table_ttl=TABLE_TTL, dataset_ttl=DATASET_TTL, list_ttl=LIST_TTL):
+        self.max_entries = max_entries
+        self.ttls        = {'table': table_ttl, 'dataset': dataset_ttl, 'tables': list_ttl, 'location': None}
+        self._entries    = collections.OrderedDict()       # (kind, project, dataset_id, table_id) -> _Entry, least recently used first
+        self._lock       = threading.RLock()
+        self.counters    = collections.Counter()
+
+    def stats(self):
+        '''
+            Hit / miss / revalidation counters; every hit and 304 revalidation is an API round-trip avoided or shrunk
+        '''
+        with self._lock:
+            stats = dict((name, self.counters[name]) for name in
+                         ('hits', 'misses', 'revalidated', 'refreshed', 'invalidations', 'evictions'))
+            stats['entries'] = len(self._entries)
+            return stats
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def _store(self, key, value, etag, ttl):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = _Entry(value, etag, ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def _get(self, kind, key, fetch, ttl, path=None, from_api_repr=None, client=None):
+        ttl   = self.ttls[kind] if ttl is None else ttl
+        entry = self._lookup(key)
+        if entry is not None and not entry.expired():
+            with self._lock:
+                self.counters['hits'] += 1
+            return entry.value
+
+        if entry is not None and entry.etag and path is not None:
+            from google.api_core.exceptions import NotModified
+            from google.cloud.bigquery import DEFAULT_RETRY
+            try:
+                resource = client._call_api(DEFAULT_RETRY, method='GET', path=path, headers={'If-None-Match': entry.etag})
+            except NotModified:
+                with self._lock:
+                    entry.renew()
+                    self.counters['revalidated'] += 1
+                return entry.value
+            except Exception:
+                with self._lock:
+                    if self._entries.get(key) is entry:
+                        del self._entries[key]
+                raise
+            value = from_api_repr(resource)
+            with self._lock:
+                self.counters['refreshed'] += 1
+        else:
+            value = fetch()
+            with self._lock:
+                self.counters['misses'] += 1
+
+        self._store(key, value, getattr(value, 'etag', None), ttl)
+        return value
+
+    def get_table(self, client, table_ref, ttl=None):
+        '''
+            Returns the bigquery.Table for table_ref (TableReference or 'project.dataset.table' / 'dataset.table')
+        '''
+        from google.cloud import bigquery
+        if isinstance(table_ref, str):
+            table_ref = bigquery.TableReference.from_string(table_ref, default_project=client.project)
+        key = ('table', table_ref.project, table_ref.dataset_id, table_ref.table_id)
+        return self._get('table', key, lambda: client.get_table(table_ref), ttl,
+                         path=table_ref.path, from_api_repr=bigquery.Table.from_api_repr, client=client)
+
+    def get_schema(self, client, table_ref, ttl=None):
+        '''
+            Returns the schema (list of bigquery.SchemaField) of table_ref
+        '''
+        return self.get_table(client, table_ref, ttl).schema
+
+    def get_dataset(self, client, dataset_ref, ttl=None):
+        '''
+            Returns the bigquery.Dataset for dataset_ref (DatasetReference or 'project.dataset' / 'dataset')
+        '''
+        from google.cloud import bigquery
+        if isinstance(dataset_ref, str):
+            dataset_ref = bigquery.DatasetReference.from_string(dataset_ref, default_project=client.project)
+        key = ('dataset', dataset_ref.project, dataset_ref.dataset_id, None)
+        return self._get('dataset', key, lambda: client.get_dataset(dataset_ref), ttl,
+                         path=dataset_ref.path, from_api_repr=bigquery.Dataset.from_api_repr, client=client)
+
+    def get_location(self, client, dataset_ref):
+        '''
+            Returns the location of a dataset (cached until the dataset is invalidated)
+        '''
+        from google.cloud import bigquery
+        if isinstance(dataset_ref, str):
+            dataset_ref = bigquery.DatasetReference.from_string(dataset_ref, default_project=client.project)
+        key = ('location', dataset_ref.project, dataset_ref.dataset_id, None)
+        return self._get('location', key, lambda: self.get_dataset(client, dataset_ref).location, None)
+
+    def list_tables(self, client, dataset_ref, ttl=None):
+        '''
+            Returns the list of bigquery.table.TableListItem in dataset_ref
+        '''
+        from google.cloud import bigquery
+        if isinstance(dataset_ref, str):
+            dataset_ref = bigquery.DatasetReference.from_string(dataset_ref, default_project=client.project)
+        key = ('tables', dataset_ref.project, dataset_ref.dataset_id, None)
+        return self._get('tables', key, lambda: list(client.list_tables(dataset_ref)), ttl)
+
+    def invalidate(self, dataset_id, table_id=None, project=None):
+        '''
+            Drops the cached metadata of a table (and its dataset's table listing),
+            or of a whole dataset and every table in it when table_id is None.
+            project=None matches the dataset in any project. A partition decorator ('events$20180701')
+            invalidates its table.
+        '''
+        if table_id is not None:
+            table_id = table_id.split('$')[0]
+        with self._lock:
+            for key in list(self._entries):
+                kind, key_project, key_dataset, key_table = key
+                if key_dataset != dataset_id or (project is not None and key_project != project):
+                    continue
+                if table_id is None or kind == 'tables' or key_table == table_id:
+                    del self._entries[key]
+                    self.counters['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+
+
+_cache      = None
+_cache_lock = threading.Lock()
+
+
+
+
+def get_metadata_cache():
+    '''
+        Returns the shared MetadataCache (default settings unless set_metadata_cache() was called)
+    '''
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = MetadataCache()
+    return _cache
+
+
+
+
+def set_metadata_cache(cache):
+    '''
+        Replaces the shared MetadataCache (None restores a default one on next use)
+    '''
+    global _cache
+    with _cache_lock:
+        _cache = cache
+
+
+
+
+def invalidate_metadata(dataset_id, table_id=None, project=None):
+    '''
+        Drops cached metadata of a table, or of a whole dataset, from the shared cache
+
+        USAGE:
+        invalidate_metadata('demo_dataset1', 'table_loans')
+        invalidate_metadata('demo_dataset1')
+    '''
+    get_metadata_cache().invalidate(dataset_id, table_id, project)
+
+
+
+
+
+
+def _standard_sql_type(field):
+    if field.field_type in ('RECORD', 'STRUCT'):
+        field_type = 'STRUCT<{}>'.format(', '.join('{} {}'.format(sub.name, _standard_sql_type(sub)) for sub in field.fields))
+    else:
+        field_type = _STANDARD_SQL_TYPES.get(field.field_type, field.field_type)
+    return 'ARRAY<{}>'.format(field_type) if field.mode == 'REPEATED' else field_type
+
+
+
+
+def _partition_expression(table):
+    '''
+        The PARTITION BY expression BigQuery shows in the DDL of table (None when not partitioned)
+    '''
+    if table.range_partitioning is not None:
+        partition_range = table.range_partitioning.range_
+        return 'RANGE_BUCKET({}, GENERATE_ARRAY({}, {}, {}))'.format(table.range_partitioning.field, partition_range.start,
+                                                                     partition_range.end, partition_range.interval)
+    partitioning = table.time_partitioning
+    if partitioning is None:
+        return None
+    unit = partitioning.type_ or 'DAY'
+    if partitioning.field is None:
+        return '_PARTITIONDATE' if unit == 'DAY' else 'TIMESTAMP_TRUNC(_PARTITIONTIME, {})'.format(unit)
+    field_type = dict((field.name, field.field_type) for field in table.schema).get(partitioning.field)
+    if field_type == 'DATE':
+        return partitioning.field if unit == 'DAY' else 'DATE_TRUNC({}, {})'.format(partitioning.field, unit)
+    if field_type == 'DATETIME':
+        return 'DATETIME_TRUNC({}, {})'.format(partitioning.field, unit)
+    return 'DATE({})'.format(partitioning.field) if unit == 'DAY' else 'TIMESTAMP_TRUNC({}, {})'.format(partitioning.field, unit)
+
+
+
+
+def _table_metadata_row(table):
+    return {'project':      table.project,
+            'dataset_id':   table.dataset_id,
+            'table_id':     table.table_id,
+            'table_type':   table.table_type,
+            'created':      table.created,
+            'modified':     table.modified,
+            'num_rows':     table.num_rows if table.table_type != 'VIEW' else None,
+            'num_bytes':    table.num_bytes,
+            'partitioning': _partition_expression(table),
+            'clustering':   ', '.join(table.clustering_fields) if table.clustering_fields else None,
+            'columns':      json.dumps([{'name': field.name, 'type': _standard_sql_type(field), 'nullable': field.mode != 'REQUIRED'}
+                                        for field in table.schema], separators=(',', ':'))}
+
+
+
+
+def _metadata_columns(rows, output):
+    '''
+        Turns metadata rows into the column structure fetch_columns() returns for the same fields
+    '''
+    import numpy
+    from google.cloud import bigquery
+    from gcp_bigquery_columnar import _column_dtype, _to_arrow
+
+    schema  = [bigquery.SchemaField(name, field_type) for name, field_type in BULK_METADATA_FIELDS]
+    buffers = []
+    masks   = []
+    for field in schema:
+        values = [row[field.name] for row in rows]
+        mask   = numpy.array([value is None for value in values], dtype=bool)
+        if field.field_type == 'TIMESTAMP':
+            values = [0 if value is None else int(value.timestamp() * 1000000) for value in values]
+            data   = numpy.array(values, dtype=numpy.int64).view('datetime64[us]')
+        elif field.field_type == 'INTEGER':
+            data   = numpy.array([0 if value is None else value for value in values], dtype=numpy.int64)
+        else:
+            data    = numpy.empty(len(values), dtype=_column_dtype(field))
+            data[:] = values
+        buffers.append(data)
+        masks.append(mask)
+
+    if output == 'arrow':
+        return _to_arrow(schema, buffers, masks)
+    return dict((field.name, numpy.ma.MaskedArray(data, mask=mask)) for field, data, mask in zip(schema, buffers, masks))
+
+
+
+
+def _bulk_metadata_sql(project, dataset_id, location):
+    if dataset_id is not None:
+        scope   = '{}.{}'.format(project, dataset_id)
+        storage = _DATASET_STORAGE_SQL.format(project=project, dataset_id=dataset_id)
+    else:
+        scope   = '{}.region-{}'.format(project, location.lower())
+        storage = _PROJECT_STORAGE_SQL.format(scope=scope)
+    return _BULK_METADATA_SQL.format(scope=scope, storage=storage)
+
+
+
+
+@instrument
+def bulk_table_metadata(dataset_id=None, project=None, location=None, output='numpy', max_workers=16, fallback=True):
+    '''
+        Metadata of every table in a dataset (or in a project) from one INFORMATION_SCHEMA query
+
+        USAGE:
+        columns = bulk_table_metadata('demo_dataset1')
+        for table_id, num_rows, num_bytes in zip(columns['table_id'], columns['num_rows'], columns['num_bytes']):
+            print(table_id, num_rows, num_bytes)
+        table   = bulk_table_metadata(project='zproject201807', location='EU', output='arrow')
+
+        Input(s):   dataset_id:     Dataset to describe; None describes every dataset of the project in location
+                    project:        Default: the client's project
+                    location:       Region of the INFORMATION_SCHEMA views (default: the dataset's location, or US)
+                    output:         'numpy' returns {column: numpy.ma.MaskedArray}, 'arrow' a pyarrow.Table
+                                    (columns: BULK_METADATA_FIELDS, one row per table, sorted by dataset and table)
+                    max_workers:    Concurrent get_table() calls when falling back
+                    fallback:       False raises the query's error instead of falling back to get_table() calls
+
+    '''
+    import concurrent.futures
+    from gcp_bigquery_clients import get_client
+    from gcp_bigquery_columnar import fetch_columns
+
+    if output not in ('numpy', 'arrow'):
+        raise ValueError("output must be 'numpy' or 'arrow', got {!r}".format(output))
+
+    client  = get_client()
+    project = project or client.project
+    if location is None:
+        location = get_metadata_cache().get_location(client, client.dataset(dataset_id, project=project)) if dataset_id else 'US'
+
+    try:
+        query_job = client.query(_bulk_metadata_sql(project, dataset_id, location), location=location)
+        return fetch_columns(client, query_job, output=output)
+    except Exception as e:
+        if not fallback:
+            raise
+        print('[ WARN ] INFORMATION_SCHEMA query failed ({}), falling back to get_table() per table'.format(str(e).splitlines()[0]))
+
+    if dataset_id is not None:
+        dataset_refs = [client.dataset(dataset_id, project=project)]
+    else:
+        dataset_refs = [item.reference for item in client.list_datasets(project)
+                        if get_metadata_cache().get_location(client, item.reference).lower() == location.lower()]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        listings   = executor.map(in_span_context(lambda dataset_ref: list(client.list_tables(dataset_ref))), dataset_refs)
+        table_refs = sorted((item.reference for listing in listings for item in listing),
+                            key=lambda table_ref: (table_ref.dataset_id, table_ref.table_id))
+        tables     = list(executor.map(in_span_context(client.get_table), table_refs))
+
+    return _metadata_columns([_table_metadata_row(table) for table in tables], output)
+
+
+
+#ZEND
@@ -0,0 +1,265 @@
+####################################################################################################
+#
+#   Google BigQuery - Partitioned and Clustered Tables
+#
+#   https://cloud.google.com/bigquery/docs/partitioned-tables
+#   https://cloud.google.com/bigquery/docs/clustered-tables
+#   https://cloud.google.com/bigquery/docs/querying-partitioned-tables
+#
+####################################################################################################
+
+
+
+'''
+NOTES
+
+    A query is billed for the bytes of every partition it reads. Against a partitioned table a query
+    without a filter on the partitioning column reads (and pays for) the whole table.
+
+    Partitioning (partitioning= of the create / load / query helpers):
+        'created'                                           Daily partitions on the DATE / TIMESTAMP / DATETIME column created
+        {'field': 'created', 'type': 'MONTH'}               type: HOUR, DAY (default), MONTH or YEAR
+        {'type': 'DAY'}                                     Ingestion-time: no field, rows go to the partition of their load
+                                                            time (or of the partition decorator), filter on _PARTITIONTIME
+        {'field': 'customer_id', 'range': (0, 100000, 1000)}  Integer range: start (inclusive), end (exclusive), interval
+        Optional keys: 'expiration_days' (partitions older than this are deleted) and
+                       'require_filter' (BigQuery itself rejects queries without a partition filter)
+
+    Clustering (clustering=): up to 4 columns, e.g. ['state', 'member_id']. Rows are sorted by these columns
+    within each partition, so filters on them read fewer blocks.
+
+    Partition decorators: 'table$20180701' addresses one partition. A load with WRITE_TRUNCATE into a
+    decorator replaces that day only (partition_decorator() builds the name).
+
+    Partition filter guard: check_partition_filter() dry-runs a query (free) and looks up each table it
+    reads. For a partitioned table whose partitioning column (or _PARTITIONTIME / _PARTITIONDATE) does not
+    appear after a WHERE, it warns (mode='warn') or raises PartitionFilterError (mode='error') before the
+    query runs. This is a textual check: it catches the usual mistake of no partition filter at all, but
+    cannot tell whether a filter actually prunes (e.g. a filter on a function of the column may not).
+    Tables created with require_filter are skipped, since BigQuery enforces it for them, and so are queries
+    that process 0 bytes (answered from metadata, e.g. SELECT COUNT(*) without a filter).
+
+    USAGE:
+    bq_create_table_empty('demo_dataset1', 'events', schema, partitioning='created', clustering=['state'])
+    bq_load_partition('demo_dataset1', 'events', 'gs://zdatasets1/events/2018-07-01/*.csv', '2018-07-01')
+    check_partition_filter('select * from `demo_dataset1.events`', mode='error')           # raises PartitionFilterError
+    bq_query('select * from `demo_dataset1.events` where created >= "2018-07-01"', partition_filter='error')
+
+'''
+
+
+####################################################################################################
+#
+#   Python Libraries
+#
+####################################################################################################
+
+
+import datetime
+import re
+
+from gcp_bigquery_clients import get_client
+from gcp_bigquery_metadata import get_metadata_cache, invalidate_metadata
+
+
+####################################################################################################
+
+
+
+PARTITION_TYPES          = ('HOUR', 'DAY', 'MONTH', 'YEAR')
+PARTITION_ID_FORMATS     = {'HOUR': '%Y%m%d%H', 'DAY': '%Y%m%d', 'MONTH': '%Y%m', 'YEAR': '%Y'}
+PARTITION_PSEUDO_COLUMNS = ('_PARTITIONTIME', '_PARTITIONDATE')
+CLUSTERING_MAX_FIELDS    = 4
+
+_PARTITIONING_KEYS       = ('field', 'type', 'range', 'expiration_days', 'require_filter')
+
+# Comments and string literals, removed before looking for the partition filter
+_SQL_NOISE               = re.compile(r'--[^\n]*|#[^\n]*|/\*.*?\*/|\'(?:\\.|[^\'\\])*\'|"(?:\\.|[^"\\])*"', re.DOTALL)
+
+
+
+
+class PartitionFilterError(ValueError):
+    '''
+        Raised by check_partition_filter(mode='error') for a query that would scan every partition of a table
+    '''
+
+
+
+
+def partitioning_spec(partitioning):
+    '''
+        Normalizes the partitioning= argument of the helpers to a dict ({} when not partitioned)
+
+        USAGE:
+        partitioning_spec('created')        # {'field': 'created', 'type': 'DAY'}
+    '''
+    if not partitioning:
+        return {}
+    if isinstance(partitioning, str):
+        partitioning = {'field': partitioning}
+    unknown = sorted(set(partitioning) - set(_PARTITIONING_KEYS))
+    if unknown:
+        raise ValueError('Unknown partitioning key(s) {}, expected {}'.format(unknown, _PARTITIONING_KEYS))
+
+    spec = dict(partitioning)
+    if 'range' in spec:
+        if not spec.get('field'):
+            raise ValueError('Integer range partitioning needs a field')
+        if len(spec['range']) != 3:
+            raise ValueError('range must be (start, end, interval), got {!r}'.format(spec['range']))
+    else:
+        spec['type'] = spec.get('type', 'DAY').upper()
+        if spec['type'] not in PARTITION_TYPES:
+            raise ValueError('Partition type must be one of {}, got {!r}'.format(PARTITION_TYPES, spec['type']))
+    return spec
+
+
+
+
+def apply_partitioning(target, partitioning=None, clustering=None):
+    '''
+        Sets partitioning and clustering on a bigquery.Table, LoadJobConfig or QueryJobConfig
+
+        USAGE:
+        table = apply_partitioning(bigquery.Table(table_ref, schema=schema), 'created', clustering=['state'])
+        job_config = apply_partitioning(bigquery.LoadJobConfig(), {'field': 'customer_id', 'range': (0, 100000, 1000)})
+
+        require_filter is a table property: job configs ignore it (see enforce_partition_filter()).
+    '''
+    from google.cloud import bigquery
+
+    spec = partitioning_spec(partitioning)
+    if 'range' in spec:
+        start, end, interval = spec['range']
+        target.range_partitioning = bigquery.RangePartitioning(
+            field=spec['field'], range_=bigquery.PartitionRange(start=start, end=end, interval=interval))
+    elif spec:
+        expiration_ms = int(spec['expiration_days'] * 86400000) if spec.get('expiration_days') else None
+        target.time_partitioning = bigquery.TimePartitioning(type_=spec['type'], field=spec.get('field'), expiration_ms=expiration_ms)
+
+    if spec.get('require_filter') and isinstance(target, bigquery.Table):
+        target.require_partition_filter = True
+
+    if clustering:
+        clustering = [clustering] if isinstance(clustering, str) else list(clustering)
+        if len(clustering) > CLUSTERING_MAX_FIELDS:
+            raise ValueError('At most {} clustering columns, got {}'.format(CLUSTERING_MAX_FIELDS, len(clustering)))
+        target.clustering_fields = clustering
+    return target
+
+
+
+
+def enforce_partition_filter(client, table_ref, partitioning):
+    '''
+        Sets require_partition_filter on a table created by a load / query job when partitioning asks for it
+    '''
+    if not partitioning_spec(partitioning).get('require_filter'):
+        return
+    table = client.get_table(table_ref)
+    table.require_partition_filter = True
+    client.update_table(table, ['require_partition_filter'])
+    invalidate_metadata(table.dataset_id, table.table_id)
+
+
+
+
+def partition_id(partition, partition_type='DAY'):
+    '''
+        The partition ID of a date / datetime / 'YYYY-MM-DD[ HH:MM:SS]' string (or of the start of an integer range)
+
+        USAGE:
+        partition_id('2018-07-01')                              # '20180701'
+        partition_id(datetime.datetime(2018, 7, 1, 9), 'HOUR')  # '2018070109'
+    '''
+    if isinstance(partition, bool):
+        raise ValueError('Not a partition: {!r}'.format(partition))
+    if isinstance(partition, int):
+        return str(partition)
+    if isinstance(partition, str):
+        if partition.isdigit() or partition == '__UNPARTITIONED__':
+            return partition
+        partition = datetime.datetime.fromisoformat(partition.replace('T', ' ')[:19])
+    if not isinstance(partition, (datetime.date, datetime.datetime)):
+        raise ValueError('Not a partition: {!r}'.format(partition))
+    return partition.strftime(PARTITION_ID_FORMATS[partition_type.upper()])
+
+
+
+
+def partition_decorator(table_id, partition, partition_type='DAY'):
+    '''
+        Table ID addressing a single partition, e.g. partition_decorator('events', '2018-07-01') == 'events$20180701'
+    '''
+    return '{}${}'.format(table_id.split('$')[0], partition_id(partition, partition_type))
+
+
+
+
+def partition_columns(table):
+    '''
+        Columns a filter has to use to prune the partitions of a bigquery.Table ([] when not partitioned)
+    '''
+    if table.range_partitioning is not None:
+        return [table.range_partitioning.field]
+    if table.time_partitioning is not None:
+        return [table.time_partitioning.field] if table.time_partitioning.field else list(PARTITION_PSEUDO_COLUMNS)
+    return []
+
+
+
+
+def _filters_on(query, columns):
+    sql   = _SQL_NOISE.sub(' ', query)
+    where = re.search(r'\bwhere\b', sql, re.IGNORECASE)
+    if where is None:
+        return False
+    return any(re.search(r'\b{}\b'.format(re.escape(column)), sql[where.end():], re.IGNORECASE) for column in columns)
+
+
+
+
+def check_partition_filter(query, location='US', mode='warn', query_parameters=None, client=None):
+    '''
+        Dry-runs query and flags the partitioned tables it reads without a filter on their partitioning column
+
+        USAGE:
+        report = check_partition_filter('select * from `demo_dataset1.events` where created = "2018-07-01"')
+        check_partition_filter(sql, mode='error')           # raises PartitionFilterError instead of warning
+
+        Output:     {'bytes_processed': <dry-run estimate>, 'unfiltered': [{'table', 'columns', 'table_bytes'}, ...]}
+    '''
+    from google.cloud import bigquery
+
+    if mode not in ('warn', 'error'):
+        raise ValueError("mode must be 'warn' or 'error', got {!r}".format(mode))
+
+    client     = client or get_client()
+    job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False, query_parameters=query_parameters or [])
+    job        = client.query(query, location=location, job_config=job_config)
+    cache      = get_metadata_cache()
+
+    unfiltered = []
+    for table_ref in job.referenced_tables if job.total_bytes_processed else []:      # 0 bytes: nothing to prune (e.g. COUNT(*))
+        table   = cache.get_table(client, table_ref)
+        columns = partition_columns(table)
+        if columns and not table.require_partition_filter and not _filters_on(query, columns):
+            unfiltered.append({'table': '{}.{}.{}'.format(table.project, table.dataset_id, table.table_id),
+                               'columns': columns, 'table_bytes': table.num_bytes})
+
+    report = {'bytes_processed': job.total_bytes_processed, 'unfiltered': unfiltered}
+    if unfiltered:
+        message = 'Query reads every partition of {} (no filter on {}); {} bytes would be processed'.format(
+                  ', '.join(item['table'] for item in unfiltered),
+                  ' / '.join(sorted(set(column for item in unfiltered for column in item['columns']))),
+                  job.total_bytes_processed)
+        if mode == 'error':
+            raise PartitionFilterError(message)
+        print('[ WARN ] {}'.format(message))
+    return report
+
+
+
+
+#ZEND
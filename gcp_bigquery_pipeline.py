@@ -0,0 +1,414 @@
+####################################################################################################
+#
+#   Google BigQuery - Pipeline Runner (declarative step graphs)
+#
+#   https://cloud.google.com/bigquery/docs/managing-jobs
+#
+####################################################################################################
+
+
+
+'''
+NOTES
+
+    A pipeline is a graph of steps, each one a call of a helper (or any function) plus the steps it needs.
+    Pipeline.run() starts every step as soon as the steps it needs are done, so independent steps run
+    side by side (e.g. creating the empty table while the GCS load runs), on up to max_workers threads.
+
+    Steps:
+        call        The function, or its dotted path ('gcp_bigquery_demoflow.bq_create_dataset')
+        args        Positional arguments
+        kwargs      Keyword arguments
+        needs       Names of the steps that must be done first
+        confirm     Prompt to confirm before the step runs (interactive runs only); a declined step and
+                    the steps needing it are not run
+    Strings in args / kwargs may use ${param} placeholders, filled from the pipeline params
+    (a string that is only '${param}' takes the param's value as is, e.g. a list or an int).
+
+    A step fails when its call raises, or when a helper it calls records an error (the helpers print
+    their errors instead of raising, see gcp_bigquery_telemetry.record_error). The steps needing a
+    failed step are skipped; the rest of the pipeline still runs.
+
+    Checkpoints:
+        With state_file, every step that is done is recorded with a fingerprint of its call and arguments.
+        A rerun with the same state_file resumes: a step is skipped when it is recorded with the same
+        fingerprint and every step it needs was skipped too (anything downstream of a step that runs
+        again runs again).
+
+    Report:
+        At the end the runner prints every step's status, start offset and wall time, and the critical
+        path: the chain of dependent steps that took longest and so bounds the pipeline's wall time.
+
+    USAGE:
+    pipeline = load_pipeline('gcp_bigquery_demoflow.yaml', project_id='zproject201807', dataset_id='demo_dataset1')
+    report   = pipeline.run(state_file='/tmp/demoflow.json')               # Non-interactive
+    report   = pipeline.run(interactive=True)                              # Asks before steps with a confirm prompt
+
+    pipeline = Pipeline('nightly', params={'dataset_id': 'demo_dataset1'})
+    pipeline.step('create_dataset', bq_create_dataset, kwargs={'dataset_id': '${dataset_id}', 'location': 'US'})
+    pipeline.step('create_table',   bq_create_table_empty, args=('${dataset_id}', 'table_empty'), needs=['create_dataset'])
+    pipeline.run()
+
+    YAML (requires PyYAML; JSON works too):
+        name: demoflow
+        params:
+          dataset_id: demo_dataset1
+        steps:
+          create_dataset:
+            call:   gcp_bigquery_demoflow.bq_create_dataset
+            kwargs: {dataset_id: '${dataset_id}', location: US}
+          create_table_empty:
+            call:   gcp_bigquery_demoflow.bq_create_table_empty
+            kwargs: {dataset_id: '${dataset_id}', table_id: table_empty}
+            needs:  [create_dataset]
+
+'''
+
+
+####################################################################################################
+#
+#   Python Libraries
+#
+####################################################################################################
+
+
+import concurrent.futures
+import hashlib
+import importlib
+import json
+import os
+import re
+import threading
+import time
+
+from gcp_bigquery_telemetry import add_sink, in_span_context, remove_sink, span
+
+
+####################################################################################################
+
+
+
+STEP_KEYS    = ('call', 'args', 'kwargs', 'needs', 'confirm')
+_PLACEHOLDER = re.compile(r'\$\{(\w+)\}')
+
+
+
+
+class Step(object):
+    def __init__(self, name, call, args=(), kwargs=None, needs=(), confirm=None):
+        self.name    = name
+        self.call    = call
+        self.args    = list(args)
+        self.kwargs  = dict(kwargs or {})
+        self.needs   = list(needs)
+        self.confirm = confirm
+
+    def function(self):
+        if callable(self.call):
+            return self.call
+        module_name, _, function_name = self.call.rpartition('.')
+        if not module_name:
+            raise ValueError('Step {}: call must be a function or a dotted path (module.function), got {!r}'.format(self.name, self.call))
+        return getattr(importlib.import_module(module_name), function_name)
+
+    def call_name(self):
+        if callable(self.call):
+            return '{}.{}'.format(getattr(self.call, '__module__', None), getattr(self.call, '__qualname__', repr(self.call)))
+        return self.call
+
+
+
+
+def _substitute(value, params, step_name):
+    '''
+        value with the ${param} placeholders in its strings (also inside lists and dicts) filled from params
+    '''
+    if isinstance(value, str):
+        names = _PLACEHOLDER.findall(value)
+        for name in names:
+            if name not in params:
+                raise ValueError('Step {}: unknown parameter ${{{}}}'.format(step_name, name))
+        if len(names) == 1 and value == '${{{}}}'.format(names[0]):
+            return params[names[0]]
+        return _PLACEHOLDER.sub(lambda match: str(params[match.group(1)]), value)
+    if isinstance(value, (list, tuple)):
+        return [_substitute(item, params, step_name) for item in value]
+    if isinstance(value, dict):
+        return dict((key, _substitute(item, params, step_name)) for key, item in value.items())
+    return value
+
+
+
+
+class _ErrorCollector(object):
+    '''
+        Telemetry sink remembering which spans are nested in which, and which helper spans failed
+    '''
+    def __init__(self):
+        self.parents = {}                   # span_id -> parent span_id
+        self.errors  = []                   # (span_id, span name, error) of failed helper spans
+        self._lock   = threading.Lock()
+
+    def __call__(self, span_dict):
+        with self._lock:
+            self.parents[span_dict['span_id']] = span_dict['parent_id']
+            if span_dict['kind'] == 'helper' and span_dict['status'] == 'error':
+                self.errors.append((span_dict['span_id'], span_dict['name'], span_dict['error']))
+
+    def errors_within(self, span_id):
+        with self._lock:
+            found = []
+            for error_span_id, name, error in self.errors:
+                parent = self.parents.get(error_span_id)
+                while parent is not None and parent != span_id:
+                    parent = self.parents.get(parent)
+                if parent == span_id:
+                    found.append('{}: {}'.format(name, error))
+            return found
+
+
+
+
+class Pipeline(object):
+    '''
+        A graph of steps run concurrently in dependency order, with checkpoints and a critical path report
+
+        USAGE:
+        pipeline = Pipeline('demoflow', params={'dataset_id': 'demo_dataset1'})
+        pipeline.step('create_dataset', 'gcp_bigquery_demoflow.bq_create_dataset', kwargs={'dataset_id': '${dataset_id}', 'location': 'US'})
+        report = pipeline.run(state_file='/tmp/demoflow.json', max_workers=8)
+
+    '''
+    def __init__(self, name='pipeline', params=None):
+        self.name   = name
+        self.params = dict(params or {})
+        self.steps  = {}                    # name -> Step, in the order they were added
+
+    def step(self, name, call, args=(), kwargs=None, needs=(), confirm=None):
+        if name in self.steps:
+            raise ValueError('Step {} is defined twice'.format(name))
+        self.steps[name] = Step(name, call, args, kwargs, needs, confirm)
+        return self.steps[name]
+
+    @classmethod
+    def from_dict(cls, spec, **params):
+        '''
+            Builds a pipeline from {'name', 'params', 'steps': {name: {'call', 'args', 'kwargs', 'needs', 'confirm'}}}
+            (params given here override the params of spec)
+        '''
+        pipeline = cls(spec.get('name', 'pipeline'), dict(spec.get('params') or {}, **params))
+        for name, step in (spec.get('steps') or {}).items():
+            unknown = sorted(set(step) - set(STEP_KEYS))
+            if unknown or 'call' not in step:
+                raise ValueError('Step {}: needs a call and only takes {}, got {}'.format(name, STEP_KEYS, sorted(step)))
+            pipeline.step(name, step['call'], step.get('args') or (), step.get('kwargs'), step.get('needs') or (), step.get('confirm'))
+        return pipeline
+
+    def order(self):
+        '''
+            The step names in an order that runs every step after the steps it needs (raises ValueError on
+            unknown needs and cycles)
+        '''
+        for step in self.steps.values():
+            unknown = [need for need in step.needs if need not in self.steps]
+            if unknown:
+                raise ValueError('Step {} needs unknown step(s) {}'.format(step.name, unknown))
+        order   = []
+        state   = {}                        # name -> 'visiting' / 'done'
+        def visit(name, path):
+            if state.get(name) == 'done':
+                return
+            if state.get(name) == 'visiting':
+                raise ValueError('Steps form a cycle: {}'.format(' -> '.join(path + [name])))
+            state[name] = 'visiting'
+            for need in self.steps[name].needs:
+                visit(need, path + [name])
+            state[name] = 'done'
+            order.append(name)
+        for name in self.steps:
+            visit(name, [])
+        return order
+
+    def _resolved(self, step):
+        args   = _substitute(step.args, self.params, step.name)
+        kwargs = _substitute(step.kwargs, self.params, step.name)
+        key    = json.dumps([step.call_name(), args, kwargs], sort_keys=True, default=repr)
+        return args, kwargs, hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def run(self, state_file=None, max_workers=8, interactive=False, confirm=None, report=True):
+        '''
+            Runs the pipeline, returning
+                {'pipeline', 'elapsed', 'steps': {name: {'status', 'start', 'seconds', 'result', 'error'}},
+                 'critical_path': [names], 'critical_path_seconds', 'done', 'resumed', 'failed', 'skipped', 'declined'}
+
+            status: done, resumed (checkpointed), failed, skipped (a step it needs did not finish), declined
+            interactive=True asks before every step with a confirm prompt (confirm(prompt) -> bool, default:
+            the prompt is shown and y continues); otherwise every step runs.
+        '''
+        order     = self.order()
+        resolved  = dict((name, self._resolved(self.steps[name])) for name in order)
+        confirm   = confirm or (lambda prompt: input('[ INFO ] {} Press y to continue:  '.format(prompt)) == 'y')
+
+        checkpoint = {'pipeline': self.name, 'done': {}}
+        if state_file and os.path.exists(state_file):
+            with open(state_file) as f:
+                checkpoint = json.load(f)
+
+        def save_checkpoint():
+            if state_file:
+                with open(state_file + '.tmp', 'w') as f:
+                    json.dump(checkpoint, f, indent=2, sort_keys=True)
+                os.replace(state_file + '.tmp', state_file)
+
+        steps     = dict((name, {'status': None, 'start': None, 'seconds': 0.0, 'result': None, 'error': None}) for name in order)
+        collector = _ErrorCollector()
+        start     = time.perf_counter()
+
+        def run_step(name):
+            step         = self.steps[name]
+            args, kwargs = resolved[name][:2]
+            started      = time.perf_counter()
+            steps[name]['start'] = started - start
+            try:
+                with span(name, kind='step', pipeline=self.name) as current:
+                    result = step.function()(*args, **kwargs)
+                    errors = collector.errors_within(current.span_id)
+                    if errors:
+                        raise RuntimeError('; '.join(errors))
+                return result
+            finally:
+                steps[name]['seconds'] = time.perf_counter() - started
+
+        add_sink(collector)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                running = {}
+                while True:
+                    for name in order:
+                        if steps[name]['status'] is not None or name in running.values():
+                            continue
+                        needs = [steps[need]['status'] for need in self.steps[name].needs]
+                        if any(status in ('failed', 'skipped', 'declined') for status in needs):
+                            steps[name]['status'] = 'skipped'
+                            continue
+                        if not all(status in ('done', 'resumed') for status in needs):
+                            continue
+                        recorded = checkpoint['done'].get(name)
+                        if recorded and recorded['fingerprint'] == resolved[name][2] and all(status == 'resumed' for status in needs):
+                            steps[name]['status'] = 'resumed'
+                            continue
+                        if interactive and self.steps[name].confirm and not confirm(self.steps[name].confirm):
+                            steps[name]['status'] = 'declined'
+                            continue
+                        running[executor.submit(in_span_context(run_step), name)] = name
+
+                    if not running:
+                        break                   # One pass in dependency order settles every step nothing is waiting on
+
+                    finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in finished:
+                        name = running.pop(future)
+                        try:
+                            steps[name]['result'] = future.result()
+                        except Exception as e:
+                            steps[name]['status'] = 'failed'
+                            steps[name]['error']  = '{}: {}'.format(type(e).__name__, e)
+                            print('[ ERROR] Step {} failed: {}'.format(name, steps[name]['error']))
+                            continue
+                        steps[name]['status'] = 'done'
+                        checkpoint['done'][name] = {'fingerprint': resolved[name][2], 'seconds': steps[name]['seconds'],
+                                                    'finished': time.time()}
+                        save_checkpoint()
+        finally:
+            remove_sink(collector)
+
+        path, path_seconds = critical_path(dict((name, self.steps[name].needs) for name in order),
+                                           dict((name, steps[name]['seconds']) for name in order))
+        results = {'pipeline': self.name, 'elapsed': time.perf_counter() - start, 'steps': steps,
+                   'critical_path': path, 'critical_path_seconds': path_seconds}
+        for status in ('done', 'resumed', 'failed', 'skipped', 'declined'):
+            results[status] = sum(1 for step in steps.values() if step['status'] == status)
+        if report:
+            print_report(results)
+        return results
+
+
+
+
+def critical_path(needs, seconds):
+    '''
+        The longest chain of dependent steps, as ([step names], total seconds)
+
+        needs:   {name: [names of the steps it needs]}
+        seconds: {name: wall time}
+    '''
+    finish = {}
+    via    = {}
+    def visit(name):
+        if name not in finish:
+            previous     = max(needs[name], key=visit, default=None)
+            via[name]    = previous
+            finish[name] = seconds[name] + (finish[previous] if previous is not None else 0.0)
+        return finish[name]
+    for name in needs:
+        visit(name)
+    if not finish:
+        return [], 0.0
+    name = max(finish, key=finish.get)
+    path = []
+    while name is not None:
+        path.append(name)
+        name = via[name]
+    return path[::-1], max(finish.values())
+
+
+
+
+def print_report(results):
+    '''
+        Prints the status and timing of every step of a Pipeline.run() report and its critical path
+    '''
+    steps = results['steps']
+    print('[ INFO ] Pipeline {}: {} steps in {:.2f}s ({} done, {} resumed, {} failed, {} skipped, {} declined)'.format(
+        results['pipeline'], len(steps), results['elapsed'], results['done'], results['resumed'], results['failed'],
+        results['skipped'], results['declined']))
+    print('[ INFO ] {:28} {:9} {:>9} {:>9}  {}'.format('step', 'status', 'start s', 'seconds', 'critical path'))
+    for name in sorted(steps, key=lambda name: (steps[name]['start'] is None, steps[name]['start'] or 0.0)):
+        step = steps[name]
+        print('[ INFO ] {:28} {:9} {:>9} {:9.2f}  {}'.format(
+            name, step['status'], '{:.2f}'.format(step['start']) if step['start'] is not None else '--', step['seconds'],
+            '*' if name in results['critical_path'] else ''))
+    print('[ INFO ] Critical path: {} ({:.2f}s of {:.2f}s wall time)'.format(
+        ' -> '.join(results['critical_path']), results['critical_path_seconds'], results['elapsed']))
+
+
+
+
+def load_pipeline(path_or_text, **params):
+    '''
+        Builds a Pipeline from a YAML (or JSON) file or string, with params overriding the ones it defines
+
+        USAGE:
+        pipeline = load_pipeline('gcp_bigquery_demoflow.yaml', dataset_id='demo_dataset2')
+
+        Requires PyYAML (pip install pyyaml) for YAML; JSON is read without it.
+    '''
+    text = path_or_text
+    if os.path.exists(path_or_text):
+        with open(path_or_text) as f:
+            text = f.read()
+    try:
+        spec = json.loads(text)
+    except ValueError:
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError('Reading YAML pipelines requires PyYAML (pip install pyyaml), or write the pipeline as JSON')
+        spec = yaml.safe_load(text)
+    if not isinstance(spec, dict):
+        raise ValueError('A pipeline is a mapping with name, params and steps, got {}'.format(type(spec).__name__))
+    return Pipeline.from_dict(spec, **params)
+
+
+
+#ZEND
@@ -0,0 +1,470 @@
+####################################################################################################
+#
+#   Google BigQuery - Quota-aware Rate Limiting and Job Reruns
+#
+#   https://cloud.google.com/bigquery/quotas
+#   https://cloud.google.com/bigquery/docs/error-messages
+#
+####################################################################################################
+
+
+
+'''
+NOTES
+
+    BigQuery enforces some of its quotas per resource, not per project:
+        - 5 table metadata updates per table per 10 seconds (tables.patch / tables.update, and every
+          load, copy or query job writing to the table)
+        - 5 dataset metadata updates per dataset per 10 seconds (datasets.patch / datasets.update)
+    plus per-project limits on the rate of API requests (jobs.insert, ...). Fanning out
+    bq_update_table_metadata, bq_copy_table or bq_create_table_from_gcs hits these at once, and
+    retrying every rateLimitExceeded as fast as possible keeps the whole fan-out over the limit.
+
+    Rate limiting:
+        Every REST request of the pooled clients (get_client) takes a token from the buckets of its
+        operation classes before it is sent, each keyed by the resource the limit applies to:
+            table_update        tables.patch / tables.update, jobs with a destinationTable     per table
+            dataset_update      datasets.patch / datasets.update                               per dataset
+            job                 jobs.insert / jobs.query                                       per project
+            api                 any other request (not limited by default)                     per API method
+        jobs.get (polling a running job) is never limited. A bucket refills at RATE_HEADROOM (90%) of its
+        limit (requests / seconds) and holds burst tokens (1 by default, so no window of `seconds` sees more
+        than `requests` even when the requests reach BigQuery a little earlier or later than they were sent).
+        A rateLimitExceeded answer halves the rate of the buckets of that request and pauses them for
+        THROTTLE_PAUSE seconds; every success then adds back 1/20 of the limit. Requests from all threads
+        share the buckets, so a fan-out settles at the quota ceiling (or below it, when other processes use
+        the same quota) instead of thrashing on errors.
+
+        A request waits for its tokens in the thread sending it, except inside without_waiting(): there it
+        raises Throttled (with the seconds to wait) before anything is sent. JobManager starts jobs that
+        way, so a throttled start is deferred instead of stalling the polling thread of every job in flight.
+
+    Retries:
+        Failed requests (bq_update_table_metadata, the dataset update helpers and every other REST call)
+        are retried by the client library only (google.cloud.bigquery.DEFAULT_RETRY: rateLimitExceeded,
+        backendError, internalError, badGateway, ...; plain exponential backoff). This module does not
+        retry requests; it only paces each attempt through the rate limiter.
+
+        RetryPolicy (decorrelated jitter) applies to job reruns only: jobs that fail with a retryable reason
+        after they started (e.g. a copy job running into the table update limit) are rerun by run_job(),
+        which bq_copy_table and bq_create_table_from_gcs use, after
+        delay = min(max_delay, uniform(base_delay, 3 * previous delay)), up to max_retries times:
+            RETRYABLE_REASONS   rateLimitExceeded, backendError, internalError, badGateway
+            RETRYABLE_STATUS    429 and 5xx
+
+    USAGE:
+    set_rate_limits(dict(OPERATION_LIMITS, job=(50, 1.0, 'project')))   # Applies to existing clients too
+    set_rate_limits(None)                                               # No rate limiting
+    set_retry_policy(RetryPolicy(max_retries=10, max_delay=60.0))     # Job reruns of run_job()
+    print(get_rate_limiter().stats)                                     # waits, wait_seconds, throttled, retries (job reruns)
+
+    job = without_waiting(lambda: client.copy_table(source_ref, dest_ref))  # Raises Throttled instead of waiting
+
+    job = run_job(lambda: client.copy_table(source_ref, dest_ref))      # Rerun while it fails with a retryable reason
+
+'''
+
+
+####################################################################################################
+#
+#   Python Libraries
+#
+####################################################################################################
+
+
+import contextvars
+import json
+import random
+import re
+import threading
+import time
+
+from gcp_bigquery_telemetry import api_method
+
+
+####################################################################################################
+
+
+
+# Operation class -> (requests, seconds, scope): at most that many requests per window of seconds per scope
+OPERATION_LIMITS    = {
+    'table_update':   (5,   10.0, 'table'),
+    'dataset_update': (5,   10.0, 'dataset'),
+    'job':            (100, 1.0,  'project'),
+}
+RATE_HEADROOM       = 0.9                     # Buckets refill at this fraction of the limit (request arrival times jitter)
+THROTTLE_PAUSE      = 1.0                     # Seconds a bucket pauses after rateLimitExceeded (the library's first retry delay)
+RETRYABLE_REASONS   = ('rateLimitExceeded', 'backendError', 'internalError', 'badGateway')
+RETRYABLE_STATUS    = (429, 500, 502, 503, 504)
+
+_OPERATIONS = {
+    'tables.patch':    'table_update',
+    'tables.update':   'table_update',
+    'datasets.patch':  'dataset_update',
+    'datasets.update': 'dataset_update',
+    'jobs.insert':     'job',
+    'jobs.query':      'job',
+}
+_RESOURCE   = re.compile(r'/projects/(?P<project>[^/?]+)(?:/datasets/(?P<dataset>[^/?]+)(?:/tables/(?P<table>[^/?]+))?)?')
+_UNLIMITED  = ('jobs.get',)
+_JOB_TYPES  = ('copy', 'load', 'query')
+_no_wait    = contextvars.ContextVar('bq_rate_limit_no_wait', default=False)
+
+
+
+
+class Throttled(Exception):
+    '''
+        Raised instead of waiting for a token by a request sent inside without_waiting()
+    '''
+    def __init__(self, wait, keys):
+        super().__init__('Rate limited for {:.2f}s ({})'.format(wait, ', '.join(str(key) for key in keys)))
+        self.wait = wait
+        self.keys = keys
+
+
+
+
+class TokenBucket(object):
+    '''
+        Hands out requests / seconds tokens per second, at most burst at once
+
+        The rate adapts to the answers: throttled() halves it (down to 1/32 of the limit) and pauses the
+        bucket, succeeded() raises it again by 1/20 of the limit.
+    '''
+    def __init__(self, requests, seconds, burst=1):
+        self.max_rate = requests / float(seconds)
+        self.rate     = self.max_rate
+        self.burst    = burst
+        self.tokens   = float(burst)
+        self.updated  = time.monotonic()
+        self._lock    = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens  = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        '''
+            Takes a token, returning the seconds to wait before using it
+        '''
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+    def wait(self):
+        '''
+            The seconds until a token is available, without taking it
+        '''
+        with self._lock:
+            self._refill(time.monotonic())
+            return max(0.0, (1 - self.tokens) / self.rate)
+
+    def throttled(self, pause=0.0):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate   = max(self.max_rate / 32, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0) - pause * self.rate
+
+    def succeeded(self):
+        if self.rate < self.max_rate:
+            with self._lock:
+                self._refill(time.monotonic())
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+
+
+class RateLimiter(object):
+    '''
+        Token buckets keyed by (operation class, resource), shared by every request of the pooled clients
+
+        USAGE:
+        limiter = RateLimiter(OPERATION_LIMITS)
+        keys    = limiter.keys('PATCH', 'https://bigquery.googleapis.com/bigquery/v2/projects/p/datasets/d/tables/t')
+        limiter.acquire(keys)                   # Sleeps until every bucket of the request has a token
+        limiter.acquire(keys, block=False)      # Raises Throttled instead
+
+    '''
+    def __init__(self, limits=OPERATION_LIMITS, burst=1, headroom=RATE_HEADROOM):
+        self.limits   = dict(limits)
+        self.burst    = burst
+        self.headroom = headroom
+        self.buckets  = {}                      # (operation class, resource) -> TokenBucket
+        self.stats    = {'waits': 0, 'wait_seconds': 0.0, 'throttled': 0, 'retries': 0}
+        self._lock    = threading.Lock()
+
+    def keys(self, method, url, data=None):
+        '''
+            The (operation class, resource) buckets a request draws from
+        '''
+        name     = api_method(method, url)
+        match    = _RESOURCE.search(url)
+        resource = match.groupdict() if match else {}
+        scopes   = {'project': resource.get('project'),
+                    'dataset': '{project}:{dataset}'.format(**resource) if resource.get('dataset') else None,
+                    'table':   '{project}:{dataset}.{table}'.format(**resource) if resource.get('table') else None,
+                    'method':  name}
+
+        if name in _UNLIMITED:
+            return []
+        operation = _OPERATIONS.get(name, 'api')
+        if operation == 'job' and method == 'PUT':
+            operation = 'api'                   # Chunks of a resumable upload, not new jobs
+        keys = []
+        if operation in self.limits:
+            keys.append((operation, scopes[self.limits[operation][2]]))
+        if operation == 'job' and 'table_update' in self.limits:
+            destination = _job_destination(data)
+            if destination is not None:
+                keys.append(('table_update', destination))
+        return keys
+
+    def bucket(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            with self._lock:
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    requests, seconds, _ = self.limits[key[0]]
+                    bucket = self.buckets[key] = TokenBucket(requests * self.headroom, seconds, self.burst)
+        return bucket
+
+    def acquire(self, keys, block=True):
+        '''
+            Waits until the request may be sent, returning the seconds waited
+
+            With block=False takes no token and raises Throttled when the request would have to wait.
+        '''
+        if not block:
+            wait = max([self.bucket(key).wait() for key in keys] or [0.0])
+            if wait > 0:
+                raise Throttled(wait, keys)
+        wait = max([self.bucket(key).reserve() for key in keys] or [0.0])
+        if wait > 0:
+            with self._lock:
+                self.stats['waits']        += 1
+                self.stats['wait_seconds'] += wait
+            time.sleep(wait)
+        return wait
+
+    def throttled(self, keys, pause=0.0):
+        with self._lock:
+            self.stats['throttled'] += 1
+        for key in keys:
+            self.bucket(key).throttled(pause)
+
+    def succeeded(self, keys):
+        for key in keys:
+            self.bucket(key).succeeded()
+
+    def retried(self):
+        with self._lock:
+            self.stats['retries'] += 1
+
+
+
+
+def _job_destination(data):
+    '''
+        'project:dataset.table' of the destinationTable in a jobs.insert body, or None
+    '''
+    if isinstance(data, bytes):
+        data = data.decode('utf-8', 'replace')
+    if not isinstance(data, str) or not data.startswith('{'):
+        return None
+    try:
+        configuration = json.loads(data).get('configuration', {})
+    except ValueError:
+        return None
+    for job_type in _JOB_TYPES:
+        table = configuration.get(job_type, {}).get('destinationTable')
+        if table:
+            return '{}:{}.{}'.format(table.get('projectId'), table.get('datasetId'), table.get('tableId', '').split('$')[0])
+    return None
+
+
+
+
+class RetryPolicy(object):
+    '''
+        Which failed jobs run_job() reruns, how often, and how long to wait in between (decorrelated jitter)
+
+        USAGE:
+        policy = RetryPolicy(max_retries=6, base_delay=0.25, max_delay=32.0)
+        for delay in policy.delays():           # At most max_retries delays
+            ...
+
+    '''
+    def __init__(self, max_retries=6, base_delay=0.25, max_delay=32.0, reasons=RETRYABLE_REASONS,
+                 status_codes=RETRYABLE_STATUS, seed=None):
+        self.max_retries  = max_retries
+        self.base_delay   = base_delay
+        self.max_delay    = max_delay
+        self.reasons      = tuple(reasons)
+        self.status_codes = tuple(status_codes)
+        self._random      = random.Random(seed)
+
+    def delays(self):
+        '''
+            Yields the delays before each retry: min(max_delay, uniform(base_delay, 3 * previous delay))
+        '''
+        delay = self.base_delay
+        for _ in range(self.max_retries):
+            delay = min(self.max_delay, self._random.uniform(self.base_delay, delay * 3))
+            yield delay
+
+    def retryable(self, status=None, reason=None):
+        return reason in self.reasons or status in self.status_codes
+
+    def retryable_error(self, error):
+        '''
+            True for an exception (google.api_core.exceptions.GoogleAPICallError, ...) worth retrying
+        '''
+        errors = getattr(error, 'errors', None) or [{}]
+        return self.retryable(getattr(error, 'code', None), errors[0].get('reason'))
+
+
+
+
+_limiter      = RateLimiter()
+_retry_policy = RetryPolicy()
+
+
+
+
+def set_rate_limits(limits=OPERATION_LIMITS, burst=1, headroom=RATE_HEADROOM):
+    '''
+        Replaces the rate limiter of every pooled client (None turns rate limiting off)
+
+        USAGE:
+        set_rate_limits(dict(OPERATION_LIMITS, api=(100, 1.0, 'method')))
+
+    '''
+    global _limiter
+    _limiter = RateLimiter(limits, burst, headroom) if limits is not None else None
+    return _limiter
+
+
+
+
+def get_rate_limiter():
+    return _limiter
+
+
+
+
+def set_retry_policy(policy=None):
+    '''
+        Replaces the retry policy of run_job() (None turns job reruns off)
+
+        USAGE:
+        set_retry_policy(RetryPolicy(max_retries=10))
+
+    '''
+    global _retry_policy
+    _retry_policy = policy
+    return policy
+
+
+
+
+def get_retry_policy():
+    return _retry_policy
+
+
+
+
+def _error_reason(response):
+    try:
+        return response.json()['error']['errors'][0].get('reason')
+    except Exception:
+        return None
+
+
+
+
+def limit_session(session):
+    '''
+        Rate limits every request sent through session (the requests.Session of a bigquery.Client)
+
+        get_client() applies it to the clients it creates. Applying it twice does nothing.
+    '''
+    if getattr(session, '_quota_limited', False):
+        return session
+    send = session.request
+
+    def request(*args, **kwargs):
+        limiter = _limiter
+        if limiter is None:
+            return send(*args, **kwargs)
+        method = kwargs.get('method', args[0] if args else '')
+        url    = kwargs.get('url', args[1] if len(args) > 1 else '')
+        data   = kwargs.get('data', args[2] if len(args) > 2 else None)
+        keys   = limiter.keys(method, url, data)
+        if not keys:
+            return send(*args, **kwargs)
+        limiter.acquire(keys, block=not _no_wait.get())
+        response = send(*args, **kwargs)
+        if response.status_code < 400:
+            limiter.succeeded(keys)
+        elif response.status_code == 429 or _error_reason(response) == 'rateLimitExceeded':
+            limiter.throttled(keys, THROTTLE_PAUSE)
+        return response
+
+    session.request = request
+    session._quota_limited = True
+    return session
+
+
+
+
+def without_waiting(fn, *args, **kwargs):
+    '''
+        Calls fn(*args, **kwargs) with rate limited requests raising Throttled instead of waiting for a token
+
+        USAGE:
+        try:
+            job = without_waiting(start_job)
+        except Throttled as e:
+            ...                                 # Try again in e.wait seconds
+
+    '''
+    token = _no_wait.set(True)
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _no_wait.reset(token)
+
+
+
+
+def run_job(start_job, policy=None, timeout=None):
+    '''
+        Starts a job with start_job() and waits for it, starting it again while it fails with a retryable reason
+
+        USAGE:
+        job = run_job(lambda: client.copy_table(source_ref, dest_ref, location='US'))
+
+        Returns the finished job, or raises the error of the last attempt.
+    '''
+    policy = policy or _retry_policy
+    delays = policy.delays() if policy is not None else iter(())
+    while True:
+        job = start_job()
+        try:
+            job.result(timeout=timeout)
+            return job
+        except Exception as e:
+            delay = next(delays, None) if policy is not None and policy.retryable_error(e) else None
+            if delay is None:
+                raise
+            if _limiter is not None:
+                _limiter.retried()
+            print('[ WARN ] Job {} failed ({}), starting it again in {:.1f}s'.format(job.job_id, e, delay))
+            time.sleep(delay)
+
+
+
+#ZEND
@@ -0,0 +1,333 @@
+####################################################################################################
+#
+#   Google BigQuery - Parallel Table Reads with the Storage Read API
+#
+#   https://cloud.google.com/bigquery/docs/reference/storage
+#   https://cloud.google.com/bigquery/docs/reference/storage/rpc/google.cloud.bigquery.storage.v1
+#
+####################################################################################################
+
+
+
+'''
+NOTES
+
+    Rows fetched through tabledata.list / getQueryResults (bq_query, list_rows) come back as JSON pages,
+    one request at a time, and every cell is parsed in Python. The Storage Read API streams the table
+    over gRPC instead, in Arrow record batches, and splits it into several streams that can be read at once.
+
+    Read session (create_read_session):
+        columns=            Column projection: only these columns are sent (selected_fields)
+        row_filter=         Row filter applied by the server before sending (row_restriction), a SQL
+                            predicate on the table's columns, e.g. "state = 'CA' AND loan_amnt > 10000"
+        max_streams=        Streams requested; the server may create fewer (small tables get one)
+        compression=        'LZ4_FRAME' compresses the Arrow buffers on the wire (decompressed by pyarrow)
+
+    Reading:
+        iter_batches()      Yields pyarrow.RecordBatch from max_workers threads, one stream each at a time,
+                            through a queue of at most max_pending batches (batches of different streams
+                            interleave). gRPC and Arrow decoding release the GIL, so the threads overlap.
+        read_table()        The whole table (or the filtered / projected part) as one pyarrow.Table
+        read_query()        Runs a query and reads its result table the same way
+        map_batches(fn)     Reads the streams in worker processes and returns fn(batch) for every batch,
+                            for CPU-heavy per-batch work that the GIL would serialize in threads
+
+    Record batches are decoded without copying: pyarrow.ipc.read_record_batch() points the Arrow buffers
+    into the bytes of the gRPC response. A stream that breaks off is resumed from the last row offset
+    by the client library.
+
+    Requires google-cloud-bigquery-storage and pyarrow. Reading uses the BigQuery Storage API (billed per
+    byte read) and the bigquery.readsessions.create permission on the project.
+
+    USAGE:
+    table = read_table('demo_dataset1.table_loans', columns=['member_id', 'loan_amnt'], row_filter="state = 'CA'")
+    for batch in iter_batches('demo_dataset1.table_loans', max_streams=16):
+        print(batch.num_rows)
+    table = read_query('select * from `demo_dataset1.table_loans` where grade = "A"')
+
+'''
+
+
+####################################################################################################
+#
+#   Python Libraries
+#
+####################################################################################################
+
+
+import threading
+
+import gcp_bigquery_clients
+from gcp_bigquery_clients import get_client, get_read_client
+from gcp_bigquery_telemetry import in_span_context, instrument, record_stats
+
+
+####################################################################################################
+
+
+
+READ_MAX_STREAMS   = 8                  # Streams requested per read session
+READ_MAX_PENDING   = 16                 # Decoded record batches held for the consumer before the readers wait
+READ_COMPRESSIONS  = ('LZ4_FRAME', 'ZSTD')
+
+
+
+
+def _table_path(table, project=None):
+    '''
+        'projects/p/datasets/d/tables/t' of a 'dataset.table' / 'project.dataset.table' / TableReference / Table
+    '''
+    if isinstance(table, str):
+        parts = table.replace(':', '.').split('.')
+        if len(parts) == 2:
+            parts = [project or get_client().project] + parts
+        if len(parts) != 3:
+            raise ValueError("Expected 'dataset.table' or 'project.dataset.table', got {!r}".format(table))
+        project_id, dataset_id, table_id = parts
+    else:
+        project_id, dataset_id, table_id = table.project, table.dataset_id, table.table_id
+    return 'projects/{}/datasets/{}/tables/{}'.format(project_id, dataset_id, table_id.split('$')[0])
+
+
+
+
+def create_read_session(table, columns=None, row_filter=None, max_streams=READ_MAX_STREAMS, compression=None,
+                        project=None, read_client=None):
+    '''
+        Opens an Arrow read session on table with up to max_streams streams
+
+        USAGE:
+        session = create_read_session('demo_dataset1.table_loans', columns=['member_id'], row_filter='loan_amnt > 10000')
+        print(len(session.streams), session.estimated_row_count)
+
+        project is the project billed for the read (default: the client's project).
+    '''
+    from google.cloud.bigquery_storage_v1 import types
+
+    if compression and compression.upper() not in READ_COMPRESSIONS:
+        raise ValueError('compression must be one of {}, got {!r}'.format(READ_COMPRESSIONS, compression))
+
+    project     = project or get_client().project
+    read_client = read_client or get_read_client()
+    options     = types.ReadSession.TableReadOptions(selected_fields=list(columns or []), row_restriction=row_filter or '')
+    if compression:
+        options.arrow_serialization_options.buffer_compression = types.ArrowSerializationOptions.CompressionCodec[compression.upper()]
+
+    requested = types.ReadSession(table=_table_path(table, project), data_format=types.DataFormat.ARROW, read_options=options)
+    return read_client.create_read_session(parent='projects/{}'.format(project), read_session=requested,
+                                           max_stream_count=max_streams)
+
+
+
+
+def session_schema(session):
+    '''
+        The pyarrow.Schema of a read session
+    '''
+    import pyarrow
+    return pyarrow.ipc.read_schema(pyarrow.py_buffer(session.arrow_schema.serialized_schema))
+
+
+
+
+def iter_stream(stream_name, schema, read_client=None):
+    '''
+        Yields the pyarrow.RecordBatch of one read stream, decoded without copying the response bytes
+    '''
+    import pyarrow
+    from google.cloud.bigquery_storage_v1 import types
+
+    read_client = read_client or get_read_client()
+    for response in read_client.read_rows(stream_name):
+        message = types.ReadRowsResponse.pb(response)
+        if message.row_count:
+            yield pyarrow.ipc.read_record_batch(pyarrow.py_buffer(message.arrow_record_batch.serialized_record_batch), schema)
+
+
+
+
+def iter_batches(table=None, columns=None, row_filter=None, max_streams=READ_MAX_STREAMS, max_workers=None,
+                 max_pending=READ_MAX_PENDING, compression=None, project=None, read_client=None, session=None):
+    '''
+        Yields the pyarrow.RecordBatch of table, reading max_workers streams at once
+
+        USAGE:
+        for batch in iter_batches('demo_dataset1.table_loans', columns=['loan_amnt'], max_streams=16):
+            total += pyarrow.compute.sum(batch.column(0)).as_py()
+
+        max_workers defaults to one thread per stream. Pass session= to read an existing read session.
+        Closing the generator early (break) stops the readers; an error of any stream is raised by the generator.
+    '''
+    import queue
+
+    read_client = read_client or get_read_client()
+    session     = session or create_read_session(table, columns, row_filter, max_streams, compression, project, read_client)
+    schema      = session_schema(session)
+    streams     = iter([stream.name for stream in session.streams])
+    workers     = max(1, min(max_workers or len(session.streams), len(session.streams)))
+    if not session.streams:
+        return
+
+    batches = queue.Queue(maxsize=max(1, max_pending))
+    stop    = threading.Event()
+    lock    = threading.Lock()
+    done    = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def work():
+        try:
+            while not stop.is_set():
+                with lock:
+                    stream_name = next(streams, None)
+                if stream_name is None:
+                    break
+                for batch in iter_stream(stream_name, schema, read_client):
+                    if not put(batch):
+                        return
+        except BaseException as e:
+            put(e)
+        finally:
+            put(done)
+
+    threads = [threading.Thread(target=in_span_context(work), name='bq-read-{}'.format(i), daemon=True) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        running = len(threads)
+        while running:
+            item = batches.get()
+            if item is done:
+                running -= 1
+            elif isinstance(item, BaseException):
+                raise item
+            else:
+                yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+
+
+@instrument
+def read_table(table, columns=None, row_filter=None, max_streams=READ_MAX_STREAMS, max_workers=None,
+               compression=None, project=None, read_client=None):
+    '''
+        Reads table (projected / filtered) into one pyarrow.Table through max_streams parallel streams
+
+        USAGE:
+        table = read_table('demo_dataset1.table_loans', columns=['member_id', 'loan_amnt'], row_filter="grade = 'A'")
+        df    = table.to_pandas()
+
+        Rows of different streams are not returned in table order.
+    '''
+    import pyarrow
+
+    read_client = read_client or get_read_client()
+    session     = create_read_session(table, columns, row_filter, max_streams, compression, project, read_client)
+    batches     = list(iter_batches(max_workers=max_workers, read_client=read_client, session=session))
+    record_stats(rows=sum(batch.num_rows for batch in batches), streams=len(session.streams))
+    return pyarrow.Table.from_batches(batches, schema=session_schema(session))
+
+
+
+
+def _query_destination(query, location, query_parameters):
+    from google.cloud import bigquery
+
+    job_config = bigquery.QueryJobConfig(query_parameters=query_parameters or [])
+    query_job  = get_client().query(query, location=location, job_config=job_config)
+    query_job.result()
+    return query_job.destination
+
+
+
+
+@instrument
+def read_query(query, location='US', query_parameters=None, max_streams=READ_MAX_STREAMS, max_workers=None,
+               compression=None, read_client=None):
+    '''
+        Runs query and reads its result into one pyarrow.Table through the Storage Read API
+
+        USAGE:
+        table = read_query('select member_id, loan_amnt from `demo_dataset1.table_loans` where grade = "A"')
+
+        The result is read from the job's destination table (the anonymous cached-result table unless the
+        query writes to a table), so the query's own ORDER BY is not kept across streams.
+    '''
+    return read_table(_query_destination(query, location, query_parameters), max_streams=max_streams,
+                      max_workers=max_workers, compression=compression, read_client=read_client)
+
+
+
+
+def iter_query_batches(query, location='US', query_parameters=None, max_streams=READ_MAX_STREAMS, max_workers=None,
+                       max_pending=READ_MAX_PENDING, compression=None, read_client=None):
+    '''
+        Runs query and yields the pyarrow.RecordBatch of its result (see iter_batches)
+    '''
+    return iter_batches(_query_destination(query, location, query_parameters), max_streams=max_streams,
+                        max_workers=max_workers, max_pending=max_pending, compression=compression, read_client=read_client)
+
+
+
+
+def _init_map_worker(read_client_factory):
+    if read_client_factory is not None:
+        gcp_bigquery_clients.set_read_client_factory(read_client_factory)
+
+
+
+
+def _map_stream(fn, stream_name, serialized_schema):
+    import pyarrow
+    schema = pyarrow.ipc.read_schema(pyarrow.py_buffer(serialized_schema))
+    return [fn(batch) for batch in iter_stream(stream_name, schema)]
+
+
+
+
+def map_batches(fn, table, columns=None, row_filter=None, max_streams=READ_MAX_STREAMS, processes=None,
+                compression=None, project=None, read_client=None):
+    '''
+        Applies fn to every record batch of table in worker processes (one stream at a time per process)
+        and returns the results, stream by stream
+
+        USAGE:
+        def total_amount(batch):
+            return pyarrow.compute.sum(batch.column('loan_amnt')).as_py()
+        total = sum(map_batches(total_amount, 'demo_dataset1.table_loans', columns=['loan_amnt'], processes=8))
+
+        fn must be picklable (a module-level function), and so must the read client factory set with
+        gcp_bigquery_clients.set_read_client_factory(): each process builds its own client from it.
+        Processes are started with 'spawn' (a forked gRPC channel is not safe to use).
+    '''
+    import concurrent.futures
+    import multiprocessing
+
+    session = create_read_session(table, columns, row_filter, max_streams, compression, project, read_client)
+    if not session.streams:
+        return []
+
+    schema  = session.arrow_schema.serialized_schema
+    workers = max(1, min(processes or multiprocessing.cpu_count(), len(session.streams)))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=_init_map_worker,
+                                                initargs=(gcp_bigquery_clients._read_client_factory,)) as executor:
+        futures = [executor.submit(_map_stream, fn, stream.name, schema) for stream in session.streams]
+        return [result for future in futures for result in future.result()]
+
+
+
+
+#ZEND
@@ -0,0 +1,313 @@
+####################################################################################################
+#
+#   Google BigQuery - Query Scheduler (priority classes, single-flight, deadlines)
+#
+#   https://cloud.google.com/bigquery/docs/running-queries#batch
+#   https://cloud.google.com/bigquery/quotas#query_jobs
+#
+####################################################################################################
+
+
+
+'''
+NOTES
+
+    BigQuery runs a query with one of two priorities:
+        INTERACTIVE     Starts as soon as possible and counts against the project's limit of concurrent
+                        interactive queries (queries beyond it fail with rateLimitExceeded or queue)
+        BATCH           Queued by BigQuery and started when idle slots are available; does not count
+                        against the concurrent interactive query limit
+    bq_query() submits INTERACTIVE queries by default, so a backfill of hundreds of queries competes with
+    user-facing queries for the same limit.
+
+    QueryScheduler keeps one queue per priority class, each with its own number of queries in flight
+    (a JobManager per class, see gcp_bigquery_jobs.py):
+        - submit() returns a Future resolving to the job statistics ({'job', 'job_id', 'queued_seconds',
+          'wall_seconds', 'total_bytes_processed', ...}); stats['job'].result() fetches the rows
+        - Single-flight: a query identical to one still queued or running in the same class (same SQL,
+          location and job configuration) joins that job instead of starting another one. Only deterministic
+          read-only queries are merged (gcp_bigquery_cache.cacheable(), no destination table): DML, DDL,
+          scripts and queries calling CURRENT_TIMESTAMP(), RAND(), ... always run on their own
+        - Deadlines: timeout= (seconds) or deadline= (time.time() based) fail the Future with
+          concurrent.futures.TimeoutError once passed
+        - Cancellation: future.cancel() (or cancel_all()) drops the submission
+        A queued or running job is cancelled (in BigQuery too) once every submission sharing it has been
+        cancelled or has timed out.
+
+    metrics() reports per class: submitted, merged (single-flight), completed, failed, cancelled,
+    timed_out, queued, in_flight, queue wait and run time (mean / p50 / p95 / max, seconds) and
+    throughput (completed queries per second since the first submission).
+
+    USAGE:
+    scheduler = QueryScheduler(max_in_flight={'INTERACTIVE': 20, 'BATCH': 5})
+    future    = scheduler.submit('select count(*) from `demo_dataset1.table_loans`', timeout=30)
+    backfill  = [scheduler.submit(sql, priority='BATCH') for sql in backfill_queries]
+    rows      = list(future.result()['job'].result())
+    print(scheduler.metrics()['BATCH'])
+    scheduler.shutdown()
+
+    bq_query(sql, priority='BATCH', scheduler=scheduler)      # The same through bq_query (returns the Future)
+
+'''
+
+
+####################################################################################################
+#
+#   Python Libraries
+#
+####################################################################################################
+
+
+import concurrent.futures
+import copy
+import heapq
+import itertools
+import json
+import re
+import threading
+import time
+
+from gcp_bigquery_clients import get_client
+from gcp_bigquery_jobs import JobManager
+
+
+####################################################################################################
+
+
+
+PRIORITIES            = ('INTERACTIVE', 'BATCH')
+DEFAULT_MAX_IN_FLIGHT = {'INTERACTIVE': 50,         # Well under the per-project concurrent interactive query limit
+                         'BATCH':       10}
+METRICS_SAMPLES       = 10000                       # Queue wait / run time samples kept per class for the percentiles
+
+
+
+
+class _SharedQuery(object):
+    '''
+        One query job and the submissions (Futures) waiting for it
+    '''
+    def __init__(self, key, priority):
+        self.key         = key
+        self.priority    = priority
+        self.subscribers = set()
+        self.job_future  = None
+
+
+
+
+def _summary(samples):
+    if not samples:
+        return {'mean': None, 'p50': None, 'p95': None, 'max': None}
+    ordered = sorted(samples)
+    return {'mean': sum(ordered) / len(ordered),
+            'p50':  ordered[int(0.50 * (len(ordered) - 1))],
+            'p95':  ordered[int(0.95 * (len(ordered) - 1))],
+            'max':  ordered[-1]}
+
+
+
+
+class QueryScheduler(object):
+    '''
+        Runs queries in priority classes (INTERACTIVE / BATCH), each with its own limit of queries in flight
+
+        USAGE:
+        with QueryScheduler(max_in_flight={'INTERACTIVE': 20, 'BATCH': 5}) as scheduler:
+            futures = [scheduler.submit(sql, priority='BATCH') for sql in backfill_queries]
+
+        Input(s):   max_in_flight:      {priority: queries running at once} (DEFAULT_MAX_IN_FLIGHT for the rest)
+                    single_flight:      Merge identical read-only queries queued or running in the same class
+                    client:             bigquery.Client (default: get_client())
+                    job_manager_options Passed to each JobManager (initial_poll_interval, max_poll_interval, ...)
+
+    '''
+    def __init__(self, max_in_flight=None, single_flight=True, client=None, **job_manager_options):
+        limits = dict(DEFAULT_MAX_IN_FLIGHT, **(max_in_flight or {}))
+        unknown = sorted(set(limits) - set(PRIORITIES))
+        if unknown:
+            raise ValueError('priority must be one of {}, got {}'.format(PRIORITIES, unknown))
+        self.single_flight = single_flight
+        self.client        = client
+        self._managers     = dict((priority, JobManager(max_in_flight=limits[priority], **job_manager_options))
+                                  for priority in PRIORITIES)
+        self._shared       = {}                     # single-flight key -> _SharedQuery
+        self._live         = set()                  # Every _SharedQuery not finished yet (merged or not)
+        self._deadlines    = []                     # heap of (deadline, sequence number, Future)
+        self._sequence     = itertools.count()
+        self._condition    = threading.Condition()
+        self._watchdog     = None
+        self._closed       = False
+        self._started      = None
+        self._metrics      = dict((priority, {'submitted': 0, 'merged': 0, 'completed': 0, 'failed': 0,
+                                              'cancelled': 0, 'timed_out': 0, 'queue_wait': [], 'run': [],
+                                              'last_finished': None})
+                                  for priority in PRIORITIES)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown(wait=True)
+
+    def _key(self, query, location, job_config):
+        configuration = job_config.to_api_repr() if job_config is not None else {}
+        return (re.sub(r'\s+', ' ', query.strip()), location, json.dumps(configuration, sort_keys=True, default=str))
+
+    def submit(self, query, priority='INTERACTIVE', location='US', job_config=None, timeout=None, deadline=None, label=None):
+        '''
+            Queues a query in its priority class and returns a Future resolving to the job statistics
+
+            timeout / deadline:     Seconds from now / time.time() at which the Future fails with
+                                    concurrent.futures.TimeoutError if the query has not finished
+            job_config:             bigquery.QueryJobConfig (its priority is set from priority)
+            priority:               'INTERACTIVE' (default, also for None) or 'BATCH'
+        '''
+        from google.cloud import bigquery
+        from gcp_bigquery_cache import cacheable
+
+        priority = (priority or 'INTERACTIVE').upper()
+        if priority not in PRIORITIES:
+            raise ValueError('priority must be one of {}, got {!r}'.format(PRIORITIES, priority))
+        if timeout is not None:
+            deadline = min(deadline, time.time() + timeout) if deadline is not None else time.time() + timeout
+
+        config          = copy.deepcopy(job_config) if job_config is not None else bigquery.QueryJobConfig()
+        config.priority = priority
+        client          = self.client or get_client()
+        key             = self._key(query, location, config)
+        future          = concurrent.futures.Future()
+        single_flight   = self.single_flight and config.destination is None and cacheable(query)
+
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('cannot submit queries after shutdown()')
+            self._started = self._started or time.time()
+            metrics = self._metrics[priority]
+            metrics['submitted'] += 1
+            shared = self._shared.get(key) if single_flight else None
+            if shared is None:
+                shared = _SharedQuery(key, priority)
+                self._live.add(shared)
+                if single_flight:
+                    self._shared[key] = shared
+                shared.job_future = self._managers[priority].submit(
+                    lambda: client.query(query, location=location, job_config=config),
+                    label=label or '{} query'.format(priority.lower()))
+                shared.job_future.add_done_callback(lambda job_future, shared=shared: self._job_done(shared, job_future))
+            else:
+                metrics['merged'] += 1
+            shared.subscribers.add(future)
+            if deadline is not None:
+                heapq.heappush(self._deadlines, (deadline, next(self._sequence), future))
+                if self._watchdog is None:
+                    self._watchdog = threading.Thread(target=self._watch_deadlines, name='bq-query-deadlines', daemon=True)
+                    self._watchdog.start()
+                self._condition.notify()
+
+        future.add_done_callback(lambda _: self._detach(shared, future))
+        return future
+
+    def _job_done(self, shared, job_future):
+        with self._condition:
+            self._live.discard(shared)
+            if self._shared.get(shared.key) is shared:
+                del self._shared[shared.key]
+            subscribers = list(shared.subscribers)
+            if job_future.cancelled() or isinstance(job_future.exception(), concurrent.futures.CancelledError):
+                return                                          # Every submission was dropped already
+            metrics = self._metrics[shared.priority]
+            error   = job_future.exception()
+            stats   = getattr(error, 'job_statistics', None) if error is not None else job_future.result()
+            metrics['failed' if error is not None else 'completed'] += 1
+            metrics['last_finished'] = time.time()
+            if stats:
+                for name, value in (('queue_wait', stats['queued_seconds']), ('run', stats['wall_seconds'])):
+                    metrics[name].append(value)
+                    del metrics[name][:-METRICS_SAMPLES]
+
+        for future in subscribers:
+            try:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(dict(stats, subscribers=len(subscribers)))
+            except concurrent.futures.InvalidStateError:
+                pass                                            # Cancelled or timed out meanwhile
+
+    def _detach(self, shared, future):
+        '''
+            Drops a finished, cancelled or timed out submission; cancels the job once nobody waits for it
+        '''
+        with self._condition:
+            shared.subscribers.discard(future)
+            if future.cancelled():
+                self._metrics[shared.priority]['cancelled'] += 1
+            elif isinstance(future.exception(), concurrent.futures.TimeoutError):
+                self._metrics[shared.priority]['timed_out'] += 1
+            if shared.subscribers or shared.job_future.done():
+                return
+            self._live.discard(shared)
+            if self._shared.get(shared.key) is shared:
+                del self._shared[shared.key]
+        self._managers[shared.priority].cancel(shared.job_future)
+
+    def _watch_deadlines(self):
+        with self._condition:
+            while True:
+                while self._deadlines and (self._deadlines[0][2].done() or self._deadlines[0][0] <= time.time()):
+                    deadline, _, future = heapq.heappop(self._deadlines)
+                    if not future.done():
+                        self._condition.release()   # set_exception runs the done callbacks (_detach takes the lock)
+                        try:
+                            future.set_exception(concurrent.futures.TimeoutError(
+                                'Query did not finish by its deadline ({:.1f}s ago)'.format(time.time() - deadline)))
+                        except concurrent.futures.InvalidStateError:
+                            pass
+                        finally:
+                            self._condition.acquire()
+                if self._closed and not self._deadlines:
+                    return
+                self._condition.wait(self._deadlines[0][0] - time.time() if self._deadlines else None)
+
+    def cancel_all(self, priority=None):
+        '''
+            Cancels every submission not finished yet (of one priority class, or all); returns how many
+        '''
+        with self._condition:
+            futures = [future for shared in list(self._live) if priority in (None, shared.priority)
+                       for future in shared.subscribers]
+        return sum(1 for future in futures if future.cancel())
+
+    def metrics(self):
+        '''
+            {priority: {'submitted', 'merged', 'completed', 'failed', 'cancelled', 'timed_out', 'queued', 'in_flight',
+                        'queue_wait': {'mean', 'p50', 'p95', 'max'}, 'run': {...}, 'throughput_per_sec'}}
+        '''
+        results = {}
+        with self._condition:
+            for priority, metrics in self._metrics.items():
+                finished = metrics['last_finished']
+                elapsed  = finished - self._started if finished and self._started else None
+                results[priority] = dict((name, metrics[name]) for name in
+                                         ('submitted', 'merged', 'completed', 'failed', 'cancelled', 'timed_out'))
+                results[priority].update({'queued':             self._managers[priority].pending(),
+                                          'in_flight':          self._managers[priority].in_flight(),
+                                          'queue_wait':         _summary(metrics['queue_wait']),
+                                          'run':                _summary(metrics['run']),
+                                          'throughput_per_sec': metrics['completed'] / elapsed if elapsed else None})
+        return results
+
+    def shutdown(self, wait=True):
+        '''
+            Stops accepting queries; with wait=True blocks until every submitted query has finished
+        '''
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        for manager in self._managers.values():
+            manager.shutdown(wait=wait)
+
+
+
+#ZEND
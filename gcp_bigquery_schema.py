@@ -0,0 +1,431 @@
+####################################################################################################
+#
+#   Google BigQuery - Schema Inference and Local Schema Registry
+#
+#   https://cloud.google.com/bigquery/docs/schemas
+#
+####################################################################################################
+
+
+
+'''
+NOTES
+
+    Loading with autodetect makes BigQuery scan a sample of every load's files again, and shards of
+    the same feed can come out with different schemas (a column that happens to hold only integers
+    in one shard becomes INTEGER there and FLOAT in the next).
+
+    infer_schema() infers the schema once, locally, from a sample of a CSV file:
+        - The sample (sample_rows rows) is read into a NumPy string array and each column is typed with
+          a handful of vectorized conversions (no per-cell Python)
+        - A column gets the narrowest type that fits every non-empty value in the sample; types widen
+          INTEGER -> FLOAT -> STRING, DATE -> TIMESTAMP -> STRING and BOOLEAN -> STRING
+        - For Cloud Storage sources (infer_gcs_schema) the start of several files spread over the shard list
+          is sampled and the schemas are merged with the same widening, so every shard fits
+        - Every inferred column is NULLABLE
+
+    SchemaRegistry persists schemas as JSON keyed by source pattern (e.g. 'gs://zdatasets1/loans/*.csv'),
+    so the first load infers and registers the schema and every later load and table creation reuses it.
+    Schemas defined in this module (BUILTIN_SCHEMAS) are always available.
+
+    USAGE:
+    registry = get_registry()
+    schema   = registry.resolve('gs://zdatasets1/loans/*.csv', infer=lambda: infer_gcs_schema('gs://zdatasets1/loans/*.csv'))
+    bq_create_table_empty('demo_dataset1', 'table_loans', schema='gs://zdatasets1/loan_200k.csv')
+
+'''
+
+
+####################################################################################################
+#
+#   Python Libraries
+#
+####################################################################################################
+
+
+import csv
+import datetime
+import json
+import os
+import re
+import threading
+
+import numpy
+from google.cloud import bigquery
+
+
+####################################################################################################
+
+
+
+DEFAULT_REGISTRY_PATH = os.path.join(os.path.expanduser('~'), '.gcp_bigquery', 'schemas.json')
+DEFAULT_SAMPLE_ROWS   = 10000
+DEFAULT_SAMPLE_BYTES  = 4 * 1024 * 1024
+
+
+# Schema of gs://zdatasets1/loan_200k.csv
+LOAN_SCHEMA = [
+    bigquery.SchemaField('id',                'STRING',   mode='REQUIRED'),
+    bigquery.SchemaField('member_id',         'STRING',   mode='REQUIRED'),
+    bigquery.SchemaField('loan_amnt',         'INTEGER',  mode='NULLABLE'),
+    bigquery.SchemaField('term_in_months',    'INTEGER',  mode='NULLABLE'),
+    bigquery.SchemaField('interest_rate',     'FLOAT',    mode='NULLABLE'),
+    bigquery.SchemaField('payment',           'FLOAT',    mode='NULLABLE'),
+    bigquery.SchemaField('grade',             'STRING',   mode='NULLABLE'),
+    bigquery.SchemaField('sub_grade',         'STRING',   mode='NULLABLE'),
+    bigquery.SchemaField('employment_length', 'INTEGER',  mode='NULLABLE'),
+    bigquery.SchemaField('home_owner',        'INTEGER',  mode='NULLABLE'),
+    bigquery.SchemaField('income',            'INTEGER',  mode='NULLABLE'),
+    bigquery.SchemaField('verified',          'INTEGER',  mode='NULLABLE'),
+    bigquery.SchemaField('default',           'INTEGER',  mode='NULLABLE'),
+    bigquery.SchemaField('purpose',           'STRING',   mode='NULLABLE'),
+    bigquery.SchemaField('zip_code',          'STRING',   mode='NULLABLE'),
+    bigquery.SchemaField('addr_state',        'STRING',   mode='NULLABLE'),
+    bigquery.SchemaField('open_accts',        'INTEGER',  mode='NULLABLE'),
+    bigquery.SchemaField('credit_debt',       'INTEGER',  mode='NULLABLE'),
+]
+
+BUILTIN_SCHEMAS = {
+    'gs://zdatasets1/loan_200k.csv': LOAN_SCHEMA,
+}
+
+
+_TIMEZONE_SUFFIX = re.compile(r'(Z| UTC|\+00:00|\+00)$')
+
+
+
+
+####################################################################################################
+#
+#   Inference
+#
+####################################################################################################
+
+
+
+def widen_type(a, b):
+    '''
+        Returns the narrowest BigQuery type that can hold values of both type a and type b
+    '''
+    if a == b:
+        return a
+    if {a, b} == {'INTEGER', 'FLOAT'}:
+        return 'FLOAT'
+    if {a, b} == {'DATE', 'TIMESTAMP'}:
+        return 'TIMESTAMP'
+    return 'STRING'
+
+
+
+
+def merge_schemas(*schemas):
+    '''
+        Merges schemas column by column (by name, in first-seen order), widening types that differ
+
+        A column missing from some of the schemas, or NULLABLE in any, is NULLABLE.
+    '''
+    merged = {}
+    for schema in schemas:
+        for field in schema:
+            if field.name not in merged:
+                merged[field.name] = [field.field_type, field.mode, 0]
+            else:
+                merged[field.name][0] = widen_type(merged[field.name][0], field.field_type)
+                if field.mode != 'REQUIRED':
+                    merged[field.name][1] = field.mode
+            merged[field.name][2] += 1
+    return [bigquery.SchemaField(name, field_type, mode=mode if count == len(schemas) else 'NULLABLE')
+            for name, (field_type, mode, count) in merged.items()]
+
+
+
+
+def _converts(values, dtype):
+    try:
+        values.astype(dtype)
+        return True
+    except (ValueError, OverflowError, TypeError):
+        return False
+
+
+
+
+def _infer_column_type(values):
+    '''
+        Types one sample column (NumPy array of str) with vectorized conversions, narrowest first
+    '''
+    present = values[values != '']
+    if present.size == 0:
+        return 'STRING'
+
+    if numpy.isin(numpy.char.lower(present), ('true', 'false')).all():
+        return 'BOOLEAN'
+    if _converts(present, numpy.int64):
+        return 'INTEGER'
+    if _converts(present, numpy.float64):
+        return 'FLOAT'
+
+    if (numpy.char.str_len(present) == 10).all() and _converts(present, 'datetime64[D]'):
+        return 'DATE'
+    timestamps = numpy.array([_TIMEZONE_SUFFIX.sub('', value) for value in numpy.unique(present)])
+    if (numpy.char.str_len(timestamps) >= 16).all() and _converts(numpy.char.replace(timestamps, ' ', 'T'), 'datetime64[us]'):
+        return 'TIMESTAMP'
+    return 'STRING'
+
+
+
+
+def _column_name(name, i):
+    name = re.sub(r'[^A-Za-z0-9_]', '_', name.strip()) or 'string_field_{}'.format(i)
+    return '_' + name if name[0].isdigit() else name
+
+
+
+
+def _file_lines(path):
+    with open(path, newline='') as f:
+        for line in f:
+            yield line
+
+
+
+
+def _sample_lines(sample):
+    if callable(sample):
+        sample = sample()
+    if isinstance(sample, str):
+        return _file_lines(sample) if os.path.exists(sample) else sample.splitlines()
+    return sample
+
+
+
+
+def infer_schema(sample, sample_rows=DEFAULT_SAMPLE_ROWS, skip_leading_rows=1, delimiter=','):
+    '''
+        Infers a BigQuery schema from the first sample_rows rows of a CSV sample
+
+        USAGE:
+        schema = infer_schema('/tmp/loan_200k.csv', sample_rows=50000)
+
+        Input(s):   sample:             Local CSV path, CSV text, list of lines, or a callable returning one of them
+                    skip_leading_rows:  Header rows; column names come from the first one (else string_field_<i>)
+    '''
+    reader = csv.reader(_sample_lines(sample), delimiter=delimiter)
+    header = None
+    for _ in range(skip_leading_rows):
+        header = next(reader, header)
+
+    rows = []
+    for row in reader:
+        if len(rows) >= sample_rows:
+            break
+        rows.append(row)
+
+    width = max([len(header or [])] + [len(row) for row in rows])
+    names = [_column_name(name, i) for i, name in enumerate(header or [])]
+    names += ['string_field_{}'.format(i) for i in range(len(names), width)]
+    cells = numpy.array([row + [''] * (width - len(row)) for row in rows], dtype=str).reshape(len(rows), width)
+
+    return [bigquery.SchemaField(name, _infer_column_type(cells[:, i]), mode='NULLABLE') for i, name in enumerate(names)]
+
+
+
+
+def _gcs_sample_lines(storage_client, uri, size, sample_bytes):
+    from gcp_bigquery_load import _split_uri
+
+    bucket_name, name = _split_uri(uri)
+    data  = storage_client.bucket(bucket_name).get_blob(name).download_as_bytes(start=0, end=sample_bytes - 1)
+    lines = data.decode('utf-8', errors='ignore').splitlines()
+    return lines[:-1] if size > sample_bytes else lines             # Drop the cut-off last line
+
+
+
+
+def infer_gcs_schema(gcs_path, storage_client=None, sample_files=5, sample_rows=DEFAULT_SAMPLE_ROWS,
+                     sample_bytes=DEFAULT_SAMPLE_BYTES, skip_leading_rows=1, delimiter=','):
+    '''
+        Infers the schema of gs:// CSV files (path, wildcard or list) from the start of up to sample_files of them
+
+        USAGE:
+        schema = infer_gcs_schema('gs://zdatasets1/loans/*.csv', sample_files=10)
+
+        The sampled files are spread evenly over the sorted file list and downloaded concurrently
+        (sample_bytes each); their schemas are merged with type widening, so every shard fits.
+    '''
+    import concurrent.futures
+    from gcp_bigquery_load import expand_gcs_uris
+
+    if storage_client is None:
+        from google.cloud import storage
+        storage_client = storage.Client()
+
+    shards = expand_gcs_uris(gcs_path, storage_client)
+    if not shards:
+        raise KeyError('No files match {}'.format(gcs_path))
+    picks  = sorted(set(numpy.linspace(0, len(shards) - 1, min(sample_files, len(shards))).round().astype(int)))
+
+    def infer(index):
+        uri, size = shards[index]
+        return infer_schema(_gcs_sample_lines(storage_client, uri, size, sample_bytes), sample_rows, skip_leading_rows, delimiter)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(picks)) as executor:
+        return merge_schemas(*executor.map(infer, picks))
+
+
+
+
+####################################################################################################
+#
+#   Registry
+#
+####################################################################################################
+
+
+
+def schema_to_json(schema):
+    return [field.to_api_repr() for field in schema]
+
+
+
+
+def schema_from_json(fields):
+    return [bigquery.SchemaField.from_api_repr(field) for field in fields]
+
+
+
+
+def source_key(paths):
+    '''
+        The registry key of a source: the path / wildcard itself, or the sorted distinct paths of a list joined by ','
+    '''
+    if isinstance(paths, str):
+        return paths
+    return ','.join(sorted(set(paths)))
+
+
+
+
+class SchemaRegistry(object):
+    '''
+        Schemas persisted as JSON (path), keyed by source pattern or name
+
+        USAGE:
+        registry = SchemaRegistry('/data/schemas.json')
+        schema   = registry.resolve('gs://zdatasets1/loans/*.csv', infer=lambda: infer_gcs_schema('gs://zdatasets1/loans/*.csv'))
+        registry.get('gs://zdatasets1/loans/*.csv')         # Same schema, no inference
+
+    '''
+    def __init__(self, path=DEFAULT_REGISTRY_PATH):
+        self.path     = path
+        self._lock    = threading.RLock()
+        self._entries = None
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path) as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_file = self.path + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(self._entries, f, indent=2, sort_keys=True)
+        os.replace(temp_file, self.path)
+
+    def keys(self):
+        with self._lock:
+            return sorted(set(self._load()) | set(BUILTIN_SCHEMAS))
+
+    def get(self, key):
+        '''
+            Returns the schema (list of bigquery.SchemaField) registered for key, or None
+        '''
+        with self._lock:
+            entry = self._load().get(key)
+        if entry is not None:
+            return schema_from_json(entry['fields'])
+        return list(BUILTIN_SCHEMAS[key]) if key in BUILTIN_SCHEMAS else None
+
+    def put(self, key, schema, source=None):
+        with self._lock:
+            self._load()[key] = {'fields':     schema_to_json(schema),
+                                 'source':     source,
+                                 'registered': datetime.datetime.utcnow().isoformat() + 'Z'}
+            self._save()
+
+    def remove(self, key):
+        with self._lock:
+            if self._load().pop(key, None) is not None:
+                self._save()
+
+    def resolve(self, key, infer=None):
+        '''
+            Returns the schema registered for key; on first use calls infer() and registers its result
+
+            USAGE:
+            schema = registry.resolve('/data/loans.csv', infer=lambda: infer_schema('/data/loans.csv'))
+        '''
+        schema = self.get(key)
+        if schema is not None:
+            return schema
+        if infer is None:
+            raise KeyError('No schema registered for {!r} and nothing to infer one from'.format(key))
+        schema = infer()
+        self.put(key, schema, source='inferred')
+        return schema
+
+
+
+
+_registry      = None
+_registry_lock = threading.Lock()
+
+
+
+
+def get_registry():
+    '''
+        Returns the shared SchemaRegistry (DEFAULT_REGISTRY_PATH unless set_registry() was called)
+    '''
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = SchemaRegistry()
+    return _registry
+
+
+
+
+def set_registry(registry):
+    '''
+        Replaces the shared SchemaRegistry (e.g. SchemaRegistry('/data/schemas.json'))
+    '''
+    global _registry
+    with _registry_lock:
+        _registry = registry
+
+
+
+
+def lookup_schema(schema):
+    '''
+        Returns schema itself when it is a list of SchemaField, or the registered schema when it is a key
+    '''
+    if isinstance(schema, str):
+        registered = get_registry().get(schema)
+        if registered is None:
+            raise KeyError('No schema registered for {!r}'.format(schema))
+        return registered
+    return schema
+
+
+
+#ZEND
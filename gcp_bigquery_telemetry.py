@@ -0,0 +1,693 @@
+####################################################################################################
+#
+#   Google BigQuery - Call and Request Telemetry
+#
+#   https://cloud.google.com/bigquery/docs/reference/rest/v2/Job#JobStatistics
+#   https://prometheus.io/docs/instrumenting/exposition_formats/
+#
+####################################################################################################
+
+
+
+'''
+NOTES
+
+    Records a span for every instrumented helper call and every REST request of the pooled clients:
+    what ran, how long it took, whether it failed, and the job statistics BigQuery returned with it.
+
+    Spans:
+        helper      One call of a helper (bq_query, bq_insert_rows, write_rows, load_gcs_shards, ...).
+                    Errors a helper catches and prints are recorded too (status 'error').
+        request     One REST request sent by a client from get_client() ('jobs.insert', 'tables.get',
+                    'tabledata.insertAll', ...), with its HTTP status and request / response bytes.
+                    The Storage Read / Write API streams (gRPC) are covered by their helper spans only.
+
+    Open spans are kept in a contextvars.ContextVar, and worker threads started by the helpers (insert chunks,
+    shard downloads, Storage Write streams, the JobManager poller, ...) run their callables through
+    in_span_context(), so spans and requests in a worker are nested under the span that started the work.
+
+    Job statistics are read from the job resources and query results in the responses and set on the
+    request span and on the helper spans it is nested in (summed over the jobs a helper ran):
+        job_id, total_bytes_processed, total_bytes_billed, slot_millis, cache_hit, rows, dml_affected_rows
+    Helpers add their own figures, e.g. rows_sent / rows_failed of bq_insert_rows or local_cache_hit of bq_query.
+
+    Sinks receive every finished span as a flat dict:
+        JsonLinesSink(path)     One JSON object per line (a path or an open file)
+        HistogramSink()         In-process latency histograms and statistic totals per span, summary()
+        PrometheusSink()        The same, rendered in the Prometheus text format: render(), write_textfile(), serve()
+        any callable            fn(span_dict)
+
+    Telemetry is off until a sink is added: an instrumented helper or request then costs one extra
+    function call and a check of the (empty) sink list.
+
+    USAGE:
+    histograms = add_sink(HistogramSink())
+    add_sink(JsonLinesSink('/tmp/bq_spans.jsonl'))
+    bq_query('select count(*) as count from `zproject201807.demo_dataset1.table_loans`')
+    print(histograms.summary()['bq_query'])
+
+    with span('nightly_load', source='gs://zdatasets1/loans'):     # A span around code of your own
+        ...
+
+'''
+
+
+####################################################################################################
+#
+#   Python Libraries
+#
+####################################################################################################
+
+
+import bisect
+import collections
+import contextvars
+import functools
+import inspect
+import itertools
+import json
+import os
+import re
+import threading
+import time
+
+
+####################################################################################################
+
+
+
+SPAN_ARGUMENTS  = ('dataset_id', 'table_id', 'location', 'mode')     # Helper arguments recorded on its span
+JOB_STATISTICS  = ('total_bytes_processed', 'total_bytes_billed', 'slot_millis', 'rows', 'dml_affected_rows')
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+_sinks    = []                          # Registered sinks (empty: telemetry off)
+_lock     = threading.Lock()
+_stack    = contextvars.ContextVar('bq_spans', default=())     # Spans open in this context, innermost last
+_span_ids = itertools.count(1)
+
+# REST method names by HTTP method + path (after /bigquery/v2)
+_API_METHODS = [(method, re.compile('^/projects/[^/]+' + pattern + '$'), name) for method, pattern, name in [
+    ('GET',    '/datasets',                                   'datasets.list'),
+    ('POST',   '/datasets',                                   'datasets.insert'),
+    ('GET',    '/datasets/[^/]+',                             'datasets.get'),
+    ('PATCH',  '/datasets/[^/]+',                             'datasets.patch'),
+    ('PUT',    '/datasets/[^/]+',                             'datasets.update'),
+    ('DELETE', '/datasets/[^/]+',                             'datasets.delete'),
+    ('GET',    '/datasets/[^/]+/tables',                      'tables.list'),
+    ('POST',   '/datasets/[^/]+/tables',                      'tables.insert'),
+    ('GET',    '/datasets/[^/]+/tables/[^/]+',                'tables.get'),
+    ('PATCH',  '/datasets/[^/]+/tables/[^/]+',                'tables.patch'),
+    ('PUT',    '/datasets/[^/]+/tables/[^/]+',                'tables.update'),
+    ('DELETE', '/datasets/[^/]+/tables/[^/]+',                'tables.delete'),
+    ('POST',   '/datasets/[^/]+/tables/[^/]+/insertAll',      'tabledata.insertAll'),
+    ('GET',    '/datasets/[^/]+/tables/[^/]+/data',           'tabledata.list'),
+    ('GET',    '/jobs',                                       'jobs.list'),
+    ('POST',   '/jobs',                                       'jobs.insert'),
+    ('PUT',    '/jobs',                                       'jobs.insert'),      # Resumable upload chunks
+    ('GET',    '/jobs/[^/]+',                                 'jobs.get'),
+    ('POST',   '/jobs/[^/]+/cancel',                          'jobs.cancel'),
+    ('POST',   '/queries',                                    'jobs.query'),
+    ('GET',    '/queries/[^/]+',                              'jobs.getQueryResults'),
+]]
+_API_PREFIX    = re.compile(r'^(?:https?://[^/]+)?(?:/upload)?/bigquery/v2')
+_JOB_RESPONSES = ('jobs.insert', 'jobs.get', 'jobs.query', 'jobs.getQueryResults')
+
+
+
+
+####################################################################################################
+#
+#   Spans
+#
+####################################################################################################
+
+
+
+
+class Span(object):
+    '''
+        One timed helper call or API request (see span())
+    '''
+    __slots__ = ('name', 'kind', 'span_id', 'parent_id', 'start', 'seconds', 'status', 'error', 'attributes', 'jobs')
+
+    def __init__(self, name, kind, attributes, parent_id):
+        self.name       = name
+        self.kind       = kind
+        self.span_id    = next(_span_ids)
+        self.parent_id  = parent_id
+        self.start      = time.time()
+        self.seconds    = None
+        self.status     = 'ok'
+        self.error      = None
+        self.attributes = attributes
+        self.jobs       = None              # job_id -> statistics of the jobs seen in this span
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def fail(self, error):
+        self.status = 'error'
+        self.error  = '{}: {}'.format(type(error).__name__, error) if isinstance(error, BaseException) else str(error)
+
+    def add_job(self, statistics):
+        '''
+            Merges the statistics of one job (the same job_id seen again replaces what was known of it)
+        '''
+        if self.jobs is None:
+            self.jobs = {}
+        job = self.jobs.setdefault(statistics.get('job_id'), {})
+        job.update((key, value) for key, value in statistics.items() if value is not None)
+
+    def to_dict(self):
+        span = {'name': self.name, 'kind': self.kind, 'span_id': self.span_id, 'parent_id': self.parent_id,
+                'start': self.start, 'seconds': self.seconds, 'status': self.status, 'error': self.error}
+        if self.jobs:
+            jobs = list(self.jobs.values())
+            for statistic in JOB_STATISTICS:
+                values = [job[statistic] for job in jobs if statistic in job]
+                if values:
+                    span[statistic] = sum(values)
+            cache_hits = [job['cache_hit'] for job in jobs if 'cache_hit' in job]
+            if cache_hits:
+                span['cache_hit'] = all(cache_hits)
+            span['jobs'] = len(jobs)
+            if len(jobs) == 1 and jobs[0].get('job_id'):
+                span['job_id'] = jobs[0]['job_id']
+        span.update(self.attributes)
+        return span
+
+
+
+
+class _NoSpan(object):
+    '''
+        Stands in for a Span while telemetry is off
+    '''
+    def set(self, **attributes):
+        pass
+
+    def fail(self, error):
+        pass
+
+    def add_job(self, statistics):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+
+
+class _SpanContext(object):
+    def __init__(self, name, kind, attributes):
+        self.name       = name
+        self.kind       = kind
+        self.attributes = attributes
+        self.span       = None
+        self._token     = None
+        self._started   = None
+
+    def __enter__(self):
+        stack         = _stack.get()
+        self.span     = Span(self.name, self.kind, self.attributes, stack[-1].span_id if stack else None)
+        self._token   = _stack.set(stack + (self.span,))
+        self._started = time.perf_counter()
+        return self.span
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        span         = self.span
+        span.seconds = time.perf_counter() - self._started
+        if exc_value is not None:
+            span.fail(exc_value)
+        _stack.reset(self._token)
+        _emit(span.to_dict())
+        return False
+
+
+
+
+def span(name, kind='helper', **attributes):
+    '''
+        Context manager timing a block as one span (a no-op while no sink is registered)
+
+        USAGE:
+        with span('nightly_load', source='gs://zdatasets1/loans') as current:
+            ...
+            current.set(files=12)
+
+        An exception leaving the block marks the span failed and is re-raised.
+    '''
+    if not _sinks:
+        return _NO_SPAN
+    return _SpanContext(name, kind, attributes)
+
+
+
+
+def current_span():
+    '''
+        The innermost span open in this context (a no-op stand-in when there is none)
+    '''
+    stack = _stack.get()
+    return stack[-1] if stack else _NO_SPAN
+
+
+
+
+def in_span_context(fn):
+    '''
+        Wraps fn to run with the spans open where in_span_context() was called, for work handed to other threads
+
+        USAGE:
+        executor.map(in_span_context(download_shard), blobs)
+        threading.Thread(target=in_span_context(work))
+
+        Each call runs in its own copy of the captured context, so concurrent calls do not see each other's spans.
+    '''
+    context = contextvars.copy_context()
+
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        return context.copy().run(fn, *args, **kwargs)
+    return run
+
+
+
+
+def record_error(error):
+    '''
+        Marks the innermost open span failed, for errors a helper handles itself (prints and returns)
+    '''
+    if _sinks:
+        current_span().fail(error)
+
+
+
+
+def record_stats(**attributes):
+    '''
+        Sets attributes on the innermost open span, e.g. record_stats(rows_sent=1000, rows_failed=2)
+    '''
+    if _sinks:
+        current_span().set(**attributes)
+
+
+
+
+def instrument(fn=None, name=None):
+    '''
+        Decorator recording every call of a helper as a span (named after the function unless name= is given)
+
+        USAGE:
+        @instrument
+        def bq_query(query, location='US'):
+            ...
+
+        The helper's SPAN_ARGUMENTS (dataset_id, table_id, ...) are recorded on the span when given as strings.
+    '''
+    if fn is None:
+        return lambda fn: instrument(fn, name)
+
+    span_name = name or fn.__name__
+    arguments = [(position, parameter) for position, parameter in enumerate(inspect.signature(fn).parameters)
+                 if parameter in SPAN_ARGUMENTS]
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not _sinks:
+            return fn(*args, **kwargs)
+        attributes = {}
+        for position, parameter in arguments:
+            value = args[position] if position < len(args) else kwargs.get(parameter)
+            if isinstance(value, str):
+                attributes[parameter] = value
+        with _SpanContext(span_name, 'helper', attributes):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+
+
+####################################################################################################
+#
+#   API requests
+#
+####################################################################################################
+
+
+
+
+def api_method(method, url):
+    '''
+        The REST method name of a request ('tables.get', 'jobs.insert', ...), or 'METHOD other'
+    '''
+    path = _API_PREFIX.sub('', url.split('?', 1)[0])
+    for route_method, pattern, name in _API_METHODS:
+        if route_method == method and pattern.match(path):
+            return name
+    return '{} other'.format(method)
+
+
+
+
+def _int(value):
+    return int(value) if value is not None else None
+
+
+
+
+def job_statistics(resource):
+    '''
+        The statistics of a job resource / query response as {'job_id', 'total_bytes_processed', ...}
+        ({} while the job is still running)
+    '''
+    if 'jobComplete' in resource:                              # jobs.query / jobs.getQueryResults
+        if not resource['jobComplete']:
+            return {}
+        return {'job_id':                resource.get('jobReference', {}).get('jobId'),
+                'total_bytes_processed': _int(resource.get('totalBytesProcessed')),
+                'cache_hit':             resource.get('cacheHit'),
+                'rows':                  _int(resource.get('totalRows')),
+                'dml_affected_rows':     _int(resource.get('numDmlAffectedRows'))}
+
+    if resource.get('status', {}).get('state') != 'DONE':
+        return {}
+    statistics = resource.get('statistics', {})
+    query      = statistics.get('query', {})
+    load       = statistics.get('load', {})
+    return {'job_id':                resource.get('jobReference', {}).get('jobId'),
+            'total_bytes_processed': _int(query.get('totalBytesProcessed', statistics.get('totalBytesProcessed'))),
+            'total_bytes_billed':    _int(query.get('totalBytesBilled')),
+            'slot_millis':           _int(query.get('totalSlotMs', statistics.get('totalSlotMs'))),
+            'cache_hit':             query.get('cacheHit'),
+            'rows':                  _int(load.get('outputRows')),
+            'dml_affected_rows':     _int(query.get('numDmlAffectedRows'))}
+
+
+
+
+def _record_response(current, name, response):
+    status = getattr(response, 'status_code', None)
+    body   = getattr(response, 'content', None) or b''
+    current.set(status_code=status, response_bytes=len(body))
+    if status is None or (status < 400 and name not in _JOB_RESPONSES):
+        return
+    try:
+        payload = json.loads(body) if body else {}
+    except ValueError:
+        payload = {}
+    if status >= 400:
+        error = payload.get('error', {}) if isinstance(payload, dict) else {}
+        reason = (error.get('errors') or [{}])[0].get('reason')
+        current.fail('{} {}'.format(status, error.get('message') or reason or ''))
+        current.set(reason=reason)
+        return
+    statistics = job_statistics(payload)
+    if statistics:
+        current.add_job(statistics)
+        for parent in _stack.get()[:-1]:
+            if parent.kind == 'helper':
+                parent.add_job(statistics)
+
+
+
+
+def instrument_session(session):
+    '''
+        Records a request span for every request sent through session (the requests.Session of a bigquery.Client)
+
+        get_client() instruments the sessions of the clients it creates. Instrumenting twice does nothing.
+    '''
+    if getattr(session, '_telemetry_instrumented', False):
+        return session
+    send = session.request
+
+    def request(*args, **kwargs):
+        if not _sinks:
+            return send(*args, **kwargs)
+        method = kwargs.get('method', args[0] if args else '')
+        url    = kwargs.get('url', args[1] if len(args) > 1 else '')
+        data   = kwargs.get('data', args[2] if len(args) > 2 else None)
+        name   = api_method(method, url)
+        with _SpanContext(name, 'request', {'http_method': method,
+                                            'request_bytes': len(data) if isinstance(data, (bytes, str)) else None}) as current:
+            response = send(*args, **kwargs)
+            _record_response(current, name, response)
+            return response
+
+    session.request = request
+    session._telemetry_instrumented = True
+    return session
+
+
+
+
+####################################################################################################
+#
+#   Sinks
+#
+####################################################################################################
+
+
+
+
+def add_sink(sink):
+    '''
+        Registers a sink (an object with emit(span_dict), or a callable) and returns it
+    '''
+    global _sinks
+    with _lock:
+        _sinks = _sinks + [sink]
+    return sink
+
+
+
+
+def remove_sink(sink):
+    global _sinks
+    with _lock:
+        _sinks = [registered for registered in _sinks if registered is not sink]
+
+
+
+
+def clear_sinks():
+    global _sinks
+    with _lock:
+        _sinks = []
+
+
+
+
+def enabled():
+    return bool(_sinks)
+
+
+
+
+def _emit(span):
+    for sink in _sinks:
+        try:
+            if hasattr(sink, 'emit'):
+                sink.emit(span)
+            else:
+                sink(span)
+        except Exception as e:
+            print('[ WARN ] Telemetry sink {!r} failed: {}'.format(sink, e))
+
+
+
+
+class JsonLinesSink(object):
+    '''
+        Writes every span as one JSON object per line to path (appended) or to an open text file
+
+        USAGE:
+        add_sink(JsonLinesSink('/tmp/bq_spans.jsonl'))
+    '''
+    def __init__(self, path_or_file, flush=True):
+        self._owned = isinstance(path_or_file, str)
+        self.file   = open(path_or_file, 'a') if self._owned else path_or_file
+        self.flush  = flush
+        self._lock  = threading.Lock()
+
+    def emit(self, span):
+        line = json.dumps(span, default=str) + '\n'
+        with self._lock:
+            self.file.write(line)
+            if self.flush:
+                self.file.flush()
+
+    def close(self):
+        if self._owned:
+            self.file.close()
+
+
+
+
+class HistogramSink(object):
+    '''
+        Latency histograms (per span kind, name and status) and totals of the job statistics (per kind and name)
+
+        USAGE:
+        histograms = add_sink(HistogramSink())
+        ...
+        print(histograms.summary())         # {'bq_query': {'count': 12, 'errors': 0, 'p50': 0.41, ...}, ...}
+    '''
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}                   # (kind, name, status) -> {'counts': per bucket + overflow, 'sum', 'count', 'max'}
+        self._totals = {}                   # (kind, name) -> Counter of statistic totals
+        self._lock   = threading.Lock()
+
+    def emit(self, span):
+        key     = (span['kind'], span['name'], span['status'])
+        seconds = span['seconds'] or 0.0
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0, 'max': 0.0}
+            series['counts'][bisect.bisect_left(self.buckets, seconds)] += 1
+            series['sum']   += seconds
+            series['count'] += 1
+            series['max']    = max(series['max'], seconds)
+
+            totals = self._totals.setdefault((span['kind'], span['name']), collections.Counter())
+            for statistic in JOB_STATISTICS + ('request_bytes', 'response_bytes', 'rows_sent', 'rows_failed'):
+                value = span.get(statistic)
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    totals[statistic] += value
+            if span.get('cache_hit') or span.get('local_cache_hit'):
+                totals['cache_hits'] += 1
+
+    def _quantile(self, counts, count, maximum, q):
+        '''
+            Estimate of the q-quantile from bucket counts (linear within the bucket it falls in)
+        '''
+        rank  = q * count
+        seen  = 0
+        lower = 0.0
+        for i, bucket_count in enumerate(counts):
+            upper = self.buckets[i] if i < len(self.buckets) else maximum
+            if bucket_count and seen + bucket_count >= rank:
+                return min(lower + (upper - lower) * (rank - seen) / bucket_count, maximum)
+            seen += bucket_count
+            lower = upper
+        return maximum
+
+    def summary(self):
+        '''
+            {span name: {'kind', 'count', 'errors', 'mean', 'p50', 'p95', 'p99', 'max', statistic totals...}}
+        '''
+        with self._lock:
+            merged = {}
+            for (kind, name, status), series in self._series.items():
+                entry = merged.setdefault(name, {'kind': kind, 'counts': [0] * (len(self.buckets) + 1),
+                                                 'sum': 0.0, 'count': 0, 'max': 0.0, 'errors': 0})
+                entry['counts'] = [a + b for a, b in zip(entry['counts'], series['counts'])]
+                entry['sum']   += series['sum']
+                entry['count'] += series['count']
+                entry['max']    = max(entry['max'], series['max'])
+                if status != 'ok':
+                    entry['errors'] += series['count']
+
+            summary = {}
+            for name, entry in merged.items():
+                summary[name] = {'kind': entry['kind'], 'count': entry['count'], 'errors': entry['errors'],
+                                 'mean': entry['sum'] / entry['count'], 'max': entry['max']}
+                for label, q in (('p50', 0.50), ('p95', 0.95), ('p99', 0.99)):
+                    summary[name][label] = self._quantile(entry['counts'], entry['count'], entry['max'], q)
+                summary[name].update(self._totals.get((entry['kind'], name), {}))
+            return summary
+
+
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+
+
+class PrometheusSink(HistogramSink):
+    '''
+        HistogramSink exposed in the Prometheus text format
+
+        USAGE:
+        metrics = add_sink(PrometheusSink())
+        metrics.serve(9464)                                         # Scrape http://host:9464/metrics
+        metrics.write_textfile('/var/lib/node_exporter/bigquery.prom')  # Or for the node_exporter textfile collector
+
+        Metrics: bigquery_span_seconds (histogram by kind, name, status) and the counters
+        bigquery_bytes_processed_total, bigquery_bytes_billed_total, bigquery_slot_milliseconds_total,
+        bigquery_rows_total and bigquery_cache_hits_total (by kind, name).
+    '''
+    COUNTERS = [('total_bytes_processed', 'bigquery_bytes_processed_total',   'Bytes processed by the queries of the span'),
+                ('total_bytes_billed',    'bigquery_bytes_billed_total',      'Bytes billed for the queries of the span'),
+                ('slot_millis',           'bigquery_slot_milliseconds_total', 'Slot milliseconds of the jobs of the span'),
+                ('rows',                  'bigquery_rows_total',              'Rows returned, loaded or affected'),
+                ('cache_hits',            'bigquery_cache_hits_total',        'Spans answered from a cache')]
+
+    def render(self):
+        with self._lock:
+            lines = ['# HELP bigquery_span_seconds Wall time of helper calls and API requests',
+                     '# TYPE bigquery_span_seconds histogram']
+            for (kind, name, status), series in sorted(self._series.items()):
+                labels     = 'kind="{}",name="{}",status="{}"'.format(_label(kind), _label(name), _label(status))
+                cumulative = 0
+                for bound, count in zip(self.buckets + (None,), series['counts']):
+                    cumulative += count
+                    lines.append('bigquery_span_seconds_bucket{{{},le="{}"}} {}'.format(labels, '+Inf' if bound is None else bound, cumulative))
+                lines.append('bigquery_span_seconds_sum{{{}}} {!r}'.format(labels, series['sum']))
+                lines.append('bigquery_span_seconds_count{{{}}} {}'.format(labels, series['count']))
+
+            for statistic, metric, help_text in self.COUNTERS:
+                lines += ['# HELP {} {}'.format(metric, help_text), '# TYPE {} counter'.format(metric)]
+                for (kind, name), totals in sorted(self._totals.items()):
+                    if statistic in totals:
+                        lines.append('{}{{kind="{}",name="{}"}} {}'.format(metric, _label(kind), _label(name), totals[statistic]))
+            return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        '''
+            Writes render() to path atomically (written to a temporary file, then renamed)
+        '''
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(temp_path, path)
+
+    def serve(self, port, address=''):
+        '''
+            Serves render() at http://address:port/metrics from a daemon thread; returns the HTTPServer
+        '''
+        import http.server
+
+        sink = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = sink.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((address, port), Handler)
+        threading.Thread(target=server.serve_forever, name='bq-metrics', daemon=True).start()
+        return server
+
+
+
+
+#ZEND
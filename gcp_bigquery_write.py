@@ -0,0 +1,645 @@
+####################################################################################################
+#
+#   Google BigQuery - Storage Write API Ingestion
+#
+#   https://cloud.google.com/bigquery/docs/write-api
+#   https://cloud.google.com/bigquery/docs/write-api-best-practices
+#
+####################################################################################################
+
+
+
+'''
+NOTES
+
+    Rows sent with client.insert_rows() (tabledata.insertAll) travel as JSON, are billed at the legacy
+    streaming rate and are deduplicated by insertId on a best-effort basis only. The Storage Write API
+    takes binary rows (protobuf or Arrow) over long-lived gRPC streams, costs less per byte, and with
+    offsets writes every row exactly once.
+
+    Modes (mode=):
+        'default'       The table's _default stream: rows are visible as soon as they are acknowledged.
+                        No offsets, so a batch re-sent after a broken connection may be written twice
+                        (at-least-once)
+        'committed'     One COMMITTED stream per writer: rows are visible as soon as they are acknowledged,
+                        and every append carries the offset of its first row, so a re-sent batch that
+                        was already written is recognized (ALREADY_EXISTS) and not written again
+        'pending'       One PENDING stream per writer, appended with offsets like 'committed'. Nothing is
+                        visible until every stream is finalized and all of them are committed at once
+                        (BatchCommitWriteStreams): the rows are written exactly once, all or nothing.
+                        If any row fails, nothing is committed
+
+    Rows (tuples in schema order, or dicts, like insert_rows) are serialized from the table schema:
+        data_format='proto'     A protobuf message type is built from the schema (nested RECORDs become nested
+                                messages, REPEATED fields repeated ones) and sent as its DescriptorProto
+        data_format='arrow'     pyarrow.RecordBatch of the schema's Arrow types
+
+    Parallel streams: the rows are cut into batches of at most max_batch_rows rows (and max_batch_bytes once
+    serialized, the API limit is 10 MB per append), dealt round-robin to max_streams writers, each on its
+    own stream / connection. A writer keeps up to max_in_flight appends unacknowledged on its connection.
+
+    Failures (per writer, in offset order):
+        - Rows the server rejects (row_errors) fail on their own; the rest of their batch is re-sent
+        - A broken connection or failed append: the writer reconnects and re-sends that batch and every
+          batch after it from the first unacknowledged offset; ALREADY_EXISTS means an append was written
+          before its acknowledgement was lost, and counts as acknowledged. Up to max_retries per batch
+
+    USAGE:
+    report = write_rows('demo_dataset1', 'table_empty', rows_to_insert, mode='committed', max_streams=4)
+    report = write_rows('demo_dataset1', 'table_empty', rows_to_insert, mode='pending', data_format='arrow')
+    print(report['rows_sent'], report['rows_failed'], report['committed'])
+
+'''
+
+
+####################################################################################################
+#
+#   Python Libraries
+#
+####################################################################################################
+
+
+import collections
+import concurrent.futures
+import datetime
+import decimal
+import json
+import time
+
+from gcp_bigquery_clients import get_client, get_write_client
+from gcp_bigquery_metadata import get_metadata_cache, invalidate_metadata
+from gcp_bigquery_telemetry import in_span_context, instrument, record_stats
+
+
+####################################################################################################
+
+
+
+WRITE_MODES           = ('default', 'committed', 'pending')
+WRITE_DATA_FORMATS    = ('proto', 'arrow')
+WRITE_MAX_STREAMS     = 4                   # Writers (streams / connections) used at once
+WRITE_MAX_BATCH_ROWS  = 10000               # Rows per append
+WRITE_MAX_BATCH_BYTES = 8 * 1024 * 1024     # Serialized bytes per append (the API limit is 10 MB per request)
+WRITE_MAX_IN_FLIGHT   = 4                   # Appends awaiting acknowledgement per stream
+
+_EPOCH      = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_EPOCH_DATE = datetime.date(1970, 1, 1)
+
+
+
+
+def _as_datetime(value):
+    if isinstance(value, datetime.datetime):
+        return value if value.tzinfo else value.replace(tzinfo=datetime.timezone.utc)
+    if isinstance(value, (int, float)):
+        return _EPOCH + datetime.timedelta(seconds=value)           # Epoch seconds, as insert_rows takes them
+    try:
+        return _EPOCH + datetime.timedelta(seconds=float(value))
+    except ValueError:
+        return _as_datetime(datetime.datetime.fromisoformat(value.replace('Z', '+00:00').replace(' UTC', '+00:00')))
+
+
+
+
+def _as_date(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    return value if isinstance(value, datetime.date) else datetime.date.fromisoformat(value)
+
+
+
+
+def _field_value(field, row, position):
+    if isinstance(row, dict):
+        return row.get(field.name)
+    return row[position] if position < len(row) else None
+
+
+
+
+####################################################################################################
+#
+#   Row serialization
+#
+####################################################################################################
+
+
+
+
+_PROTO_TYPES = {'INTEGER': 'TYPE_INT64', 'INT64': 'TYPE_INT64', 'FLOAT': 'TYPE_DOUBLE', 'FLOAT64': 'TYPE_DOUBLE',
+                'BOOLEAN': 'TYPE_BOOL', 'BOOL': 'TYPE_BOOL', 'BYTES': 'TYPE_BYTES', 'TIMESTAMP': 'TYPE_INT64',
+                'DATE': 'TYPE_INT32'}             # Everything else (STRING, NUMERIC, DATETIME, TIME, JSON, ...) is sent as a string
+
+
+
+
+def _descriptor_proto(fields, name):
+    '''
+        Self-contained proto2 DescriptorProto for a list of bigquery.SchemaField (nested RECORDs as nested types)
+    '''
+    from google.protobuf import descriptor_pb2
+
+    proto = descriptor_pb2.DescriptorProto(name=name)
+    for number, field in enumerate(fields, 1):
+        entry = proto.field.add(name=field.name, number=number)
+        entry.label = entry.LABEL_REPEATED if field.mode == 'REPEATED' else entry.LABEL_OPTIONAL     # BigQuery checks REQUIRED itself (row_errors)
+        if field.field_type in ('RECORD', 'STRUCT'):
+            nested = _descriptor_proto(field.fields, '{}_Struct{}'.format(name, number))
+            proto.nested_type.add().CopyFrom(nested)
+            entry.type      = entry.TYPE_MESSAGE
+            entry.type_name = nested.name
+        else:
+            entry.type = getattr(entry, _PROTO_TYPES.get(field.field_type, 'TYPE_STRING'))
+    return proto
+
+
+
+
+def _proto_scalar(field, value):
+    field_type = field.field_type
+    if field_type in ('INTEGER', 'INT64'):
+        return int(value)
+    if field_type in ('FLOAT', 'FLOAT64'):
+        return float(value)
+    if field_type in ('BOOLEAN', 'BOOL'):
+        return value if isinstance(value, bool) else value in ('true', 'True', 1, '1')
+    if field_type == 'BYTES':
+        return value if isinstance(value, bytes) else value.encode('utf-8')
+    if field_type == 'TIMESTAMP':
+        return (_as_datetime(value) - _EPOCH) // datetime.timedelta(microseconds=1)
+    if field_type == 'DATE':
+        return (_as_date(value) - _EPOCH_DATE).days
+    if field_type == 'JSON' and not isinstance(value, str):
+        return json.dumps(value)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(' ')
+    return value if isinstance(value, str) else str(value)
+
+
+
+
+def _fill_message(message, fields, row):
+    for position, field in enumerate(fields):
+        value = _field_value(field, row, position)
+        if value is None:
+            continue
+        nested = field.field_type in ('RECORD', 'STRUCT')
+        if field.mode == 'REPEATED':
+            target = getattr(message, field.name)
+            for item in value:
+                if nested:
+                    _fill_message(target.add(), field.fields, item)
+                else:
+                    target.append(_proto_scalar(field, item))
+        elif nested:
+            _fill_message(getattr(message, field.name), field.fields, value)
+        else:
+            setattr(message, field.name, _proto_scalar(field, value))
+
+
+
+
+class ProtoRowSerializer(object):
+    '''
+        Serializes rows to protobuf messages of a message type built from the table schema
+
+        USAGE:
+        serializer = ProtoRowSerializer(table.schema)
+        payload    = serializer.serialize_row((1, 'CA', 1000.0))
+    '''
+    data_format = 'proto'
+
+    def __init__(self, schema):
+        from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+
+        self.schema     = list(schema)
+        self.descriptor = _descriptor_proto(self.schema, 'Row')
+        pool            = descriptor_pool.DescriptorPool()
+        pool.Add(descriptor_pb2.FileDescriptorProto(name='gcp_bigquery_write_row.proto', syntax='proto2',
+                                                    message_type=[self.descriptor]))
+        self.message_class = message_factory.GetMessageClass(pool.FindMessageTypeByName('Row'))
+
+    def serialize_row(self, row):
+        message = self.message_class()
+        _fill_message(message, self.schema, row)
+        return message.SerializeToString()
+
+    def template(self, stream_name):
+        from google.cloud.bigquery_storage_v1 import types
+
+        request = types.AppendRowsRequest(write_stream=stream_name)
+        types.AppendRowsRequest.pb(request).proto_rows.writer_schema.proto_descriptor.CopyFrom(self.descriptor)
+        return request
+
+    def request(self, rows, positions):
+        '''
+            (AppendRowsRequest, positions sent, {position: error message} of rows that could not be serialized)
+        '''
+        from google.cloud.bigquery_storage_v1 import types
+
+        request = types.AppendRowsRequest()
+        payload = types.AppendRowsRequest.pb(request).proto_rows.rows.serialized_rows
+        sent    = []
+        errors  = {}
+        for position in positions:
+            try:
+                payload.append(self.serialize_row(rows[position]))
+                sent.append(position)
+            except (TypeError, ValueError, AttributeError, IndexError) as e:
+                errors[position] = '{}: {}'.format(type(e).__name__, e)
+        return request, sent, errors
+
+
+
+
+_ARROW_TYPES = {'INTEGER': 'int64', 'INT64': 'int64', 'FLOAT': 'float64', 'FLOAT64': 'float64', 'BOOLEAN': 'bool_',
+                'BOOL': 'bool_', 'STRING': 'string', 'BYTES': 'binary', 'DATE': 'date32', 'JSON': 'string',
+                'GEOGRAPHY': 'string'}
+
+
+
+
+def _arrow_type(field):
+    import pyarrow
+
+    if field.field_type in ('RECORD', 'STRUCT'):
+        arrow_type = pyarrow.struct([_arrow_field(child) for child in field.fields])
+    elif field.field_type == 'TIMESTAMP':
+        arrow_type = pyarrow.timestamp('us', tz='UTC')
+    elif field.field_type == 'DATETIME':
+        arrow_type = pyarrow.timestamp('us')
+    elif field.field_type == 'TIME':
+        arrow_type = pyarrow.time64('us')
+    elif field.field_type in ('NUMERIC', 'DECIMAL'):
+        arrow_type = pyarrow.decimal128(38, 9)
+    elif field.field_type in ('BIGNUMERIC', 'BIGDECIMAL'):
+        arrow_type = pyarrow.decimal256(76, 38)
+    else:
+        arrow_type = getattr(pyarrow, _ARROW_TYPES.get(field.field_type, 'string'))()
+    return pyarrow.list_(arrow_type) if field.mode == 'REPEATED' else arrow_type
+
+
+
+
+def _arrow_field(field):
+    import pyarrow
+    return pyarrow.field(field.name, _arrow_type(field), nullable=field.mode != 'REQUIRED')
+
+
+
+
+def _arrow_scalar(field, value):
+    if value is None:
+        return None
+    if field.field_type in ('RECORD', 'STRUCT'):
+        return dict((child.name, _arrow_value(child, _field_value(child, value, position)))
+                    for position, child in enumerate(field.fields))
+    if field.field_type == 'TIMESTAMP':
+        return _as_datetime(value)
+    if field.field_type == 'DATETIME':
+        return value if isinstance(value, datetime.datetime) else datetime.datetime.fromisoformat(value)
+    if field.field_type == 'DATE':
+        return _as_date(value)
+    if field.field_type == 'TIME' and isinstance(value, str):
+        return datetime.time.fromisoformat(value)
+    if field.field_type in ('NUMERIC', 'DECIMAL', 'BIGNUMERIC', 'BIGDECIMAL'):
+        return decimal.Decimal(str(value))
+    if field.field_type == 'JSON' and not isinstance(value, str):
+        return json.dumps(value)
+    return value
+
+
+
+
+def _arrow_value(field, value):
+    if field.mode == 'REPEATED' and value is not None:
+        return [_arrow_scalar(field, item) for item in value]
+    return _arrow_scalar(field, value)
+
+
+
+
+class ArrowRowSerializer(object):
+    '''
+        Serializes rows to Arrow record batches with the Arrow types of the table schema
+
+        USAGE:
+        serializer = ArrowRowSerializer(table.schema)
+        batch      = serializer.record_batch([(1, 'CA', 1000.0), (2, 'NY', 2000.0)])
+    '''
+    data_format = 'arrow'
+
+    def __init__(self, schema):
+        import pyarrow
+
+        self.schema       = list(schema)
+        self.arrow_schema = pyarrow.schema([_arrow_field(field) for field in self.schema])
+
+    def record_batch(self, rows):
+        import pyarrow
+
+        columns = [pyarrow.array([_arrow_value(field, _field_value(field, row, position)) for row in rows], type=arrow_field.type)
+                   for position, (field, arrow_field) in enumerate(zip(self.schema, self.arrow_schema))]
+        return pyarrow.RecordBatch.from_arrays(columns, schema=self.arrow_schema)
+
+    def template(self, stream_name):
+        from google.cloud.bigquery_storage_v1 import types
+
+        request = types.AppendRowsRequest(write_stream=stream_name)
+        types.AppendRowsRequest.pb(request).arrow_rows.writer_schema.serialized_schema = self.arrow_schema.serialize().to_pybytes()
+        return request
+
+    def request(self, rows, positions):
+        '''
+            (AppendRowsRequest, positions sent, {position: error message} of rows that could not be serialized)
+        '''
+        import pyarrow
+        from google.cloud.bigquery_storage_v1 import types
+
+        sent   = list(positions)
+        errors = {}
+        try:
+            batch = self.record_batch([rows[position] for position in sent])
+        except (TypeError, ValueError, AttributeError, IndexError, pyarrow.ArrowException):
+            for position in positions:                  # Find the rows that do not convert
+                try:
+                    self.record_batch([rows[position]])
+                except (TypeError, ValueError, AttributeError, IndexError, pyarrow.ArrowException) as e:
+                    errors[position] = '{}: {}'.format(type(e).__name__, e)
+            sent  = [position for position in positions if position not in errors]
+            batch = self.record_batch([rows[position] for position in sent])
+
+        request = types.AppendRowsRequest()
+        types.AppendRowsRequest.pb(request).arrow_rows.rows.serialized_record_batch = batch.serialize().to_pybytes()
+        return request, sent, errors
+
+
+
+
+def row_serializer(schema, data_format='proto'):
+    '''
+        ProtoRowSerializer or ArrowRowSerializer for a table schema (list of bigquery.SchemaField)
+    '''
+    if data_format not in WRITE_DATA_FORMATS:
+        raise ValueError('data_format must be one of {}, got {!r}'.format(WRITE_DATA_FORMATS, data_format))
+    return ProtoRowSerializer(schema) if data_format == 'proto' else ArrowRowSerializer(schema)
+
+
+
+
+####################################################################################################
+#
+#   Stream writers
+#
+####################################################################################################
+
+
+
+
+class _FailedAppend(object):
+    '''
+        Stands in for the future of an append that could not be sent
+    '''
+    def __init__(self, error):
+        self.error = error
+
+    def result(self):
+        raise self.error
+
+
+
+
+class _StreamWriter(object):
+    '''
+        Appends batches of rows to one write stream over one connection, max_in_flight at a time,
+        re-sending unacknowledged appends at their offsets after a failure
+    '''
+    def __init__(self, write_client, stream_name, serializer, rows, use_offsets, max_batch_bytes, max_in_flight,
+                 max_retries, retry_delay):
+        self.write_client    = write_client
+        self.stream_name     = stream_name
+        self.serializer      = serializer
+        self.rows            = rows
+        self.use_offsets     = use_offsets
+        self.max_batch_bytes = max_batch_bytes
+        self.max_in_flight   = max(1, max_in_flight)
+        self.max_retries     = max_retries
+        self.retry_delay     = retry_delay
+        self.connection      = None
+        self.written         = 0
+        self.appends         = 0
+        self.retried         = 0
+        self.failed          = {}           # row position -> [{'reason', 'message'}]
+
+    def _send(self, request):
+        from google.cloud.bigquery_storage_v1 import writer
+
+        if self.connection is None:
+            self.connection = writer.AppendRowsStream(self.write_client, self.serializer.template(self.stream_name))
+        try:
+            return self.connection.send(request)
+        except Exception as e:
+            return _FailedAppend(e)
+
+    def _disconnect(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass                        # Already closed by the failure
+            self.connection = None
+
+    def _serialize(self, positions):
+        '''
+            Serialized requests for positions, halving the batch until each request fits max_batch_bytes
+        '''
+        request, sent, errors = self.serializer.request(self.rows, positions)
+        for position, message in errors.items():
+            self.failed[position] = [{'reason': 'invalid', 'message': message}]
+        if len(sent) > 1 and type(request).pb(request).ByteSize() > self.max_batch_bytes:
+            middle = len(sent) // 2
+            return self._serialize(sent[:middle]) + self._serialize(sent[middle:])
+        return [(request, sent)] if sent else []
+
+    def write(self, batches):
+        from google.api_core.exceptions import AlreadyExists
+
+        pending     = collections.deque((batch, 0, None) for batch in batches)   # (row positions, attempts, offset)
+        in_flight   = collections.deque()                                        # (row positions, attempts, offset, future)
+        next_offset = 0
+        try:
+            while pending or in_flight:
+                while pending and len(in_flight) < self.max_in_flight:
+                    positions, attempts, offset = pending.popleft()
+                    start = next_offset if offset is None else offset
+                    for request, sent in self._serialize(positions):
+                        if self.use_offsets:
+                            request.offset = start
+                        in_flight.append((sent, attempts, start, self._send(request)))
+                        self.appends += 1
+                        start        += len(sent)
+                    if offset is None:
+                        next_offset = start
+                if not in_flight:
+                    continue
+
+                sent, attempts, offset, future = in_flight.popleft()
+                try:
+                    future.result()
+                    self.written += len(sent)
+                    continue
+                except AlreadyExists:
+                    self.written += len(sent)       # Written before its acknowledgement was lost
+                    continue
+                except Exception as e:
+                    failures = [(sent, attempts, offset, e, True)]
+
+                # Appends after a failed one are acknowledged only if the failure came after the server stored it
+                for later_sent, later_attempts, later_offset, later_future in in_flight:
+                    try:
+                        later_future.result()
+                        self.written += len(later_sent)
+                    except AlreadyExists:
+                        self.written += len(later_sent)
+                    except Exception as e:
+                        failures.append((later_sent, later_attempts, later_offset, e, False))
+                in_flight.clear()
+
+                # A batch keeps its offset when re-sent (so an append already stored answers ALREADY_EXISTS),
+                # until a batch shrinks or is dropped: it and everything after it is then placed again
+                requeue = []
+                moved   = False
+                backoff = 0
+                for positions, attempts, offset, error, first in failures:
+                    offset     = None if moved else offset
+                    row_errors = list(getattr(getattr(error, 'response', None), 'row_errors', None) or [])
+                    if row_errors:
+                        bad = dict((positions[row_error.index], [{'reason': 'invalid', 'message': row_error.message}])
+                                   for row_error in row_errors)
+                        self.failed.update(bad)
+                        positions = [position for position in positions if position not in bad]
+                        if positions:
+                            requeue.append((positions, attempts, offset))
+                        if not moved:
+                            next_offset = offset + len(positions)
+                            moved       = True
+                    elif not first:
+                        requeue.append((positions, attempts, offset))    # Failed only because an earlier append did
+                    elif attempts < self.max_retries:
+                        self._disconnect()
+                        requeue.append((positions, attempts + 1, offset))
+                        self.retried += 1
+                        backoff       = attempts + 1
+                    else:
+                        self._disconnect()
+                        self.failed.update((position, [{'reason': 'backendError', 'message': '{}: {}'.format(type(error).__name__, error)}])
+                                           for position in positions)
+                        if not moved:
+                            next_offset = offset
+                            moved       = True
+                if moved:
+                    pending = collections.deque((positions, attempts, None) for positions, attempts, _ in pending)
+                pending.extendleft(reversed(requeue))
+                if backoff:
+                    time.sleep(min(self.retry_delay * 2 ** (backoff - 1), 5.0))
+        finally:
+            self._disconnect()
+        return self
+
+
+
+
+def _table_path(project, dataset_id, table_id):
+    return 'projects/{}/datasets/{}/tables/{}'.format(project, dataset_id, table_id)
+
+
+
+
+@instrument
+def write_rows(dataset_id, table_id, rows, mode='default', data_format='proto', max_streams=WRITE_MAX_STREAMS,
+               max_batch_rows=WRITE_MAX_BATCH_ROWS, max_batch_bytes=WRITE_MAX_BATCH_BYTES, max_in_flight=WRITE_MAX_IN_FLIGHT,
+               max_retries=3, retry_delay=0.1, schema=None, project=None, write_client=None):
+    '''
+        Writes rows into dataset_id.table_id through the Storage Write API (see NOTES for the modes)
+
+        USAGE:
+        report = write_rows('demo_dataset1', 'table_empty', [(1, 'CA', 1000.0), (2, 'NY', 2000.0)], mode='committed')
+
+        Input(s):   rows:           Tuples in schema order or dicts (as client.insert_rows takes them)
+                    schema:         List of bigquery.SchemaField (default: the table's, from the metadata cache)
+
+        Output:     {'rows_sent', 'rows_failed', 'requests', 'elapsed', 'errors': [{'index', 'row', 'errors'}, ...],
+                     'mode', 'streams', 'retried_appends', 'committed', 'commit_time'}
+                    rows_sent counts rows written (for 'pending': committed); 'committed' is False when a
+                    'pending' write was not committed (or a commit error is in 'commit_errors')
+    '''
+    from google.cloud.bigquery_storage_v1 import types
+
+    if mode not in WRITE_MODES:
+        raise ValueError('mode must be one of {}, got {!r}'.format(WRITE_MODES, mode))
+
+    start        = time.time()
+    client       = get_client()
+    project      = project or client.project
+    write_client = write_client or get_write_client()
+    if schema is None:
+        schema = get_metadata_cache().get_table(client, client.dataset(dataset_id, project=project).table(table_id)).schema
+    serializer   = row_serializer(schema, data_format)
+    table_path   = _table_path(project, dataset_id, table_id)
+
+    batches = [list(range(first, min(first + max_batch_rows, len(rows)))) for first in range(0, len(rows), max(1, max_batch_rows))]
+    writers = max(1, min(max_streams, len(batches)))
+    if mode == 'default':
+        streams = ['{}/streams/_default'.format(table_path)] * writers
+    else:
+        stream_type = types.WriteStream.Type.COMMITTED if mode == 'committed' else types.WriteStream.Type.PENDING
+        streams     = [write_client.create_write_stream(parent=table_path, write_stream=types.WriteStream(type_=stream_type)).name
+                       for _ in range(writers)]
+
+    stream_writers = [_StreamWriter(write_client, stream, serializer, rows, mode != 'default', max_batch_bytes,
+                                    max_in_flight, max_retries, retry_delay) for stream in streams]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=writers) as executor:
+        futures = [executor.submit(in_span_context(stream_writer.write), batches[i::writers]) for i, stream_writer in enumerate(stream_writers)]
+        for future in futures:
+            future.result()
+
+    failed = {}
+    for stream_writer in stream_writers:
+        failed.update(stream_writer.failed)
+    written = sum(stream_writer.written for stream_writer in stream_writers)
+
+    committed, commit_time, commit_errors = True, None, []
+    if mode != 'default':
+        for stream in streams:
+            write_client.finalize_write_stream(name=stream)
+    if mode == 'pending':
+        committed = not failed
+        if committed:
+            response      = write_client.batch_commit_write_streams(
+                types.BatchCommitWriteStreamsRequest(parent=table_path, write_streams=streams))
+            commit_errors = [{'stream': error.entity, 'message': error.error_message} for error in response.stream_errors]
+            committed     = not commit_errors
+            commit_time   = response.commit_time if committed else None
+        if not committed:
+            written = 0
+    if written:
+        invalidate_metadata(dataset_id, table_id)
+    rows_failed = len(rows) - written if mode == 'pending' and not committed else len(failed)
+    appends     = sum(stream_writer.appends for stream_writer in stream_writers)
+    record_stats(rows_sent=written, rows_failed=rows_failed, appends=appends, streams=len(streams))
+
+    return {'rows_sent':       written,
+            'rows_failed':     rows_failed,
+            'requests':        appends,
+            'elapsed':         time.time() - start,
+            'errors':          [{'index': i, 'row': rows[i], 'errors': failed[i]} for i in sorted(failed)],
+            'mode':            mode,
+            'streams':         len(streams),
+            'retried_appends': sum(stream_writer.retried for stream_writer in stream_writers),
+            'committed':       committed,
+            'commit_time':     commit_time,
+            'commit_errors':   commit_errors}
+
+
+
+#ZEND